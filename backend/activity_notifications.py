@@ -0,0 +1,133 @@
+"""
+Activity notifications for tenant admins.
+Each tenant's admin recipient list is cached in process (invalidated on user
+create, update and delete, and expiring after ADMIN_CACHE_SECONDS so other
+workers' edits are picked up). Repeated activity by the same staff member
+within the coalescing window updates the admin's open notification
+("12 sales by Rahim in the last 5 minutes") instead of adding a new one.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Tuple
+import logging
+import os
+import time
+import uuid
+
+from notification_counters import insert_notifications, update_unread_notifications
+
+logger = logging.getLogger(__name__)
+
+ADMIN_CACHE_SECONDS = 300
+ACTIVITY_COALESCE_SECONDS = int(os.environ.get('ACTIVITY_COALESCE_SECONDS', 300))
+
+ACTIVITY_LABELS = {
+    "pos_sale_created": "sales",
+    "invoice_created": "invoices",
+    "payment_added": "payments",
+    "refund_processed": "refunds",
+    "sale_cancelled_by_staff": "cancellations",
+}
+
+# tenant_id -> (expires at, admin user ids)
+_admin_cache: Dict[str, Tuple[float, List[str]]] = {}
+
+
+def invalidate_tenant_admins(tenant_id: str) -> None:
+    if tenant_id:
+        _admin_cache.pop(tenant_id, None)
+
+
+async def get_tenant_admin_ids(users_db, tenant_id: str) -> List[str]:
+    """Ids of a tenant's tenant_admin users (users live in the global database)."""
+    cached = _admin_cache.get(tenant_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    admins = await users_db.users.find(
+        {"tenant_id": tenant_id, "role": "tenant_admin"},
+        {"_id": 0, "id": 1}
+    ).to_list(100)
+    admin_ids = [admin["id"] for admin in admins]
+    _admin_cache[tenant_id] = (time.monotonic() + ADMIN_CACHE_SECONDS, admin_ids)
+    return admin_ids
+
+
+def _window_label() -> str:
+    minutes = max(ACTIVITY_COALESCE_SECONDS // 60, 1)
+    return f"in the last {minutes} minute{'s' if minutes != 1 else ''}"
+
+
+async def notify_admins_of_activity(
+    notification_db,
+    users_db,
+    tenant_id: str,
+    actor_user: Dict[str, Any],
+    activity_subtype: str,
+    title: str,
+    message: str
+) -> int:
+    """
+    Notify every tenant admin of a staff action.
+
+    Returns:
+        Number of new notifications inserted (coalesced updates are not counted)
+    """
+    admin_ids = await get_tenant_admin_ids(users_db, tenant_id)
+    if not admin_ids:
+        return 0
+
+    now = datetime.now(timezone.utc)
+    actor_name = actor_user.get("full_name", "User")
+    coalesce_key = f"{activity_subtype}:{actor_user.get('id')}"
+
+    pending = list(admin_ids)
+    if ACTIVITY_COALESCE_SECONDS > 0:
+        open_query = {
+            "tenant_id": tenant_id,
+            "type": "activity",
+            "user_id": {"$in": admin_ids},
+            "is_read": False,
+            "metadata.coalesce_key": coalesce_key,
+            "metadata.window_started_at": {"$gte": (now - timedelta(seconds=ACTIVITY_COALESCE_SECONDS)).isoformat()}
+        }
+        label = ACTIVITY_LABELS.get(activity_subtype, "actions")
+        # Updated docs are pushed to the admins like new ones; an admin whose open
+        # notification was read meanwhile gets a new one below
+        coalesced = await update_unread_notifications(notification_db, open_query, [
+            {"$set": {
+                "metadata.count": {"$add": [{"$ifNull": ["$metadata.count", 1]}, 1]},
+                "updated_at": now.isoformat()
+            }},
+            {"$set": {"message": {"$concat": [
+                {"$toString": "$metadata.count"},
+                {"$literal": f" {label} by {actor_name} {_window_label()}"}
+            ]}}}
+        ])
+        coalesced_admins = {doc["user_id"] for doc in coalesced}
+        pending = [admin_id for admin_id in admin_ids if admin_id not in coalesced_admins]
+
+    docs = []
+    for admin_id in pending:
+        docs.append({
+            "id": str(uuid.uuid4()),
+            "tenant_id": tenant_id,
+            "user_id": admin_id,
+            "type": "activity",
+            "sale_id": None,
+            "reference_id": None,
+            "branch_id": None,
+            "title": title,
+            "message": message,
+            "is_read": False,
+            "is_sticky": False,
+            "metadata": {
+                "activity_subtype": activity_subtype,
+                "actor_name": actor_name,
+                "coalesce_key": coalesce_key,
+                "window_started_at": now.isoformat(),
+                "count": 1
+            },
+            "created_at": now.isoformat(),
+            "updated_at": now.isoformat()
+        })
+    return await insert_notifications(notification_db, docs)
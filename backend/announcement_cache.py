@@ -0,0 +1,130 @@
+"""
+In-memory announcement cache.
+Active announcements are cached per process under a global version kept in
+`cache_versions`; creating, delivering or deleting an announcement bumps it.
+Each tenant's receipt state (delivered, read, dismissed) is cached as a compact
+map and updated in place on read and dismiss, so the feed path normally does
+no admin-DB reads. The version is re-checked at most every
+VERSION_CHECK_SECONDS, and tenant maps expire after TENANT_STATE_SECONDS to pick
+up reads made on other workers.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import time
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+VERSION_CHECK_SECONDS = 15
+TENANT_STATE_SECONDS = 60
+MAX_CACHED_TENANTS = 10000
+VERSION_KEY = "announcements"
+
+
+class TenantReceiptState:
+    __slots__ = ("version", "loaded_at", "receipts")
+
+    def __init__(self, version: int, receipts: Dict[str, List[Any]]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # announcement_id -> [delivered_at, is_read, is_dismissed]
+        self.receipts = receipts
+
+
+class AnnouncementCache:
+    def __init__(self, database):
+        self._db = database
+        self._version: Optional[int] = None
+        self._checked_at = 0.0
+        self._announcements: Dict[str, Dict[str, Any]] = {}
+        self._tenants: "OrderedDict[str, TenantReceiptState]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def bump_version(self) -> None:
+        """Invalidate every worker's cache (call after announcements or receipts change)."""
+        doc = await self._db.cache_versions.find_one_and_update(
+            {"_id": VERSION_KEY},
+            {"$inc": {"version": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        await self._load(doc["version"])
+
+    async def _load(self, version: int) -> None:
+        announcements = await self._db.announcements.find({"is_active": True}, {"_id": 0}).to_list(None)
+        self._announcements = {a["announcement_id"]: a for a in announcements}
+        self._version = version
+        self._checked_at = time.monotonic()
+
+    async def _ensure_current(self) -> int:
+        if self._version is not None and time.monotonic() - self._checked_at < VERSION_CHECK_SECONDS:
+            return self._version
+        async with self._lock:
+            if self._version is not None and time.monotonic() - self._checked_at < VERSION_CHECK_SECONDS:
+                return self._version
+            doc = await self._db.cache_versions.find_one({"_id": VERSION_KEY})
+            version = doc["version"] if doc else 0
+            if version != self._version:
+                await self._load(version)
+            else:
+                self._checked_at = time.monotonic()
+            return self._version
+
+    async def _tenant_state(self, tenant_id: str) -> TenantReceiptState:
+        version = await self._ensure_current()
+        state = self._tenants.get(tenant_id)
+        if state is None or state.version != version or time.monotonic() - state.loaded_at > TENANT_STATE_SECONDS:
+            receipts = await self._db.notification_receipts.find(
+                {"tenant_id": tenant_id},
+                {"_id": 0, "announcement_id": 1, "delivered_at": 1, "is_read": 1, "is_dismissed": 1}
+            ).to_list(None)
+            state = TenantReceiptState(version, {
+                r["announcement_id"]: [r.get("delivered_at"), r.get("is_read", False), r.get("is_dismissed", False)]
+                for r in receipts
+            })
+            self._tenants[tenant_id] = state
+        self._tenants.move_to_end(tenant_id)
+        while len(self._tenants) > MAX_CACHED_TENANTS:
+            self._tenants.popitem(last=False)
+        return state
+
+    def _is_live(self, announcement: Optional[Dict[str, Any]], now: datetime) -> bool:
+        if not announcement or not announcement.get("is_active", True):
+            return False
+        expires_at = announcement.get("expires_at")
+        return expires_at is None or expires_at > now
+
+    async def tenant_announcements(self, tenant_id: str) -> List[Tuple[Dict[str, Any], List[Any]]]:
+        """
+        (announcement, [delivered_at, is_read, is_dismissed]) pairs for the tenant's
+        live, non-dismissed announcements, newest delivery first.
+        """
+        state = await self._tenant_state(tenant_id)
+        now = datetime.utcnow()
+        items = []
+        for announcement_id, receipt in state.receipts.items():
+            if receipt[2]:
+                continue
+            announcement = self._announcements.get(announcement_id)
+            if self._is_live(announcement, now):
+                items.append((announcement, receipt))
+        items.sort(key=lambda item: item[1][0] or datetime.min, reverse=True)
+        return items
+
+    async def unread_count(self, tenant_id: str) -> int:
+        return sum(1 for _, receipt in await self.tenant_announcements(tenant_id) if not receipt[1])
+
+    def mark_local(self, tenant_id: str, announcement_id: str, *, read: bool = False, dismissed: bool = False) -> None:
+        """Apply a read or dismiss to the cached tenant map (the receipt was already updated)."""
+        state = self._tenants.get(tenant_id)
+        if state is None or announcement_id not in state.receipts:
+            return
+        if read:
+            state.receipts[announcement_id][1] = True
+        if dismissed:
+            state.receipts[announcement_id][2] = True
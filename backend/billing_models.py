@@ -183,7 +183,7 @@ class UsageSnapshot(BaseModel):
     """
     snapshot_id: str = Field(..., description="Unique snapshot ID")
     tenant_id: str = Field(..., description="Tenant being measured")
-    subscription_id: str = Field(..., description="Associated subscription")
+    subscription_id: Optional[str] = Field(None, description="Associated subscription")
     
     snapshot_date: datetime = Field(..., description="Date of this snapshot")
     
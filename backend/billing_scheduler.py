@@ -1,11 +1,17 @@
 """
 Background scheduler for billing operations
-Runs periodic tasks like subscription expiration checks
+Runs periodic tasks like subscription expiration checks. Every worker runs the
+scheduler, but jobs only execute in the worker holding the scheduler lease.
 """
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from subscription_state_manager import SubscriptionStateManager
-from datetime import datetime, timedelta, timezone
+from notification_counters import reconcile_all_tenant_counters
+from notification_retention import apply_retention_all_tenants
+from notification_service import NotificationService
+from scheduled_notifications import ensure_scheduled_notification_indexes, notify_daily_due_reminders
+from job_coordination import leader_only, run_for_tenants, scheduler_leader
+from usage_metering import reconcile_all_tenant_usage, write_daily_snapshots
 import logging
 
 logger = logging.getLogger(__name__)
@@ -34,76 +40,96 @@ async def send_daily_customer_due_reminders():
     logger.info("🔄 Running daily customer due reminder check...")
     
     try:
-        from db_connection import resolve_tenant_db, get_all_tenants
-        from models import Notification, NotificationType
-        
-        # Get all active tenants
-        tenants = await get_all_tenants()
-        total_notifications = 0
-        
-        for tenant in tenants:
-            try:
-                # Skip suspended tenants
-                if tenant.get('status') == 'suspended':
-                    continue
-                
-                tenant_slug = tenant.get('tenant_slug')
-                if not tenant_slug:
-                    continue
-                
-                # Resolve tenant database
-                target_db = await resolve_tenant_db(tenant_slug)
-                
-                # Get all customer dues
-                customer_dues = await target_db.customer_dues.find(
-                    {"tenant_id": tenant.get('tenant_id'), "due_amount": {"$gt": 0}},
-                    {"_id": 0}
-                ).to_list(1000)
-                
-                # Create notifications for each due
-                twenty_four_hours_ago = datetime.now(timezone.utc) - timedelta(hours=24)
-                
-                for due in customer_dues:
-                    # Check if notification was already sent today
-                    recent_notif = await target_db.notifications.find_one({
-                        "tenant_id": tenant.get('tenant_id'),
-                        "type": NotificationType.UNPAID_INVOICE.value,
-                        "reference_id": due['id'],
-                        "created_at": {"$gte": twenty_four_hours_ago.isoformat()}
-                    })
-                    
-                    if not recent_notif:
-                        # Create daily reminder notification
-                        notification = Notification(
-                            tenant_id=tenant.get('tenant_id'),
-                            type=NotificationType.UNPAID_INVOICE,
-                            reference_id=due['id'],
-                            sale_id=due.get('sale_id'),
-                            message=f"Reminder: {due['customer_name']} has outstanding due of ৳{due['due_amount']:.2f} (Invoice: {due['sale_number']})",
-                            is_sticky=False
-                        )
-                        notif_doc = notification.model_dump()
-                        notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-                        notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-                        await target_db.notifications.insert_one(notif_doc)
-                        total_notifications += 1
-                
-                logger.info(f"✅ Created {len(customer_dues)} due reminders for tenant {tenant_slug}")
+        async def remind_tenant(tenant, target_db):
+            await ensure_scheduled_notification_indexes(target_db)
             
-            except Exception as tenant_error:
-                logger.error(f"❌ Error processing dues for tenant {tenant.get('tenant_slug')}: {str(tenant_error)}")
-                continue
+            # Registry entries may not carry tenant_id; fall back to the ids present in the database
+            tenant_ids = [tenant['tenant_id']] if tenant.get('tenant_id') else await target_db.customer_dues.distinct("tenant_id")
+            
+            created = 0
+            for tenant_id in tenant_ids:
+                result = await notify_daily_due_reminders(target_db, tenant_id, message_prefix="Reminder")
+                created += result["created"]
+                logger.info(f"✅ Created {result['created']} of {result['scanned']} due reminders for tenant {tenant.get('slug')}")
+            return created
+        
+        results, failed = await run_for_tenants("Daily due reminders", remind_tenant)
+        total_notifications = sum(results.values())
         
-        logger.info(f"✅ Daily due reminder check complete: {total_notifications} notifications created")
+        logger.info(f"✅ Daily due reminder check complete: {total_notifications} notifications created, {len(failed)} tenants failed")
     
     except Exception as e:
         logger.error(f"❌ Error in daily customer due reminders: {str(e)}")
 
+async def reconcile_notification_counters_job():
+    """
+    Rebuild unread notification counters from the notifications collection
+    Runs every 6 hours to correct any drift
+    """
+    logger.info("🔄 Reconciling notification counters...")
+    
+    try:
+        reconciled = await reconcile_all_tenant_counters()
+        logger.info(f"✅ Notification counters reconciled for {reconciled} tenants")
+    except Exception as e:
+        logger.error(f"❌ Error reconciling notification counters: {str(e)}")
+
+async def apply_notification_retention_job():
+    """
+    Expire read notifications and archive old sticky/unread ones
+    Runs once daily at 3 AM
+    """
+    logger.info("🔄 Applying notification retention...")
+    
+    try:
+        totals = await apply_retention_all_tenants()
+        logger.info(f"✅ Notification retention applied: {totals}")
+    except Exception as e:
+        logger.error(f"❌ Error applying notification retention: {str(e)}")
+
+async def cleanup_orphaned_receipts_job():
+    """
+    Remove announcement receipts whose announcement is inactive, expired or deleted
+    Runs every hour
+    """
+    try:
+        deleted = await NotificationService.cleanup_orphaned_receipts()
+        logger.info(f"✅ Orphaned receipt cleanup complete: {deleted} removed")
+    except Exception as e:
+        logger.error(f"❌ Error cleaning up orphaned receipts: {str(e)}")
+
+async def write_usage_snapshots_job():
+    """
+    Write daily usage snapshots from the live usage counters
+    Runs once daily at 00:15
+    """
+    logger.info("🔄 Writing daily usage snapshots...")
+    
+    try:
+        seeded = await reconcile_all_tenant_usage(only_missing=True)
+        inserted = await write_daily_snapshots()
+        logger.info(f"✅ Usage snapshots written: {inserted} ({seeded} tenants newly metered)")
+    except Exception as e:
+        logger.error(f"❌ Error writing usage snapshots: {str(e)}")
+
+async def reconcile_usage_counters_job():
+    """
+    Recount every tenant's usage to correct counter drift
+    Runs weekly on Sunday at 2 AM
+    """
+    logger.info("🔄 Reconciling usage counters...")
+    
+    try:
+        reconciled = await reconcile_all_tenant_usage()
+        logger.info(f"✅ Usage counters reconciled for {reconciled} tenants")
+    except Exception as e:
+        logger.error(f"❌ Error reconciling usage counters: {str(e)}")
+
 def start_scheduler():
     """Start the background scheduler"""
     # Schedule subscription checks every hour
     scheduler.add_job(
-        check_subscription_expirations,
+        leader_only(check_subscription_expirations),
         CronTrigger(hour='*'),  # Every hour
         id='subscription_expiration_check',
         name='Check subscription expirations',
@@ -112,17 +138,62 @@ def start_scheduler():
     
     # Schedule daily customer due reminders at 9 AM
     scheduler.add_job(
-        send_daily_customer_due_reminders,
+        leader_only(send_daily_customer_due_reminders),
         CronTrigger(hour=9, minute=0),  # Daily at 9:00 AM
         id='daily_customer_due_reminders',
         name='Send daily customer due reminders',
         replace_existing=True
     )
     
+    # Reconcile unread notification counters every 6 hours
+    scheduler.add_job(
+        leader_only(reconcile_notification_counters_job),
+        CronTrigger(hour='*/6', minute=30),
+        id='notification_counter_reconciliation',
+        name='Reconcile notification counters',
+        replace_existing=True
+    )
+    
+    # Apply notification retention daily at 3 AM
+    scheduler.add_job(
+        leader_only(apply_notification_retention_job),
+        CronTrigger(hour=3, minute=0),
+        id='notification_retention',
+        name='Apply notification retention',
+        replace_existing=True
+    )
+    
+    # Clean up orphaned announcement receipts hourly
+    scheduler.add_job(
+        leader_only(cleanup_orphaned_receipts_job),
+        CronTrigger(minute=45),
+        id='orphaned_receipt_cleanup',
+        name='Clean up orphaned announcement receipts',
+        replace_existing=True
+    )
+    
+    # Write daily usage snapshots shortly after midnight
+    scheduler.add_job(
+        leader_only(write_usage_snapshots_job),
+        CronTrigger(hour=0, minute=15),
+        id='usage_snapshots',
+        name='Write daily usage snapshots',
+        replace_existing=True
+    )
+    
+    # Reconcile usage counters weekly
+    scheduler.add_job(
+        leader_only(reconcile_usage_counters_job),
+        CronTrigger(day_of_week='sun', hour=2, minute=0),
+        id='usage_counter_reconciliation',
+        name='Reconcile usage counters',
+        replace_existing=True
+    )
+    
     # Also check every 15 minutes for faster response (optional)
     # Uncomment for more frequent checks:
     # scheduler.add_job(
-    #     check_subscription_expirations,
+    #     leader_only(check_subscription_expirations),
     #     CronTrigger(minute='*/15'),
     #     id='subscription_expiration_check_frequent',
     #     name='Check subscription expirations (frequent)',
@@ -130,10 +201,12 @@ def start_scheduler():
     # )
     
     scheduler.start()
+    scheduler_leader.start()
     logger.info("✅ Billing scheduler started successfully")
 
 def stop_scheduler():
     """Stop the background scheduler"""
+    scheduler_leader.stop()
     if scheduler.running:
         scheduler.shutdown()
         logger.info("🛑 Billing scheduler stopped")
@@ -0,0 +1,216 @@
+"""
+Per-branch stock counters.
+`branch_stock_counters` holds one document per branch with SKU count, units,
+stock value and low-stock count, incremented on every stock mutation so branch
+stats are a single document read. Each product_branches row carries an
+`is_low_stock` flag kept in sync by the same updates; a partial index on that
+flag makes low-stock listings an indexed range scan. Every increment bumps a
+version, so a rebuild only replaces counters no increment touched meanwhile.
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+import logging
+
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REORDER_LEVEL = 5
+REBUILD_RETRIES = 5
+
+# Mongo partial indexes cannot compare two fields, so the comparison is stored as a flag
+LOW_STOCK_EXPRESSION = {
+    "$lte": [
+        {"$ifNull": ["$stock_quantity", 0]},
+        {"$ifNull": ["$reorder_level", DEFAULT_REORDER_LEVEL]}
+    ]
+}
+
+
+async def ensure_branch_counter_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "branch_counters"):
+        return
+    try:
+        await target_db.product_branches.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("stock_quantity", ASCENDING)],
+            partialFilterExpression={"is_low_stock": True},
+            name="tenant_branch_low_stock"
+        )
+        await target_db.branch_stock_counters.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING)],
+            unique=True,
+            name="tenant_branch"
+        )
+        mark_indexes_ensured(target_db, "branch_counters")
+    except Exception as e:
+        logger.warning(f"Failed to ensure branch counter indexes on {target_db.name}: {e}")
+
+
+def is_low_stock(stock_quantity: Optional[float], reorder_level: Optional[float]) -> bool:
+    reorder = reorder_level if reorder_level is not None else DEFAULT_REORDER_LEVEL
+    return (stock_quantity or 0) <= reorder
+
+
+async def inc_branch_counters(
+    target_db,
+    tenant_id: str,
+    branch_id: Optional[str],
+    *,
+    skus: int = 0,
+    units: float = 0,
+    value: float = 0,
+    low_stock: int = 0
+) -> None:
+    if not branch_id or not (skus or units or value or low_stock):
+        return
+    await target_db.branch_stock_counters.update_one(
+        {"tenant_id": tenant_id, "branch_id": branch_id},
+        {
+            "$inc": {"sku_count": skus, "units": units, "value": value, "low_stock_count": low_stock, "version": 1},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        },
+        upsert=True
+    )
+
+
+async def apply_branch_stock_delta(
+    target_db,
+    tenant_id: str,
+    product_id: str,
+    branch_id: str,
+    delta: float
+) -> Optional[Dict[str, Any]]:
+    """
+    Increment a product's branch stock, refresh its low-stock flag and update the branch counters.
+
+    Returns:
+        The product_branches document after the update, or None if the product is not assigned
+    """
+    await ensure_branch_counter_indexes(target_db)
+    before = await target_db.product_branches.find_one_and_update(
+        {"product_id": product_id, "branch_id": branch_id, "tenant_id": tenant_id},
+        [
+            {"$set": {
+                "stock_quantity": {"$add": [{"$ifNull": ["$stock_quantity", 0]}, delta]},
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }},
+            {"$set": {"is_low_stock": LOW_STOCK_EXPRESSION}}
+        ],
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return None
+
+    before_quantity = before.get("stock_quantity") or 0
+    was_low = before.get("is_low_stock", is_low_stock(before_quantity, before.get("reorder_level")))
+    after = {**before, "stock_quantity": before_quantity + delta}
+    after["is_low_stock"] = is_low_stock(after["stock_quantity"], before.get("reorder_level"))
+
+    await inc_branch_counters(
+        target_db, tenant_id, branch_id,
+        units=delta,
+        low_stock=int(after["is_low_stock"]) - int(bool(was_low))
+    )
+    return after
+
+
+async def refresh_low_stock_flag(target_db, tenant_id: str, product_id: str, branch_id: str) -> None:
+    """Recompute one assignment's low-stock flag (after a stock or reorder level edit)."""
+    await ensure_branch_counter_indexes(target_db)
+    before = await target_db.product_branches.find_one_and_update(
+        {"product_id": product_id, "branch_id": branch_id, "tenant_id": tenant_id},
+        [{"$set": {"is_low_stock": LOW_STOCK_EXPRESSION}}],
+        projection={"_id": 0, "stock_quantity": 1, "reorder_level": 1, "is_low_stock": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return
+    now_low = is_low_stock(before.get("stock_quantity"), before.get("reorder_level"))
+    was_low = before.get("is_low_stock", now_low)
+    await inc_branch_counters(target_db, tenant_id, branch_id, low_stock=int(now_low) - int(bool(was_low)))
+
+
+async def _count_branch_stock(target_db, tenant_id: str, branch_id: str) -> Dict[str, Any]:
+    stock_rows = await target_db.product_branches.aggregate([
+        {"$match": {"tenant_id": tenant_id, "branch_id": branch_id}},
+        {"$group": {
+            "_id": None,
+            "sku_count": {"$sum": 1},
+            "units": {"$sum": {"$ifNull": ["$stock_quantity", 0]}},
+            "low_stock_count": {"$sum": {"$cond": ["$is_low_stock", 1, 0]}}
+        }}
+    ]).to_list(1)
+    value_rows = await target_db.stock_valuation_totals.aggregate([
+        {"$match": {"tenant_id": tenant_id, "branch_id": branch_id}},
+        {"$group": {"_id": None, "value": {"$sum": "$avg_value"}}}
+    ]).to_list(1)
+
+    stock = stock_rows[0] if stock_rows else {}
+    return {
+        "tenant_id": tenant_id,
+        "branch_id": branch_id,
+        "sku_count": stock.get("sku_count", 0),
+        "units": stock.get("units", 0),
+        "low_stock_count": stock.get("low_stock_count", 0),
+        "value": value_rows[0]["value"] if value_rows else 0,
+        "initialized": True,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def rebuild_branch_counters(target_db, tenant_id: str, branch_id: str) -> Dict[str, Any]:
+    """
+    Recompute a branch's counters and low-stock flags from product_branches and valuation totals.
+
+    Assignments without a valuation position are seeded first, so the value covers
+    every assignment and their first movement does not add it again. The counters
+    are replaced with a compare-and-set on their version; an increment landing
+    during the recount makes the rebuild retry instead of being overwritten.
+    """
+    from inventory_valuation import seed_branch_positions
+
+    await ensure_branch_counter_indexes(target_db)
+    await target_db.product_branches.update_many(
+        {"tenant_id": tenant_id, "branch_id": branch_id},
+        [{"$set": {"is_low_stock": LOW_STOCK_EXPRESSION}}]
+    )
+    await seed_branch_positions(target_db, tenant_id, branch_id)
+
+    key = {"tenant_id": tenant_id, "branch_id": branch_id}
+    for _ in range(REBUILD_RETRIES):
+        current = await target_db.branch_stock_counters.find_one(key, {"_id": 0, "version": 1})
+        version = (current or {}).get("version")
+        counters = await _count_branch_stock(target_db, tenant_id, branch_id)
+        # $exists rather than None, so an upsert does not copy a null version into the new document
+        version_filter = {"version": version} if version is not None else {"version": {"$exists": False}}
+        try:
+            result = await target_db.branch_stock_counters.update_one(
+                {**key, **version_filter},
+                {"$set": counters, "$inc": {"version": 1}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # The counters document changed (or was created) since it was read
+            continue
+        if result.matched_count or result.upserted_id is not None:
+            return counters
+
+    logger.warning(f"Branch counter rebuild for {branch_id} kept racing with stock updates; writing last recount")
+    await target_db.branch_stock_counters.update_one(key, {"$set": counters, "$inc": {"version": 1}}, upsert=True)
+    return counters
+
+
+async def get_branch_counters(target_db, tenant_id: str, branch_id: str) -> Dict[str, Any]:
+    """Counters for a branch, built on first use."""
+    counters = await target_db.branch_stock_counters.find_one(
+        {"tenant_id": tenant_id, "branch_id": branch_id},
+        {"_id": 0}
+    )
+    if not counters or not counters.get("initialized"):
+        counters = await rebuild_branch_counters(target_db, tenant_id, branch_id)
+    return counters
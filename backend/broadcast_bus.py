@@ -0,0 +1,144 @@
+"""
+Broadcast bus for WebSocket fan-out across workers.
+A message published on one worker is delivered to its own sockets directly
+and relayed to every other worker, which delivers it to its local sockets.
+The MongoDB implementation relays through a capped collection tailed by each
+worker; the in-process implementation delivers locally only (single worker,
+tests). Select with BROADCAST_BUS=mongo|memory.
+"""
+
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+from uuid import uuid4
+import asyncio
+import logging
+import os
+import socket
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_BUS = os.environ.get('BROADCAST_BUS', 'mongo')
+BROADCAST_COLLECTION = "ws_broadcasts"
+BROADCAST_COLLECTION_BYTES = int(os.environ.get('BROADCAST_COLLECTION_BYTES', 16 * 1024 * 1024))
+# Workers' clocks and ObjectIds are not strictly ordered, so tailing starts slightly in the past
+TAIL_OVERLAP = timedelta(seconds=5)
+TAIL_RETRY_SECONDS = 1.0
+SEEN_IDS = 2048
+
+DeliverFn = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class BroadcastBus:
+    """Publishes envelopes ({"tenant_id", "user_id", "admins_only", "message"}) to every worker."""
+
+    def __init__(self):
+        self._deliver: Optional[DeliverFn] = None
+
+    async def start(self, deliver: DeliverFn):
+        self._deliver = deliver
+
+    async def stop(self):
+        self._deliver = None
+
+    async def publish(self, envelope: Dict[str, Any]):
+        await self._deliver_local(envelope)
+
+    async def _deliver_local(self, envelope: Dict[str, Any]):
+        if self._deliver is None:
+            return
+        try:
+            await self._deliver(envelope)
+        except Exception as e:
+            logger.warning(f"Broadcast delivery failed: {e}")
+
+
+class InProcessBroadcastBus(BroadcastBus):
+    """Local delivery only; for a single worker and tests."""
+
+
+class MongoBroadcastBus(BroadcastBus):
+    """Relays envelopes between workers through a tailed capped collection."""
+
+    def __init__(self, database_factory: Callable[[], Any]):
+        super().__init__()
+        self._database_factory = database_factory
+        self._collection = None
+        self._origin = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._task: Optional[asyncio.Task] = None
+        self._seen: Set[Any] = set()
+        self._seen_order: Deque[Any] = deque()
+
+    async def start(self, deliver: DeliverFn):
+        await super().start(deliver)
+        if self._task:
+            return
+        database = self._database_factory()
+        try:
+            await database.create_collection(BROADCAST_COLLECTION, capped=True, size=BROADCAST_COLLECTION_BYTES)
+        except CollectionInvalid:
+            pass
+        self._collection = database[BROADCAST_COLLECTION]
+        self._task = asyncio.create_task(self._tail())
+        logger.info(f"Broadcast bus started (worker {self._origin})")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await super().stop()
+
+    async def publish(self, envelope: Dict[str, Any]):
+        await self._deliver_local(envelope)
+        if self._collection is None:
+            return
+        try:
+            await self._collection.insert_one({
+                "origin": self._origin,
+                "envelope": envelope,
+                "published_at": datetime.now(timezone.utc)
+            })
+        except Exception as e:
+            logger.warning(f"Failed to relay broadcast to other workers: {e}")
+
+    def _mark_seen(self, doc_id) -> bool:
+        """Record a relayed document; False if it was already delivered (tail restarts overlap)."""
+        if doc_id in self._seen:
+            return False
+        self._seen.add(doc_id)
+        self._seen_order.append(doc_id)
+        if len(self._seen_order) > SEEN_IDS:
+            self._seen.discard(self._seen_order.popleft())
+        return True
+
+    async def _tail(self):
+        since = datetime.now(timezone.utc)
+        while True:
+            try:
+                cursor = self._collection.find(
+                    {"published_at": {"$gte": since - TAIL_OVERLAP}},
+                    cursor_type=CursorType.TAILABLE_AWAIT
+                )
+                while cursor.alive:
+                    async for doc in cursor:
+                        since = max(since, doc["published_at"].replace(tzinfo=timezone.utc))
+                        if doc.get("origin") == self._origin or not self._mark_seen(doc["_id"]):
+                            continue
+                        await self._deliver_local(doc["envelope"])
+                # The cursor dies when the collection is empty or it falls behind the capped window
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Broadcast tail interrupted, retrying: {e}")
+            await asyncio.sleep(TAIL_RETRY_SECONDS)
+
+
+def create_broadcast_bus() -> BroadcastBus:
+    if BROADCAST_BUS == "memory":
+        return InProcessBroadcastBus()
+    from db_connection import get_admin_db
+    return MongoBroadcastBus(get_admin_db)
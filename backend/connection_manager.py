@@ -0,0 +1,212 @@
+"""
+WebSocket connection manager.
+Connections are indexed by user and by (tenant, role), so a broadcast touches
+only its recipients. Each connection has a bounded send queue drained by its
+own task: a slow client only delays itself, and messages are JSON-encoded once
+per broadcast rather than once per socket. Notification envelopes are routed to
+the same audience the feed shows them to; counter envelopes are summed per
+recipient's visible scopes.
+"""
+
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+import asyncio
+import json
+import logging
+
+from fastapi import WebSocket
+
+from notification_counters import sum_counter_docs, visible_scopes
+
+logger = logging.getLogger(__name__)
+
+ADMIN_ROLES = ("tenant_admin", "super_admin")
+SEND_QUEUE_SIZE = 100
+SEND_TIMEOUT_SECONDS = 10
+
+
+class Connection:
+    """One socket with its own bounded send queue."""
+
+    def __init__(self, websocket: WebSocket, tenant_id: str, user_id: str, role: str, branch_id: Optional[str], on_close):
+        self.websocket = websocket
+        self.tenant_id = tenant_id
+        self.user_id = user_id
+        self.role = role
+        self.branch_id = branch_id
+        self.dropped = 0
+        # Entries are (coalesce key or None, encoded text)
+        self._queue: Deque[Tuple[Optional[str], str]] = deque()
+        self._ready = asyncio.Event()
+        self._on_close = on_close
+        self._task = asyncio.create_task(self._drain())
+
+    def send(self, text: str, coalesce_key: Optional[str] = None):
+        """
+        Queue an encoded message without waiting.
+        A message with a coalesce key replaces a queued one with the same key
+        (only the latest state matters); when the queue is full the oldest
+        message is dropped.
+        """
+        if coalesce_key is not None:
+            for index, (key, _) in enumerate(self._queue):
+                if key == coalesce_key:
+                    self._queue[index] = (coalesce_key, text)
+                    return
+        if len(self._queue) >= SEND_QUEUE_SIZE:
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append((coalesce_key, text))
+        self._ready.set()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._queue:
+                    _, text = self._queue.popleft()
+                    await asyncio.wait_for(self.websocket.send_text(text), SEND_TIMEOUT_SECONDS)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.info(f"WebSocket send failed for {self.tenant_id}:{self.user_id}, closing: {e}")
+            self._on_close(self)
+            try:
+                await self.websocket.close(code=4000)
+            except Exception:
+                pass
+
+    def close(self):
+        self._task.cancel()
+
+
+class ConnectionManager:
+    def __init__(self):
+        self._by_user: Dict[Tuple[str, str], Set[Connection]] = {}
+        self._by_tenant_role: Dict[str, Dict[str, Set[Connection]]] = {}
+        self._by_branch: Dict[Tuple[str, str], Set[Connection]] = {}
+        self._by_socket: Dict[int, Connection] = {}
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        tenant_id: str,
+        user_id: str,
+        role: str = "",
+        branch_id: Optional[str] = None
+    ) -> Connection:
+        await websocket.accept()
+        connection = Connection(websocket, tenant_id, user_id, role, branch_id, self._remove)
+        self._by_user.setdefault((tenant_id, user_id), set()).add(connection)
+        self._by_tenant_role.setdefault(tenant_id, {}).setdefault(role, set()).add(connection)
+        if branch_id:
+            self._by_branch.setdefault((tenant_id, branch_id), set()).add(connection)
+        self._by_socket[id(websocket)] = connection
+        logging.info(f"WebSocket connected: {tenant_id}:{user_id} (role: {role}), total connections: {len(self._by_user[(tenant_id, user_id)])}")
+        return connection
+
+    def disconnect(self, websocket: WebSocket, tenant_id: str, user_id: str):
+        connection = self._by_socket.get(id(websocket))
+        if connection is not None:
+            self._remove(connection)
+            connection.close()
+        logging.info(f"WebSocket disconnected: {tenant_id}:{user_id}")
+
+    def _remove(self, connection: Connection):
+        self._by_socket.pop(id(connection.websocket), None)
+        user_key = (connection.tenant_id, connection.user_id)
+        user_connections = self._by_user.get(user_key)
+        if user_connections is not None:
+            user_connections.discard(connection)
+            if not user_connections:
+                del self._by_user[user_key]
+        if connection.branch_id:
+            branch_key = (connection.tenant_id, connection.branch_id)
+            branch_connections = self._by_branch.get(branch_key)
+            if branch_connections is not None:
+                branch_connections.discard(connection)
+                if not branch_connections:
+                    del self._by_branch[branch_key]
+        roles = self._by_tenant_role.get(connection.tenant_id)
+        if roles is not None:
+            role_connections = roles.get(connection.role)
+            if role_connections is not None:
+                role_connections.discard(connection)
+                if not role_connections:
+                    del roles[connection.role]
+            if not roles:
+                del self._by_tenant_role[connection.tenant_id]
+
+    @staticmethod
+    def encode(message: Dict[str, Any]) -> str:
+        return json.dumps(message, default=str)
+
+    @staticmethod
+    def _fan_out(connections: Iterable[Connection], text: str, coalesce_key: Optional[str]) -> int:
+        sent = 0
+        for connection in list(connections):
+            connection.send(text, coalesce_key)
+            sent += 1
+        return sent
+
+    async def send_to_user(self, tenant_id: str, user_id: str, message: dict, coalesce_key: Optional[str] = None) -> int:
+        connections = self._by_user.get((tenant_id, user_id))
+        if not connections:
+            return 0
+        return self._fan_out(connections, self.encode(message), coalesce_key)
+
+    async def send_to_tenant_admins(self, tenant_id: str, message: dict, coalesce_key: Optional[str] = None) -> int:
+        roles = self._by_tenant_role.get(tenant_id)
+        if not roles:
+            return 0
+        text = self.encode(message)
+        return sum(
+            self._fan_out(roles.get(role, ()), text, coalesce_key)
+            for role in ADMIN_ROLES
+        )
+
+    def _audience_connections(self, tenant_id: str, audience: Dict[str, Any]) -> Set[Connection]:
+        """Connections allowed to see a notification for this audience (admins see everything)."""
+        roles = self._by_tenant_role.get(tenant_id, {})
+        recipients: Set[Connection] = set()
+        for role in ADMIN_ROLES:
+            recipients.update(roles.get(role, ()))
+        if audience.get("user_id"):
+            recipients.update(self._by_user.get((tenant_id, audience["user_id"]), ()))
+        elif audience.get("branch_id"):
+            recipients.update(self._by_branch.get((tenant_id, audience["branch_id"]), ()))
+        else:
+            for connections in roles.values():
+                recipients.update(connections)
+        return recipients
+
+    def _send_counters(self, recipients: Iterable[Connection], scopes: Dict[str, Dict[str, Any]]):
+        """Send each recipient the sum of its visible counter scopes, encoding once per distinct scope set."""
+        groups: Dict[Tuple[str, ...], List[Connection]] = {}
+        for connection in recipients:
+            key = tuple(visible_scopes({"id": connection.user_id, "role": connection.role, "branch_id": connection.branch_id}))
+            groups.setdefault(key, []).append(connection)
+        for scope_key, connections in groups.items():
+            totals = sum_counter_docs(scopes.values(), list(scope_key))
+            text = self.encode({"type": "notification_counters", "data": totals})
+            self._fan_out(connections, text, "notification_counters")
+
+    async def deliver(self, envelope: dict):
+        """Deliver a broadcast bus envelope to this worker's sockets"""
+        kind = envelope.get("kind")
+        if kind == "notification":
+            recipients = self._audience_connections(envelope["tenant_id"], envelope["audience"])
+            self._fan_out(recipients, self.encode(envelope["message"]), None)
+            return
+        if kind == "counters":
+            recipients: Set[Connection] = set()
+            for audience in envelope["audiences"]:
+                recipients.update(self._audience_connections(envelope["tenant_id"], audience))
+            self._send_counters(recipients, envelope["scopes"])
+            return
+        coalesce_key = envelope.get("coalesce_key")
+        if envelope.get("user_id"):
+            await self.send_to_user(envelope["tenant_id"], envelope["user_id"], envelope["message"], coalesce_key)
+        else:
+            await self.send_to_tenant_admins(envelope["tenant_id"], envelope["message"], coalesce_key)
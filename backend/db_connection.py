@@ -133,6 +133,49 @@ async def resolve_tenant_db(tenant_slug: str):
     return get_tenant_db(db_uri, db_name)
 
 
+def tenant_db_for(tenant: Dict):
+    """
+    Database handle for a registry document already in hand (e.g. from
+    iter_active_tenants), without another registry lookup.
+    
+    Raises:
+        ValueError: If the tenant has no database configured
+    """
+    db_uri = tenant.get('db_uri')
+    if not db_uri:
+        raise ValueError(f"Tenant '{tenant.get('slug')}' has no database configured")
+    return get_tenant_db(db_uri, tenant.get('db_name'))
+
+
+# (client address, database name, index group) whose indexes were ensured in this process
+_ensured_indexes: set = set()
+# id(client) -> seed addresses, captured once so later topology discovery doesn't change the key
+_client_addresses: Dict[int, tuple] = {}
+
+
+def _database_key(target_db) -> tuple:
+    client = target_db.client
+    address = _client_addresses.get(id(client))
+    if address is None:
+        delegate = getattr(client, "delegate", client)
+        address = tuple(sorted(delegate.topology_description.server_descriptions().keys()))
+        _client_addresses[id(client)] = address
+    return (address, target_db.name)
+
+
+def indexes_ensured(target_db, group: str) -> bool:
+    """
+    Whether a module's lazily created indexes (its `group`) already exist on this
+    database. Keyed on the client's address as well as the database name, so
+    tenants on different clusters with the same database name are kept apart.
+    """
+    return (*_database_key(target_db), group) in _ensured_indexes
+
+
+def mark_indexes_ensured(target_db, group: str) -> None:
+    _ensured_indexes.add((*_database_key(target_db), group))
+
+
 # In-memory tenant cache to reduce registry lookups
 _tenant_cache: Dict[str, Dict] = {}
 
@@ -185,3 +228,17 @@ async def get_all_tenants():
         {"_id": 0}
     ).to_list(1000)
     return tenants
+
+
+async def iter_active_tenants(batch_size: int = 1000):
+    """
+    Stream every active tenant from the registry.
+    Unlike get_all_tenants this is not capped, so fleet-wide jobs see every tenant.
+    
+    Yields:
+        Tenant documents
+    """
+    admin_db = get_admin_db()
+    cursor = admin_db.tenants_registry.find({"status": "active"}, {"_id": 0}).batch_size(batch_size)
+    async for tenant in cursor:
+        yield tenant
@@ -0,0 +1,315 @@
+"""
+Customer dues aging and statements.
+Aging buckets are computed in a single aggregation over open dues, grouped by
+customer or branch with totals and paging. Statements stream a customer's
+invoices and payments from one chronologically sorted cursor.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+import logging
+
+from pymongo import ASCENDING, UpdateOne
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+
+logger = logging.getLogger(__name__)
+
+# (bucket key, min age in days, max age in days)
+AGING_BUCKETS = [
+    ("0_30", 0, 30),
+    ("31_60", 31, 60),
+    ("61_90", 61, 90),
+    ("90_plus", 91, None),
+]
+
+AGING_GROUP_FIELDS = {
+    "customer": {"$ifNull": ["$customer_id", "$customer_name"]},
+    "branch": {"$ifNull": ["$branch_id", "unassigned"]},
+}
+
+BACKFILL_BATCH_SIZE = 1000
+
+_backfilled_tenants: set = set()
+
+
+async def ensure_dues_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "dues"):
+        return
+    try:
+        await target_db.customer_dues.create_index(
+            [("tenant_id", ASCENDING), ("due_amount", ASCENDING), ("transaction_date", ASCENDING)],
+            name="tenant_due_amount_transaction_date"
+        )
+        await target_db.customer_dues.create_index(
+            [("tenant_id", ASCENDING), ("sale_id", ASCENDING)],
+            name="tenant_sale_id"
+        )
+        await target_db.sales.create_index(
+            [("tenant_id", ASCENDING), ("customer_id", ASCENDING), ("created_at", ASCENDING)],
+            name="tenant_customer_created_at"
+        )
+        await target_db.payments.create_index(
+            [("tenant_id", ASCENDING), ("sale_id", ASCENDING)],
+            name="tenant_sale_id"
+        )
+        mark_indexes_ensured(target_db, "dues")
+    except Exception as e:
+        logger.warning(f"Failed to ensure dues indexes on {target_db.name}: {e}")
+
+
+async def backfill_due_references(target_db, tenant_id: str) -> int:
+    """
+    Copy branch_id and customer_id from the sale onto dues created before those
+    fields were stored, so aging can group without a per-document $lookup.
+    Runs once per tenant database per process.
+    """
+    key = (target_db.name, tenant_id)
+    if key in _backfilled_tenants:
+        return 0
+
+    updated = 0
+    cursor = target_db.customer_dues.find(
+        {"tenant_id": tenant_id, "branch_id": {"$exists": False}},
+        {"_id": 0, "id": 1, "sale_id": 1}
+    ).batch_size(BACKFILL_BATCH_SIZE)
+
+    batch: List[Dict[str, Any]] = []
+
+    async def _flush():
+        nonlocal updated
+        sales = await target_db.sales.find(
+            {"tenant_id": tenant_id, "id": {"$in": [d["sale_id"] for d in batch]}},
+            {"_id": 0, "id": 1, "branch_id": 1, "customer_id": 1}
+        ).to_list(len(batch))
+        sale_map = {s["id"]: s for s in sales}
+        operations = []
+        for due in batch:
+            sale = sale_map.get(due["sale_id"], {})
+            operations.append(UpdateOne(
+                {"id": due["id"], "tenant_id": tenant_id},
+                {"$set": {"branch_id": sale.get("branch_id"), "customer_id": sale.get("customer_id")}}
+            ))
+        if operations:
+            result = await target_db.customer_dues.bulk_write(operations, ordered=False)
+            updated += result.modified_count
+
+    async for due in cursor:
+        batch.append(due)
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            await _flush()
+            batch = []
+    if batch:
+        await _flush()
+
+    _backfilled_tenants.add(key)
+    if updated:
+        logger.info(f"Backfilled branch/customer on {updated} customer dues for tenant {tenant_id}")
+    return updated
+
+
+def _transaction_date_expression() -> Dict[str, Any]:
+    """transaction_date as an ISO string (seeded data may store BSON dates)."""
+    return {
+        "$cond": [
+            {"$eq": [{"$type": "$transaction_date"}, "date"]},
+            {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%S", "date": "$transaction_date"}},
+            {"$ifNull": ["$transaction_date", "$created_at"]}
+        ]
+    }
+
+
+def _bucket_expression(as_of: datetime) -> Dict[str, Any]:
+    """$switch mapping a due's transaction date to its aging bucket, by ISO string cutoffs."""
+    branches = []
+    for key, _, max_days in AGING_BUCKETS:
+        if max_days is None:
+            continue
+        cutoff = (as_of - timedelta(days=max_days + 1)).isoformat()
+        branches.append({"case": {"$gt": ["$txn_date", cutoff]}, "then": key})
+    return {"$switch": {"branches": branches, "default": AGING_BUCKETS[-1][0]}}
+
+
+async def get_dues_aging(
+    target_db,
+    tenant_id: str,
+    group_by: str = "customer",
+    branch_id: Optional[str] = None,
+    as_of: Optional[datetime] = None,
+    skip: int = 0,
+    limit: int = 50
+) -> Dict[str, Any]:
+    """
+    Aging of open dues grouped by customer or branch.
+
+    Returns:
+        {"rows": [...], "totals": {...}, "total_groups": int}; rows are ordered by
+        total due (largest first) and paged with skip/limit
+    """
+    if group_by not in AGING_GROUP_FIELDS:
+        raise ValueError(f"group_by must be one of {', '.join(AGING_GROUP_FIELDS)}")
+
+    await ensure_dues_indexes(target_db)
+    await backfill_due_references(target_db, tenant_id)
+
+    as_of = as_of or datetime.now(timezone.utc)
+    match: Dict[str, Any] = {"tenant_id": tenant_id, "due_amount": {"$gt": 0}}
+    if branch_id:
+        match["branch_id"] = branch_id
+
+    bucket_sums = {
+        key: {"$sum": {"$cond": [{"$eq": ["$bucket", key]}, "$due_amount", 0]}}
+        for key, _, _ in AGING_BUCKETS
+    }
+    group_stage: Dict[str, Any] = {
+        "_id": AGING_GROUP_FIELDS[group_by],
+        "total_due": {"$sum": "$due_amount"},
+        "open_invoices": {"$sum": 1},
+        "oldest_transaction_date": {"$min": "$txn_date"},
+        **bucket_sums
+    }
+    if group_by == "customer":
+        group_stage["customer_name"] = {"$first": "$customer_name"}
+        group_stage["customer_id"] = {"$first": "$customer_id"}
+
+    totals_stage = {
+        "_id": None,
+        "total_due": {"$sum": "$total_due"},
+        "open_invoices": {"$sum": "$open_invoices"},
+        **{key: {"$sum": f"${key}"} for key, _, _ in AGING_BUCKETS}
+    }
+
+    pipeline = [
+        {"$match": match},
+        {"$project": {
+            "_id": 0,
+            "customer_id": 1,
+            "customer_name": 1,
+            "branch_id": 1,
+            "due_amount": 1,
+            "txn_date": _transaction_date_expression()
+        }},
+        {"$addFields": {"bucket": _bucket_expression(as_of)}},
+        {"$group": group_stage},
+        {"$facet": {
+            "rows": [
+                {"$sort": {"total_due": -1, "_id": 1}},
+                {"$skip": max(skip, 0)},
+                {"$limit": limit}
+            ],
+            "totals": [{"$group": totals_stage}],
+            "count": [{"$count": "total_groups"}]
+        }}
+    ]
+
+    result = await target_db.customer_dues.aggregate(pipeline, allowDiskUse=True).to_list(1)
+    facets = result[0] if result else {"rows": [], "totals": [], "count": []}
+
+    rows = []
+    for row in facets["rows"]:
+        row[f"{group_by}_key"] = row.pop("_id")
+        rows.append(row)
+
+    totals = facets["totals"][0] if facets["totals"] else {"total_due": 0, "open_invoices": 0, **{k: 0 for k, _, _ in AGING_BUCKETS}}
+    totals.pop("_id", None)
+
+    return {
+        "as_of": as_of.isoformat(),
+        "group_by": group_by,
+        "buckets": [key for key, _, _ in AGING_BUCKETS],
+        "rows": rows,
+        "totals": totals,
+        "total_groups": facets["count"][0]["total_groups"] if facets["count"] else 0
+    }
+
+
+async def iter_customer_statement(
+    target_db,
+    tenant_id: str,
+    customer_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Yield a customer's statement entries (invoices and payments) in date order with a running balance.
+
+    Invoices and their payments come from one aggregation cursor: sales are joined
+    to payments, unwound into entries and sorted by date on the server. Entries
+    before start_date are folded into an opening balance entry.
+    """
+    await ensure_dues_indexes(target_db)
+
+    pipeline = [
+        {"$match": {
+            "tenant_id": tenant_id,
+            "customer_id": customer_id,
+            "status": {"$ne": "cancelled"}
+        }},
+        {"$lookup": {
+            "from": "payments",
+            "let": {"sale_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$sale_id", "$$sale_id"]},
+                    {"$eq": ["$tenant_id", tenant_id]}
+                ]}}},
+                {"$project": {"_id": 0, "id": 1, "amount": 1, "method": 1, "reference": 1, "received_at": 1, "created_at": 1}}
+            ],
+            "as": "payments"
+        }},
+        {"$project": {
+            "_id": 0,
+            "entries": {"$concatArrays": [
+                [{
+                    "date": "$created_at",
+                    "type": "invoice",
+                    "sale_id": "$id",
+                    "reference": {"$ifNull": ["$invoice_no", "$sale_number"]},
+                    "debit": "$total",
+                    "credit": 0
+                }],
+                {"$map": {
+                    "input": "$payments",
+                    "as": "payment",
+                    "in": {
+                        "date": {"$ifNull": ["$$payment.received_at", "$$payment.created_at"]},
+                        "type": "payment",
+                        "sale_id": "$id",
+                        "reference": {"$ifNull": ["$$payment.reference", "$$payment.method"]},
+                        "debit": 0,
+                        "credit": "$$payment.amount"
+                    }
+                }}
+            ]}
+        }},
+        {"$unwind": "$entries"},
+        {"$replaceRoot": {"newRoot": "$entries"}},
+        {"$addFields": {"date": {"$cond": [
+            {"$eq": [{"$type": "$date"}, "date"]},
+            {"$dateToString": {"format": "%Y-%m-%dT%H:%M:%S", "date": "$date"}},
+            "$date"
+        ]}}},
+    ]
+    if end_date:
+        pipeline.append({"$match": {"date": {"$lte": f"{end_date}T23:59:59"}}})
+    pipeline.append({"$sort": {"date": 1, "type": 1}})
+
+    start_boundary = f"{start_date}T00:00:00" if start_date else None
+    balance = 0.0
+    opening_emitted = start_boundary is None
+    cursor = target_db.sales.aggregate(pipeline, allowDiskUse=True, batchSize=1000)
+    async for entry in cursor:
+        balance += (entry.get("debit") or 0) - (entry.get("credit") or 0)
+        if not opening_emitted:
+            if entry["date"] < start_boundary:
+                continue
+            opening_emitted = True
+            opening = balance - (entry.get("debit") or 0) + (entry.get("credit") or 0)
+            yield {"date": start_boundary, "type": "opening_balance", "sale_id": None,
+                   "reference": None, "debit": 0, "credit": 0, "balance": round(opening, 2)}
+        entry["balance"] = round(balance, 2)
+        yield entry
+
+    if not opening_emitted:
+        yield {"date": start_boundary, "type": "opening_balance", "sale_id": None,
+               "reference": None, "debit": 0, "credit": 0, "balance": round(balance, 2)}
@@ -0,0 +1,258 @@
+"""
+Durable email queue workers.
+Campaign emails are written to `email_queue` and sent by worker tasks that
+claim them with findOneAndUpdate leases, so any number of workers across
+processes can drain the same queue without double-sending. A lease left by a
+crashed worker expires after LEASE_SECONDS and the email is claimed again.
+Failed sends are retried with exponential backoff until max_retries, and each
+batch's results are written back with one bulk write.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from email_service import (
+    admin_db, EmailService, SMTPSessionPool, TokenBucket, build_message,
+    EMAIL_MAX_PER_SECOND, EMAIL_SENDING_PROCESSES, SMTP_POOL_SIZE
+)
+from notification_models import EmailQueueStatus
+
+logger = logging.getLogger(__name__)
+
+# One worker per pooled SMTP session by default
+EMAIL_QUEUE_WORKERS = int(os.environ.get('EMAIL_QUEUE_WORKERS', SMTP_POOL_SIZE))
+CLAIM_BATCH_SIZE = 20
+LEASE_SECONDS = 300
+POLL_SECONDS = 2.0
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 6 * 3600
+DEFAULT_MAX_RETRIES = 3
+
+
+def retry_delay(retry_count: int) -> timedelta:
+    """Backoff before retry number `retry_count` (1, 2, 4 ... minutes, capped)."""
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** max(retry_count - 1, 0), RETRY_MAX_SECONDS))
+
+
+async def ensure_email_queue_indexes():
+    try:
+        await admin_db.email_queue.create_index(
+            [("status", ASCENDING), ("scheduled_for", ASCENDING)],
+            name="status_scheduled_for"
+        )
+        await admin_db.email_queue.create_index(
+            [("status", ASCENDING), ("lease_expires_at", ASCENDING)],
+            name="status_lease_expires_at"
+        )
+        await admin_db.email_queue.create_index(
+            [("campaign_id", ASCENDING), ("status", ASCENDING)],
+            name="campaign_status"
+        )
+        await admin_db.email_queue.create_index(
+            [("status", ASCENDING), ("sent_at", ASCENDING)],
+            name="status_sent_at"
+        )
+    except Exception as e:
+        logger.warning(f"Failed to ensure email queue indexes: {e}")
+
+
+class EmailQueueWorkers:
+    """
+    A pool of worker tasks draining `email_queue`.
+    The workers share the process's SMTPSessionPool (SMTP_POOL_SIZE persistent
+    sessions) and a token bucket capped at this process's share of
+    EMAIL_MAX_PER_SECOND (divided by EMAIL_SENDING_PROCESSES).
+    """
+
+    def __init__(self, workers: int = EMAIL_QUEUE_WORKERS):
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._bucket = TokenBucket(EMAIL_MAX_PER_SECOND / EMAIL_SENDING_PROCESSES)
+        self._pool: Optional[SMTPSessionPool] = None
+        self._started_at: Optional[float] = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def start(self):
+        if self._tasks:
+            return
+        await ensure_email_queue_indexes()
+        self._started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._run(index)) for index in range(self.workers)]
+        logger.info(f"📧 Email queue workers started ({self.workers} workers, {self.owner})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def notify(self):
+        """Wake idle workers after new emails were queued in this process."""
+        self._wakeup.set()
+
+    async def claim(self, limit: int = CLAIM_BATCH_SIZE) -> List[Dict[str, Any]]:
+        """Atomically lease up to `limit` due emails to this worker."""
+        claimed = []
+        now = datetime.utcnow()
+        claimable = {"$or": [
+            {"status": EmailQueueStatus.PENDING.value, "scheduled_for": {"$lte": now}},
+            {"status": EmailQueueStatus.PENDING.value, "scheduled_for": None},
+            {"status": EmailQueueStatus.SENDING.value, "lease_expires_at": {"$lt": now}}
+        ]}
+        for _ in range(limit):
+            record = await admin_db.email_queue.find_one_and_update(
+                claimable,
+                {
+                    "$set": {
+                        "status": EmailQueueStatus.SENDING.value,
+                        "lease_owner": self.owner,
+                        "lease_expires_at": now + timedelta(seconds=LEASE_SECONDS),
+                        "updated_at": now
+                    },
+                    "$inc": {"attempts": 1}
+                },
+                sort=[("scheduled_for", ASCENDING)],
+                projection={"_id": 0},
+                return_document=ReturnDocument.AFTER
+            )
+            if record is None:
+                break
+            claimed.append(record)
+        return claimed
+
+    def _session_pool(self, smtp_config: Dict[str, Any]) -> SMTPSessionPool:
+        if self._pool is None:
+            self._pool = SMTPSessionPool(smtp_config, size=SMTP_POOL_SIZE)
+        elif self._pool.smtp_config != smtp_config:
+            self._pool.configure(smtp_config)
+        return self._pool
+
+    async def _run(self, index: int):
+        while True:
+            try:
+                batch = await self.claim()
+                if not batch:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                smtp_config = await EmailService._get_default_smtp_config()
+                await self._process(batch, self._session_pool(smtp_config), smtp_config)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Email queue worker {index} error: {e}")
+                await asyncio.sleep(POLL_SECONDS)
+
+    async def _process(self, batch: List[Dict[str, Any]], pool: SMTPSessionPool, smtp_config: Dict[str, Any]):
+        operations = []
+        campaign_totals: Dict[str, Dict[str, int]] = {}
+        for record in batch:
+            # Don't send if the lease ran out while earlier emails in the batch were sending
+            if record["lease_expires_at"] <= datetime.utcnow():
+                continue
+            await self._bucket.acquire()
+            now = datetime.utcnow()
+            lease = {"lease_owner": None, "lease_expires_at": None, "updated_at": now}
+            totals = campaign_totals.setdefault(record.get("campaign_id"), {"total_sent": 0, "total_failed": 0})
+            try:
+                await pool.send(build_message(
+                    smtp_config, record["to_email"], record["subject"], record["html_body"], record.get("text_body")
+                ))
+                update = {"$set": {**lease, "status": EmailQueueStatus.SENT.value, "sent_at": now, "error_message": None}}
+                totals["total_sent"] += 1
+                self.sent += 1
+            except Exception as e:
+                retry_count = record.get("retry_count", 0) + 1
+                if retry_count <= record.get("max_retries", DEFAULT_MAX_RETRIES):
+                    update = {"$set": {
+                        **lease,
+                        "status": EmailQueueStatus.PENDING.value,
+                        "retry_count": retry_count,
+                        "scheduled_for": now + retry_delay(retry_count),
+                        "error_message": str(e)
+                    }}
+                    self.retried += 1
+                else:
+                    logger.error(f"Error sending to {record['to_email']}: {str(e)}")
+                    update = {"$set": {**lease, "status": EmailQueueStatus.FAILED.value, "failed_at": now, "error_message": str(e)}}
+                    totals["total_failed"] += 1
+                    self.failed += 1
+            operations.append(UpdateOne({"queue_id": record["queue_id"], "lease_owner": self.owner}, update))
+
+        if operations:
+            await admin_db.email_queue.bulk_write(operations, ordered=False)
+        for campaign_id, totals in campaign_totals.items():
+            if campaign_id:
+                await self._update_campaign(campaign_id, totals)
+
+    async def _update_campaign(self, campaign_id: str, totals: Dict[str, int]):
+        if totals["total_sent"] or totals["total_failed"]:
+            await admin_db.email_campaigns.update_one({"campaign_id": campaign_id}, {"$inc": totals})
+        remaining = await admin_db.email_queue.find_one(
+            {"campaign_id": campaign_id, "status": {"$in": [EmailQueueStatus.PENDING.value, EmailQueueStatus.SENDING.value]}},
+            {"_id": 0, "queue_id": 1}
+        )
+        if remaining is None:
+            await admin_db.email_campaigns.update_one(
+                {"campaign_id": campaign_id, "status": "sending"},
+                {"$set": {"status": "sent", "sent_at": datetime.utcnow()}}
+            )
+            logger.info(f"✅ Campaign {campaign_id} complete")
+
+    def local_stats(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        return {
+            "owner": self.owner,
+            "workers": len(self._tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "sent_per_minute": round(self.sent / elapsed * 60, 1) if elapsed else 0
+        }
+
+
+async def get_email_queue_stats() -> Dict[str, Any]:
+    """Queue depth by status and cluster-wide throughput over the last minute and hour."""
+    now = datetime.utcnow()
+    by_status = await admin_db.email_queue.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]).to_list(None)
+    depth = {row["_id"]: row["count"] for row in by_status}
+    due = await admin_db.email_queue.count_documents({
+        "status": EmailQueueStatus.PENDING.value,
+        "$or": [{"scheduled_for": {"$lte": now}}, {"scheduled_for": None}]
+    })
+    sent_last_minute = await admin_db.email_queue.count_documents({
+        "status": EmailQueueStatus.SENT.value, "sent_at": {"$gte": now - timedelta(minutes=1)}
+    })
+    sent_last_hour = await admin_db.email_queue.count_documents({
+        "status": EmailQueueStatus.SENT.value, "sent_at": {"$gte": now - timedelta(hours=1)}
+    })
+    return {
+        "depth": depth,
+        "due_now": due,
+        "sent_last_minute": sent_last_minute,
+        "sent_last_hour": sent_last_hour,
+        "this_process": email_queue_workers.local_stats()
+    }
+
+
+email_queue_workers = EmailQueueWorkers()
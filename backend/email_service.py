@@ -6,11 +6,13 @@ import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
-from typing import Dict, Any, Optional, List
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, List, Tuple
 import logging
 import os
 import asyncio
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +21,167 @@ MONGO_URL = os.getenv("MONGO_URL")
 mongo_client = AsyncIOMotorClient(MONGO_URL)
 admin_db = mongo_client["admin_hub"]
 
+SMTP_CONFIG_CACHE_SECONDS = 300
+# Persistent SMTP sessions per process (shared by that process's email queue workers)
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 5))
+# Reconnect after this many messages; many servers cap messages per session
+SMTP_MESSAGES_PER_SESSION = 100
+# Provider-wide send cap, applied on top of a campaign's hourly rate limit. Each
+# process enforces its share, so set EMAIL_SENDING_PROCESSES (or WEB_CONCURRENCY)
+# to the number of processes running email queue workers.
+EMAIL_MAX_PER_SECOND = float(os.getenv("EMAIL_MAX_PER_SECOND", 20))
+EMAIL_SENDING_PROCESSES = max(int(os.getenv("EMAIL_SENDING_PROCESSES", os.getenv("WEB_CONCURRENCY", 1))), 1)
+QUEUE_INSERT_CHUNK = 1000
+
+_smtp_config_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+
+
+class TokenBucket:
+    """Async token bucket: acquire() waits until a send is allowed at `rate` per second."""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SMTPSessionPool:
+    """
+    A fixed set of persistent SMTP sessions.
+    Sessions connect lazily, are reused across messages, and are reopened after
+    an error, SMTP_MESSAGES_PER_SESSION messages or a configuration change.
+    """
+    
+    def __init__(self, smtp_config: Dict[str, Any], size: int = SMTP_POOL_SIZE):
+        self.smtp_config = smtp_config
+        self.size = size
+        self._generation = 0
+        self._idle: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            # [client or None, messages sent on this session, config generation]
+            self._idle.put_nowait([None, 0, 0])
+    
+    def configure(self, smtp_config: Dict[str, Any]):
+        """Switch to new SMTP settings; each session reconnects on its next use."""
+        self.smtp_config = smtp_config
+        self._generation += 1
+    
+    async def _open(self) -> aiosmtplib.SMTP:
+        client = aiosmtplib.SMTP(
+            hostname=self.smtp_config['host'],
+            port=self.smtp_config.get('port', 587),
+            use_tls=self.smtp_config.get('use_tls', True),
+            timeout=30
+        )
+        await client.connect()
+        if self.smtp_config.get('username') and self.smtp_config.get('password'):
+            await client.login(self.smtp_config['username'], self.smtp_config['password'])
+        return client
+    
+    @staticmethod
+    async def _quit(client: Optional[aiosmtplib.SMTP]):
+        if client is None:
+            return
+        try:
+            await client.quit()
+        except Exception:
+            client.close()
+    
+    async def send(self, message: MIMEMultipart):
+        slot = await self._idle.get()
+        try:
+            if slot[2] != self._generation:
+                await self._quit(slot[0])
+                slot[0], slot[2] = None, self._generation
+            if slot[0] is None or not slot[0].is_connected:
+                slot[0], slot[1] = await self._open(), 0
+            await slot[0].send_message(message)
+            slot[1] += 1
+            if slot[1] >= SMTP_MESSAGES_PER_SESSION:
+                await self._quit(slot[0])
+                slot[0] = None
+        except Exception:
+            await self._quit(slot[0])
+            slot[0] = None
+            raise
+        finally:
+            self._idle.put_nowait(slot)
+    
+    async def close(self):
+        for _ in range(self.size):
+            slot = await self._idle.get()
+            await self._quit(slot[0])
+
+
+def build_message(smtp_config: Dict[str, Any], to_email: str, subject: str, html_body: str, text_body: Optional[str] = None) -> MIMEMultipart:
+    message = MIMEMultipart('alternative')
+    message['Subject'] = subject
+    message['From'] = smtp_config.get('from_email', smtp_config.get('username'))
+    message['To'] = to_email
+    
+    # Add plain text part
+    if text_body:
+        message.attach(MIMEText(text_body, 'plain'))
+    
+    # Add HTML part
+    message.attach(MIMEText(html_body, 'html'))
+    return message
+
+
+def queue_record_for(
+    campaign_id: str,
+    tenant_id: Optional[str],
+    to_email: str,
+    subject: str,
+    html_body: str,
+    text_body: Optional[str]
+) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    return {
+        "queue_id": f"eq_{now.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:12]}",
+        "campaign_id": campaign_id,
+        "tenant_id": tenant_id,
+        "to_email": to_email,
+        "subject": subject,
+        "html_body": html_body,
+        "text_body": text_body,
+        "status": "pending",
+        "scheduled_for": now,
+        "retry_count": 0,
+        "max_retries": 3,
+        "created_at": now,
+        "attempts": 0
+    }
+
+
+def _notify_queue_workers():
+    from email_queue import email_queue_workers
+    email_queue_workers.notify()
+
+
+def personalize(subject: str, html_body: str, text_body: Optional[str], values: Optional[Dict[str, Any]]) -> Tuple[str, str, Optional[str]]:
+    """Replace {{key}} placeholders in subject and bodies."""
+    for key, value in (values or {}).items():
+        placeholder = f"{{{{{key}}}}}"
+        html_body = html_body.replace(placeholder, str(value))
+        if text_body:
+            text_body = text_body.replace(placeholder, str(value))
+        subject = subject.replace(placeholder, str(value))
+    return subject, html_body, text_body
+
 class EmailService:
     """Service for sending emails via SMTP or SendGrid"""
     
@@ -49,19 +212,7 @@ class EmailService:
                 smtp_config = await EmailService._get_default_smtp_config()
             
             # Create message
-            message = MIMEMultipart('alternative')
-            message['Subject'] = subject
-            message['From'] = smtp_config.get('from_email', smtp_config.get('username'))
-            message['To'] = to_email
-            
-            # Add plain text part
-            if text_body:
-                text_part = MIMEText(text_body, 'plain')
-                message.attach(text_part)
-            
-            # Add HTML part
-            html_part = MIMEText(html_body, 'html')
-            message.attach(html_part)
+            message = build_message(smtp_config, to_email, subject, html_body, text_body)
             
             # Send via SMTP
             await aiosmtplib.send(
@@ -102,7 +253,7 @@ class EmailService:
         personalization: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """
-        Send a single email as part of a campaign with tracking
+        Queue a single email as part of a campaign with tracking
         
         Args:
             campaign_id: Campaign identifier
@@ -114,61 +265,18 @@ class EmailService:
             personalization: Dictionary of placeholder values
             
         Returns:
-            Email queue record with status
+            Email queue record (sent by the email queue workers)
         """
         # Personalize content if needed
-        if personalization:
-            for key, value in personalization.items():
-                placeholder = f"{{{{{key}}}}}"
-                html_body = html_body.replace(placeholder, str(value))
-                if text_body:
-                    text_body = text_body.replace(placeholder, str(value))
-                subject = subject.replace(placeholder, str(value))
-        
-        # Create email queue record
-        queue_record = {
-            "queue_id": f"eq_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{to_email.replace('@', '_').replace('.', '_')}",
-            "campaign_id": campaign_id,
-            "tenant_id": tenant_id,
-            "to_email": to_email,
-            "subject": subject,
-            "html_body": html_body,
-            "text_body": text_body,
-            "status": "pending",
-            "created_at": datetime.utcnow(),
-            "attempts": 0
-        }
+        subject, html_body, text_body = personalize(subject, html_body, text_body, personalization)
         
-        # Insert into queue
-        await admin_db.email_queue.insert_one(queue_record)
+        queue_record = queue_record_for(campaign_id, tenant_id, to_email, subject, html_body, text_body)
         
-        # Try to send immediately
-        result = await EmailService.send_smtp_email(
-            to_email=to_email,
-            subject=subject,
-            html_body=html_body,
-            text_body=text_body
-        )
-        
-        # Update queue record with result
-        update_data = {
-            "status": result["status"],
-            "attempts": 1,
-            "updated_at": datetime.utcnow()
-        }
-        
-        if result["status"] == "sent":
-            update_data["sent_at"] = result["sent_at"]
-        else:
-            update_data["error_message"] = result.get("error", "Unknown error")
-            update_data["failed_at"] = result["failed_at"]
-        
-        await admin_db.email_queue.update_one(
-            {"queue_id": queue_record["queue_id"]},
-            {"$set": update_data}
-        )
+        # Queue for the email queue workers; a crash before sending no longer loses the email
+        await admin_db.email_queue.insert_one(dict(queue_record))
+        _notify_queue_workers()
         
-        return {**queue_record, **update_data}
+        return queue_record
     
     @staticmethod
     async def send_campaign_batch(
@@ -177,10 +285,14 @@ class EmailService:
         subject: str,
         html_body: str,
         text_body: Optional[str] = None,
-        rate_limit: int = 100
+        rate_limit: Optional[int] = None
     ) -> Dict[str, Any]:
         """
-        Send email campaign to multiple recipients with rate limiting
+        Queue an email campaign for multiple recipients with rate limiting
+        
+        Queue records are inserted in bulk and sent by the email queue workers.
+        A campaign rate limit is applied by spacing the records' scheduled_for
+        times, so it holds however many workers drain the queue.
         
         Args:
             campaign_id: Campaign identifier
@@ -188,75 +300,56 @@ class EmailService:
             subject: Email subject
             html_body: HTML template
             text_body: Plain text template
-            rate_limit: Max emails per hour
+            rate_limit: Max emails per hour (None for the provider cap only)
             
         Returns:
-            Campaign statistics
+            Campaign queueing statistics
         """
         total = len(recipients)
-        sent = 0
-        failed = 0
-        
-        # Calculate delay between emails based on rate limit
-        delay_seconds = 3600 / rate_limit if rate_limit > 0 else 0
+        start = datetime.utcnow()
+        interval = timedelta(seconds=3600 / rate_limit) if rate_limit else timedelta(0)
         
-        logger.info(f"📧 Starting campaign {campaign_id}: {total} recipients, {rate_limit}/hr rate limit")
-        
-        for recipient in recipients:
-            try:
-                result = await EmailService.send_campaign_email(
-                    campaign_id=campaign_id,
-                    tenant_id=recipient.get("tenant_id"),
-                    to_email=recipient["email"],
-                    subject=subject,
-                    html_body=html_body,
-                    text_body=text_body,
-                    personalization=recipient.get("personalization", {})
-                )
-                
-                if result["status"] == "sent":
-                    sent += 1
-                else:
-                    failed += 1
-                
-                # Rate limiting delay
-                if delay_seconds > 0:
-                    await asyncio.sleep(delay_seconds)
-                    
-            except Exception as e:
-                logger.error(f"Error sending to {recipient['email']}: {str(e)}")
-                failed += 1
-        
-        # Update campaign statistics
         await admin_db.email_campaigns.update_one(
             {"campaign_id": campaign_id},
-            {
-                "$set": {
-                    "status": "sent",
-                    "total_sent": sent,
-                    "total_failed": failed,
-                    "sent_at": datetime.utcnow()
-                }
-            }
+            {"$set": {"status": "sending", "total_recipients": total, "total_sent": 0, "total_failed": 0, "updated_at": start}}
         )
         
-        logger.info(f"✅ Campaign {campaign_id} complete: {sent} sent, {failed} failed")
+        # Personalize and queue every recipient up front
+        records = []
+        for index, recipient in enumerate(recipients):
+            r_subject, r_html, r_text = personalize(subject, html_body, text_body, recipient.get("personalization"))
+            record = queue_record_for(campaign_id, recipient.get("tenant_id"), recipient["email"], r_subject, r_html, r_text)
+            record["scheduled_for"] = start + interval * index
+            records.append(record)
+        for offset in range(0, len(records), QUEUE_INSERT_CHUNK):
+            await admin_db.email_queue.insert_many(records[offset:offset + QUEUE_INSERT_CHUNK], ordered=False)
+        _notify_queue_workers()
+        
+        logger.info(f"📧 Queued campaign {campaign_id}: {total} recipients")
         
         return {
             "campaign_id": campaign_id,
             "total": total,
-            "sent": sent,
-            "failed": failed
+            "queued": total
         }
     
     @staticmethod
     async def _get_default_smtp_config() -> Dict[str, Any]:
         """
         Get default SMTP configuration from environment or database
+        Cached for SMTP_CONFIG_CACHE_SECONDS so sends don't read system_config.
+        
+        A local sink for testing can be used with SMTP_HOST=localhost,
+        SMTP_PORT=1025 and SMTP_USE_TLS=false (e.g. `python -m aiosmtpd -n`);
+        credentials are optional.
         
         Returns:
             SMTP configuration dict
         """
+        global _smtp_config_cache
+        if _smtp_config_cache and time.monotonic() - _smtp_config_cache[0] < SMTP_CONFIG_CACHE_SECONDS:
+            return _smtp_config_cache[1]
+        
         # Try to get from environment first
         smtp_host = os.getenv("SMTP_HOST")
         smtp_port = os.getenv("SMTP_PORT", "587")
@@ -264,20 +357,23 @@ class EmailService:
         smtp_password = os.getenv("SMTP_PASSWORD")
         smtp_from = os.getenv("SMTP_FROM_EMAIL", smtp_username)
         
-        if smtp_host and smtp_username and smtp_password:
-            return {
+        if smtp_host:
+            config = {
                 "host": smtp_host,
                 "port": int(smtp_port),
                 "username": smtp_username,
                 "password": smtp_password,
-                "from_email": smtp_from,
-                "use_tls": True
+                "from_email": smtp_from or f"noreply@{smtp_host}",
+                "use_tls": os.getenv("SMTP_USE_TLS", "true").lower() != "false"
             }
+            _smtp_config_cache = (time.monotonic(), config)
+            return config
         
         # Try to get from database
         config = await admin_db.system_config.find_one({"config_type": "smtp"})
         if config:
-            return config.get("smtp_config", {})
+            _smtp_config_cache = (time.monotonic(), config.get("smtp_config", {}))
+            return _smtp_config_cache[1]
         
         # Return dummy config for development (will fail but show error)
         logger.warning("⚠️ No SMTP configuration found. Set SMTP environment variables.")
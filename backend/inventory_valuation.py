@@ -0,0 +1,450 @@
+"""
+Inventory valuation maintained incrementally from stock movements.
+Each (product, branch) position in `stock_valuations` keeps a running
+weighted-average value and FIFO cost layers. Every movement also increments
+per (branch, category) totals in `stock_valuation_totals`, so valuation reports
+read a handful of precomputed documents.
+"""
+
+from datetime import datetime, timezone
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+from branch_stock_counters import inc_branch_counters
+
+logger = logging.getLogger(__name__)
+
+UNCATEGORIZED = "Uncategorized"
+MAX_UPDATE_RETRIES = 5
+REBUILD_BATCH_SIZE = 1000
+
+
+class ValuationMethod(str, Enum):
+    WEIGHTED_AVERAGE = "weighted_average"
+    FIFO = "fifo"
+
+
+VALUE_FIELDS = {
+    ValuationMethod.WEIGHTED_AVERAGE: "avg_value",
+    ValuationMethod.FIFO: "fifo_value",
+}
+
+
+async def ensure_valuation_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "valuation"):
+        return
+    try:
+        await target_db.stock_valuations.create_index(
+            [("tenant_id", ASCENDING), ("product_id", ASCENDING), ("branch_id", ASCENDING)],
+            unique=True,
+            name="tenant_product_branch"
+        )
+        await target_db.stock_valuation_totals.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("category", ASCENDING)],
+            unique=True,
+            name="tenant_branch_category"
+        )
+        mark_indexes_ensured(target_db, "valuation")
+    except Exception as e:
+        logger.warning(f"Failed to ensure valuation indexes on {target_db.name}: {e}")
+
+
+def _round(value: float) -> float:
+    return round(value, 6)
+
+
+async def _load_position_seed(target_db, tenant_id: str, product_id: str, branch_id: Optional[str]) -> Dict[str, Any]:
+    """Current stock level, fallback unit cost and category for a position that has no valuation yet."""
+    product = await target_db.products.find_one(
+        {"id": product_id, "tenant_id": tenant_id},
+        {"_id": 0, "stock": 1, "unit_cost": 1, "cost": 1, "category": 1}
+    ) or {}
+    unit_cost = product.get("unit_cost") or product.get("cost") or 0
+    quantity = product.get("stock", 0) or 0
+    if branch_id:
+        assignment = await target_db.product_branches.find_one(
+            {"product_id": product_id, "branch_id": branch_id, "tenant_id": tenant_id},
+            {"_id": 0, "stock_quantity": 1, "purchase_price": 1}
+        ) or {}
+        quantity = assignment.get("stock_quantity", 0) or 0
+        unit_cost = assignment.get("purchase_price") or unit_cost
+    return {
+        "quantity": quantity,
+        "unit_cost": float(unit_cost or 0),
+        "category": product.get("category") or UNCATEGORIZED
+    }
+
+
+def _consume_layers(layers: List[Dict[str, float]], quantity: float) -> Tuple[List[Dict[str, float]], float, float]:
+    """Take quantity from the oldest layers. Returns (remaining layers, value taken, quantity not covered)."""
+    remaining = []
+    taken_value = 0.0
+    for layer in layers:
+        if quantity <= 0:
+            remaining.append(layer)
+            continue
+        used = min(layer["quantity"], quantity)
+        taken_value += used * layer["unit_cost"]
+        quantity -= used
+        if layer["quantity"] > used:
+            remaining.append({"quantity": layer["quantity"] - used, "unit_cost": layer["unit_cost"]})
+    return remaining, taken_value, quantity
+
+
+def _apply_delta(position: Dict[str, Any], delta: float, unit_cost: Optional[float]) -> Dict[str, Any]:
+    """Return the position after a movement, valued by weighted average and FIFO."""
+    quantity = position["quantity"]
+    avg_value = position["avg_value"]
+    fifo_value = position["fifo_value"]
+    layers = list(position["layers"])
+    avg_cost = avg_value / quantity if quantity > 0 else position["fallback_cost"]
+    last_cost = avg_cost
+
+    if delta > 0:
+        cost = unit_cost if unit_cost is not None else avg_cost
+        last_cost = cost
+        if quantity < 0:
+            # A receipt into negative stock first covers the shortfall, settled at its own cost
+            on_hand = quantity + delta
+            avg_value = fifo_value = on_hand * cost
+        else:
+            on_hand = delta
+            avg_value += delta * cost
+            fifo_value += delta * cost
+        if on_hand > 0:
+            if layers and layers[-1]["unit_cost"] == cost:
+                layers[-1] = {"quantity": layers[-1]["quantity"] + on_hand, "unit_cost": cost}
+            else:
+                layers.append({"quantity": on_hand, "unit_cost": cost})
+    elif delta < 0:
+        out = -delta
+        avg_value -= out * avg_cost
+        layers, taken_value, uncovered = _consume_layers(layers, out)
+        fifo_value -= taken_value + uncovered * avg_cost
+
+    quantity += delta
+    if quantity <= 0:
+        # Negative stock is valued at the last unit cost rather than written off to
+        # zero, so the receipt that covers it is not averaged up
+        avg_value = fifo_value = quantity * last_cost
+        layers = []
+
+    return {
+        "quantity": quantity,
+        "avg_value": _round(avg_value),
+        "fifo_value": _round(fifo_value),
+        "layers": layers,
+        "fallback_cost": last_cost,
+        "last_unit_cost": last_cost
+    }
+
+
+async def apply_valuation_movement(target_db, movement: Dict[str, Any]) -> Optional[float]:
+    """
+    Update a position's valuation for one ledger movement and increment branch/category totals.
+
+    Positions are updated with an optimistic compare-and-set on quantity and values,
+    so concurrent movements on the same product retry instead of overwriting each other.
+
+    Returns:
+        The unit cost the movement was valued at
+    """
+    await ensure_valuation_indexes(target_db)
+    tenant_id = movement["tenant_id"]
+    product_id = movement["product_id"]
+    branch_id = movement.get("branch_id")
+    delta = movement["delta"]
+    unit_cost = movement.get("unit_cost")
+    key = {"tenant_id": tenant_id, "product_id": product_id, "branch_id": branch_id}
+
+    for _ in range(MAX_UPDATE_RETRIES):
+        current = await target_db.stock_valuations.find_one(key, {"_id": 0})
+        if current is None:
+            seed = await _load_position_seed(target_db, tenant_id, product_id, branch_id)
+            # The live level already includes this movement
+            opening_quantity = seed["quantity"] - delta
+            opening_value = opening_quantity * seed["unit_cost"]
+            current = {
+                **key,
+                "category": seed["category"],
+                "fallback_cost": seed["unit_cost"],
+                "quantity": opening_quantity,
+                "avg_value": opening_value,
+                "fifo_value": opening_value,
+                "layers": [{"quantity": opening_quantity, "unit_cost": seed["unit_cost"]}] if opening_quantity > 0 else [],
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }
+            try:
+                await target_db.stock_valuations.insert_one(dict(current))
+            except DuplicateKeyError:
+                continue
+            await _inc_totals(target_db, tenant_id, branch_id, current["category"], opening_quantity, opening_value, opening_value)
+
+        updated = _apply_delta(current, delta, unit_cost)
+        result = await target_db.stock_valuations.update_one(
+            {**key, "quantity": current["quantity"], "avg_value": current["avg_value"], "fifo_value": current["fifo_value"]},
+            {"$set": {
+                "quantity": updated["quantity"],
+                "avg_value": updated["avg_value"],
+                "fifo_value": updated["fifo_value"],
+                "layers": updated["layers"],
+                "fallback_cost": updated["fallback_cost"],
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
+        )
+        if result.matched_count:
+            await _inc_totals(
+                target_db, tenant_id, branch_id, current["category"],
+                updated["quantity"] - current["quantity"],
+                updated["avg_value"] - current["avg_value"],
+                updated["fifo_value"] - current["fifo_value"]
+            )
+            return updated["last_unit_cost"]
+
+    logger.warning(f"Valuation update for product {product_id} (branch {branch_id}) gave up after retries")
+    return None
+
+
+async def _inc_totals(target_db, tenant_id: str, branch_id: Optional[str], category: str,
+                      quantity: float, avg_value: float, fifo_value: float) -> None:
+    if not (quantity or avg_value or fifo_value):
+        return
+    await target_db.stock_valuation_totals.update_one(
+        {"tenant_id": tenant_id, "branch_id": branch_id, "category": category},
+        {
+            "$inc": {"quantity": quantity, "avg_value": avg_value, "fifo_value": fifo_value},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        },
+        upsert=True
+    )
+    await inc_branch_counters(target_db, tenant_id, branch_id, value=avg_value)
+
+
+async def seed_branch_positions(target_db, tenant_id: str, branch_id: str) -> int:
+    """
+    Create valuation positions for a branch's assignments that have none yet, valued at
+    their current quantity and cost, and add them to the totals and branch counters.
+    Positions created concurrently by a movement are left to that movement.
+
+    Returns:
+        Number of positions seeded
+    """
+    await ensure_valuation_indexes(target_db)
+    rows = await target_db.product_branches.aggregate([
+        {"$match": {"tenant_id": tenant_id, "branch_id": branch_id}},
+        {"$lookup": {
+            "from": "stock_valuations",
+            "let": {"product_id": "$product_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$tenant_id", tenant_id]},
+                    {"$eq": ["$product_id", "$$product_id"]},
+                    {"$eq": ["$branch_id", branch_id]}
+                ]}}},
+                {"$project": {"_id": 1}},
+                {"$limit": 1}
+            ],
+            "as": "valuation"
+        }},
+        {"$match": {"valuation": {"$size": 0}}},
+        {"$lookup": {
+            "from": "products",
+            "let": {"product_id": "$product_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$and": [
+                    {"$eq": ["$id", "$$product_id"]},
+                    {"$eq": ["$tenant_id", tenant_id]}
+                ]}}},
+                {"$project": {"_id": 0, "unit_cost": 1, "cost": 1, "category": 1}},
+                {"$limit": 1}
+            ],
+            "as": "product"
+        }},
+        {"$project": {
+            "_id": 0, "product_id": 1, "stock_quantity": 1, "purchase_price": 1,
+            "product": {"$arrayElemAt": ["$product", 0]}
+        }}
+    ]).to_list(None)
+    if not rows:
+        return 0
+
+    now = datetime.now(timezone.utc).isoformat()
+    positions = []
+    for row in rows:
+        product = row.get("product") or {}
+        unit_cost = float(row.get("purchase_price") or product.get("unit_cost") or product.get("cost") or 0)
+        quantity = row.get("stock_quantity", 0) or 0
+        value = quantity * unit_cost
+        positions.append({
+            "tenant_id": tenant_id,
+            "product_id": row["product_id"],
+            "branch_id": branch_id,
+            "category": product.get("category") or UNCATEGORIZED,
+            "fallback_cost": unit_cost,
+            "quantity": quantity,
+            "avg_value": value,
+            "fifo_value": value,
+            "layers": [{"quantity": quantity, "unit_cost": unit_cost}] if quantity > 0 else [],
+            "updated_at": now
+        })
+
+    skipped = set()
+    try:
+        await target_db.stock_valuations.insert_many([dict(position) for position in positions], ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        skipped = {error["index"] for error in errors}
+
+    by_category: Dict[str, List[float]] = {}
+    for index, position in enumerate(positions):
+        if index in skipped:
+            continue
+        totals = by_category.setdefault(position["category"], [0, 0])
+        totals[0] += position["quantity"]
+        totals[1] += position["avg_value"]
+    for category, (quantity, value) in by_category.items():
+        await _inc_totals(target_db, tenant_id, branch_id, category, quantity, value, value)
+    return len(positions) - len(skipped)
+
+
+async def get_average_unit_cost(target_db, tenant_id: str, product_id: str, branch_id: Optional[str]) -> Optional[float]:
+    """Current weighted-average unit cost of a position, or None if it has no valued stock."""
+    position = await target_db.stock_valuations.find_one(
+        {"tenant_id": tenant_id, "product_id": product_id, "branch_id": branch_id},
+        {"_id": 0, "quantity": 1, "avg_value": 1}
+    )
+    if not position or position.get("quantity", 0) <= 0:
+        return None
+    return position["avg_value"] / position["quantity"]
+
+
+async def get_stock_valuation(
+    target_db,
+    tenant_id: str,
+    method: ValuationMethod = ValuationMethod.WEIGHTED_AVERAGE,
+    branch_id: Optional[str] = None,
+    category: Optional[str] = None
+) -> Dict[str, Any]:
+    """Valuation by branch and category, read from the precomputed totals."""
+    await ensure_valuation_indexes(target_db)
+    query: Dict[str, Any] = {"tenant_id": tenant_id}
+    if branch_id is not None:
+        query["branch_id"] = branch_id
+    if category:
+        query["category"] = category
+
+    value_field = VALUE_FIELDS[method]
+    rows = []
+    total_quantity = 0.0
+    total_value = 0.0
+    async for doc in target_db.stock_valuation_totals.find(query, {"_id": 0}).sort([("branch_id", 1), ("category", 1)]):
+        value = round(doc.get(value_field, 0), 2)
+        quantity = doc.get("quantity", 0)
+        if not quantity and not value:
+            continue
+        rows.append({
+            "branch_id": doc.get("branch_id"),
+            "category": doc.get("category"),
+            "quantity": quantity,
+            "value": value
+        })
+        total_quantity += quantity
+        total_value += value
+
+    return {
+        "method": method.value,
+        "rows": rows,
+        "total_quantity": total_quantity,
+        "total_value": round(total_value, 2)
+    }
+
+
+async def rebuild_stock_valuation(target_db, tenant_id: str) -> int:
+    """
+    Reset valuations to current stock levels at each product's known cost.
+    Used to initialise a tenant or to pick up category changes.
+
+    Returns:
+        Number of positions written
+    """
+    await ensure_valuation_indexes(target_db)
+    products: Dict[str, Dict[str, Any]] = {}
+    async for product in target_db.products.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "stock": 1, "unit_cost": 1, "cost": 1, "category": 1}
+    ):
+        products[product["id"]] = product
+
+    positions = []
+    for product in products.values():
+        positions.append((product["id"], None, product.get("stock", 0) or 0, product.get("unit_cost") or product.get("cost") or 0))
+    async for assignment in target_db.product_branches.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "product_id": 1, "branch_id": 1, "stock_quantity": 1, "purchase_price": 1}
+    ):
+        product = products.get(assignment["product_id"], {})
+        cost = assignment.get("purchase_price") or product.get("unit_cost") or product.get("cost") or 0
+        positions.append((assignment["product_id"], assignment["branch_id"], assignment.get("stock_quantity", 0) or 0, cost))
+
+    now = datetime.now(timezone.utc).isoformat()
+    docs = []
+    totals: Dict[Tuple[Optional[str], str], Dict[str, float]] = {}
+    for product_id, branch_id, quantity, cost in positions:
+        category = products.get(product_id, {}).get("category") or UNCATEGORIZED
+        value = _round(quantity * float(cost))
+        docs.append({
+            "tenant_id": tenant_id,
+            "product_id": product_id,
+            "branch_id": branch_id,
+            "category": category,
+            "fallback_cost": float(cost),
+            "quantity": quantity,
+            "avg_value": value,
+            "fifo_value": value,
+            "layers": [{"quantity": quantity, "unit_cost": float(cost)}] if quantity > 0 else [],
+            "updated_at": now
+        })
+        bucket = totals.setdefault((branch_id, category), {"quantity": 0, "value": 0.0})
+        bucket["quantity"] += quantity
+        bucket["value"] += value
+
+    # Positions and totals are replaced in place, so a movement applied mid-rebuild
+    # updates a live document instead of colliding with a re-insert; whatever the
+    # rebuild did not write (and nothing has touched since) is then dropped
+    for start in range(0, len(docs), REBUILD_BATCH_SIZE):
+        await target_db.stock_valuations.bulk_write([
+            ReplaceOne(
+                {"tenant_id": tenant_id, "product_id": doc["product_id"], "branch_id": doc["branch_id"]},
+                doc,
+                upsert=True
+            )
+            for doc in docs[start:start + REBUILD_BATCH_SIZE]
+        ], ordered=False)
+    if totals:
+        await target_db.stock_valuation_totals.bulk_write([
+            ReplaceOne(
+                {"tenant_id": tenant_id, "branch_id": branch_id, "category": category},
+                {
+                    "tenant_id": tenant_id,
+                    "branch_id": branch_id,
+                    "category": category,
+                    "quantity": bucket["quantity"],
+                    "avg_value": bucket["value"],
+                    "fifo_value": bucket["value"],
+                    "updated_at": now
+                },
+                upsert=True
+            )
+            for (branch_id, category), bucket in totals.items()
+        ], ordered=False)
+    stale = {"tenant_id": tenant_id, "updated_at": {"$not": {"$gte": now}}}
+    await target_db.stock_valuations.delete_many(stale)
+    await target_db.stock_valuation_totals.delete_many(stale)
+    return len(docs)
@@ -0,0 +1,157 @@
+"""
+Cluster-wide coordination for scheduled jobs.
+Every worker process starts the scheduler, but a job only runs in the worker
+holding the scheduler lease in MongoDB, so each job runs once per cluster. The
+leader renews its lease in the background; if it dies, the next worker whose
+job fires after LEADER_LEASE_SECONDS takes over. Per-tenant work fans out under
+a semaphore with a timeout per tenant, so a nightly run takes about as long as
+its slowest tenant and one failing tenant does not hold up the others.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+import asyncio
+import functools
+import logging
+import os
+import socket
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+LEADER_LEASE_SECONDS = int(os.environ.get('SCHEDULER_LEASE_SECONDS', 60))
+TENANT_CONCURRENCY = int(os.environ.get('SCHEDULER_TENANT_CONCURRENCY', 10))
+TENANT_TIMEOUT_SECONDS = int(os.environ.get('SCHEDULER_TENANT_TIMEOUT_SECONDS', 300))
+LEASE_COLLECTION = "scheduler_leases"
+
+TenantWork = Callable[[Dict[str, Any], Any], Awaitable[Any]]
+
+
+class LeaderLease:
+    """A named lease in the admin database held by at most one worker at a time."""
+
+    def __init__(self, name: str, database_factory: Callable[[], Any]):
+        self.name = name
+        self._database_factory = database_factory
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def try_acquire(self) -> bool:
+        """Take the lease if it is free or expired, or renew it if already held."""
+        now = datetime.now(timezone.utc)
+        try:
+            doc = await self._database_factory()[LEASE_COLLECTION].find_one_and_update(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {
+                    "owner": self.owner,
+                    "expires_at": now + timedelta(seconds=LEADER_LEASE_SECONDS),
+                    "renewed_at": now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            acquired = doc is not None and doc.get("owner") == self.owner
+        except DuplicateKeyError:
+            # Another worker holds a live lease
+            acquired = False
+        except Exception as e:
+            logger.warning(f"Failed to renew scheduler lease {self.name}: {e}")
+            acquired = False
+        if acquired != self.is_leader:
+            logger.info(f"{'👑 Acquired' if acquired else '🛑 Lost'} scheduler lease {self.name} ({self.owner})")
+        self.is_leader = acquired
+        return acquired
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._renew())
+
+    def stop(self):
+        # The lease is left to expire so a restarting deploy hands over cleanly
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.is_leader = False
+
+    async def _renew(self):
+        while True:
+            await self.try_acquire()
+            await asyncio.sleep(LEADER_LEASE_SECONDS / 3)
+
+
+def _admin_db():
+    from db_connection import get_admin_db
+    return get_admin_db()
+
+
+scheduler_leader = LeaderLease("billing_scheduler", _admin_db)
+
+
+def leader_only(job: Callable[[], Awaitable[Any]]):
+    """Wrap a scheduled job so it only runs in the worker holding the scheduler lease."""
+    @functools.wraps(job)
+    async def run():
+        # Checked at fire time: renews the lease, or takes it over from a dead leader
+        if not await scheduler_leader.try_acquire():
+            logger.debug(f"Skipping {job.__name__}: not the scheduler leader")
+            return
+        await job()
+    return run
+
+
+async def run_for_tenants(
+    job_name: str,
+    work: TenantWork,
+    concurrency: int = TENANT_CONCURRENCY,
+    timeout: float = TENANT_TIMEOUT_SECONDS,
+    unique_databases: bool = False
+) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Run work(tenant, target_db) for every active tenant concurrently.
+    With unique_databases, tenants sharing a database run once for it (for work
+    that already covers every tenant_id in the database).
+
+    Returns:
+        (results by tenant slug, slugs that failed or timed out)
+    """
+    from db_connection import iter_active_tenants, tenant_db_for
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results: Dict[str, Any] = {}
+    failed: List[str] = []
+    running: Set[asyncio.Task] = set()
+    seen_databases: Set[Tuple[Any, Any]] = set()
+
+    async def _run_tenant(tenant: Dict[str, Any], slug: str):
+        try:
+            results[slug] = await asyncio.wait_for(work(tenant, tenant_db_for(tenant)), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"❌ {job_name} timed out for tenant {slug} after {timeout}s")
+            failed.append(slug)
+        except Exception as e:
+            logger.error(f"❌ {job_name} failed for tenant {slug}: {e}")
+            failed.append(slug)
+        finally:
+            semaphore.release()
+
+    # Streamed from the registry cursor; a slot is taken before each tenant starts,
+    # so reading the registry keeps pace with the work instead of loading it whole
+    async for tenant in iter_active_tenants():
+        slug = tenant.get("slug") or tenant.get("tenant_slug")
+        if not slug or tenant.get("status") == "suspended":
+            continue
+        if unique_databases:
+            database = (tenant.get("db_uri"), tenant.get("db_name"))
+            if database in seen_databases:
+                continue
+            seen_databases.add(database)
+        await semaphore.acquire()
+        task = asyncio.create_task(_run_tenant(tenant, slug))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+    return results, failed
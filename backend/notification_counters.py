@@ -0,0 +1,360 @@
+"""
+Unread notification counters.
+One document per (tenant, scope) in `notification_counters` holds unread counts
+broken down by type and sticky flag. Scopes are "user:<id>", "branch:<id>",
+"tenant" (tenant-wide notifications) and "all" (everything, for admins).
+Counters are adjusted with $inc on every insert, read and delete made through
+this module, and rebuilt from the notifications collection by reconciliation.
+Content-only updates (activity coalescing) also go through here to be pushed.
+Every change is also pushed to connected clients via notification_publisher.
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+from uuid import uuid4
+import logging
+
+from pymongo import ASCENDING, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+from notification_retention import read_expiry_expression
+from notification_publisher import publish_notification_changes
+
+logger = logging.getLogger(__name__)
+
+ALL_SCOPE = "all"
+TENANT_SCOPE = "tenant"
+# Reads and deletes flip this many notifications per round trip
+NOTIFICATION_BATCH_SIZE = 500
+# Fields _apply_counter_deltas needs to uncount a notification
+COUNTED_FIELDS = {"_id": 0, "id": 1, "tenant_id": 1, "type": 1, "is_sticky": 1, "is_read": 1, "user_id": 1, "branch_id": 1}
+
+
+async def ensure_counter_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "notification_counters"):
+        return
+    try:
+        await target_db.notification_counters.create_index(
+            [("tenant_id", ASCENDING), ("scope", ASCENDING)],
+            unique=True,
+            name="tenant_scope"
+        )
+        mark_indexes_ensured(target_db, "notification_counters")
+    except Exception as e:
+        logger.warning(f"Failed to ensure notification counter indexes on {target_db.name}: {e}")
+
+
+def notification_scope(notification: Dict[str, Any]) -> str:
+    if notification.get("user_id"):
+        return f"user:{notification['user_id']}"
+    if notification.get("branch_id"):
+        return f"branch:{notification['branch_id']}"
+    return TENANT_SCOPE
+
+
+def visible_scopes(current_user: dict) -> List[str]:
+    """Counter scopes making up a user's badge (matches the feed's visibility rules)."""
+    if current_user.get("role") in ("tenant_admin", "super_admin"):
+        return [ALL_SCOPE]
+    scopes = [f"user:{current_user.get('id')}", TENANT_SCOPE]
+    if current_user.get("branch_id"):
+        scopes.append(f"branch:{current_user['branch_id']}")
+    return scopes
+
+
+def _type_value(notification: Dict[str, Any]) -> str:
+    value = notification.get("type")
+    return getattr(value, "value", value) or "unknown"
+
+
+async def _apply_counter_deltas(target_db, notifications: Iterable[Dict[str, Any]], sign: int) -> None:
+    """$inc the scope and "all" counters for unread notifications (sign +1 or -1)."""
+    deltas: Dict[tuple, Dict[str, int]] = {}
+    for notification in notifications:
+        if notification.get("is_read"):
+            continue
+        notif_type = _type_value(notification)
+        fields = {"unread": sign, f"by_type.{notif_type}": sign}
+        if notification.get("is_sticky"):
+            fields["sticky"] = sign
+            fields[f"sticky_by_type.{notif_type}"] = sign
+        for scope in (notification_scope(notification), ALL_SCOPE):
+            bucket = deltas.setdefault((notification["tenant_id"], scope), {})
+            for field, value in fields.items():
+                bucket[field] = bucket.get(field, 0) + value
+
+    if not deltas:
+        return
+    await ensure_counter_indexes(target_db)
+    now = datetime.now(timezone.utc).isoformat()
+    for (tenant_id, scope), inc in deltas.items():
+        await target_db.notification_counters.update_one(
+            {"tenant_id": tenant_id, "scope": scope},
+            {"$inc": inc, "$set": {"updated_at": now}},
+            upsert=True
+        )
+
+
+async def insert_notifications(target_db, notifications: List[Dict[str, Any]]) -> int:
+    """
+    Insert notification documents and count the unread ones.
+    Documents rejected as duplicates (by a unique dedupe key) are skipped.
+
+    Returns:
+        Number of notifications inserted
+    """
+    if not notifications:
+        return 0
+    inserted = notifications
+    if len(notifications) == 1:
+        try:
+            await target_db.notifications.insert_one(notifications[0])
+        except DuplicateKeyError:
+            return 0
+    else:
+        try:
+            await target_db.notifications.insert_many(notifications, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != 11000 for error in errors):
+                raise
+            failed = {error["index"] for error in errors}
+            inserted = [doc for i, doc in enumerate(notifications) if i not in failed]
+    await _apply_counter_deltas(target_db, inserted, 1)
+    await publish_notification_changes(target_db, inserted, created=True)
+    return len(inserted)
+
+
+async def mark_notifications_read(
+    target_db,
+    query: Dict[str, Any],
+    extra_set: Optional[Dict[str, Any]] = None
+) -> int:
+    """
+    Mark unread notifications matching query as read.
+    Unread matches are flipped in batches of NOTIFICATION_BATCH_SIZE with one
+    update_many each, and each batch's counters take one $inc per scope. Every
+    flip is tagged with this call's read_op, so when a concurrent read took part
+    of a batch only the notifications this call flipped are uncounted.
+
+    Returns:
+        Number of notifications marked read
+    """
+    read_op = uuid4().hex
+    # Pipeline update so the read timestamp also sets the retention expiry
+    update = [
+        {"$set": {
+            "is_read": True,
+            "read_op": read_op,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            **(extra_set or {})
+        }},
+        {"$set": {"expires_at": read_expiry_expression()}}
+    ]
+    marked = 0
+
+    async def _flush(batch: List[Dict[str, Any]]):
+        nonlocal marked
+        ids = [doc["id"] for doc in batch]
+        result = await target_db.notifications.update_many(
+            {**query, "id": {"$in": ids}, "is_read": {"$ne": True}}, update
+        )
+        if result.modified_count == len(batch):
+            flipped = batch
+        elif result.modified_count:
+            mine = set(await target_db.notifications.distinct("id", {"id": {"$in": ids}, "read_op": read_op}))
+            flipped = [doc for doc in batch if doc["id"] in mine]
+        else:
+            flipped = []
+        marked += len(flipped)
+        await _apply_counter_deltas(target_db, flipped, -1)
+        await publish_notification_changes(target_db, flipped)
+
+    await _in_batches(target_db, {**query, "is_read": {"$ne": True}}, _flush)
+
+    if extra_set:
+        # Apply the extra fields to already-read matches too
+        await target_db.notifications.update_many(
+            query,
+            [{"$set": extra_set}, {"$set": {"expires_at": read_expiry_expression()}}]
+        )
+    return marked
+
+
+async def delete_notifications(target_db, query: Dict[str, Any]) -> int:
+    """
+    Delete notifications matching query and uncount the unread ones.
+    Matches are deleted by the ids read, in batches, so notifications inserted
+    meanwhile are left alone. An unread match that is read concurrently is not
+    uncounted a second time.
+    """
+    deleted = 0
+
+    async def _flush(batch: List[Dict[str, Any]]):
+        nonlocal deleted
+        unread = [doc for doc in batch if not doc.get("is_read")]
+        unread_ids = [doc["id"] for doc in unread]
+        removed: List[Dict[str, Any]] = []
+        if unread_ids:
+            result = await target_db.notifications.delete_many(
+                {**query, "id": {"$in": unread_ids}, "is_read": {"$ne": True}}
+            )
+            deleted += result.deleted_count
+            if result.deleted_count == len(unread_ids):
+                removed = unread
+            else:
+                # The ones still there were read meanwhile, which already uncounted them
+                left = set(await target_db.notifications.distinct("id", {"id": {"$in": unread_ids}}))
+                removed = [doc for doc in unread if doc["id"] not in left]
+        removed_ids = {doc["id"] for doc in removed}
+        rest = [doc["id"] for doc in batch if doc["id"] not in removed_ids]
+        if rest:
+            deleted += (await target_db.notifications.delete_many({**query, "id": {"$in": rest}})).deleted_count
+        await _apply_counter_deltas(target_db, removed, -1)
+        await publish_notification_changes(target_db, removed)
+
+    await _in_batches(target_db, query, _flush)
+    return deleted
+
+
+async def _in_batches(target_db, query: Dict[str, Any], handle) -> None:
+    """Stream the counted fields of matching notifications to handle() in batches."""
+    batch: List[Dict[str, Any]] = []
+    seen = set()
+    async for doc in target_db.notifications.find(query, COUNTED_FIELDS).batch_size(NOTIFICATION_BATCH_SIZE):
+        # A document updated mid-scan can be returned twice
+        if doc.get("id") is None or doc["id"] in seen:
+            continue
+        seen.add(doc["id"])
+        batch.append(doc)
+        if len(batch) >= NOTIFICATION_BATCH_SIZE:
+            await handle(batch)
+            batch = []
+    if batch:
+        await handle(batch)
+
+
+async def update_unread_notifications(target_db, query: Dict[str, Any], update: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Apply a content-only pipeline update (no change to read state, type, stickiness
+    or audience, so counters are untouched) to each unread notification matching
+    query, and push the updated documents to their audiences.
+
+    Returns:
+        The updated notifications (matches read concurrently are skipped)
+    """
+    ids = await target_db.notifications.distinct("id", {**query, "is_read": {"$ne": True}})
+    updated = []
+    for notification_id in ids:
+        after = await target_db.notifications.find_one_and_update(
+            {**query, "id": notification_id, "is_read": {"$ne": True}},
+            update,
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if after is not None:
+            updated.append(after)
+    await publish_notification_changes(target_db, updated, created=True)
+    return updated
+
+
+async def reconcile_notification_counters(target_db, tenant_id: str) -> Dict[str, Any]:
+    """Rebuild a tenant's counters from the notifications collection."""
+    await ensure_counter_indexes(target_db)
+    rows = await target_db.notifications.aggregate([
+        {"$match": {"tenant_id": tenant_id, "is_read": {"$ne": True}}},
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id",
+                "branch_id": "$branch_id",
+                "type": "$type",
+                "is_sticky": {"$ifNull": ["$is_sticky", False]}
+            },
+            "count": {"$sum": 1}
+        }}
+    ], allowDiskUse=True).to_list(None)
+
+    now = datetime.now(timezone.utc).isoformat()
+    counters: Dict[str, Dict[str, Any]] = {
+        ALL_SCOPE: {"tenant_id": tenant_id, "scope": ALL_SCOPE, "unread": 0, "sticky": 0, "by_type": {}, "sticky_by_type": {}}
+    }
+    for row in rows:
+        key = row["_id"]
+        notif_type = key.get("type") or "unknown"
+        for scope in (notification_scope(key), ALL_SCOPE):
+            doc = counters.setdefault(scope, {
+                "tenant_id": tenant_id, "scope": scope, "unread": 0, "sticky": 0, "by_type": {}, "sticky_by_type": {}
+            })
+            doc["unread"] += row["count"]
+            doc["by_type"][notif_type] = doc["by_type"].get(notif_type, 0) + row["count"]
+            if key.get("is_sticky"):
+                doc["sticky"] += row["count"]
+                doc["sticky_by_type"][notif_type] = doc["sticky_by_type"].get(notif_type, 0) + row["count"]
+
+    for doc in counters.values():
+        doc["updated_at"] = now
+        doc["reconciled_at"] = now
+    counters[ALL_SCOPE]["initialized"] = True
+
+    # Replace each scope in place and then drop only scopes with no unread left, so
+    # readers never see the tenant without counters mid-rebuild
+    await target_db.notification_counters.bulk_write([
+        ReplaceOne({"tenant_id": tenant_id, "scope": scope}, dict(doc), upsert=True)
+        for scope, doc in counters.items()
+    ], ordered=False)
+    await target_db.notification_counters.delete_many(
+        {"tenant_id": tenant_id, "scope": {"$nin": list(counters)}}
+    )
+    return counters[ALL_SCOPE]
+
+
+async def get_notification_counters(target_db, tenant_id: str, scopes: List[str]) -> Dict[str, Any]:
+    """
+    Summed counters for the given scopes (one indexed read).
+
+    Returns:
+        {"unread": int, "sticky": int, "by_type": {...}, "sticky_by_type": {...}}
+    """
+    await ensure_counter_indexes(target_db)
+    docs = await target_db.notification_counters.find(
+        {"tenant_id": tenant_id, "scope": {"$in": scopes + [ALL_SCOPE]}},
+        {"_id": 0}
+    ).to_list(len(scopes) + 1)
+    all_doc = next((d for d in docs if d["scope"] == ALL_SCOPE), None)
+    if all_doc is None or not all_doc.get("initialized"):
+        await reconcile_notification_counters(target_db, tenant_id)
+        docs = await target_db.notification_counters.find(
+            {"tenant_id": tenant_id, "scope": {"$in": scopes}},
+            {"_id": 0}
+        ).to_list(len(scopes))
+
+    return sum_counter_docs(docs, scopes)
+
+
+def sum_counter_docs(docs: Iterable[Dict[str, Any]], scopes: List[str]) -> Dict[str, Any]:
+    """Add up the counter documents of the given scopes."""
+    totals: Dict[str, Any] = {"unread": 0, "sticky": 0, "by_type": {}, "sticky_by_type": {}}
+    for doc in docs:
+        if doc["scope"] not in scopes:
+            continue
+        totals["unread"] += max(doc.get("unread", 0), 0)
+        totals["sticky"] += max(doc.get("sticky", 0), 0)
+        for field in ("by_type", "sticky_by_type"):
+            for notif_type, count in (doc.get(field) or {}).items():
+                totals[field][notif_type] = totals[field].get(notif_type, 0) + max(count, 0)
+    return totals
+
+
+async def reconcile_all_tenant_counters() -> int:
+    """Scheduled job: reconcile counters for every tenant found in each active tenant database, tenants in parallel."""
+    from job_coordination import run_for_tenants
+
+    async def reconcile_tenant(tenant, target_db) -> int:
+        tenant_ids = await target_db.notifications.distinct("tenant_id")
+        for tenant_id in tenant_ids:
+            await reconcile_notification_counters(target_db, tenant_id)
+        return len(tenant_ids)
+
+    results, _ = await run_for_tenants("Notification counter reconciliation", reconcile_tenant, unique_databases=True)
+    return sum(results.values())
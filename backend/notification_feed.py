@@ -0,0 +1,237 @@
+"""
+Unified notifications feed.
+Tenant notifications (sorted newest first on an index and fetched only up to
+the page size) and cached announcements are read as separate streams, then
+merged k-way. Pages are addressed with an opaque (timestamp, id) cursor.
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+import base64
+import heapq
+import json
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+from notification_service import admin_db, announcement_cache
+
+logger = logging.getLogger(__name__)
+
+FEED_MAX_LIMIT = 100
+
+ADMIN_FEED_ROLES = ("tenant_admin", "super_admin")
+
+_receipt_indexes_ready = False
+
+
+async def ensure_notification_indexes(target_db) -> None:
+    global _receipt_indexes_ready
+    if not indexes_ensured(target_db, "notification_feed"):
+        try:
+            await target_db.notifications.create_index(
+                [("tenant_id", ASCENDING), ("created_at", DESCENDING), ("id", DESCENDING)],
+                name="tenant_created_at"
+            )
+            await target_db.notifications.create_index(
+                [("tenant_id", ASCENDING), ("user_id", ASCENDING), ("created_at", DESCENDING)],
+                name="tenant_user_created_at"
+            )
+            await target_db.notifications.create_index(
+                [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("user_id", ASCENDING), ("created_at", DESCENDING)],
+                name="tenant_branch_user_created_at"
+            )
+            mark_indexes_ensured(target_db, "notification_feed")
+        except Exception as e:
+            logger.warning(f"Failed to ensure notification indexes on {target_db.name}: {e}")
+    if not _receipt_indexes_ready:
+        try:
+            await admin_db.notification_receipts.create_index(
+                [("tenant_id", ASCENDING), ("delivered_at", DESCENDING)],
+                name="tenant_delivered_at"
+            )
+            _receipt_indexes_ready = True
+        except Exception as e:
+            logger.warning(f"Failed to ensure notification receipt indexes: {e}")
+
+
+def as_utc(value: Any) -> datetime:
+    """Normalise ISO strings, naive datetimes and missing values to aware UTC datetimes."""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            value = None
+    if not isinstance(value, datetime):
+        return datetime.min.replace(tzinfo=timezone.utc)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def encode_cursor(timestamp: datetime, item_id: str) -> str:
+    raw = json.dumps({"t": timestamp.isoformat(), "id": item_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Raises ValueError for a malformed cursor."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return as_utc(data["t"]), str(data["id"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def notification_scopes(current_user: dict) -> List[Dict[str, Any]]:
+    """
+    Disjoint filters for the notifications a user can see.
+    Admins see everything; other users see their own, their branch's and tenant-wide ones.
+    """
+    if current_user.get("role") in ADMIN_FEED_ROLES:
+        return [{}]
+    scopes = [
+        {"user_id": current_user.get("id")},
+        {"branch_id": None, "user_id": None},
+    ]
+    if current_user.get("branch_id"):
+        scopes.append({"branch_id": current_user["branch_id"], "user_id": None})
+    return scopes
+
+
+def _after_cursor(item: Dict[str, Any], before: Optional[Tuple[datetime, str]]) -> bool:
+    if before is None:
+        return True
+    key = (item["_sort_ts"], str(item.get("id")))
+    return key < before
+
+
+async def _tenant_stream(
+    target_db,
+    base_query: Dict[str, Any],
+    scope: Dict[str, Any],
+    before: Optional[Tuple[datetime, str]],
+    limit: int
+) -> List[Dict[str, Any]]:
+    query = {**base_query, **scope}
+    if before is not None:
+        # The whole (created_at, id) keyset is matched in MongoDB, so any number of
+        # notifications sharing the cursor's timestamp still page through
+        created_at, cursor_id = before[0].isoformat(), before[1]
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": cursor_id}}
+        ]
+    docs = await target_db.notifications.find(query, {"_id": 0}).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(limit + 1).to_list(limit + 1)
+
+    items = []
+    for notif in docs:
+        notif["_sort_ts"] = as_utc(notif.get("created_at"))
+        notif["created_at"] = notif["_sort_ts"]
+        if notif.get("updated_at") is not None:
+            notif["updated_at"] = as_utc(notif["updated_at"])
+        notif["source"] = "tenant"
+        if "is_read" in notif:
+            notif["read"] = notif["is_read"]
+        items.append(notif)
+    return items
+
+
+async def _announcement_stream(
+    tenant_id: str,
+    before: Optional[Tuple[datetime, str]],
+    limit: int,
+    unread_only: bool
+) -> List[Dict[str, Any]]:
+    # Served from the in-memory announcement cache, newest delivery first
+    items: List[Dict[str, Any]] = []
+    for ann, (delivered_at, is_read, is_dismissed) in await announcement_cache.tenant_announcements(tenant_id):
+        if unread_only and is_read:
+            continue
+        item = {
+            "id": ann["announcement_id"],
+            "type": ann.get("announcement_type", "info"),
+            "message": ann.get("message", ""),
+            "title": ann.get("title", ""),
+            "created_at": ann.get("created_at", delivered_at),
+            "updated_at": ann.get("updated_at", delivered_at),
+            "is_read": is_read,
+            "read": is_read,
+            "is_dismissed": is_dismissed,
+            "source": "announcement",
+            "priority": ann.get("priority", 0),
+            "tenant_id": tenant_id,
+            "_sort_ts": as_utc(delivered_at)
+        }
+        if not _after_cursor(item, before):
+            continue
+        items.append(item)
+        if len(items) > limit:
+            break
+    return items
+
+
+async def get_notification_feed(
+    target_db,
+    current_user: dict,
+    *,
+    notification_type: Optional[str] = None,
+    unread_only: bool = False,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    include_announcements: bool = True
+) -> Dict[str, Any]:
+    """
+    One page of the merged feed, newest first.
+
+    Returns:
+        {"notifications": [...], "next_cursor": str | None}
+    """
+    limit = max(1, min(limit, FEED_MAX_LIMIT))
+    before = decode_cursor(cursor) if cursor else None
+    tenant_id = current_user["tenant_id"]
+
+    streams: List[List[Dict[str, Any]]] = []
+    if target_db is not None:
+        await ensure_notification_indexes(target_db)
+        base_query: Dict[str, Any] = {"tenant_id": tenant_id}
+        if notification_type:
+            base_query["type"] = notification_type
+        if unread_only:
+            base_query["is_read"] = False
+        for scope in notification_scopes(current_user):
+            streams.append(await _tenant_stream(target_db, base_query, scope, before, limit))
+
+    # Announcements have their own types, so a type filter only applies to tenant notifications
+    if include_announcements and not notification_type:
+        try:
+            streams.append(await _announcement_stream(tenant_id, before, limit, unread_only))
+        except Exception as e:
+            logger.error(f"Error fetching announcements: {str(e)}")
+
+    def sort_key(item):
+        return (item["_sort_ts"], str(item.get("id")))
+
+    for stream in streams:
+        stream.sort(key=sort_key, reverse=True)
+    merged = heapq.merge(*streams, key=sort_key, reverse=True)
+
+    page: List[Dict[str, Any]] = []
+    has_more = False
+    for item in merged:
+        if len(page) == limit:
+            has_more = True
+            break
+        page.append(item)
+
+    next_cursor = None
+    if has_more and page:
+        next_cursor = encode_cursor(page[-1]["_sort_ts"], str(page[-1].get("id")))
+    for item in page:
+        item.pop("_sort_ts", None)
+
+    return {"notifications": page, "next_cursor": next_cursor}
+
@@ -33,6 +33,14 @@ class NotificationChannel(str, Enum):
     EMAIL = "email"
     BOTH = "both"
 
+class AnnouncementDeliveryStatus(str, Enum):
+    """In-app receipt delivery states"""
+    NOT_REQUIRED = "not_required"
+    QUEUED = "queued"
+    DELIVERING = "delivering"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
 class EmailCampaignStatus(str, Enum):
     """Email campaign states"""
     DRAFT = "draft"
@@ -87,6 +95,10 @@ class Announcement(BaseModel):
     total_read: int = 0
     total_dismissed: int = 0
     
+    # In-app delivery progress (receipts are created by a background job)
+    delivery_status: AnnouncementDeliveryStatus = AnnouncementDeliveryStatus.NOT_REQUIRED
+    delivered_count: int = 0
+    
     @validator('target_sectors')
     def validate_sectors(cls, v, values):
         """Ensure sectors are provided when audience_type is SPECIFIC_SECTORS"""
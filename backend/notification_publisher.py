@@ -0,0 +1,88 @@
+"""
+Live notification push.
+notification_counters calls publish_notification_changes after every insert,
+read and delete, so new notifications and the affected unread counters reach
+connected clients over the broadcast bus without polling. Pushing never fails
+the write that triggered it.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Larger batches (scheduler runs) are announced as a count instead of one message per notification
+LIVE_NOTIFICATION_LIMIT = 20
+
+_bus = None
+
+
+def configure_notification_publisher(bus) -> None:
+    global _bus
+    _bus = bus
+
+
+def notification_audience(notification: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """Who can see a notification: one user, one branch, or the whole tenant (admins always)."""
+    return {"user_id": notification.get("user_id"), "branch_id": notification.get("branch_id")}
+
+
+def _message(message_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": message_type, "data": data, "timestamp": datetime.now(timezone.utc).isoformat()}
+
+
+async def _publish_tenant(target_db, tenant_id: str, notifications: List[Dict[str, Any]], created: bool):
+    audiences: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+    counts: Dict[tuple, int] = {}
+    for notification in notifications:
+        audience = notification_audience(notification)
+        key = (audience["user_id"], audience["branch_id"])
+        audiences.setdefault(key, audience)
+        counts[key] = counts.get(key, 0) + 1
+
+    if created:
+        if len(notifications) <= LIVE_NOTIFICATION_LIMIT:
+            for notification in notifications:
+                data = {k: v for k, v in notification.items() if k != "_id"}
+                await _bus.publish({
+                    "kind": "notification",
+                    "tenant_id": tenant_id,
+                    "audience": notification_audience(notification),
+                    "message": _message("notification", data)
+                })
+        else:
+            for key, audience in audiences.items():
+                await _bus.publish({
+                    "kind": "notification",
+                    "tenant_id": tenant_id,
+                    "audience": audience,
+                    "message": _message("notifications_created", {"count": counts[key]})
+                })
+
+    # One doc per user and branch plus tenant and all; small enough to send whole
+    counter_docs = await target_db.notification_counters.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "scope": 1, "unread": 1, "sticky": 1, "by_type": 1, "sticky_by_type": 1}
+    ).to_list(None)
+    await _bus.publish({
+        "kind": "counters",
+        "tenant_id": tenant_id,
+        "audiences": list(audiences.values()),
+        "scopes": {doc["scope"]: doc for doc in counter_docs}
+    })
+
+
+async def publish_notification_changes(target_db, notifications: List[Dict[str, Any]], created: bool = False) -> None:
+    """Push created notifications (when created) and refreshed counters to their audiences."""
+    if _bus is None or not notifications:
+        return
+    by_tenant: Dict[str, List[Dict[str, Any]]] = {}
+    for notification in notifications:
+        by_tenant.setdefault(notification["tenant_id"], []).append(notification)
+    for tenant_id, tenant_notifications in by_tenant.items():
+        try:
+            await _publish_tenant(target_db, tenant_id, tenant_notifications, created)
+        except Exception as e:
+            logger.warning(f"Failed to publish notification changes for tenant {tenant_id}: {e}")
@@ -0,0 +1,213 @@
+"""
+Notification retention.
+Read, non-sticky notifications get an `expires_at` date when they are read
+(retention depends on type) and a TTL index removes them. Anything TTL does
+not cover (sticky or never read) is moved to `notifications_archive` once it
+is older than the archive horizon, so the live collection stays bounded.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION_DAYS = 30
+# Days a read, non-sticky notification is kept, by type; override with a JSON object in NOTIFICATION_RETENTION_DAYS
+RETENTION_DAYS: Dict[str, int] = {
+    "activity": 7,
+    "payment_received": 14,
+    "unpaid_invoice": 30,
+    "low_stock": 30,
+    "sale_cancelled": 30,
+    "due_request": 90,
+    "due_request_approved": 90,
+    "due_request_rejected": 90,
+    **json.loads(os.environ.get('NOTIFICATION_RETENTION_DAYS', '{}'))
+}
+ARCHIVE_AFTER_DAYS = int(os.environ.get('NOTIFICATION_ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_BATCH_SIZE = 1000
+
+
+async def ensure_retention_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "notification_retention"):
+        return
+    try:
+        await target_db.notifications.create_index(
+            [("expires_at", ASCENDING)],
+            expireAfterSeconds=0,
+            name="expires_at_ttl"
+        )
+        await target_db.notifications_archive.create_index(
+            [("tenant_id", ASCENDING), ("created_at", ASCENDING)],
+            name="tenant_created_at"
+        )
+        await target_db.notifications_archive.create_index(
+            [("id", ASCENDING)],
+            unique=True,
+            name="id"
+        )
+        mark_indexes_ensured(target_db, "notification_retention")
+    except Exception as e:
+        logger.warning(f"Failed to ensure notification retention indexes on {target_db.name}: {e}")
+
+
+def read_expiry_expression(base: Any = "$$NOW") -> Dict[str, Any]:
+    """
+    Aggregation expression for a notification's expires_at, for use in pipeline updates.
+    Sticky or unread notifications have no expiry ($$REMOVE drops the field).
+    """
+    retention_ms = {
+        "$switch": {
+            "branches": [
+                {"case": {"$eq": ["$type", notif_type]}, "then": days * 86400000}
+                for notif_type, days in RETENTION_DAYS.items()
+            ],
+            "default": DEFAULT_RETENTION_DAYS * 86400000
+        }
+    }
+    return {
+        "$cond": [
+            {"$or": [{"$eq": ["$is_sticky", True]}, {"$ne": ["$is_read", True]}]},
+            "$$REMOVE",
+            {"$add": [base, retention_ms]}
+        ]
+    }
+
+
+async def backfill_read_expiry(target_db, tenant_id: str) -> int:
+    """Set expires_at on notifications read before retention existed, counted from their last update."""
+    result = await target_db.notifications.update_many(
+        {"tenant_id": tenant_id, "is_read": True, "is_sticky": {"$ne": True}, "expires_at": {"$exists": False}},
+        [{"$set": {"expires_at": read_expiry_expression(
+            {"$dateFromString": {"dateString": "$updated_at", "onError": "$$NOW", "onNull": "$$NOW"}}
+        )}}]
+    )
+    return result.modified_count
+
+
+async def archive_old_notifications(target_db, tenant_id: str, now: Optional[datetime] = None) -> int:
+    """
+    Move notifications older than ARCHIVE_AFTER_DAYS that TTL will not remove
+    (sticky or unread) into notifications_archive, in batches.
+
+    Returns:
+        Number of notifications archived
+    """
+    from notification_counters import delete_notifications
+
+    now = now or datetime.now(timezone.utc)
+    cutoff = (now - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    query = {
+        "tenant_id": tenant_id,
+        "created_at": {"$lt": cutoff},
+        "$or": [{"is_sticky": True}, {"is_read": {"$ne": True}}]
+    }
+
+    archived = 0
+    while True:
+        batch = await target_db.notifications.find(query, {"_id": 0}).limit(ARCHIVE_BATCH_SIZE).to_list(ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        archived_at = now.isoformat()
+        for doc in batch:
+            doc["archived_at"] = archived_at
+        try:
+            await target_db.notifications_archive.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # Already archived by an earlier, interrupted run
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        archived += await delete_notifications(
+            target_db,
+            {"tenant_id": tenant_id, "id": {"$in": [doc["id"] for doc in batch]}}
+        )
+        if len(batch) < ARCHIVE_BATCH_SIZE:
+            break
+    return archived
+
+
+async def apply_notification_retention(target_db, tenant_id: str) -> Dict[str, int]:
+    await ensure_retention_indexes(target_db)
+    return {
+        "expiry_backfilled": await backfill_read_expiry(target_db, tenant_id),
+        "archived": await archive_old_notifications(target_db, tenant_id)
+    }
+
+
+async def apply_retention_all_tenants() -> Dict[str, int]:
+    """Scheduled job: apply retention in every active tenant database, tenants in parallel."""
+    from job_coordination import run_for_tenants
+
+    async def retain_tenant(tenant, target_db) -> Dict[str, int]:
+        tenant_totals = {"expiry_backfilled": 0, "archived": 0}
+        for tenant_id in await target_db.notifications.distinct("tenant_id"):
+            result = await apply_notification_retention(target_db, tenant_id)
+            for key, value in result.items():
+                tenant_totals[key] += value
+        return tenant_totals
+
+    results, _ = await run_for_tenants("Notification retention", retain_tenant, unique_databases=True)
+    totals = {"expiry_backfilled": 0, "archived": 0}
+    for tenant_totals in results.values():
+        for key, value in tenant_totals.items():
+            totals[key] += value
+    return totals
+
+
+async def get_notification_storage_stats(target_db, tenant_id: str) -> Dict[str, Any]:
+    """Document counts and estimated bytes of a tenant's live and archived notifications."""
+    stats: Dict[str, Any] = {"tenant_id": tenant_id}
+    for collection in ("notifications", "notifications_archive"):
+        rows = await target_db[collection].aggregate([
+            {"$match": {"tenant_id": tenant_id}},
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                "unread": {"$sum": {"$cond": [{"$ne": ["$is_read", True]}, 1, 0]}},
+                "sticky": {"$sum": {"$cond": [{"$eq": ["$is_sticky", True]}, 1, 0]}},
+                "expiring": {"$sum": {"$cond": [{"$ifNull": ["$expires_at", False]}, 1, 0]}},
+                "oldest": {"$min": "$created_at"}
+            }}
+        ], allowDiskUse=True).to_list(1)
+        row = rows[0] if rows else {"count": 0, "unread": 0, "sticky": 0, "expiring": 0, "oldest": None}
+        row.pop("_id", None)
+
+        # Size is estimated from the collection's average document size
+        try:
+            coll_stats = await target_db.command("collStats", collection)
+            row["estimated_bytes"] = int(row["count"] * coll_stats.get("avgObjSize", 0))
+        except Exception:
+            row["estimated_bytes"] = None
+        stats[collection] = row
+
+    stats["retention_days"] = {**RETENTION_DAYS, "default": DEFAULT_RETENTION_DAYS}
+    stats["archive_after_days"] = ARCHIVE_AFTER_DAYS
+    return stats
+
+
+async def get_all_tenant_storage_stats() -> List[Dict[str, Any]]:
+    from db_connection import resolve_tenant_db, iter_active_tenants
+
+    results = []
+    async for tenant in iter_active_tenants():
+        slug = tenant.get("slug") or tenant.get("tenant_slug")
+        if not slug:
+            continue
+        try:
+            target_db = await resolve_tenant_db(slug)
+            for tenant_id in await target_db.notifications.distinct("tenant_id"):
+                stats = await get_notification_storage_stats(target_db, tenant_id)
+                stats["tenant_slug"] = slug
+                results.append(stats)
+        except Exception as e:
+            logger.error(f"❌ Failed to read notification storage for {slug}: {e}")
+    results.sort(key=lambda s: s["notifications"]["count"], reverse=True)
+    return results
@@ -5,12 +5,18 @@ Handles announcement creation, audience filtering, and delivery tracking
 from motor.motor_asyncio import AsyncIOMotorClient
 from notification_models import (
     Announcement, NotificationReceipt, EmailCampaign, EmailQueue,
-    AudienceType, NotificationChannel, AnnouncementType
+    AudienceType, NotificationChannel, AnnouncementType, AnnouncementDeliveryStatus
 )
-from datetime import datetime
+from pymongo import ASCENDING, ReturnDocument
+from announcement_cache import AnnouncementCache
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
+from uuid import uuid4
+import asyncio
 import logging
 import os
+import socket
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +25,14 @@ MONGO_URL = os.getenv("MONGO_URL")
 mongo_client = AsyncIOMotorClient(MONGO_URL)
 admin_db = mongo_client["admin_hub"]
 
+# Receipts are inserted in chunks of this size while streaming recipient tenants
+RECEIPT_CHUNK_SIZE = 1000
+# A delivery's lease is renewed with every chunk; an expired lease lets another worker resume it
+DELIVERY_LEASE_SECONDS = 300
+DELIVERY_POLL_SECONDS = 30
+
+announcement_cache = AnnouncementCache(admin_db)
+
 class NotificationService:
     """Service for managing announcements and notifications"""
     
@@ -42,12 +56,17 @@ class NotificationService:
         recipient_count = await NotificationService._calculate_recipients(announcement)
         announcement["total_recipients"] = recipient_count
         
+        # In-app receipts are delivered by a background job; the request only queues it
+        in_app = NotificationChannel.IN_APP in announcement["channels"] or NotificationChannel.BOTH in announcement["channels"]
+        if in_app:
+            announcement["delivery_status"] = AnnouncementDeliveryStatus.QUEUED.value
+        
         # Insert announcement
         await admin_db.announcements.insert_one(announcement)
         
-        # If in-app notification, create receipts for all recipients
-        if NotificationChannel.IN_APP in announcement["channels"] or NotificationChannel.BOTH in announcement["channels"]:
-            await NotificationService._create_notification_receipts(announcement)
+        await announcement_cache.bump_version()
+        if in_app:
+            announcement_delivery_queue.enqueue(announcement["announcement_id"])
         
         # Remove MongoDB's _id field before returning (it's not JSON serializable)
         if "_id" in announcement:
@@ -102,40 +121,133 @@ class NotificationService:
         return 0
     
     @staticmethod
-    async def _create_notification_receipts(announcement: Dict[str, Any]):
+    async def deliver_announcement(announcement_id: str, owner: Optional[str] = None) -> int:
         """
-        Create notification receipts for all recipients
+        Create in-app receipts for every recipient tenant.
+        Tenant ids are streamed from a cursor and receipts inserted in chunks,
+        with progress recorded on the announcement. Receipts are unique per
+        (announcement, tenant), so an interrupted delivery can simply be rerun.
         
         Args:
-            announcement: Announcement data
+            announcement_id: Announcement ID
+            owner: Delivery lease owner when claimed through AnnouncementDeliveryQueue;
+                the lease is renewed with each chunk
+            
+        Returns:
+            Number of receipts created
         """
-        # Get recipient tenant IDs
-        tenant_ids = await NotificationService._get_recipient_tenant_ids(announcement)
-        
-        # Create receipts
-        receipts = []
-        for tenant_id in tenant_ids:
-            receipt = NotificationReceipt(
-                announcement_id=announcement["announcement_id"],
-                tenant_id=tenant_id,
-                channel=NotificationChannel.IN_APP
+        progress_filter = {"announcement_id": announcement_id}
+        if owner is not None:
+            progress_filter["delivery_owner"] = owner
+        done = {"$unset": {"delivery_owner": "", "delivery_lease_expires_at": ""}}
+        
+        announcement = await admin_db.announcements.find_one({"announcement_id": announcement_id}, {"_id": 0})
+        if not announcement or not announcement.get("is_active", True):
+            if owner is not None:
+                # Deactivated while queued: nothing to deliver, so don't leave it to be claimed again
+                await admin_db.announcements.update_one(
+                    progress_filter,
+                    {**done, "$set": {"delivery_status": AnnouncementDeliveryStatus.COMPLETED.value, "updated_at": datetime.utcnow()}}
+                )
+            return 0
+        
+        if owner is None:
+            await admin_db.announcements.update_one(
+                {"announcement_id": announcement_id},
+                {"$set": {"delivery_status": AnnouncementDeliveryStatus.DELIVERING.value, "updated_at": datetime.utcnow()}}
             )
-            receipts.append(receipt.dict())
         
-        if receipts:
-            await admin_db.notification_receipts.insert_many(receipts)
-            logger.info(f"Created {len(receipts)} notification receipts for {announcement['announcement_id']}")
+        delivered = 0
+        chunk: List[Dict[str, Any]] = []
+        
+        async def _flush() -> bool:
+            nonlocal delivered
+            if owner is not None:
+                # Renewed before inserting: a worker whose lease was taken over stops here
+                now = datetime.utcnow()
+                renewed = await admin_db.announcements.update_one(
+                    progress_filter,
+                    {"$set": {"delivery_lease_expires_at": now + timedelta(seconds=DELIVERY_LEASE_SECONDS), "updated_at": now}}
+                )
+                if not renewed.matched_count:
+                    return False
+            try:
+                result = await admin_db.notification_receipts.insert_many(chunk, ordered=False)
+                inserted = len(result.inserted_ids)
+            except BulkWriteError as e:
+                # Duplicates are receipts from an earlier, interrupted run
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+                inserted = e.details.get("nInserted", 0)
+            delivered += inserted
+            await admin_db.announcements.update_one(
+                {"announcement_id": announcement_id},
+                {"$inc": {"delivered_count": inserted}, "$set": {"updated_at": datetime.utcnow()}}
+            )
+            # Make the new receipts visible to cached tenant maps
+            await announcement_cache.bump_version()
+            return True
+        
+        cursor = admin_db.tenant_registry.find(
+            NotificationService._recipient_query(announcement),
+            {"_id": 0, "tenant_id": 1}
+        ).batch_size(RECEIPT_CHUNK_SIZE)
+        async for tenant in cursor:
+            if not tenant.get("tenant_id"):
+                continue
+            chunk.append(NotificationReceipt(
+                announcement_id=announcement_id,
+                tenant_id=tenant["tenant_id"],
+                channel=NotificationChannel.IN_APP
+            ).dict())
+            if len(chunk) >= RECEIPT_CHUNK_SIZE:
+                if not await _flush():
+                    logger.warning(f"Lost the delivery lease for {announcement_id}; stopping after {delivered} receipts")
+                    return delivered
+                chunk = []
+        if chunk and not await _flush():
+            logger.warning(f"Lost the delivery lease for {announcement_id}; stopping after {delivered} receipts")
+            return delivered
+        
+        await admin_db.announcements.update_one(
+            progress_filter,
+            {**done, "$set": {"delivery_status": AnnouncementDeliveryStatus.COMPLETED.value, "updated_at": datetime.utcnow()}}
+        )
+        logger.info(f"Created {delivered} notification receipts for {announcement_id}")
+        return delivered
     
     @staticmethod
-    async def _get_recipient_tenant_ids(announcement: Dict[str, Any]) -> List[str]:
+    async def get_delivery_progress(announcement_id: str) -> Optional[Dict[str, Any]]:
         """
-        Get list of tenant IDs that should receive this announcement
+        Receipt delivery progress for an announcement
+        
+        Args:
+            announcement_id: Announcement ID
+            
+        Returns:
+            Delivery status, counts and percentage, or None if not found
+        """
+        progress = await admin_db.announcements.find_one(
+            {"announcement_id": announcement_id},
+            {"_id": 0, "announcement_id": 1, "delivery_status": 1, "delivered_count": 1, "total_recipients": 1, "delivery_error": 1}
+        )
+        if not progress:
+            return None
+        total = progress.get("total_recipients") or 0
+        delivered = progress.get("delivered_count") or 0
+        progress["progress_percent"] = round(min(delivered / total * 100, 100), 1) if total else 100.0
+        return progress
+    
+    @staticmethod
+    def _recipient_query(announcement: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Registry query matching the tenants that should receive this announcement
         
         Args:
             announcement: Announcement data
             
         Returns:
-            List of tenant IDs
+            MongoDB query
         """
         audience_type = announcement["audience_type"]
         
@@ -155,18 +267,17 @@ class NotificationService:
                 query["tenant_id"] = {"$in": tenant_ids}  # type: ignore
         
         elif audience_type == AudienceType.CUSTOM_FILTER.value:
-            custom_filter = announcement.get("custom_filter", {})
+            custom_filter = announcement.get("custom_filter") or {}
             query.update(custom_filter)
         
-        # Fetch tenant IDs
-        tenants = await admin_db.tenant_registry.find(query, {"tenant_id": 1}).to_list(None)
-        return [t["tenant_id"] for t in tenants]
+        return query
     
     @staticmethod
     async def get_announcements_for_tenant(tenant_id: str) -> List[Dict[str, Any]]:
         """
         Get all active announcements for a specific tenant (excluding dismissed ones).
-        Filters out orphaned receipts and opportunistically cleans them up.
+        Served from the announcement cache; orphaned receipts are removed by
+        cleanup_orphaned_receipts on a schedule.
         
         Args:
             tenant_id: Tenant ID
@@ -174,59 +285,35 @@ class NotificationService:
         Returns:
             List of announcements with read status
         """
-        # Get all non-dismissed receipts for this tenant
-        receipts = await admin_db.notification_receipts.find({
-            "tenant_id": tenant_id,
-            "is_dismissed": {"$ne": True}  # Exclude dismissed notifications
-        }).to_list(None)
-        
-        if not receipts:
-            return []
-        
-        # Get announcement IDs
-        announcement_ids = [r["announcement_id"] for r in receipts]
+        announcements = []
+        for announcement, (delivered_at, is_read, is_dismissed) in await announcement_cache.tenant_announcements(tenant_id):
+            announcements.append({
+                **announcement,
+                "delivered_at": delivered_at,
+                "is_read": is_read,
+                "is_dismissed": is_dismissed
+            })
+        announcements.sort(key=lambda a: (a.get("priority", 0), a.get("created_at") or datetime.min), reverse=True)
+        return announcements
+    
+    @staticmethod
+    async def cleanup_orphaned_receipts() -> int:
+        """
+        Delete receipts whose announcement is inactive, expired or missing
         
-        # Fetch announcements
+        Returns:
+            Number of receipts deleted
+        """
         now = datetime.utcnow()
-        announcements = await admin_db.announcements.find({
-            "announcement_id": {"$in": announcement_ids},
+        live_ids = await admin_db.announcements.distinct("announcement_id", {
             "is_active": True,
-            "$or": [
-                {"expires_at": None},
-                {"expires_at": {"$gt": now}}
-            ]
-        }).sort("priority", -1).sort("created_at", -1).to_list(None)
-        
-        # Identify valid announcement IDs
-        valid_announcement_ids = {ann["announcement_id"] for ann in announcements}
-        
-        # Find orphaned receipts (receipts without corresponding announcements)
-        orphaned_receipt_ids = [
-            r["announcement_id"] for r in receipts 
-            if r["announcement_id"] not in valid_announcement_ids
-        ]
-        
-        # Opportunistically delete orphaned receipts
-        if orphaned_receipt_ids:
-            delete_result = await admin_db.notification_receipts.delete_many({
-                "tenant_id": tenant_id,
-                "announcement_id": {"$in": orphaned_receipt_ids}
-            })
-            logger.warning(
-                f"🧹 Cleaned up {delete_result.deleted_count} orphaned notification receipts "
-                f"for tenant {tenant_id} (announcements: {orphaned_receipt_ids[:5]}{'...' if len(orphaned_receipt_ids) > 5 else ''})"
-            )
-        
-        # Merge read status
-        receipt_map = {r["announcement_id"]: r for r in receipts}
-        for ann in announcements:
-            receipt = receipt_map.get(ann["announcement_id"])
-            if receipt:
-                ann["is_read"] = receipt.get("is_read", False)
-                ann["read_at"] = receipt.get("read_at")
-                ann["is_dismissed"] = receipt.get("is_dismissed", False)
-        
-        return announcements
+            "$or": [{"expires_at": None}, {"expires_at": {"$gt": now}}]
+        })
+        result = await admin_db.notification_receipts.delete_many({"announcement_id": {"$nin": live_ids}})
+        if result.deleted_count:
+            logger.info(f"🧹 Cleaned up {result.deleted_count} orphaned notification receipts")
+            await announcement_cache.bump_version()
+        return result.deleted_count
     
     @staticmethod
     async def mark_as_read(announcement_id: str, tenant_id: str) -> bool:
@@ -254,6 +341,7 @@ class NotificationService:
         )
         
         if result.modified_count > 0:
+            announcement_cache.mark_local(tenant_id, announcement_id, read=True)
             # Increment total_read counter
             await admin_db.announcements.update_one(
                 {"announcement_id": announcement_id},
@@ -289,6 +377,7 @@ class NotificationService:
         )
         
         if result.modified_count > 0:
+            announcement_cache.mark_local(tenant_id, announcement_id, dismissed=True)
             # Increment total_dismissed counter
             await admin_db.announcements.update_one(
                 {"announcement_id": announcement_id},
@@ -309,30 +398,7 @@ class NotificationService:
         Returns:
             Count of unread notifications
         """
-        # Get non-dismissed, unread receipt IDs
-        receipts = await admin_db.notification_receipts.find({
-            "tenant_id": tenant_id,
-            "is_read": False,
-            "is_dismissed": False
-        }, {"announcement_id": 1}).to_list(None)
-        
-        if not receipts:
-            return 0
-        
-        announcement_ids = [r["announcement_id"] for r in receipts]
-        
-        # Count only active, non-expired announcements
-        now = datetime.utcnow()
-        count = await admin_db.announcements.count_documents({
-            "announcement_id": {"$in": announcement_ids},
-            "is_active": True,
-            "$or": [
-                {"expires_at": None},
-                {"expires_at": {"$gt": now}}
-            ]
-        })
-        
-        return count
+        return await announcement_cache.unread_count(tenant_id)
     
     @staticmethod
     async def get_all_announcements(skip: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
@@ -375,5 +441,110 @@ class NotificationService:
                 f"🧹 Deleted announcement {announcement_id} and cleaned up "
                 f"{receipt_result.deleted_count} associated notification receipts"
             )
+            await announcement_cache.bump_version()
         
         return result.modified_count > 0
+
+
+class AnnouncementDeliveryQueue:
+    """
+    Runs announcement receipt delivery in the background, one announcement at a time.
+    A worker claims a delivery with a lease before running it, so each delivery runs
+    in one process even though every process runs a queue. Deliveries left queued,
+    or in progress under an expired lease by a process that died, are picked up by
+    the next poll in any process.
+    """
+    
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+    
+    async def start(self):
+        if self._worker:
+            return
+        self._queue = asyncio.Queue()
+        try:
+            await admin_db.notification_receipts.create_index(
+                [("announcement_id", ASCENDING), ("tenant_id", ASCENDING)],
+                unique=True,
+                name="announcement_tenant"
+            )
+            await admin_db.announcements.create_index(
+                [("delivery_status", ASCENDING), ("delivery_lease_expires_at", ASCENDING)],
+                name="delivery_status_lease"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to ensure notification receipt indexes: {e}")
+        self._worker = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+    
+    def enqueue(self, announcement_id: str):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+        self._queue.put_nowait(announcement_id)
+    
+    async def claim(self, announcement_id: Optional[str] = None) -> Optional[str]:
+        """Lease a queued delivery, or one whose lease expired, to this process."""
+        now = datetime.utcnow()
+        claimable: Dict[str, Any] = {"$or": [
+            {"delivery_status": AnnouncementDeliveryStatus.QUEUED.value},
+            {
+                "delivery_status": AnnouncementDeliveryStatus.DELIVERING.value,
+                "$or": [{"delivery_lease_expires_at": {"$lt": now}}, {"delivery_lease_expires_at": None}]
+            }
+        ]}
+        if announcement_id is not None:
+            claimable["announcement_id"] = announcement_id
+        claimed = await admin_db.announcements.find_one_and_update(
+            claimable,
+            {"$set": {
+                "delivery_status": AnnouncementDeliveryStatus.DELIVERING.value,
+                "delivery_owner": self.owner,
+                "delivery_lease_expires_at": now + timedelta(seconds=DELIVERY_LEASE_SECONDS),
+                "updated_at": now
+            }},
+            projection={"_id": 0, "announcement_id": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        return claimed["announcement_id"] if claimed else None
+    
+    async def _run(self):
+        while True:
+            try:
+                announcement_id = await asyncio.wait_for(self._queue.get(), DELIVERY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                announcement_id = None
+            try:
+                # Without a local request, poll for deliveries nobody is running
+                claimed = await self.claim(announcement_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to claim announcement delivery: {e}")
+                continue
+            if claimed is None:
+                continue
+            try:
+                await NotificationService.deliver_announcement(claimed, owner=self.owner)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Announcement delivery failed for {claimed}: {e}")
+                await admin_db.announcements.update_one(
+                    {"announcement_id": claimed, "delivery_owner": self.owner},
+                    {
+                        "$set": {"delivery_status": AnnouncementDeliveryStatus.FAILED.value, "delivery_error": str(e)},
+                        "$unset": {"delivery_owner": "", "delivery_lease_expires_at": ""}
+                    }
+                )
+
+
+announcement_delivery_queue = AnnouncementDeliveryQueue()
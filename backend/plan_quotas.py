@@ -0,0 +1,185 @@
+"""
+Plan quota enforcement.
+Creating a product, user, branch or sale reserves one unit on the tenant's live
+usage counter (see usage_metering) with a single conditional $inc that only
+succeeds while the counter is below the plan limit, so the check is O(1) and
+two concurrent creates cannot both take the last slot. The first time a quota
+is enforced for a tenant, its counter is seeded from a real count, so tenants
+that existed before metering are not let past their limit. Deleting or
+cancelling releases the unit. Tenant plan quotas are cached for
+PLAN_CACHE_SECONDS and invalidated when a plan or subscription changes.
+"""
+
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple, Union
+import logging
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from usage_metering import (
+    USAGE_COLLECTION, PRODUCTS, USERS, BRANCHES, ORDERS_BY_MONTH, SEEDED,
+    count_usage, ensure_usage_indexes, record_usage, usage_month
+)
+
+logger = logging.getLogger(__name__)
+
+PLAN_CACHE_SECONDS = 300
+
+MAX_PRODUCTS = "max_products"
+MAX_USERS = "max_users"
+MAX_BRANCHES = "max_branches"
+MAX_ORDERS_PER_MONTH = "max_orders_per_month"
+
+QUOTA_METRICS = {
+    MAX_PRODUCTS: PRODUCTS,
+    MAX_USERS: USERS,
+    MAX_BRANCHES: BRANCHES,
+}
+
+QUOTA_LABELS = {
+    MAX_PRODUCTS: "products",
+    MAX_USERS: "users",
+    MAX_BRANCHES: "branches",
+    MAX_ORDERS_PER_MONTH: "orders this month",
+}
+
+# tenant_id -> (expires at, quotas)
+_quota_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+class QuotaExceeded(Exception):
+    """Raised when a create would take a tenant past its plan quota"""
+
+    def __init__(self, quota: str, limit: int):
+        self.quota = quota
+        self.limit = limit
+        super().__init__(f"Plan limit reached: {limit} {QUOTA_LABELS.get(quota, quota)}. Upgrade your plan to add more.")
+
+
+def _admin_db():
+    from db_connection import get_admin_db
+    return get_admin_db()
+
+
+def invalidate_plan_cache(tenant_id: Optional[str] = None) -> None:
+    """Forget cached quotas for one tenant, or for every tenant after a plan edit."""
+    if tenant_id:
+        _quota_cache.pop(tenant_id, None)
+    else:
+        _quota_cache.clear()
+
+
+async def get_tenant_quotas(tenant_id: str) -> Dict[str, Any]:
+    """The quotas of the tenant's subscribed plan ({} when unsubscribed, i.e. unlimited)."""
+    cached = _quota_cache.get(tenant_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    admin_db = _admin_db()
+    quotas: Dict[str, Any] = {}
+    subscription = await admin_db.subscriptions.find_one(
+        {"tenant_id": tenant_id}, {"_id": 0, "plan_id": 1}
+    )
+    if subscription and subscription.get("plan_id"):
+        plan = await admin_db.plans.find_one({"plan_id": subscription["plan_id"]}, {"_id": 0, "quotas": 1})
+        quotas = (plan or {}).get("quotas") or {}
+    _quota_cache[tenant_id] = (time.monotonic() + PLAN_CACHE_SECONDS, quotas)
+    return quotas
+
+
+def _counter_field(quota: str, created_at: Union[str, datetime, None] = None) -> str:
+    if quota == MAX_ORDERS_PER_MONTH:
+        return f"{ORDERS_BY_MONTH}.{usage_month(created_at)}"
+    return QUOTA_METRICS[quota]
+
+
+async def _seed_counter(target_db, tenant_id: str, field: str) -> None:
+    """Set a counter that was never counted to the tenant's real usage."""
+    from db_connection import get_default_db
+
+    if field != USERS and target_db is None:
+        raise ValueError(f"target_db is required to seed the {field} counter")
+    if not await ensure_usage_indexes():
+        # Fail closed: without the unique index the seeding upsert could create a second counter
+        raise RuntimeError("Usage counters are unavailable; try again shortly")
+    count = await count_usage(target_db, get_default_db(), tenant_id, field)
+    try:
+        await _admin_db()[USAGE_COLLECTION].update_one(
+            {"tenant_id": tenant_id, f"{SEEDED}.{field}": {"$ne": True}},
+            {"$set": {field: count, f"{SEEDED}.{field}": True, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Seeded concurrently by another request
+        pass
+
+
+def _is_seeded(counter: Dict[str, Any], field: str) -> bool:
+    value: Any = counter.get(SEEDED, {})
+    for part in field.split("."):
+        if not isinstance(value, dict):
+            return False
+        value = value.get(part)
+    return value is True
+
+
+async def reserve_quota(
+    tenant_id: Optional[str],
+    quota: str,
+    created_at: Union[str, datetime, None] = None,
+    target_db=None
+) -> None:
+    """
+    Count one more unit against a quota.
+    target_db (the tenant's database) is needed to seed product, branch and order counters.
+
+    Raises:
+        QuotaExceeded: If the tenant is already at its plan limit
+    """
+    if not tenant_id:
+        return
+    field = _counter_field(quota, created_at)
+    limit = (await get_tenant_quotas(tenant_id)).get(quota)
+    if limit is None or limit < 0:
+        await record_usage(tenant_id, field)
+        return
+
+    usage = _admin_db()[USAGE_COLLECTION]
+    for attempt in range(2):
+        # Matches only a seeded counter below the limit; the document always exists
+        # once seeded, so no upsert (and no reliance on the unique index) is needed
+        result = await usage.update_one(
+            {"tenant_id": tenant_id, f"{SEEDED}.{field}": True, field: {"$not": {"$gte": limit}}},
+            {"$inc": {field: 1}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+        )
+        if result.matched_count:
+            return
+        if attempt == 0:
+            counter = await usage.find_one({"tenant_id": tenant_id}, {"_id": 0, SEEDED: 1})
+            if not _is_seeded(counter or {}, field):
+                await _seed_counter(target_db, tenant_id, field)
+                continue
+        break
+    raise QuotaExceeded(quota, limit)
+
+
+async def release_quota(tenant_id: Optional[str], quota: str, created_at: Union[str, datetime, None] = None) -> None:
+    """Give back a unit after a delete or cancellation."""
+    await record_usage(tenant_id, _counter_field(quota, created_at), -1)
+
+
+@asynccontextmanager
+async def quota_reservation(
+    tenant_id: Optional[str],
+    quota: str,
+    created_at: Union[str, datetime, None] = None,
+    target_db=None
+):
+    """Reserve a unit for the enclosed create; the unit is released if the create fails."""
+    await reserve_quota(tenant_id, quota, created_at, target_db)
+    try:
+        yield
+    except BaseException:
+        await release_quota(tenant_id, quota, created_at)
+        raise
@@ -0,0 +1,170 @@
+"""
+In-process cache for report results.
+Entries are keyed by tenant, report name and normalized parameters. Stale entries
+are served while a single background refresh runs, and tenant writes invalidate
+that tenant's entries. Invalidations are relayed over the broadcast bus so
+every worker drops the tenant's entries, not only the one that took the write.
+"""
+
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+from uuid import uuid4
+import asyncio
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# (fresh_seconds, stale_seconds) per report; stale entries are served while refreshing
+REPORT_TTLS: Dict[str, Tuple[int, int]] = {
+    "profit_loss": (120, 900),
+    "top_products": (300, 1800),
+    "branch_sales": (120, 900),
+    "cnf_summary": (60, 600),
+    "warranty_stats": (60, 600),
+}
+DEFAULT_TTL: Tuple[int, int] = (60, 300)
+
+MAX_ENTRIES = 5000
+
+CacheKey = Tuple[str, str, str]
+
+INVALIDATE_KIND = "report_cache_invalidate"
+
+
+def normalize_params(params: Optional[Dict[str, Any]]) -> str:
+    """Stable string form of report parameters (None values dropped, keys sorted)."""
+    cleaned = {k: v for k, v in (params or {}).items() if v is not None}
+    return json.dumps(cleaned, sort_keys=True, default=str)
+
+
+class _CacheEntry:
+    __slots__ = ("value", "created_at", "generation")
+
+    def __init__(self, value: Any, generation: int):
+        self.value = value
+        self.created_at = time.monotonic()
+        self.generation = generation
+
+
+class ReportCache:
+    def __init__(self):
+        self._entries: Dict[CacheKey, _CacheEntry] = {}
+        self._inflight: Dict[CacheKey, Tuple[asyncio.Future, int]] = {}
+        self._generations: Dict[str, int] = {}
+        self._bus = None
+        self._origin = uuid4().hex
+        self._relays: Set[asyncio.Task] = set()
+
+    def configure_bus(self, bus) -> None:
+        """Relay invalidations to the other workers through the broadcast bus."""
+        self._bus = bus
+
+    async def get_or_compute(
+        self,
+        tenant_id: str,
+        report_name: str,
+        params: Optional[Dict[str, Any]],
+        compute: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Return a cached report result, computing it on a miss.
+
+        Fresh entries are returned directly. Stale entries are returned immediately
+        and refreshed in the background by exactly one task. Concurrent misses for
+        the same key share a single computation.
+        """
+        key = (tenant_id, report_name, normalize_params(params))
+        fresh_ttl, stale_ttl = REPORT_TTLS.get(report_name, DEFAULT_TTL)
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry.created_at
+            if age < fresh_ttl:
+                return entry.value
+            if age < fresh_ttl + stale_ttl:
+                if key not in self._inflight:
+                    self._start_refresh(key, compute)
+                return entry.value
+
+        inflight = self._inflight.get(key)
+        if inflight is None or inflight[1] != self._generations.get(tenant_id, 0):
+            task = self._start_refresh(key, compute)
+        else:
+            task = inflight[0]
+        return await asyncio.shield(task)
+
+    def _start_refresh(self, key: CacheKey, compute: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        generation = self._generations.get(key[0], 0)
+        task = asyncio.ensure_future(compute())
+        self._inflight[key] = (task, generation)
+
+        def _on_done(done: asyncio.Future):
+            if self._inflight.get(key, (None, 0))[0] is done:
+                del self._inflight[key]
+            if done.cancelled():
+                return
+            error = done.exception()
+            if error is not None:
+                logger.warning(f"Report refresh failed for {key[1]} (tenant {key[0]}): {error}")
+                return
+            # Drop results computed before a write invalidated the tenant
+            if self._generations.get(key[0], 0) != generation:
+                return
+            if len(self._entries) >= MAX_ENTRIES:
+                self._evict_oldest()
+            self._entries[key] = _CacheEntry(done.result(), generation)
+
+        task.add_done_callback(_on_done)
+        return task
+
+    def _evict_oldest(self):
+        oldest = sorted(self._entries.items(), key=lambda item: item[1].created_at)
+        for key, _ in oldest[: max(1, len(oldest) // 10)]:
+            self._entries.pop(key, None)
+
+    def invalidate_tenant(self, tenant_id: Optional[str], report_names: Optional[Tuple[str, ...]] = None):
+        """
+        Drop cached reports for a tenant (all reports, or only the given names).
+        In-flight computations started before the call will not be stored.
+        """
+        if not tenant_id:
+            return
+        self._invalidate_local(tenant_id, report_names)
+        self._relay({
+            "kind": INVALIDATE_KIND,
+            "origin": self._origin,
+            "tenant_id": tenant_id,
+            "report_names": list(report_names) if report_names is not None else None
+        })
+
+    def _invalidate_local(self, tenant_id: str, report_names: Optional[Tuple[str, ...]]):
+        self._generations[tenant_id] = self._generations.get(tenant_id, 0) + 1
+        for key in [k for k in self._entries if k[0] == tenant_id]:
+            if report_names is None or key[1] in report_names:
+                del self._entries[key]
+
+    def _relay(self, envelope: Dict[str, Any]):
+        if self._bus is None:
+            return
+        try:
+            task = asyncio.get_running_loop().create_task(self._bus.publish(envelope))
+        except RuntimeError:
+            # No running loop (scripts); there are no other workers to tell
+            return
+        self._relays.add(task)
+        task.add_done_callback(self._relays.discard)
+
+    def apply_invalidation(self, envelope: Dict[str, Any]):
+        """Apply an invalidation relayed by another worker (ignores this cache's own)."""
+        if envelope.get("origin") == self._origin:
+            return
+        report_names = envelope.get("report_names")
+        self._invalidate_local(envelope["tenant_id"], tuple(report_names) if report_names is not None else None)
+
+    def clear(self):
+        self._entries.clear()
+        self._generations.clear()
+
+
+report_cache = ReportCache()
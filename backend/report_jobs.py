@@ -0,0 +1,537 @@
+"""
+Background report jobs.
+Long reports and full exports are queued, run on a bounded worker pool that
+streams from server-side cursors, and written to a local file store that the
+client downloads once the job completes. Jobs hold a lease that their worker
+renews; a periodic sweep fails queued or running jobs whose lease ran out,
+since the process that owned them is gone, and deletes export files once
+their job expires.
+"""
+
+from datetime import datetime, timezone, timedelta
+from enum import Enum
+from pathlib import Path
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+from uuid import uuid4
+from collections import deque
+import asyncio
+import csv
+import logging
+import os
+
+from pydantic import BaseModel
+
+from report_service import (
+    build_created_at_filter, build_top_products_pipeline, add_margin_percent,
+    get_branch_sales_totals, get_profit_loss_totals, ensure_report_indexes
+)
+from dues_service import backfill_due_references
+from sales_export import SALE_LINE_COLUMNS, iter_sale_line_batches, write_sale_lines_parquet
+
+logger = logging.getLogger(__name__)
+
+REPORT_EXPORT_DIR = Path(os.environ.get('REPORT_EXPORT_DIR', Path(__file__).parent / "exports"))
+REPORT_JOB_WORKERS = int(os.environ.get('REPORT_JOB_WORKERS', 2))
+MAX_RUNNING_JOBS_PER_TENANT = int(os.environ.get('REPORT_JOBS_PER_TENANT', 1))
+MAX_QUEUED_JOBS_PER_TENANT = 10
+CURSOR_BATCH_SIZE = 1000
+JOB_LEASE_SECONDS = 300
+REPORT_FILE_RETENTION_HOURS = int(os.environ.get('REPORT_FILE_RETENTION_HOURS', 24))
+REPORT_SWEEP_SECONDS = 3600
+
+
+class ReportJobType(str, Enum):
+    PROFIT_LOSS = "profit_loss"
+    BRANCH_SALES = "branch_sales"
+    TOP_PRODUCTS = "top_products"
+    STOCK_VALUATION = "stock_valuation"
+    CUSTOMER_DUES = "customer_dues"
+    SALE_LINES = "sale_lines"
+
+
+class ReportJobFormat(str, Enum):
+    CSV = "csv"
+    XLSX = "xlsx"
+    PARQUET = "parquet"
+
+
+# Reports that can also be written as Parquet
+PARQUET_REPORT_TYPES = {ReportJobType.SALE_LINES}
+
+MEDIA_TYPES = {
+    ReportJobFormat.CSV.value: "text/csv",
+    ReportJobFormat.XLSX.value: "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ReportJobFormat.PARQUET.value: "application/vnd.apache.parquet",
+}
+
+
+class ReportJobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    EXPIRED = "expired"
+
+
+class ReportJobCreate(BaseModel):
+    report_type: ReportJobType
+    format: ReportJobFormat = ReportJobFormat.CSV
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    branch_id: Optional[str] = None
+    category: Optional[str] = None
+    sort_by: str = "revenue"
+
+
+class ReportJobQueueFull(Exception):
+    """Raised when a tenant already has the maximum number of pending jobs"""
+
+
+# ========== ROW SOURCES ==========
+
+async def _profit_loss_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    yield ["metric", "value"]
+    totals = await get_profit_loss_totals(
+        target_db=target_db,
+        tenant_id=tenant_id,
+        start_date=params.get("start_date"),
+        end_date=params.get("end_date"),
+        branch_id=params.get("branch_id")
+    )
+    for metric, value in totals.items():
+        yield [metric, value]
+
+
+async def _branch_sales_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    fields = ["total_sales", "sales_count", "subtotal", "discount", "tax", "items_sold", "payments_received"]
+    yield ["branch_id", "branch_name", "branch_code"] + fields
+    totals = await get_branch_sales_totals(
+        target_db=target_db,
+        tenant_id=tenant_id,
+        branch_id=params.get("branch_id"),
+        start_date=params.get("start_date"),
+        end_date=params.get("end_date")
+    )
+    branches = await target_db.branches.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "name": 1, "branch_code": 1}
+    ).to_list(1000)
+    branch_map = {b["id"]: b for b in branches}
+    for branch_id, row in sorted(totals.items(), key=lambda item: item[1]["total_sales"], reverse=True):
+        branch = branch_map.get(branch_id, {})
+        yield [branch_id, branch.get("name", "Unassigned"), branch.get("branch_code", "")] + [row[f] for f in fields]
+
+
+async def _top_products_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    fields = ["product_id", "product_name", "product_sku", "category", "quantity", "revenue", "cost", "margin", "margin_percent"]
+    yield fields
+    sales_query: Dict[str, Any] = {"tenant_id": tenant_id}
+    if params.get("branch_id"):
+        sales_query["branch_id"] = params["branch_id"]
+    date_filter = build_created_at_filter(params.get("start_date"), params.get("end_date"))
+    if date_filter:
+        sales_query["created_at"] = date_filter
+
+    pipeline = await build_top_products_pipeline(
+        target_db=target_db,
+        sales_query=sales_query,
+        limit=None,
+        sort_by=params.get("sort_by") or "revenue",
+        category=params.get("category")
+    )
+    if pipeline is None:
+        return
+    cursor = target_db.sales.aggregate(pipeline, allowDiskUse=True, batchSize=CURSOR_BATCH_SIZE)
+    async for row in cursor:
+        add_margin_percent(row)
+        yield [row.get(f) for f in fields]
+
+
+async def _stock_valuation_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    yield ["product_id", "product_name", "sku", "category", "branch_id", "stock", "unit_cost", "value"]
+
+    product_costs: Dict[str, Dict[str, Any]] = {}
+    products = target_db.products.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0, "id": 1, "name": 1, "sku": 1, "category": 1, "stock": 1, "unit_cost": 1, "cost": 1}
+    ).batch_size(CURSOR_BATCH_SIZE)
+    async for product in products:
+        unit_cost = product.get("unit_cost") or product.get("cost") or 0
+        product_costs[product["id"]] = {**product, "unit_cost": unit_cost}
+        if not params.get("branch_id"):
+            stock = product.get("stock", 0) or 0
+            yield [product["id"], product.get("name"), product.get("sku"), product.get("category"), "", stock, unit_cost, stock * unit_cost]
+
+    branch_query: Dict[str, Any] = {"tenant_id": tenant_id}
+    if params.get("branch_id"):
+        branch_query["branch_id"] = params["branch_id"]
+    assignments = target_db.product_branches.find(branch_query, {"_id": 0}).batch_size(CURSOR_BATCH_SIZE)
+    async for assignment in assignments:
+        product = product_costs.get(assignment.get("product_id"), {})
+        stock = assignment.get("stock_quantity", assignment.get("stock", 0)) or 0
+        unit_cost = assignment.get("purchase_price") or product.get("unit_cost", 0)
+        yield [
+            assignment.get("product_id"), product.get("name"), product.get("sku"), product.get("category"),
+            assignment.get("branch_id"), stock, unit_cost, stock * unit_cost
+        ]
+
+
+async def _customer_dues_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    fields = ["customer_name", "sale_number", "sale_id", "total_amount", "paid_amount", "due_amount", "transaction_date"]
+    yield fields
+    query: Dict[str, Any] = {"tenant_id": tenant_id, "due_amount": {"$gt": 0}}
+    if params.get("branch_id"):
+        # Older dues only carry their branch once backfilled from the sale
+        await backfill_due_references(target_db, tenant_id)
+        query["branch_id"] = params["branch_id"]
+    cursor = target_db.customer_dues.find(
+        query,
+        {"_id": 0, **{f: 1 for f in fields}}
+    ).sort("transaction_date", 1).batch_size(CURSOR_BATCH_SIZE)
+    async for due in cursor:
+        yield [due.get(f) for f in fields]
+
+
+async def _sale_lines_rows(target_db, tenant_id: str, params: Dict[str, Any]) -> AsyncIterator[List[Any]]:
+    columns = [name for name, _ in SALE_LINE_COLUMNS]
+    yield columns
+    batches = iter_sale_line_batches(
+        target_db, tenant_id, params.get("start_date"), params.get("end_date"), branch_id=params.get("branch_id")
+    )
+    async for rows in batches:
+        for row in rows:
+            yield [row[column] for column in columns]
+
+
+ROW_SOURCES = {
+    ReportJobType.PROFIT_LOSS: _profit_loss_rows,
+    ReportJobType.BRANCH_SALES: _branch_sales_rows,
+    ReportJobType.TOP_PRODUCTS: _top_products_rows,
+    ReportJobType.STOCK_VALUATION: _stock_valuation_rows,
+    ReportJobType.CUSTOMER_DUES: _customer_dues_rows,
+    ReportJobType.SALE_LINES: _sale_lines_rows,
+}
+
+
+# ========== FILE WRITERS ==========
+
+class _CsvWriter:
+    def __init__(self, path: Path):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+
+    def write_rows(self, rows: List[List[Any]]):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class _XlsxWriter:
+    def __init__(self, path: Path):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise RuntimeError("XLSX export requires openpyxl to be installed")
+        self._path = path
+        self._workbook = Workbook(write_only=True)
+        self._sheet = self._workbook.create_sheet("Report")
+
+    def write_rows(self, rows: List[List[Any]]):
+        for row in rows:
+            self._sheet.append(row)
+
+    def close(self):
+        self._workbook.save(self._path)
+
+
+def job_file_path(tenant_id: str, job_id: str, file_format: str) -> Path:
+    return REPORT_EXPORT_DIR / tenant_id / f"{job_id}.{file_format}"
+
+
+async def _write_report_file(target_db, job: Dict[str, Any]) -> int:
+    """Stream report rows into the job's file in batches; returns the number of data rows."""
+    path = job_file_path(job["tenant_id"], job["id"], job["format"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if job["format"] == ReportJobFormat.PARQUET.value:
+        # Written one row group per cursor batch, off the event loop
+        params = job.get("params", {})
+        return await write_sale_lines_parquet(
+            target_db, job["tenant_id"], path,
+            start_date=params.get("start_date"), end_date=params.get("end_date"), branch_id=params.get("branch_id")
+        )
+
+    writer_cls = _XlsxWriter if job["format"] == ReportJobFormat.XLSX.value else _CsvWriter
+    writer = await asyncio.to_thread(writer_cls, path)
+    row_count = -1  # header row is not counted
+    batch: List[List[Any]] = []
+    try:
+        rows = ROW_SOURCES[ReportJobType(job["report_type"])](target_db, job["tenant_id"], job.get("params", {}))
+        async for row in rows:
+            batch.append(row)
+            row_count += 1
+            if len(batch) >= CURSOR_BATCH_SIZE:
+                # File I/O runs off the event loop so POS requests are not blocked
+                await asyncio.to_thread(writer.write_rows, batch)
+                batch = []
+        if batch:
+            await asyncio.to_thread(writer.write_rows, batch)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return max(row_count, 0)
+
+
+# ========== QUEUE ==========
+
+class ReportJobQueue:
+    """
+    Bounded worker pool for report jobs with a per-tenant concurrency limit.
+
+    Tenants, not jobs, are placed on the ready queue, so a tenant with many
+    queued exports occupies at most MAX_RUNNING_JOBS_PER_TENANT workers and
+    other tenants' jobs are interleaved fairly.
+    """
+
+    def __init__(self, workers: int = REPORT_JOB_WORKERS, per_tenant: int = MAX_RUNNING_JOBS_PER_TENANT):
+        self._worker_count = workers
+        self._per_tenant = per_tenant
+        self._ready: Optional[asyncio.Queue] = None
+        self._pending: Dict[str, Deque[tuple]] = {}
+        self._running: Dict[str, int] = {}
+        self._scheduled: Dict[str, int] = {}
+        self._workers: List[asyncio.Task] = []
+        # job id -> (target_db, job) for every queued or running job owned by this process
+        self._active: Dict[str, tuple] = {}
+        self._maintenance: List[asyncio.Task] = []
+
+    def start(self, recover_stale: bool = True):
+        if self._workers:
+            return
+        self._ready = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self._worker_count)]
+        self._maintenance = [asyncio.create_task(self._renew_leases())]
+        if recover_stale:
+            self._maintenance.append(asyncio.create_task(self._sweep()))
+        logger.info(f"Report job queue started with {self._worker_count} workers")
+
+    async def stop(self):
+        tasks = self._workers + self._maintenance
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._maintenance = []
+
+    async def _renew_leases(self):
+        """Keep this process's queued and running jobs from being failed as stale by other workers."""
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            by_database: Dict[int, tuple] = {}
+            for target_db, job in list(self._active.values()):
+                by_database.setdefault(id(target_db), (target_db, []))[1].append(job["id"])
+            lease_expires_at = _lease_expiry()
+            for target_db, job_ids in by_database.values():
+                try:
+                    await target_db.report_jobs.update_many(
+                        {"id": {"$in": job_ids}},
+                        {"$set": {"lease_expires_at": lease_expires_at}}
+                    )
+                except Exception as e:
+                    logger.warning(f"Failed to renew report job leases on {target_db.name}: {e}")
+
+    async def _sweep(self):
+        """Recover stale jobs and delete expired files now and every REPORT_SWEEP_SECONDS."""
+        while True:
+            await sweep_report_jobs_all_tenants()
+            await asyncio.sleep(REPORT_SWEEP_SECONDS)
+
+    async def enqueue(self, target_db, tenant_id: str, created_by: Optional[str], request: ReportJobCreate) -> Dict[str, Any]:
+        """Persist a queued job and schedule it; raises ReportJobQueueFull when the tenant is saturated."""
+        pending = self._pending.setdefault(tenant_id, deque())
+        if len(pending) >= MAX_QUEUED_JOBS_PER_TENANT:
+            raise ReportJobQueueFull(f"Too many queued report jobs (max {MAX_QUEUED_JOBS_PER_TENANT})")
+
+        now = datetime.now(timezone.utc).isoformat()
+        job = {
+            "id": str(uuid4()),
+            "tenant_id": tenant_id,
+            "report_type": request.report_type.value,
+            "format": request.format.value,
+            "params": request.model_dump(exclude={"report_type", "format"}, exclude_none=True),
+            "status": ReportJobStatus.QUEUED.value,
+            "row_count": 0,
+            "error": None,
+            "created_by": created_by,
+            "created_at": now,
+            "updated_at": now,
+            "lease_expires_at": _lease_expiry(),
+        }
+        await target_db.report_jobs.insert_one(dict(job))
+
+        self._active[job["id"]] = (target_db, job)
+        pending.append((target_db, job))
+        self._schedule(tenant_id)
+        return job
+
+    def _schedule(self, tenant_id: str):
+        if self._ready is None:
+            self.start()
+        active = self._running.get(tenant_id, 0) + self._scheduled.get(tenant_id, 0)
+        if self._pending.get(tenant_id) and active < self._per_tenant:
+            self._scheduled[tenant_id] = self._scheduled.get(tenant_id, 0) + 1
+            self._ready.put_nowait(tenant_id)
+
+    async def _worker(self, index: int):
+        while True:
+            tenant_id = await self._ready.get()
+            self._scheduled[tenant_id] -= 1
+            pending = self._pending.get(tenant_id)
+            if not pending:
+                continue
+            target_db, job = pending.popleft()
+            self._running[tenant_id] = self._running.get(tenant_id, 0) + 1
+            try:
+                await self._run_job(target_db, job)
+            finally:
+                self._active.pop(job["id"], None)
+                self._running[tenant_id] -= 1
+                if not self._running[tenant_id]:
+                    del self._running[tenant_id]
+                if not pending:
+                    self._pending.pop(tenant_id, None)
+                self._schedule(tenant_id)
+
+    async def _run_job(self, target_db, job: Dict[str, Any]):
+        job_filter = {"id": job["id"], "tenant_id": job["tenant_id"]}
+        started_at = datetime.now(timezone.utc).isoformat()
+        await target_db.report_jobs.update_one(
+            job_filter,
+            {"$set": {"status": ReportJobStatus.RUNNING.value, "started_at": started_at, "updated_at": started_at}}
+        )
+        try:
+            await ensure_report_indexes(target_db)
+            row_count = await _write_report_file(target_db, job)
+            update = {
+                "status": ReportJobStatus.COMPLETED.value,
+                "row_count": row_count,
+                "file_name": f"{job['report_type']}_{job['id'][:8]}.{job['format']}",
+            }
+            logger.info(f"Report job {job['id']} ({job['report_type']}) completed with {row_count} rows")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Report job {job['id']} ({job['report_type']}) failed: {e}")
+            update = {"status": ReportJobStatus.FAILED.value, "error": str(e)}
+
+        finished = datetime.now(timezone.utc)
+        # A failed job's partial file is removed by the next sweep
+        expires_at = finished
+        if update["status"] == ReportJobStatus.COMPLETED.value:
+            expires_at += timedelta(hours=REPORT_FILE_RETENTION_HOURS)
+        await target_db.report_jobs.update_one(
+            job_filter,
+            {"$set": {
+                **update,
+                "finished_at": finished.isoformat(),
+                "updated_at": finished.isoformat(),
+                "expires_at": expires_at.isoformat()
+            }}
+        )
+
+
+def _lease_expiry() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()
+
+
+async def fail_stale_jobs(target_db) -> int:
+    """
+    Mark queued or running jobs whose lease expired as failed.
+    Jobs written before leases existed count as stale once not updated for a lease period.
+    """
+    now = datetime.now(timezone.utc)
+    result = await target_db.report_jobs.update_many(
+        {
+            "status": {"$in": [ReportJobStatus.QUEUED.value, ReportJobStatus.RUNNING.value]},
+            "$or": [
+                {"lease_expires_at": {"$lt": now.isoformat()}},
+                {
+                    "lease_expires_at": {"$exists": False},
+                    "updated_at": {"$lt": (now - timedelta(seconds=JOB_LEASE_SECONDS)).isoformat()}
+                }
+            ]
+        },
+        {"$set": {
+            "status": ReportJobStatus.FAILED.value,
+            "error": "Interrupted by a server restart; please run the report again",
+            "finished_at": now.isoformat(),
+            "updated_at": now.isoformat(),
+            "expires_at": now.isoformat()
+        }}
+    )
+    return result.modified_count
+
+
+async def expire_report_files(target_db) -> int:
+    """
+    Delete the files of finished jobs whose expires_at has passed.
+    Completed jobs are marked expired; failed jobs keep their status and error.
+    Jobs completed before expiry was recorded expire a retention period after finishing.
+    """
+    now = datetime.now(timezone.utc)
+    retention_cutoff = (now - timedelta(hours=REPORT_FILE_RETENTION_HOURS)).isoformat()
+    cursor = target_db.report_jobs.find(
+        {
+            "status": {"$in": [ReportJobStatus.COMPLETED.value, ReportJobStatus.FAILED.value]},
+            "$or": [
+                {"expires_at": {"$lt": now.isoformat()}},
+                {
+                    "status": ReportJobStatus.COMPLETED.value,
+                    "expires_at": {"$exists": False},
+                    "finished_at": {"$lt": retention_cutoff}
+                }
+            ]
+        },
+        {"_id": 0, "id": 1, "tenant_id": 1, "format": 1, "status": 1}
+    ).batch_size(CURSOR_BATCH_SIZE)
+
+    expired = 0
+    async for job in cursor:
+        path = job_file_path(job["tenant_id"], job["id"], job["format"])
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        if job["status"] == ReportJobStatus.COMPLETED.value:
+            update = {"$set": {"status": ReportJobStatus.EXPIRED.value, "updated_at": now.isoformat()}}
+        else:
+            update = {"$unset": {"expires_at": ""}}
+        await target_db.report_jobs.update_one(
+            {"id": job["id"], "tenant_id": job["tenant_id"], "status": job["status"]},
+            update
+        )
+        expired += 1
+    return expired
+
+
+async def sweep_report_jobs_all_tenants() -> Dict[str, int]:
+    """Fail stale jobs and delete expired files in every tenant database."""
+    from job_coordination import run_for_tenants
+
+    async def sweep_tenant(tenant, target_db) -> Dict[str, int]:
+        return {"failed": await fail_stale_jobs(target_db), "expired": await expire_report_files(target_db)}
+
+    try:
+        results, _ = await run_for_tenants("Report job sweep", sweep_tenant, unique_databases=True)
+    except Exception as e:
+        logger.warning(f"Failed to sweep report jobs: {e}")
+        return {"failed": 0, "expired": 0}
+    totals = {
+        key: sum(result[key] for result in results.values())
+        for key in ("failed", "expired")
+    }
+    if totals["failed"]:
+        logger.info(f"Marked {totals['failed']} interrupted report jobs as failed")
+    if totals["expired"]:
+        logger.info(f"Deleted {totals['expired']} expired report files")
+    return totals
+
+
+report_job_queue = ReportJobQueue()
@@ -0,0 +1,503 @@
+"""
+Report aggregation service.
+Builds MongoDB aggregation pipelines for the reporting endpoints so that
+grouping, sorting and limiting happen inside the database instead of in Python.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Optional, List, Dict, Any
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+
+logger = logging.getLogger(__name__)
+
+TOP_PRODUCTS_SORT_FIELDS = {
+    "qty": "quantity",
+    "quantity": "quantity",
+    "revenue": "revenue",
+    "margin": "margin",
+}
+
+
+async def ensure_report_indexes(target_db) -> None:
+    """
+    Create the indexes the report pipelines rely on (once per database per process).
+
+    Args:
+        target_db: Tenant-specific database handle
+    """
+    if indexes_ensured(target_db, "reports"):
+        return
+
+    try:
+        await target_db.sales.create_index(
+            [("tenant_id", ASCENDING), ("created_at", DESCENDING)],
+            name="tenant_created_at"
+        )
+        await target_db.sales.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("created_at", DESCENDING)],
+            name="tenant_branch_created_at"
+        )
+        await target_db.products.create_index([("id", ASCENDING)], name="product_id")
+        await target_db.products.create_index(
+            [("tenant_id", ASCENDING), ("category_id", ASCENDING)],
+            name="tenant_category_id"
+        )
+        mark_indexes_ensured(target_db, "reports")
+    except Exception as e:
+        logger.warning(f"Failed to ensure report indexes on {target_db.name}: {e}")
+
+
+def build_created_at_filter(start_date: Optional[str], end_date: Optional[str]) -> Optional[Dict[str, str]]:
+    """
+    Build a created_at range filter from YYYY-MM-DD strings.
+    Sales store created_at as ISO strings, so the range is compared lexicographically.
+    """
+    date_filter = {}
+    if start_date:
+        date_filter["$gte"] = start_date + "T00:00:00"
+    if end_date:
+        date_filter["$lte"] = end_date + "T23:59:59"
+    return date_filter or None
+
+
+async def build_top_products_pipeline(
+    *,
+    target_db,
+    sales_query: Dict[str, Any],
+    limit: Optional[int] = 10,
+    sort_by: str = "revenue",
+    category: Optional[str] = None
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Build the top-products aggregation pipeline.
+
+    Items are unwound and grouped by product_id in MongoDB. Product details are
+    joined with a single $lookup after the limit is applied (or before it when
+    sorting by margin, which needs the product cost).
+
+    Args:
+        target_db: Tenant-specific database handle
+        sales_query: Match filter for the sales collection (tenant, branch, date range)
+        limit: Number of products to return, or None for every product
+        sort_by: One of qty, revenue, margin
+        category: Optional category id or name to restrict products
+
+    Returns:
+        The pipeline, or None when the category has no products
+    """
+    sort_field = TOP_PRODUCTS_SORT_FIELDS.get(sort_by)
+    if not sort_field:
+        raise ValueError(f"Invalid sort_by '{sort_by}'. Use one of: qty, revenue, margin")
+
+    pipeline: List[Dict[str, Any]] = [
+        {"$match": sales_query},
+        {"$project": {"_id": 0, "items": 1}},
+        {"$unwind": "$items"},
+    ]
+
+    if category:
+        # Resolve the category to product ids once instead of joining every line item
+        category_product_ids = await target_db.products.distinct(
+            "id",
+            {
+                "tenant_id": sales_query.get("tenant_id"),
+                "$or": [{"category_id": category}, {"category": category}]
+            }
+        )
+        if not category_product_ids:
+            return None
+        pipeline.append({"$match": {"items.product_id": {"$in": category_product_ids}}})
+
+    quantity = {"$ifNull": ["$items.quantity", 0]}
+    pipeline.append({
+        "$group": {
+            "_id": "$items.product_id",
+            "quantity": {"$sum": quantity},
+            "revenue": {"$sum": {"$multiply": [{"$ifNull": ["$items.price", 0]}, quantity]}},
+            "known_cost": {"$sum": {"$multiply": [{"$ifNull": ["$items.unit_cost", 0]}, quantity]}},
+            "uncosted_quantity": {
+                "$sum": {"$cond": [{"$eq": [{"$ifNull": ["$items.unit_cost", None]}, None]}, quantity, 0]}
+            }
+        }
+    })
+
+    lookup_stages = [
+        {
+            "$lookup": {
+                "from": "products",
+                "localField": "_id",
+                "foreignField": "id",
+                "as": "product"
+            }
+        },
+        {
+            "$addFields": {
+                "product": {
+                    "$arrayElemAt": [
+                        {
+                            "$filter": {
+                                "input": "$product",
+                                "as": "p",
+                                "cond": {"$eq": ["$$p.tenant_id", sales_query.get("tenant_id")]}
+                            }
+                        },
+                        0
+                    ]
+                }
+            }
+        },
+        {
+            "$addFields": {
+                "cost": {
+                    "$add": [
+                        "$known_cost",
+                        {"$multiply": [
+                            "$uncosted_quantity",
+                            {"$ifNull": ["$product.unit_cost", {"$ifNull": ["$product.cost", 0]}]}
+                        ]}
+                    ]
+                }
+            }
+        },
+        {"$addFields": {"margin": {"$subtract": ["$revenue", "$cost"]}}},
+    ]
+
+    sort_stages: List[Dict[str, Any]] = [{"$sort": {sort_field: -1, "_id": 1}}]
+    if limit:
+        sort_stages.append({"$limit": limit})
+
+    if sort_field == "margin":
+        pipeline.extend(lookup_stages + sort_stages)
+    else:
+        pipeline.extend(sort_stages + lookup_stages)
+
+    pipeline.append({
+        "$project": {
+            "_id": 0,
+            "product_id": "$_id",
+            "quantity": 1,
+            "revenue": 1,
+            "cost": 1,
+            "margin": 1,
+            "product_name": "$product.name",
+            "product_sku": "$product.sku",
+            "category": "$product.category"
+        }
+    })
+    return pipeline
+
+
+def add_margin_percent(row: Dict[str, Any]) -> Dict[str, Any]:
+    row["margin_percent"] = (row["margin"] / row["revenue"] * 100) if row.get("revenue") else 0
+    return row
+
+
+async def get_top_products_report(
+    *,
+    target_db,
+    sales_query: Dict[str, Any],
+    limit: int = 10,
+    sort_by: str = "revenue",
+    category: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Aggregate sale line items by product and return the top products.
+
+    Returns:
+        List of product rows with quantity, revenue, cost and margin
+    """
+    await ensure_report_indexes(target_db)
+
+    pipeline = await build_top_products_pipeline(
+        target_db=target_db,
+        sales_query=sales_query,
+        limit=limit,
+        sort_by=sort_by,
+        category=category
+    )
+    if pipeline is None:
+        return []
+
+    rows = await target_db.sales.aggregate(pipeline, allowDiskUse=True).to_list(limit)
+    return [add_margin_percent(row) for row in rows]
+
+
+# ========== BRANCH SALES ==========
+
+SALES_DAILY_ROLLUP = "sales_daily"
+
+BRANCH_SALES_FIELDS = ("total_sales", "sales_count", "subtotal", "discount", "tax", "items_sold", "payments_received")
+
+
+def _sale_day_expression() -> Dict[str, Any]:
+    """Day key (YYYY-MM-DD) for a sale whose created_at may be an ISO string or a BSON date."""
+    return {
+        "$cond": [
+            {"$eq": [{"$type": "$created_at"}, "date"]},
+            {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+            {"$substrBytes": ["$created_at", 0, 10]}
+        ]
+    }
+
+
+def _sale_day(created_at: Any) -> str:
+    if isinstance(created_at, datetime):
+        return created_at.strftime("%Y-%m-%d")
+    return str(created_at or "")[:10]
+
+
+def _branch_sales_group_stage(group_id: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "$group": {
+            "_id": group_id,
+            "total_sales": {"$sum": {"$ifNull": ["$total", 0]}},
+            "sales_count": {"$sum": 1},
+            "subtotal": {"$sum": {"$ifNull": ["$subtotal", 0]}},
+            "discount": {"$sum": {"$ifNull": ["$discount", 0]}},
+            "tax": {"$sum": {"$ifNull": ["$tax", 0]}},
+            "items_sold": {"$sum": {"$sum": "$items.quantity"}},
+            "payments_received": {"$sum": {"$ifNull": ["$amount_paid", {"$ifNull": ["$total", 0]}]}}
+        }
+    }
+
+
+_BRANCH_KEY_EXPRESSION = {
+    "$cond": [{"$in": [{"$ifNull": ["$branch_id", ""]}, [""]]}, "unassigned", "$branch_id"]
+}
+
+
+async def _get_rollup_through_day(target_db, tenant_id: str) -> Optional[str]:
+    state = await target_db.report_rollup_state.find_one(
+        {"tenant_id": tenant_id, "name": SALES_DAILY_ROLLUP},
+        {"_id": 0, "through_day": 1}
+    )
+    return state.get("through_day") if state else None
+
+
+async def refresh_sales_daily_rollups(target_db, tenant_id: str) -> Optional[str]:
+    """
+    Roll up closed days (up to yesterday, UTC) that are not yet in sales_daily_rollups.
+
+    Only days after the stored watermark are aggregated, so a refresh normally
+    touches a single day of sales. Results are written with $merge.
+
+    Returns:
+        The last fully rolled-up day, or None if there is nothing to roll up yet
+    """
+    through_day = await _get_rollup_through_day(target_db, tenant_id)
+    yesterday = (datetime.now(timezone.utc) - timedelta(days=1)).strftime("%Y-%m-%d")
+    if through_day and through_day >= yesterday:
+        return through_day
+
+    day_filter: Dict[str, Any] = {"$lte": yesterday}
+    if through_day:
+        day_filter["$gt"] = through_day
+
+    # Bound created_at up front so the tenant_created_at index limits the scan to the
+    # new days; created_at may be an ISO string or a BSON date, so both are matched.
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    string_range: Dict[str, Any] = {"$lt": today.strftime("%Y-%m-%d")}
+    date_range: Dict[str, Any] = {"$lt": today}
+    if through_day:
+        first_day = datetime.strptime(through_day, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)
+        string_range["$gte"] = first_day.strftime("%Y-%m-%d")
+        date_range["$gte"] = first_day
+
+    pipeline = [
+        {"$match": {"$or": [
+            {"tenant_id": tenant_id, "created_at": string_range},
+            {"tenant_id": tenant_id, "created_at": date_range}
+        ]}},
+        {"$project": {
+            "_id": 0, "branch_id": 1, "created_at": 1, "total": 1, "subtotal": 1,
+            "discount": 1, "tax": 1, "amount_paid": 1, "items.quantity": 1
+        }},
+        {"$addFields": {"day": _sale_day_expression()}},
+        {"$match": {"day": day_filter}},
+        _branch_sales_group_stage({"branch_id": _BRANCH_KEY_EXPRESSION, "day": "$day"}),
+        {"$project": {
+            "_id": 0,
+            "tenant_id": {"$literal": tenant_id},
+            "branch_id": "$_id.branch_id",
+            "day": "$_id.day",
+            **{field: 1 for field in BRANCH_SALES_FIELDS}
+        }},
+        {"$merge": {
+            "into": "sales_daily_rollups",
+            "on": ["tenant_id", "branch_id", "day"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+    await target_db.sales_daily_rollups.create_index(
+        [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("day", ASCENDING)],
+        unique=True,
+        name="tenant_branch_day"
+    )
+    await target_db.sales.aggregate(pipeline, allowDiskUse=True).to_list(None)
+
+    await target_db.report_rollup_state.update_one(
+        {"tenant_id": tenant_id, "name": SALES_DAILY_ROLLUP},
+        {"$set": {"through_day": yesterday, "refreshed_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    return yesterday
+
+
+async def adjust_sales_daily_rollup(
+    target_db,
+    sale: Dict[str, Any],
+    total_delta: float = 0,
+    payments_delta: float = 0
+) -> None:
+    """
+    Apply a change to an already rolled-up sale (late payment, refund) to its daily rollup.
+    Sales on days after the watermark are picked up by the next refresh instead.
+    """
+    tenant_id = sale.get("tenant_id")
+    day = _sale_day(sale.get("created_at"))
+    through_day = await _get_rollup_through_day(target_db, tenant_id)
+    if not through_day or day > through_day:
+        return
+
+    inc: Dict[str, float] = {}
+    if total_delta:
+        inc["total_sales"] = total_delta
+    if payments_delta:
+        inc["payments_received"] = payments_delta
+    if not inc:
+        return
+
+    await target_db.sales_daily_rollups.update_one(
+        {"tenant_id": tenant_id, "branch_id": sale.get("branch_id") or "unassigned", "day": day},
+        {"$inc": inc}
+    )
+
+
+def _merge_branch_totals(target: Dict[str, Dict[str, Any]], rows: List[Dict[str, Any]]) -> None:
+    for row in rows:
+        totals = target.setdefault(row["_id"], {field: 0 for field in BRANCH_SALES_FIELDS})
+        for field in BRANCH_SALES_FIELDS:
+            totals[field] += row.get(field) or 0
+
+
+async def get_branch_sales_totals(
+    *,
+    target_db,
+    tenant_id: str,
+    branch_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Per-branch sales totals for a whole-day date range.
+
+    Closed days are read from sales_daily_rollups; days after the rollup
+    watermark are aggregated from sales. Memory use is O(branches).
+
+    Returns:
+        Mapping of branch_id (or "unassigned") to totals
+    """
+    await ensure_report_indexes(target_db)
+
+    try:
+        through_day = await refresh_sales_daily_rollups(target_db, tenant_id)
+    except Exception as e:
+        logger.warning(f"Sales rollup refresh failed for tenant {tenant_id}, aggregating from sales: {e}")
+        through_day = None
+
+    totals: Dict[str, Dict[str, Any]] = {}
+    live_start = start_date
+
+    if through_day and (not start_date or start_date <= through_day):
+        rollup_day: Dict[str, str] = {"$lte": min(through_day, end_date) if end_date else through_day}
+        if start_date:
+            rollup_day["$gte"] = start_date
+        rollup_query: Dict[str, Any] = {"tenant_id": tenant_id, "day": rollup_day}
+        if branch_id:
+            rollup_query["branch_id"] = branch_id
+
+        rollup_rows = await target_db.sales_daily_rollups.aggregate([
+            {"$match": rollup_query},
+            {"$group": {"_id": "$branch_id", **{field: {"$sum": f"${field}"} for field in BRANCH_SALES_FIELDS}}}
+        ]).to_list(None)
+        _merge_branch_totals(totals, rollup_rows)
+
+        live_start = (datetime.strptime(through_day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+    if end_date and live_start and live_start > end_date:
+        return totals
+
+    sales_query: Dict[str, Any] = {"tenant_id": tenant_id}
+    if branch_id:
+        sales_query["branch_id"] = branch_id
+    date_filter = build_created_at_filter(live_start, end_date)
+    if date_filter:
+        sales_query["created_at"] = date_filter
+
+    live_rows = await target_db.sales.aggregate([
+        {"$match": sales_query},
+        _branch_sales_group_stage(_BRANCH_KEY_EXPRESSION)
+    ], allowDiskUse=True).to_list(None)
+    _merge_branch_totals(totals, live_rows)
+
+    return totals
+
+
+# ========== PROFIT & LOSS ==========
+
+async def _sum_field(collection, match: Dict[str, Any], field: str) -> float:
+    rows = await collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": None, "total": {"$sum": {"$ifNull": [f"${field}", 0]}}}}
+    ]).to_list(1)
+    return rows[0]["total"] if rows else 0
+
+
+async def get_profit_loss_totals(
+    *,
+    target_db,
+    tenant_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    branch_id: Optional[str] = None
+) -> Dict[str, float]:
+    """
+    Revenue, expenses, purchases and profit summed with $group in MongoDB.
+    Expenses are filtered on their `date` field, sales and purchases on created_at.
+    With a branch_id only that branch's documents count; expenses and purchases
+    recorded without a branch belong to head office and are left out.
+    """
+    created_filter = build_created_at_filter(start_date, end_date)
+
+    sales_match: Dict[str, Any] = {"tenant_id": tenant_id}
+    purchases_match: Dict[str, Any] = {"tenant_id": tenant_id}
+    expenses_match: Dict[str, Any] = {"tenant_id": tenant_id}
+    if branch_id:
+        for match in (sales_match, purchases_match, expenses_match):
+            match["branch_id"] = branch_id
+    if created_filter:
+        sales_match["created_at"] = created_filter
+        purchases_match["created_at"] = created_filter
+        expenses_match["date"] = {
+            op: value[:10] if op == "$gte" else value for op, value in created_filter.items()
+        }
+
+    total_revenue = await _sum_field(target_db.sales, sales_match, "total")
+    total_expenses = await _sum_field(target_db.expenses, expenses_match, "amount")
+    total_purchases = await _sum_field(target_db.purchases, purchases_match, "total_amount")
+
+    profit = total_revenue - total_expenses - total_purchases
+
+    return {
+        "revenue": total_revenue,
+        "expenses": total_expenses,
+        "purchases": total_purchases,
+        "profit": profit,
+        "profit_margin": (profit / total_revenue * 100) if total_revenue > 0 else 0
+    }
@@ -0,0 +1,283 @@
+"""
+Columnar export of sale line items for BI.
+Streams a tenant's sales from a server-side cursor, flattens each line item,
+joins product, branch and customer details, and writes Parquet row groups.
+
+Usage:
+    python sales_export.py --tenant-slug techland --tenant-id <uuid> --out ./exports/techland
+    python sales_export.py --tenant-slug techland --tenant-id <uuid> --out ./exports/techland \\
+        --start-date 2025-01-01 --end-date 2025-12-31 --partition-by day
+"""
+
+from datetime import datetime
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+import argparse
+import asyncio
+import logging
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pa = None
+    pq = None
+
+from report_service import build_created_at_filter, ensure_report_indexes
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 5000
+
+SALE_LINE_COLUMNS = [
+    ("sale_id", "string"),
+    ("sale_number", "string"),
+    ("invoice_no", "string"),
+    ("sale_date", "string"),
+    ("created_at", "string"),
+    ("status", "string"),
+    ("payment_status", "string"),
+    ("payment_method", "string"),
+    ("branch_id", "string"),
+    ("branch_name", "string"),
+    ("customer_id", "string"),
+    ("customer_name", "string"),
+    ("customer_phone", "string"),
+    ("line_number", "int32"),
+    ("product_id", "string"),
+    ("product_name", "string"),
+    ("product_sku", "string"),
+    ("category", "string"),
+    ("quantity", "float64"),
+    ("unit_price", "float64"),
+    ("unit_cost", "float64"),
+    ("line_total", "float64"),
+    ("sale_subtotal", "float64"),
+    ("sale_discount", "float64"),
+    ("sale_tax", "float64"),
+    ("sale_total", "float64"),
+]
+
+
+def pyarrow_available() -> bool:
+    return pa is not None
+
+
+def sale_line_schema():
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in SALE_LINE_COLUMNS])
+
+
+def _as_float(value: Any) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _as_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+class _LookupCache:
+    """Per-export cache of product, branch and customer fields, filled with one $in query per batch."""
+
+    def __init__(self, target_db, tenant_id: str):
+        self._db = target_db
+        self._tenant_id = tenant_id
+        self.products: Dict[str, Dict[str, Any]] = {}
+        self.branches: Dict[str, Dict[str, Any]] = {}
+        self.customers: Dict[str, Dict[str, Any]] = {}
+
+    async def _fill(self, collection, cache: Dict[str, Dict[str, Any]], ids: set, projection: Dict[str, int]):
+        missing = [i for i in ids if i and i not in cache]
+        if not missing:
+            return
+        docs = await collection.find(
+            {"id": {"$in": missing}, "tenant_id": self._tenant_id},
+            {"_id": 0, "id": 1, **projection}
+        ).to_list(len(missing))
+        for doc in docs:
+            cache[doc["id"]] = doc
+        for i in missing:
+            cache.setdefault(i, {})
+
+    async def load_for(self, sales: List[Dict[str, Any]]):
+        product_ids = {item.get("product_id") for sale in sales for item in sale.get("items", [])}
+        await self._fill(self._db.products, self.products, product_ids, {"name": 1, "sku": 1, "category": 1})
+        await self._fill(self._db.branches, self.branches, {s.get("branch_id") for s in sales}, {"name": 1})
+        await self._fill(self._db.customers, self.customers, {s.get("customer_id") for s in sales}, {"name": 1, "phone": 1})
+
+
+def _flatten_sale(sale: Dict[str, Any], lookups: _LookupCache) -> List[Dict[str, Any]]:
+    created_at = _as_text(sale.get("created_at")) or ""
+    branch = lookups.branches.get(sale.get("branch_id"), {})
+    customer = lookups.customers.get(sale.get("customer_id"), {})
+    rows = []
+    for line_number, item in enumerate(sale.get("items", []), start=1):
+        product = lookups.products.get(item.get("product_id"), {})
+        quantity = _as_float(item.get("quantity")) or 0.0
+        price = _as_float(item.get("price")) or 0.0
+        rows.append({
+            "sale_id": sale.get("id"),
+            "sale_number": sale.get("sale_number"),
+            "invoice_no": sale.get("invoice_no"),
+            "sale_date": created_at[:10],
+            "created_at": created_at,
+            "status": _as_text(sale.get("status")),
+            "payment_status": _as_text(sale.get("payment_status")),
+            "payment_method": sale.get("payment_method"),
+            "branch_id": sale.get("branch_id"),
+            "branch_name": branch.get("name"),
+            "customer_id": sale.get("customer_id"),
+            "customer_name": sale.get("customer_name") or customer.get("name"),
+            "customer_phone": sale.get("customer_phone") or customer.get("phone"),
+            "line_number": line_number,
+            "product_id": item.get("product_id"),
+            "product_name": product.get("name") or item.get("name"),
+            "product_sku": product.get("sku"),
+            "category": product.get("category"),
+            "quantity": quantity,
+            "unit_price": price,
+            "unit_cost": _as_float(item.get("unit_cost")),
+            "line_total": quantity * price,
+            "sale_subtotal": _as_float(sale.get("subtotal")),
+            "sale_discount": _as_float(sale.get("discount")),
+            "sale_tax": _as_float(sale.get("tax")),
+            "sale_total": _as_float(sale.get("total")),
+        })
+    return rows
+
+
+async def iter_sale_line_batches(
+    target_db,
+    tenant_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    branch_id: Optional[str] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Yield flattened sale line rows in batches, ordered by created_at.
+    Sales are read from a single server-side cursor; lookups are batched per cursor batch.
+    """
+    await ensure_report_indexes(target_db)
+
+    query: Dict[str, Any] = {"tenant_id": tenant_id}
+    if branch_id:
+        query["branch_id"] = branch_id
+    date_filter = build_created_at_filter(start_date, end_date)
+    if date_filter:
+        query["created_at"] = date_filter
+
+    lookups = _LookupCache(target_db, tenant_id)
+    cursor = target_db.sales.find(query, {"_id": 0}).sort("created_at", 1).batch_size(batch_size)
+
+    sales: List[Dict[str, Any]] = []
+    async for sale in cursor:
+        sales.append(sale)
+        if len(sales) >= batch_size:
+            await lookups.load_for(sales)
+            yield [row for s in sales for row in _flatten_sale(s, lookups)]
+            sales = []
+    if sales:
+        await lookups.load_for(sales)
+        yield [row for s in sales for row in _flatten_sale(s, lookups)]
+
+
+async def write_sale_lines_parquet(
+    target_db,
+    tenant_id: str,
+    output: Path,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    partition_by_day: bool = False,
+    branch_id: Optional[str] = None
+) -> int:
+    """
+    Write sale lines to Parquet, one row group per cursor batch.
+
+    Args:
+        output: File path, or a directory when partition_by_day is set
+            (hive-style sale_date=YYYY-MM-DD/part-0.parquet)
+        partition_by_day: Write one file per sale day
+        branch_id: Only export this branch's sales
+
+    Returns:
+        Number of line rows written
+    """
+    if not pyarrow_available():
+        raise RuntimeError("Parquet export requires pyarrow to be installed")
+
+    schema = sale_line_schema()
+    writers: Dict[str, Any] = {}
+    total_rows = 0
+
+    def _writer_for(key: str):
+        if key not in writers:
+            if partition_by_day:
+                path = output / f"sale_date={key}" / "part-0.parquet"
+            else:
+                path = output
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writers[key] = pq.ParquetWriter(str(path), schema, compression="zstd")
+        return writers[key]
+
+    def _write_batch(rows: List[Dict[str, Any]]):
+        if partition_by_day:
+            by_day: Dict[str, List[Dict[str, Any]]] = {}
+            for row in rows:
+                by_day.setdefault(row["sale_date"] or "unknown", []).append(row)
+            for day, day_rows in by_day.items():
+                _writer_for(day).write_table(pa.Table.from_pylist(day_rows, schema=schema))
+            # Sales arrive ordered by created_at, so earlier days are complete
+            last_day = rows[-1]["sale_date"] or "unknown"
+            for day in [d for d in writers if d < last_day]:
+                writers.pop(day).close()
+        else:
+            _writer_for("all").write_table(pa.Table.from_pylist(rows, schema=schema))
+
+    try:
+        async for rows in iter_sale_line_batches(target_db, tenant_id, start_date, end_date, branch_id=branch_id):
+            if rows:
+                await asyncio.to_thread(_write_batch, rows)
+                total_rows += len(rows)
+        if not partition_by_day and not writers:
+            # Always produce a readable file, even for an empty range
+            await asyncio.to_thread(_writer_for, "all")
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    return total_rows
+
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Export a tenant's sale line items to Parquet")
+    parser.add_argument("--tenant-slug", help="Tenant slug in the registry (omit for the default database)")
+    parser.add_argument("--tenant-id", required=True, help="tenant_id stored on the sale documents")
+    parser.add_argument("--out", required=True, help="Output .parquet file, or directory with --partition-by day")
+    parser.add_argument("--start-date", help="YYYY-MM-DD")
+    parser.add_argument("--end-date", help="YYYY-MM-DD")
+    parser.add_argument("--partition-by", choices=["none", "day"], default="none")
+    args = parser.parse_args()
+
+    from db_connection import resolve_tenant_db, get_default_db
+
+    target_db = await resolve_tenant_db(args.tenant_slug) if args.tenant_slug else get_default_db()
+    rows = await write_sale_lines_parquet(
+        target_db,
+        args.tenant_id,
+        Path(args.out),
+        start_date=args.start_date,
+        end_date=args.end_date,
+        partition_by_day=args.partition_by == "day"
+    )
+    print(f"✅ Exported {rows} sale lines to {args.out}")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -9,6 +9,9 @@ from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 import logging
 
+from stock_ledger import StockMovementReason, apply_stock_movement
+from notification_counters import insert_notifications
+
 logger = logging.getLogger(__name__)
 
 
@@ -154,21 +157,24 @@ async def perform_sale_creation(
                     f"Insufficient stock for {item.name}. Available: {available_stock}, Requested: {item.quantity}"
                 )
     
+    sale_id = overrides.sale_id or str(uuid4())
+    
     # Update stock (unless skipped for idempotent retries)
     if not overrides.skip_stock_update:
         for item in sale_input.items:
-            if sale_input.branch_id:
-                result = await target_db.product_branches.update_one(
-                    {"product_id": item.product_id, "branch_id": sale_input.branch_id, "tenant_id": actor.tenant_id},
-                    {"$inc": {"stock_quantity": -item.quantity}}
-                )
-                if result.matched_count == 0:
-                    raise ValueError(f"Product {item.product_id} not assigned to branch or insufficient stock")
-            else:
-                await target_db.products.update_one(
-                    {"id": item.product_id, "tenant_id": actor.tenant_id},
-                    {"$inc": {"stock": -item.quantity}}
-                )
+            result = await apply_stock_movement(
+                target_db,
+                tenant_id=actor.tenant_id,
+                product_id=item.product_id,
+                branch_id=sale_input.branch_id,
+                delta=-item.quantity,
+                reason=StockMovementReason.SALE,
+                reference_type="sale",
+                reference_id=sale_id,
+                actor_id=actor.user_id
+            )
+            if sale_input.branch_id and result is None:
+                raise ValueError(f"Product {item.product_id} not assigned to branch or insufficient stock")
     
     # Check for low stock and create notifications
     low_stock_product_ids = []
@@ -205,7 +211,7 @@ async def perform_sale_creation(
                             "created_at": datetime.utcnow().isoformat(),
                             "updated_at": datetime.utcnow().isoformat()
                         }
-                        await target_db.notifications.insert_one(notif_doc)
+                        await insert_notifications(target_db, [notif_doc])
                         low_stock_product_ids.append(item.product_id)
         else:
             product = await target_db.products.find_one(
@@ -232,7 +238,7 @@ async def perform_sale_creation(
                         "created_at": datetime.utcnow().isoformat(),
                         "updated_at": datetime.utcnow().isoformat()
                     }
-                    await target_db.notifications.insert_one(notif_doc)
+                    await insert_notifications(target_db, [notif_doc])
                     low_stock_product_ids.append(item.product_id)
     
     # Auto-create or update customer
@@ -286,7 +292,6 @@ async def perform_sale_creation(
             actual_customer_id = new_customer_id
     
     # Create sale document (using dict instead of Pydantic model to avoid circular imports)
-    sale_id = overrides.sale_id or str(uuid4())
     now = datetime.utcnow()
     
     # Inherit warranty terms from products if not explicitly provided
@@ -438,6 +443,8 @@ async def perform_sale_creation(
             "id": str(uuid4()),
             "tenant_id": actor.tenant_id,
             "customer_name": sale_input.customer_name,
+            "customer_id": actual_customer_id,
+            "branch_id": sale_input.branch_id,
             "sale_id": sale_id,
             "sale_number": sale_number,
             "total_amount": total,
@@ -462,7 +469,7 @@ async def perform_sale_creation(
             "created_at": now.isoformat(),
             "updated_at": now.isoformat()
         }
-        await target_db.notifications.insert_one(unpaid_notif)
+        await insert_notifications(target_db, [unpaid_notif])
     
     return SaleCreationResult(
         sale_id=sale_id,
@@ -0,0 +1,192 @@
+"""
+Scheduled notification checks (low stock, overdue invoices, daily due reminders).
+Candidates are streamed in batches; for each batch one $in query finds the
+references that already have a notification and the rest are inserted with a
+single insert_many. Daily reminders also carry a per-day dedupe key under a
+unique index, so concurrent runs cannot create the same reminder twice.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, Callable, Dict, List, Optional
+import logging
+import uuid
+
+from pymongo import ASCENDING
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+from notification_counters import insert_notifications
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+LOW_STOCK_THRESHOLD = 5
+OVERDUE_AFTER_DAYS = 7
+
+LOW_STOCK = "low_stock"
+UNPAID_INVOICE = "unpaid_invoice"
+
+
+async def ensure_scheduled_notification_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "scheduled_notifications"):
+        return
+    try:
+        await target_db.notifications.create_index(
+            [("tenant_id", ASCENDING), ("type", ASCENDING), ("reference_id", ASCENDING), ("created_at", ASCENDING)],
+            name="tenant_type_reference_created_at"
+        )
+        await target_db.notifications.create_index(
+            [("tenant_id", ASCENDING), ("type", ASCENDING), ("sale_id", ASCENDING), ("is_read", ASCENDING)],
+            name="tenant_type_sale_is_read"
+        )
+        await target_db.notifications.create_index(
+            [("dedupe_key", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"dedupe_key": {"$exists": True}},
+            name="dedupe_key"
+        )
+        mark_indexes_ensured(target_db, "scheduled_notifications")
+    except Exception as e:
+        logger.warning(f"Failed to ensure scheduled notification indexes on {target_db.name}: {e}")
+
+
+def _notification_doc(tenant_id: str, notification_type: str, message: str, **fields: Any) -> Dict[str, Any]:
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "id": str(uuid.uuid4()),
+        "tenant_id": tenant_id,
+        "type": notification_type,
+        "sale_id": None,
+        "reference_id": None,
+        "message": message,
+        "is_sticky": False,
+        "is_read": False,
+        "branch_id": None,
+        "user_id": None,
+        "title": None,
+        "metadata": None,
+        "created_at": now,
+        "updated_at": now,
+        **fields
+    }
+
+
+async def _notify_missing(
+    target_db,
+    candidates,
+    key_field: str,
+    existing_query: Callable[[List[str]], Dict[str, Any]],
+    build: Callable[[Dict[str, Any]], Dict[str, Any]]
+) -> Dict[str, int]:
+    """
+    Create notifications for candidates that do not already have one.
+
+    Args:
+        candidates: Async cursor of candidate documents
+        key_field: Notification field holding the candidate's id
+        existing_query: Builds the query for existing notifications given a batch of ids
+        build: Builds the notification document for a candidate
+    """
+    scanned = 0
+    created = 0
+    batch: List[Dict[str, Any]] = []
+
+    async def _flush():
+        nonlocal created
+        ids = [doc["id"] for doc in batch]
+        existing = set(await target_db.notifications.distinct(key_field, existing_query(ids)))
+        docs = [build(doc) for doc in batch if doc["id"] not in existing]
+        if docs:
+            created += await insert_notifications(target_db, docs)
+
+    async for doc in candidates:
+        scanned += 1
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            await _flush()
+            batch = []
+    if batch:
+        await _flush()
+
+    return {"scanned": scanned, "created": created}
+
+
+async def notify_low_stock(target_db, tenant_id: str) -> Dict[str, int]:
+    """One alert per low-stock product (never repeated while an alert exists)."""
+    candidates = target_db.products.find(
+        {"tenant_id": tenant_id, "stock": {"$lte": LOW_STOCK_THRESHOLD}},
+        {"_id": 0, "id": 1, "name": 1, "stock": 1}
+    ).batch_size(BATCH_SIZE)
+    return await _notify_missing(
+        target_db, candidates, "reference_id",
+        lambda ids: {"tenant_id": tenant_id, "type": LOW_STOCK, "reference_id": {"$in": ids}},
+        lambda product: _notification_doc(
+            tenant_id, LOW_STOCK,
+            f"Low stock alert: {product['name']} - Only {product['stock']} units left!",
+            reference_id=product["id"]
+        )
+    )
+
+
+async def notify_overdue_invoices(target_db, tenant_id: str) -> Dict[str, int]:
+    """One sticky alert per invoice unpaid for OVERDUE_AFTER_DAYS, unless an unread one exists."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=OVERDUE_AFTER_DAYS)
+    candidates = target_db.sales.find(
+        {
+            "tenant_id": tenant_id,
+            "payment_status": {"$in": ["unpaid", "partially_paid"]},
+            "created_at": {"$lt": cutoff.isoformat()}
+        },
+        {"_id": 0, "id": 1, "invoice_no": 1, "balance_due": 1}
+    ).batch_size(BATCH_SIZE)
+    return await _notify_missing(
+        target_db, candidates, "sale_id",
+        lambda ids: {"tenant_id": tenant_id, "type": UNPAID_INVOICE, "sale_id": {"$in": ids}, "is_read": False},
+        lambda sale: _notification_doc(
+            tenant_id, UNPAID_INVOICE,
+            f"Overdue invoice {sale.get('invoice_no')}: ৳{sale.get('balance_due', 0):.2f} outstanding for 7+ days",
+            sale_id=sale["id"],
+            is_sticky=True
+        )
+    )
+
+
+async def notify_daily_due_reminders(
+    target_db,
+    tenant_id: str,
+    message_prefix: str = "Daily Reminder",
+    now: Optional[datetime] = None
+) -> Dict[str, int]:
+    """One reminder per open customer due per UTC day."""
+    now = now or datetime.now(timezone.utc)
+    day = now.strftime("%Y-%m-%d")
+    day_start = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    candidates = target_db.customer_dues.find(
+        {"tenant_id": tenant_id, "due_amount": {"$gt": 0}},
+        {"_id": 0, "id": 1, "sale_id": 1, "customer_name": 1, "due_amount": 1, "sale_number": 1}
+    ).batch_size(BATCH_SIZE)
+    return await _notify_missing(
+        target_db, candidates, "reference_id",
+        lambda ids: {
+            "tenant_id": tenant_id,
+            "type": UNPAID_INVOICE,
+            "reference_id": {"$in": ids},
+            "created_at": {"$gte": day_start}
+        },
+        lambda due: _notification_doc(
+            tenant_id, UNPAID_INVOICE,
+            f"{message_prefix}: {due.get('customer_name')} has outstanding due of ৳{due.get('due_amount', 0):.2f} (Invoice: {due.get('sale_number')})",
+            reference_id=due["id"],
+            sale_id=due.get("sale_id"),
+            dedupe_key=f"{tenant_id}:{UNPAID_INVOICE}:{due['id']}:{day}"
+        )
+    )
+
+
+async def run_scheduled_checks(target_db, tenant_id: str) -> Dict[str, Dict[str, int]]:
+    """Run every scheduled check for a tenant."""
+    await ensure_scheduled_notification_indexes(target_db)
+    return {
+        "low_stock": await notify_low_stock(target_db, tenant_id),
+        "overdue_invoices": await notify_overdue_invoices(target_db, tenant_id),
+        "daily_due_reminders": await notify_daily_due_reminders(target_db, tenant_id)
+    }
@@ -1,11 +1,12 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, WebSocket, WebSocketDisconnect, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import asyncio
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import os
 import logging
 import json
@@ -42,7 +43,46 @@ from notification_models import (
     Announcement, CreateAnnouncementRequest, NotificationChannel,
     AnnouncementType, AudienceType
 )
-from notification_service import NotificationService
+from notification_service import NotificationService, announcement_delivery_queue
+from email_queue import email_queue_workers, get_email_queue_stats
+from usage_metering import record_usage, get_fleet_usage, ensure_usage_indexes, USERS
+from plan_quotas import (
+    QuotaExceeded, quota_reservation, release_quota, invalidate_plan_cache,
+    MAX_PRODUCTS, MAX_USERS, MAX_BRANCHES, MAX_ORDERS_PER_MONTH
+)
+from report_cache import report_cache, INVALIDATE_KIND as REPORT_CACHE_INVALIDATE
+from sales_export import pyarrow_available
+from report_jobs import (
+    ReportJobCreate, ReportJobFormat, ReportJobStatus, ReportJobType, ReportJobQueueFull,
+    MEDIA_TYPES, PARQUET_REPORT_TYPES, report_job_queue, job_file_path
+)
+from report_service import (
+    TOP_PRODUCTS_SORT_FIELDS, build_created_at_filter, get_top_products_report,
+    get_branch_sales_totals, adjust_sales_daily_rollup, get_profit_loss_totals
+)
+from stock_ledger import (
+    StockMovementReason, apply_stock_movement, record_stock_movements,
+    get_stock_levels_at, get_stock_movement_summary, ensure_stock_ledger_indexes
+)
+from inventory_valuation import (
+    ValuationMethod, get_stock_valuation, get_average_unit_cost, rebuild_stock_valuation
+)
+from dues_service import AGING_GROUP_FIELDS, get_dues_aging, iter_customer_statement
+from notification_feed import get_notification_feed
+from notification_counters import (
+    insert_notifications, mark_notifications_read, delete_notifications,
+    get_notification_counters, visible_scopes
+)
+from scheduled_notifications import run_scheduled_checks
+from notification_retention import get_notification_storage_stats, get_all_tenant_storage_stats, ensure_retention_indexes
+from broadcast_bus import create_broadcast_bus
+from connection_manager import ConnectionManager
+from notification_publisher import configure_notification_publisher
+from activity_notifications import notify_admins_of_activity, invalidate_tenant_admins
+from branch_stock_counters import (
+    is_low_stock, inc_branch_counters, refresh_low_stock_flag, rebuild_branch_counters,
+    get_branch_counters, ensure_branch_counter_indexes
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -81,6 +121,13 @@ ALGORITHM = "HS256"
 
 app = FastAPI()
 
+@app.exception_handler(QuotaExceeded)
+async def quota_exceeded_handler(request: Request, exc: QuotaExceeded):
+    return JSONResponse(
+        status_code=402,
+        content={"detail": str(exc), "quota": exc.quota, "limit": exc.limit}
+    )
+
 # CORS origins - include production URLs
 cors_origins = [
     "http://localhost:3000",
@@ -120,59 +167,18 @@ app.add_middleware(
 api_router = APIRouter(prefix="/api")
 
 # WebSocket Connection Manager for real-time updates
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-        self.user_roles: Dict[str, str] = {}
-    
-    async def connect(self, websocket: WebSocket, tenant_id: str, user_id: str, role: str = ""):
-        await websocket.accept()
-        key = f"{tenant_id}:{user_id}"
-        if key not in self.active_connections:
-            self.active_connections[key] = []
-        self.active_connections[key].append(websocket)
-        self.user_roles[key] = role
-        logging.info(f"WebSocket connected: {key} (role: {role}), total connections: {len(self.active_connections[key])}")
-    
-    def disconnect(self, websocket: WebSocket, tenant_id: str, user_id: str):
-        key = f"{tenant_id}:{user_id}"
-        if key in self.active_connections:
-            if websocket in self.active_connections[key]:
-                self.active_connections[key].remove(websocket)
-            if not self.active_connections[key]:
-                del self.active_connections[key]
-                if key in self.user_roles:
-                    del self.user_roles[key]
-        logging.info(f"WebSocket disconnected: {key}")
-    
-    async def send_to_user(self, tenant_id: str, user_id: str, message: dict):
-        key = f"{tenant_id}:{user_id}"
-        if key in self.active_connections:
-            disconnected = []
-            for connection in self.active_connections[key]:
-                try:
-                    await connection.send_json(message)
-                except Exception:
-                    disconnected.append(connection)
-            for conn in disconnected:
-                self.active_connections[key].remove(conn)
-    
-    async def send_to_tenant_admins(self, tenant_id: str, message: dict):
-        admin_roles = ["tenant_admin", "super_admin"]
-        for key, connections in list(self.active_connections.items()):
-            if key.startswith(f"{tenant_id}:"):
-                role = self.user_roles.get(key, "")
-                if role in admin_roles:
-                    disconnected = []
-                    for connection in connections:
-                        try:
-                            await connection.send_json(message)
-                        except Exception:
-                            disconnected.append(connection)
-                    for conn in disconnected:
-                        connections.remove(conn)
-
 ws_manager = ConnectionManager()
+# Relays broadcasts between uvicorn workers so every worker reaches its own sockets
+broadcast_bus = create_broadcast_bus()
+configure_notification_publisher(broadcast_bus)
+report_cache.configure_bus(broadcast_bus)
+
+async def deliver_broadcast(envelope: dict):
+    """Route a bus envelope: report cache invalidations here, everything else to sockets"""
+    if envelope.get("kind") == REPORT_CACHE_INVALIDATE:
+        report_cache.apply_invalidation(envelope)
+        return
+    await ws_manager.deliver(envelope)
 
 # MongoDB connection test on startup
 @app.on_event("startup")
@@ -224,6 +230,30 @@ async def test_database_connection():
         print("✅ Billing scheduler started - checking subscriptions hourly")
     except Exception as e:
         print(f"⚠️  Failed to start billing scheduler: {str(e)}")
+    
+    # Usage counters need their unique index before quotas seed them
+    await ensure_usage_indexes()
+    
+    # Start the background report job workers
+    report_job_queue.start()
+    
+    # Resume and run background announcement deliveries
+    try:
+        await announcement_delivery_queue.start()
+    except Exception as e:
+        print(f"⚠️  Failed to start announcement delivery: {str(e)}")
+    
+    # Start the email queue workers (safe to run in every process)
+    try:
+        await email_queue_workers.start()
+    except Exception as e:
+        print(f"⚠️  Failed to start email queue workers: {str(e)}")
+    
+    # Subscribe this worker to WebSocket broadcasts
+    try:
+        await broadcast_bus.start(deliver_broadcast)
+    except Exception as e:
+        print(f"⚠️  Failed to start broadcast bus: {str(e)}")
 
 @app.on_event("shutdown")
 async def shutdown_scheduler():
@@ -232,6 +262,10 @@ async def shutdown_scheduler():
         stop_scheduler()
     except Exception as e:
         print(f"⚠️  Error stopping scheduler: {str(e)}")
+    await report_job_queue.stop()
+    await broadcast_bus.stop()
+    await announcement_delivery_queue.stop()
+    await email_queue_workers.stop()
 
 # ========== ENUMS ==========
 class UserRole(str, Enum):
@@ -642,6 +676,8 @@ class CustomerDueCreate(BaseModel):
 class CustomerDue(BaseDBModel):
     tenant_id: str
     customer_name: str
+    customer_id: Optional[str] = None
+    branch_id: Optional[str] = None
     sale_id: str
     sale_number: str
     total_amount: float
@@ -1464,29 +1500,16 @@ async def create_activity_notification(
     if actor_user["role"] in [UserRole.TENANT_ADMIN.value, UserRole.SUPER_ADMIN.value]:
         return
     
-    # Find all tenant_admins for this tenant from global users collection
-    # Note: Users are stored in the global database, not tenant-specific databases
-    tenant_admins = await db.users.find(
-        {"tenant_id": tenant_id, "role": UserRole.TENANT_ADMIN.value},
-        {"_id": 0}
-    ).to_list(100)
-    
-    # Create a notification for each tenant_admin in the tenant-specific database
-    for admin in tenant_admins:
-        notification = Notification(
-            tenant_id=tenant_id,
-            user_id=admin["id"],
-            type=NotificationType.ACTIVITY,
-            title=title,
-            message=message,
-            is_read=False,
-            is_sticky=False,
-            metadata={"activity_subtype": activity_subtype, "actor_name": actor_user.get("full_name", "User")}
-        )
-        notif_doc = notification.model_dump()
-        notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-        notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-        await notification_db.notifications.insert_one(notif_doc)
+    # Admin recipients are cached per tenant; users live in the global database
+    await notify_admins_of_activity(
+        notification_db,
+        db,
+        tenant_id,
+        actor_user,
+        getattr(activity_subtype, "value", activity_subtype),
+        title,
+        message
+    )
 
 # ========== AUTH ROUTES ==========
 @api_router.post("/auth/register", response_model=TokenResponse)
@@ -1505,7 +1528,9 @@ async def register(user_data: UserCreate):
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     
-    await db.users.insert_one(doc)
+    async with quota_reservation(user.tenant_id, MAX_USERS):
+        await db.users.insert_one(doc)
+    invalidate_tenant_admins(user.tenant_id)
     
     # Get tenant information for JWT (including tenant_slug for multi-tenant support)
     business_type = None
@@ -1808,6 +1833,8 @@ async def signup_tenant(tenant_data: TenantCreate):
         admin_doc['updated_at'] = admin_doc['updated_at'].isoformat()
         
         await db.users.insert_one(admin_doc)
+        invalidate_tenant_admins(admin_user.tenant_id)
+        await record_usage(admin_user.tenant_id, USERS)
         
         # Note: This is legacy signup, not multi-tenant (no registry entry)
         token = create_access_token({
@@ -1940,7 +1967,9 @@ async def create_user(
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     
-    await db.users.insert_one(doc)
+    async with quota_reservation(doc.get("tenant_id"), MAX_USERS):
+        await db.users.insert_one(doc)
+    invalidate_tenant_admins(doc.get("tenant_id"))
     
     # Return user without hashed_password and _id (MongoDB ObjectId)
     user_response = {k: v for k, v in doc.items() if k not in ["hashed_password", "_id"]}
@@ -2007,6 +2036,7 @@ async def update_user(
         {"id": user_id, "tenant_id": current_user["tenant_id"]},
         {"$set": update_data}
     )
+    invalidate_tenant_admins(current_user["tenant_id"])
     
     return {"message": "User updated successfully"}
 
@@ -2040,9 +2070,11 @@ async def delete_user(
     result = await db.users.delete_one(
         {"id": user_id, "tenant_id": current_user["tenant_id"]}
     )
+    invalidate_tenant_admins(current_user["tenant_id"])
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await release_quota(current_user["tenant_id"], MAX_USERS)
     
     return {"message": "User deleted successfully"}
 
@@ -2080,6 +2112,8 @@ async def create_tenant(
     admin_doc['updated_at'] = admin_doc['updated_at'].isoformat()
     
     await db.users.insert_one(admin_doc)
+    invalidate_tenant_admins(admin_doc.get("tenant_id"))
+    await record_usage(admin_doc.get("tenant_id"), USERS)
     
     return tenant
 
@@ -2402,6 +2436,7 @@ async def update_plan(
         
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail=f"Plan '{plan_id}' not found")
+        invalidate_plan_cache()
         
         # Get updated plan
         updated_plan = await admin_db.plans.find_one({"plan_id": plan_id}, {"_id": 0})
@@ -2544,6 +2579,7 @@ async def create_subscription(
         }
         
         await admin_db.subscriptions.insert_one(subscription_doc)
+        invalidate_plan_cache(subscription_doc.get("tenant_id"))
         
         # Create billing event
         event_doc = {
@@ -2821,7 +2857,8 @@ async def create_announcement(
         return {
             "success": True,
             "announcement": result,
-            "message": f"Announcement created for {result['total_recipients']} recipients"
+            "message": f"Announcement created for {result['total_recipients']} recipients",
+            "delivery_status": result.get("delivery_status")
         }
     except Exception as e:
         logger.error(f"Error creating announcement: {str(e)}")
@@ -2847,6 +2884,45 @@ async def get_all_announcements(
         logger.error(f"Error fetching announcements: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/super/announcements/{announcement_id}/delivery")
+async def get_announcement_delivery(
+    announcement_id: str,
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """
+    Progress of an announcement's background receipt delivery.
+    """
+    progress = await NotificationService.get_delivery_progress(announcement_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="Announcement not found")
+    return progress
+
+@api_router.get("/super/email-queue/stats")
+async def get_email_queue_status(
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """
+    Email queue depth by status and send throughput.
+    """
+    return await get_email_queue_stats()
+
+@api_router.get("/super/usage")
+async def get_fleet_usage_snapshots(
+    snapshot_date: Optional[str] = None,
+    current_user: dict = Depends(require_role([UserRole.SUPER_ADMIN]))
+):
+    """
+    Per-tenant usage for the whole fleet, from the daily usage snapshots.
+    Defaults to the latest snapshot day; pass snapshot_date=YYYY-MM-DD for an earlier one.
+    """
+    day = None
+    if snapshot_date:
+        try:
+            day = datetime.strptime(snapshot_date, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="snapshot_date must be YYYY-MM-DD")
+    return await get_fleet_usage(day)
+
 @api_router.delete("/super/announcements/{announcement_id}")
 async def delete_announcement(
     announcement_id: str,
@@ -3747,7 +3823,19 @@ async def create_product(
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     
-    await target_db.products.insert_one(doc)
+    async with quota_reservation(current_user["tenant_id"], MAX_PRODUCTS, target_db=target_db):
+        await target_db.products.insert_one(doc)
+    if product.stock:
+        await record_stock_movements(target_db, [{
+            "tenant_id": current_user["tenant_id"],
+            "product_id": product.id,
+            "branch_id": None,
+            "delta": product.stock,
+            "reason": StockMovementReason.OPENING,
+            "reference_type": "product",
+            "reference_id": product.id,
+            "actor_id": current_user.get("id")
+        }])
     return product
 
 @api_router.get("/products", response_model=List[Product])
@@ -3863,14 +3951,29 @@ async def update_product(
     update_data = product_data.model_dump()
     update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
     
-    result = await target_db.products.update_one(
+    previous = await target_db.products.find_one_and_update(
         {"id": product_id, "tenant_id": current_user["tenant_id"]},
-        {"$set": update_data}
+        {"$set": update_data},
+        projection={"_id": 0, "stock": 1},
+        return_document=ReturnDocument.BEFORE
     )
     
-    if result.matched_count == 0:
+    if previous is None:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    stock_delta = update_data["stock"] - (previous.get("stock") or 0)
+    if stock_delta:
+        await record_stock_movements(target_db, [{
+            "tenant_id": current_user["tenant_id"],
+            "product_id": product_id,
+            "branch_id": None,
+            "delta": stock_delta,
+            "reason": StockMovementReason.ADJUSTMENT,
+            "reference_type": "product",
+            "reference_id": product_id,
+            "actor_id": current_user.get("id")
+        }])
+    
     return {"message": "Product updated"}
 
 @api_router.delete("/products/{product_id}")
@@ -3896,6 +3999,7 @@ async def delete_product(
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await release_quota(current_user["tenant_id"], MAX_PRODUCTS)
     
     return {"message": "Product deleted"}
 
@@ -4246,23 +4350,140 @@ async def create_sale(
     sale_number = f"SALE-{count + 1:06d}"
     invoice_no = f"INV-{count + 1:06d}"
     
-    # Update stock (auto stock adjustment)
-    # If branch_id is provided, use product_branches, otherwise use products
-    for item in sale_data.items:
-        if sale_data.branch_id:
-            # Update branch-specific stock (use stock_quantity field)
-            result = await target_db.product_branches.update_one(
-                {"product_id": item.product_id, "branch_id": sale_data.branch_id, "tenant_id": current_user["tenant_id"]},
-                {"$inc": {"stock_quantity": -item.quantity}}
+    sale_id = str(uuid.uuid4())
+    
+    # Reserve against the plan's monthly order quota before touching stock
+    # (released again if a stock adjustment or the sale insert fails)
+    async with quota_reservation(current_user["tenant_id"], MAX_ORDERS_PER_MONTH, target_db=target_db):
+        # Update stock (auto stock adjustment)
+        # If branch_id is provided, use product_branches, otherwise use products
+        for item in sale_data.items:
+            result = await apply_stock_movement(
+                target_db,
+                tenant_id=current_user["tenant_id"],
+                product_id=item.product_id,
+                branch_id=sale_data.branch_id,
+                delta=-item.quantity,
+                reason=StockMovementReason.SALE,
+                reference_type="sale",
+                reference_id=sale_id,
+                actor_id=current_user.get("id")
             )
-            if result.matched_count == 0:
+            if sale_data.branch_id and result is None:
                 raise HTTPException(status_code=400, detail=f"Product {item.product_id} not assigned to branch or insufficient stock")
-        else:
-            # Update global stock
-            await target_db.products.update_one(
-                {"id": item.product_id, "tenant_id": current_user["tenant_id"]},
-                {"$inc": {"stock": -item.quantity}}
-            )
+        
+        # Auto-create or update customer if customer details are provided
+        actual_customer_id = sale_data.customer_id
+        if sale_data.customer_name and (sale_data.customer_phone or sale_data.customer_address):
+            # Try to find existing customer by phone (more reliable) or name
+            existing_customer = None
+            if sale_data.customer_phone:
+                existing_customer = await target_db.customers.find_one({
+                    "tenant_id": current_user["tenant_id"],
+                    "phone": sale_data.customer_phone
+                }, {"_id": 0})
+            
+            if not existing_customer and sale_data.customer_name:
+                # Fallback: try to find by name
+                existing_customer = await target_db.customers.find_one({
+                    "tenant_id": current_user["tenant_id"],
+                    "name": sale_data.customer_name
+                }, {"_id": 0})
+            
+            if existing_customer:
+                # Update existing customer
+                actual_customer_id = existing_customer['id']
+                update_data = {}
+                
+                # Update fields if provided and different
+                if sale_data.customer_address and sale_data.customer_address != existing_customer.get('address'):
+                    update_data['address'] = sale_data.customer_address
+                if sale_data.customer_phone and sale_data.customer_phone != existing_customer.get('phone'):
+                    update_data['phone'] = sale_data.customer_phone
+                
+                # Always increment total_purchases
+                update_data['total_purchases'] = existing_customer.get('total_purchases', 0) + total
+                update_data['updated_at'] = datetime.utcnow().isoformat()
+                
+                if update_data:
+                    await target_db.customers.update_one(
+                        {"id": actual_customer_id, "tenant_id": current_user["tenant_id"]},
+                        {"$set": update_data}
+                    )
+            else:
+                # Create new customer
+                from uuid import uuid4
+                new_customer_id = str(uuid4())
+                new_customer = {
+                    "id": new_customer_id,
+                    "tenant_id": current_user["tenant_id"],
+                    "name": sale_data.customer_name,
+                    "phone": sale_data.customer_phone or "",
+                    "email": None,
+                    "address": sale_data.customer_address or "",
+                    "credit_limit": 0.0,
+                    "total_purchases": total,
+                    "created_at": datetime.utcnow().isoformat(),
+                    "updated_at": datetime.utcnow().isoformat()
+                }
+                await target_db.customers.insert_one(new_customer)
+                actual_customer_id = new_customer_id
+        
+        # Inherit warranty terms from products if not explicitly provided
+        include_warranty_terms = sale_data.include_warranty_terms
+        warranty_terms = sale_data.warranty_terms
+        
+        if not warranty_terms:
+            # Check if any product in the sale has warranty terms from purchase
+            product_ids = [item.product_id for item in sale_data.items]
+            if product_ids:
+                products_with_warranty = await target_db.products.find(
+                    {
+                        "id": {"$in": product_ids},
+                        "tenant_id": current_user["tenant_id"],
+                        "include_warranty_terms": True,
+                        "warranty_terms": {"$ne": None}
+                    },
+                    {"_id": 0, "warranty_terms": 1}
+                ).to_list(len(product_ids))
+                
+                if products_with_warranty:
+                    include_warranty_terms = True
+                    warranty_terms = products_with_warranty[0].get("warranty_terms")
+        
+        sale = Sale(
+            id=sale_id,
+            tenant_id=current_user["tenant_id"],
+            sale_number=sale_number,
+            invoice_no=invoice_no,
+            branch_id=sale_data.branch_id,
+            customer_id=actual_customer_id,
+            customer_name=sale_data.customer_name,
+            customer_phone=sale_data.customer_phone,
+            customer_address=sale_data.customer_address,
+            items=[item.model_dump() for item in sale_data.items],
+            subtotal=subtotal,
+            discount=sale_data.discount,
+            tax=sale_data.tax,
+            total=total,
+            amount_paid=paid_amount,
+            balance_due=balance_due,
+            status=SaleStatus.COMPLETED,
+            payment_status=payment_status,
+            payment_method=sale_data.payment_method,
+            reference=sale_data.reference,
+            created_by=current_user.get("email"),
+            include_warranty_terms=include_warranty_terms,
+            warranty_terms=warranty_terms
+        )
+        
+        doc = sale.model_dump()
+        doc['created_at'] = doc['created_at'].isoformat()
+        doc['updated_at'] = doc['updated_at'].isoformat()
+        
+        await target_db.sales.insert_one(doc)
+    
+    report_cache.invalidate_tenant(current_user["tenant_id"])
     
     # Check for low stock and create notifications (≤5 units)
     for item in sale_data.items:
@@ -4301,7 +4522,7 @@ async def create_sale(
                         notif_doc = notification.model_dump()
                         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
                         notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-                        await target_db.notifications.insert_one(notif_doc)
+                        await insert_notifications(target_db, [notif_doc])
         else:
             # Check global stock
             product = await target_db.products.find_one(
@@ -4328,118 +4549,8 @@ async def create_sale(
                     notif_doc = notification.model_dump()
                     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
                     notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-                    await target_db.notifications.insert_one(notif_doc)
-    
-    # Auto-create or update customer if customer details are provided
-    actual_customer_id = sale_data.customer_id
-    if sale_data.customer_name and (sale_data.customer_phone or sale_data.customer_address):
-        # Try to find existing customer by phone (more reliable) or name
-        existing_customer = None
-        if sale_data.customer_phone:
-            existing_customer = await target_db.customers.find_one({
-                "tenant_id": current_user["tenant_id"],
-                "phone": sale_data.customer_phone
-            }, {"_id": 0})
-        
-        if not existing_customer and sale_data.customer_name:
-            # Fallback: try to find by name
-            existing_customer = await target_db.customers.find_one({
-                "tenant_id": current_user["tenant_id"],
-                "name": sale_data.customer_name
-            }, {"_id": 0})
-        
-        if existing_customer:
-            # Update existing customer
-            actual_customer_id = existing_customer['id']
-            update_data = {}
-            
-            # Update fields if provided and different
-            if sale_data.customer_address and sale_data.customer_address != existing_customer.get('address'):
-                update_data['address'] = sale_data.customer_address
-            if sale_data.customer_phone and sale_data.customer_phone != existing_customer.get('phone'):
-                update_data['phone'] = sale_data.customer_phone
-            
-            # Always increment total_purchases
-            update_data['total_purchases'] = existing_customer.get('total_purchases', 0) + total
-            update_data['updated_at'] = datetime.utcnow().isoformat()
-            
-            if update_data:
-                await target_db.customers.update_one(
-                    {"id": actual_customer_id, "tenant_id": current_user["tenant_id"]},
-                    {"$set": update_data}
-                )
-        else:
-            # Create new customer
-            from uuid import uuid4
-            new_customer_id = str(uuid4())
-            new_customer = {
-                "id": new_customer_id,
-                "tenant_id": current_user["tenant_id"],
-                "name": sale_data.customer_name,
-                "phone": sale_data.customer_phone or "",
-                "email": None,
-                "address": sale_data.customer_address or "",
-                "credit_limit": 0.0,
-                "total_purchases": total,
-                "created_at": datetime.utcnow().isoformat(),
-                "updated_at": datetime.utcnow().isoformat()
-            }
-            await target_db.customers.insert_one(new_customer)
-            actual_customer_id = new_customer_id
-    
-    # Inherit warranty terms from products if not explicitly provided
-    include_warranty_terms = sale_data.include_warranty_terms
-    warranty_terms = sale_data.warranty_terms
-    
-    if not warranty_terms:
-        # Check if any product in the sale has warranty terms from purchase
-        product_ids = [item.product_id for item in sale_data.items]
-        if product_ids:
-            products_with_warranty = await target_db.products.find(
-                {
-                    "id": {"$in": product_ids},
-                    "tenant_id": current_user["tenant_id"],
-                    "include_warranty_terms": True,
-                    "warranty_terms": {"$ne": None}
-                },
-                {"_id": 0, "warranty_terms": 1}
-            ).to_list(len(product_ids))
-            
-            if products_with_warranty:
-                include_warranty_terms = True
-                warranty_terms = products_with_warranty[0].get("warranty_terms")
-    
-    sale = Sale(
-        tenant_id=current_user["tenant_id"],
-        sale_number=sale_number,
-        invoice_no=invoice_no,
-        branch_id=sale_data.branch_id,
-        customer_id=actual_customer_id,
-        customer_name=sale_data.customer_name,
-        customer_phone=sale_data.customer_phone,
-        customer_address=sale_data.customer_address,
-        items=[item.model_dump() for item in sale_data.items],
-        subtotal=subtotal,
-        discount=sale_data.discount,
-        tax=sale_data.tax,
-        total=total,
-        amount_paid=paid_amount,
-        balance_due=balance_due,
-        status=SaleStatus.COMPLETED,
-        payment_status=payment_status,
-        payment_method=sale_data.payment_method,
-        reference=sale_data.reference,
-        created_by=current_user.get("email"),
-        include_warranty_terms=include_warranty_terms,
-        warranty_terms=warranty_terms
-    )
-    
-    doc = sale.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    doc['updated_at'] = doc['updated_at'].isoformat()
+                    await insert_notifications(target_db, [notif_doc])
     
-    sale_id = doc['id']
-    await target_db.sales.insert_one(doc)
     
     # Auto-create warranty records for products with warranty
     try:
@@ -4515,6 +4626,7 @@ async def create_sale(
                 await target_db.warranty_events.insert_one(warranty_event)
     except Exception as e:
         logger.warning(f"Warranty auto-creation failed for sale {sale_id}: {e}")
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("warranty_stats",))
     
     # Create payment record if initial payment was made
     if paid_amount > 0:
@@ -4536,6 +4648,8 @@ async def create_sale(
         customer_due = CustomerDue(
             tenant_id=current_user["tenant_id"],
             customer_name=sale_data.customer_name,
+            customer_id=actual_customer_id,
+            branch_id=sale_data.branch_id,
             sale_id=sale_id,
             sale_number=sale_number,
             total_amount=total,
@@ -4562,7 +4676,7 @@ async def create_sale(
         notif_doc = notification.model_dump()
         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
         notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-        await target_db.notifications.insert_one(notif_doc)
+        await insert_notifications(target_db, [notif_doc])
     
     # Create activity notification for tenant_admins (if user is not admin)
     await create_activity_notification(
@@ -4625,6 +4739,26 @@ async def get_sales(
     
     return sales
 
+@api_router.post("/sales/export/parquet")
+async def export_sales_parquet(
+    current_user: dict = Depends(get_current_user),
+    start_date: str = None,
+    end_date: str = None
+):
+    """
+    Queue a Parquet export of sale line items (joined with product, branch and customer).
+    Poll /reports/jobs/{id} and download the file from /reports/jobs/{id}/download once completed.
+    """
+    return await create_report_job(
+        ReportJobCreate(
+            report_type=ReportJobType.SALE_LINES,
+            format=ReportJobFormat.PARQUET,
+            start_date=start_date,
+            end_date=end_date
+        ),
+        current_user
+    )
+
 # Invoice data endpoint removed - use PDF endpoint directly
 
 @api_router.post("/sales/{sale_id}/payments")
@@ -4712,6 +4846,8 @@ async def add_payment_to_sale(
             }
         }
     )
+    await adjust_sales_daily_rollup(target_db, sale, payments_delta=payment_data.amount)
+    report_cache.invalidate_tenant(current_user["tenant_id"])
     
     # Update or delete customer due if exists
     if sale.get('customer_name'):
@@ -4735,15 +4871,10 @@ async def add_payment_to_sale(
     
     # Remove sticky notification only when balance is exactly zero (fully paid)
     if new_balance_due == 0:
-        await target_db.notifications.update_many(
+        await mark_notifications_read(
+            target_db,
             {"sale_id": sale_id, "tenant_id": current_user["tenant_id"], "type": NotificationType.UNPAID_INVOICE.value},
-            {
-                "$set": {
-                    "is_read": True,
-                    "is_sticky": False,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
+            extra_set={"is_sticky": False}
         )
         
         # Create payment received notification
@@ -4757,7 +4888,7 @@ async def add_payment_to_sale(
         notif_doc = notif.model_dump()
         notif_doc['created_at'] = notif_doc['created_at'].isoformat()
         notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-        await target_db.notifications.insert_one(notif_doc)
+        await insert_notifications(target_db, [notif_doc])
     
     # Create activity notification for tenant_admins (if user is not admin)
     await create_activity_notification(
@@ -4814,30 +4945,19 @@ async def cancel_sale(
             detail="Cannot cancel sale with payments. Please process a return instead."
         )
     
-    # Restore stock for each item
+    # Restore stock for each item (branch stock_quantity or global stock)
     for item in sale.get('items', []):
-        if sale.get('branch_id'):
-            # Restore branch-specific stock
-            await target_db.product_branches.update_one(
-                {
-                    "product_id": item['product_id'],
-                    "branch_id": sale['branch_id'],
-                    "tenant_id": current_user["tenant_id"]
-                },
-                {
-                    "$inc": {"stock": item['quantity']},
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
-            )
-        else:
-            # Restore global stock
-            await target_db.products.update_one(
-                {"id": item['product_id'], "tenant_id": current_user["tenant_id"]},
-                {
-                    "$inc": {"stock": item['quantity']},
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
-            )
+        await apply_stock_movement(
+            target_db,
+            tenant_id=current_user["tenant_id"],
+            product_id=item['product_id'],
+            branch_id=sale.get('branch_id'),
+            delta=item['quantity'],
+            reason=StockMovementReason.SALE_CANCELLED,
+            reference_type="sale",
+            reference_id=sale_id,
+            actor_id=current_user.get("id")
+        )
     
     # Update sale status
     await target_db.sales.update_one(
@@ -4852,6 +4972,8 @@ async def cancel_sale(
             }
         }
     )
+    report_cache.invalidate_tenant(current_user["tenant_id"])
+    await release_quota(current_user["tenant_id"], MAX_ORDERS_PER_MONTH, sale.get('created_at'))
     
     # Remove customer due if exists
     if sale.get('customer_name'):
@@ -4860,7 +4982,8 @@ async def cancel_sale(
         )
     
     # Remove unpaid invoice notifications
-    await target_db.notifications.delete_many(
+    await delete_notifications(
+        target_db,
         {
             "sale_id": sale_id,
             "tenant_id": current_user["tenant_id"],
@@ -4879,7 +5002,7 @@ async def cancel_sale(
     notif_doc = notif.model_dump()
     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
     notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-    await target_db.notifications.insert_one(notif_doc)
+    await insert_notifications(target_db, [notif_doc])
     
     return {
         "message": "Sale cancelled successfully",
@@ -4984,6 +5107,39 @@ async def get_customer_dues(
     
     return dues
 
+@api_router.get("/customer-dues/aging")
+async def get_customer_dues_aging(
+    group_by: str = "customer",
+    branch_id: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 50,
+    current_user: dict = Depends(get_current_user)
+):
+    """Open dues in 0-30/31-60/61-90/90+ day buckets, grouped by customer or branch"""
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    if group_by not in AGING_GROUP_FIELDS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(AGING_GROUP_FIELDS)}")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for dues aging: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    branch_query = apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    return await get_dues_aging(
+        target_db,
+        current_user["tenant_id"],
+        group_by=group_by,
+        branch_id=branch_query.get("branch_id"),
+        skip=max(skip, 0),
+        limit=max(1, min(limit, 500))
+    )
+
 @api_router.get("/customer-dues/{due_id}", response_model=CustomerDue)
 async def get_customer_due(
     due_id: str,
@@ -5024,19 +5180,21 @@ async def get_notifications(
     type: Optional[NotificationType] = None,
     unread_only: bool = False,
     limit: int = 20,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """
     Unified endpoint that returns BOTH tenant-specific notifications (sales, dues, stock) 
     AND announcement notifications from super admin.
+    
+    Results are newest first; pass next_cursor back as cursor to get the following page.
     """
     if not current_user.get("tenant_id"):
         raise HTTPException(status_code=400, detail="Tenant ID required")
     
     tenant_id = current_user["tenant_id"]
-    all_notifications = []
     
-    # 1. Fetch tenant-specific notifications (sales, customer dues, low stock, etc.)
+    # 1. Resolve tenant DB for tenant-specific notifications (sales, customer dues, low stock, etc.)
     target_db = db
     if current_user.get("tenant_slug"):
         try:
@@ -5046,119 +5204,37 @@ async def get_notifications(
             # Continue to fetch announcements even if tenant DB fails
             target_db = None
     
-    if target_db is not None:
-        query = {"tenant_id": tenant_id}
-        
-        # Role-based filtering
-        user_role = current_user.get("role")
-        user_branch_id = current_user.get("branch_id")
-        user_id = current_user.get("id")
-        
-        # Tenant admins and super admins see all notifications
-        if user_role not in [UserRole.TENANT_ADMIN.value, UserRole.SUPER_ADMIN.value]:
-            # For other users, show notifications that match ANY of these criteria:
-            # 1. Notification is specifically for this user (user_id matches)
-            # 2. Notification is for their branch but not for a specific user (branch_id matches AND user_id is None)
-            # 3. Notification has no branch_id and no user_id (tenant-wide notification)
-            or_conditions = [
-                {"user_id": user_id},  # User-specific notification
-                {"branch_id": None, "user_id": None}  # Tenant-wide notification
-            ]
-            
-            # Add branch-wide notifications (branch_id matches but user_id is None)
-            if user_branch_id:
-                or_conditions.append({"branch_id": user_branch_id, "user_id": None})
-            
-            query["$or"] = or_conditions
-        
-        if type:
-            query["type"] = type.value
-        
-        if unread_only:
-            query["is_read"] = False
-        
-        tenant_notifications = await target_db.notifications.find(query, {"_id": 0}).sort("created_at", -1).to_list(1000)
-        
-        # Normalize tenant notifications
-        for notif in tenant_notifications:
-            if isinstance(notif.get('created_at'), str):
-                try:
-                    notif['created_at'] = datetime.fromisoformat(notif['created_at'])
-                except:
-                    notif['created_at'] = datetime.utcnow()
-            if isinstance(notif.get('updated_at'), str):
-                try:
-                    notif['updated_at'] = datetime.fromisoformat(notif['updated_at'])
-                except:
-                    notif['updated_at'] = datetime.utcnow()
-            
-            # Add source field to distinguish notification type
-            notif['source'] = 'tenant'
-            # Ensure 'read' field for frontend compatibility
-            if 'is_read' in notif:
-                notif['read'] = notif['is_read']
-        
-        all_notifications.extend(tenant_notifications)
+    # 2. Merge with announcement notifications from super admin system (skip for super admins)
+    include_announcements = current_user.get("role") != UserRole.SUPER_ADMIN.value
+    try:
+        feed = await get_notification_feed(
+            target_db,
+            current_user,
+            notification_type=type.value if type else None,
+            unread_only=unread_only,
+            limit=limit,
+            cursor=cursor,
+            include_announcements=include_announcements
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # 2. Fetch announcement notifications from super admin system (skip for super admins)
-    if current_user.get("role") != UserRole.SUPER_ADMIN.value:
+    # Badge counter covers everything unread, not just this page
+    unread_count = 0
+    if target_db is not None:
+        counters = await get_notification_counters(target_db, tenant_id, visible_scopes(current_user))
+        unread_count += counters["unread"]
+    if include_announcements:
         try:
-            announcements = await NotificationService.get_announcements_for_tenant(tenant_id)
-            
-            # Normalize announcements to match notification format
-            for ann in announcements:
-                # Convert announcement to notification format
-                notification = {
-                    'id': ann.get('announcement_id', ann.get('id')),
-                    'type': ann.get('announcement_type', 'info'),
-                    'message': ann.get('message', ''),
-                    'title': ann.get('title', ''),
-                    'created_at': ann.get('created_at', datetime.utcnow()),
-                    'updated_at': ann.get('updated_at', datetime.utcnow()),
-                    'is_read': ann.get('is_read', False),
-                    'read': ann.get('is_read', False),
-                    'is_dismissed': ann.get('is_dismissed', False),
-                    'source': 'announcement',
-                    'priority': ann.get('priority', 0),
-                    'tenant_id': tenant_id
-                }
-                
-                # Apply unread filter
-                if unread_only and notification['is_read']:
-                    continue
-                
-                all_notifications.append(notification)
+            unread_count += await NotificationService.get_unread_count(tenant_id)
         except Exception as e:
-            logger.error(f"Error fetching announcements: {str(e)}")
-            # Continue without announcements
-    
-    # Calculate unread count BEFORE applying limit (for badge counter)
-    unread_count = sum(1 for n in all_notifications if not n.get('is_read', False))
-    
-    # Sort all notifications by created_at (newest first)
-    # Handle mixed datetime types (string ISO format vs datetime objects)
-    def get_sortable_datetime(x):
-        created = x.get('created_at')
-        if created is None:
-            return ""
-        if isinstance(created, str):
-            return created
-        # Convert datetime to ISO string for consistent comparison
-        try:
-            return created.isoformat()
-        except:
-            return ""
-    
-    all_notifications.sort(key=get_sortable_datetime, reverse=True)
-    
-    # Apply limit AFTER counting unread
-    if limit:
-        all_notifications = all_notifications[:limit]
+            logger.error(f"Error counting unread announcements: {str(e)}")
     
     return {
         "success": True,
-        "notifications": all_notifications,
-        "unread_count": unread_count
+        "notifications": feed["notifications"],
+        "unread_count": unread_count,
+        "next_cursor": feed["next_cursor"]
     }
 
 @api_router.patch("/notifications/{notification_id}/read")
@@ -5186,19 +5262,12 @@ async def mark_notification_read(
             target_db = None
     
     if target_db is not None:
-        result = await target_db.notifications.update_one(
-            {"id": notification_id, "tenant_id": tenant_id},
-            {
-                "$set": {
-                    "is_read": True,
-                    "updated_at": datetime.now(timezone.utc).isoformat()
-                }
-            }
-        )
+        notification_query = {"id": notification_id, "tenant_id": tenant_id}
+        marked = await mark_notifications_read(target_db, notification_query)
         
-        logger.info(f"📊 Tenant DB update: matched={result.matched_count}, modified={result.modified_count}")
+        logger.info(f"📊 Tenant DB update: marked={marked}")
         
-        if result.matched_count > 0:
+        if marked or await target_db.notifications.count_documents(notification_query, limit=1):
             updated = True
     
     # If not found in tenant DB, try announcement system
@@ -5222,6 +5291,30 @@ async def mark_notification_read(
     logger.info(f"🔵 RETURNING SUCCESS FOR {notification_id}")
     return {"message": "Notification marked as read", "success": True}
 
+@api_router.get("/notifications/storage")
+async def get_notification_storage(
+    current_user: dict = Depends(get_current_user)
+):
+    """Notification collection size per tenant (super admins see every tenant)"""
+    if current_user.get("role") == UserRole.SUPER_ADMIN.value and not current_user.get("tenant_id"):
+        return {"tenants": await get_all_tenant_storage_stats()}
+    if current_user.get("role") not in [UserRole.SUPER_ADMIN.value, UserRole.TENANT_ADMIN.value]:
+        raise HTTPException(status_code=403, detail="Only administrators can view notification storage")
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for notification storage: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    await ensure_retention_indexes(target_db)
+    stats = await get_notification_storage_stats(target_db, current_user["tenant_id"])
+    return {"tenants": [stats]}
+
 @api_router.post("/notifications/scheduled-check")
 async def scheduled_notification_check(
     current_user: dict = Depends(get_current_user)
@@ -5239,114 +5332,14 @@ async def scheduled_notification_check(
             raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
     
     tenant_id = current_user["tenant_id"]
-    created_count = 0
-    
-    # 1. Check for low stock products (≤5 units)
-    low_stock_products = await target_db.products.find(
-        {"tenant_id": tenant_id, "stock": {"$lte": 5}},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    for product in low_stock_products:
-        # Check if notification already exists
-        existing_notif = await target_db.notifications.find_one({
-            "tenant_id": tenant_id,
-            "type": NotificationType.LOW_STOCK,
-            "reference_id": product['id']
-        })
-        
-        if not existing_notif:
-            notification = Notification(
-                tenant_id=tenant_id,
-                type=NotificationType.LOW_STOCK,
-                reference_id=product['id'],
-                message=f"Low stock alert: {product['name']} - Only {product['stock']} units left!",
-                is_sticky=False
-            )
-            notif_doc = notification.model_dump()
-            notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-            notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-            await target_db.notifications.insert_one(notif_doc)
-            created_count += 1
-    
-    # 2. Check for unpaid/partially paid invoices older than 7 days
-    from datetime import timedelta
-    seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    
-    overdue_sales = await target_db.sales.find(
-        {
-            "tenant_id": tenant_id,
-            "payment_status": {"$in": [PaymentStatus.UNPAID, PaymentStatus.PARTIALLY_PAID]},
-            "created_at": {"$lt": seven_days_ago.isoformat()}
-        },
-        {"_id": 0}
-    ).to_list(1000)
-    
-    for sale in overdue_sales:
-        # Check if notification already exists and is still unread
-        existing_notif = await target_db.notifications.find_one({
-            "tenant_id": tenant_id,
-            "type": NotificationType.UNPAID_INVOICE,
-            "sale_id": sale['id'],
-            "is_read": False
-        })
-        
-        # Only create if no unread notification exists
-        if not existing_notif:
-            notification = Notification(
-                tenant_id=tenant_id,
-                type=NotificationType.UNPAID_INVOICE,
-                sale_id=sale['id'],
-                message=f"Overdue invoice {sale['invoice_no']}: ৳{sale.get('balance_due', 0):.2f} outstanding for 7+ days",
-                is_sticky=True
-            )
-            notif_doc = notification.model_dump()
-            notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-            notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-            await target_db.notifications.insert_one(notif_doc)
-            created_count += 1
-    
-    # 3. Daily notifications for all customer dues (check last notification was 24+ hours ago)
-    twenty_four_hours_ago = datetime.now(timezone.utc) - timedelta(hours=24)
-    
-    all_customer_dues = await target_db.customer_dues.find(
-        {"tenant_id": tenant_id},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    daily_due_notifications = 0
-    for due in all_customer_dues:
-        # Check if a notification was created in the last 24 hours for this due
-        recent_notif = await target_db.notifications.find_one({
-            "tenant_id": tenant_id,
-            "type": NotificationType.UNPAID_INVOICE.value,
-            "reference_id": due['id'],
-            "created_at": {"$gte": twenty_four_hours_ago.isoformat()}
-        })
-        
-        # Only create daily notification if no notification in last 24 hours
-        if not recent_notif:
-            notification = Notification(
-                tenant_id=tenant_id,
-                type=NotificationType.UNPAID_INVOICE,
-                reference_id=due['id'],
-                sale_id=due.get('sale_id'),
-                message=f"Daily Reminder: {due['customer_name']} has outstanding due of ৳{due['due_amount']:.2f} (Invoice: {due['sale_number']})",
-                is_sticky=False
-            )
-            notif_doc = notification.model_dump()
-            notif_doc['created_at'] = notif_doc['created_at'].isoformat()
-            notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-            await target_db.notifications.insert_one(notif_doc)
-            created_count += 1
-            daily_due_notifications += 1
+    results = await run_scheduled_checks(target_db, tenant_id)
     
     return {
         "message": "Scheduled check completed",
-        "notifications_created": created_count,
-        "low_stock_products": len(low_stock_products),
-        "overdue_invoices": len(overdue_sales),
-        "daily_due_reminders": daily_due_notifications
+        "notifications_created": sum(r["created"] for r in results.values()),
+        "low_stock_products": results["low_stock"]["scanned"],
+        "overdue_invoices": results["overdue_invoices"]["scanned"],
+        "daily_due_reminders": results["daily_due_reminders"]["created"]
     }
 
 # ========== LOW STOCK ROUTES ==========
@@ -5486,39 +5479,24 @@ async def get_dashboard_alerts(
     
     tenant_id = current_user["tenant_id"]
     
-    # Get all notifications
-    all_notifications = await target_db.notifications.find(
-        {"tenant_id": tenant_id},
-        {"_id": 0}
-    ).to_list(10000)
-    
-    # Count unread notifications
-    unread_count = len([n for n in all_notifications if not n.get('is_read', False)])
-    
-    # Count by type
-    unpaid_invoices = len([n for n in all_notifications if n.get('type') == NotificationType.UNPAID_INVOICE.value and not n.get('is_read', False)])
-    low_stock_alerts = len([n for n in all_notifications if n.get('type') == NotificationType.LOW_STOCK.value and not n.get('is_read', False)])
-    payment_received = len([n for n in all_notifications if n.get('type') == NotificationType.PAYMENT_RECEIVED.value and not n.get('is_read', False)])
-    sale_cancelled = len([n for n in all_notifications if n.get('type') == NotificationType.SALE_CANCELLED.value and not n.get('is_read', False)])
-    
-    # Count sticky notifications (critical alerts)
-    sticky_count = len([n for n in all_notifications if n.get('is_sticky', False) and not n.get('is_read', False)])
+    # Unread counts come from the maintained tenant-wide counters
+    counters = await get_notification_counters(target_db, tenant_id, ["all"])
+    by_type = counters["by_type"]
     
     # Get recent notifications (last 5)
-    recent_notifications = sorted(
-        all_notifications,
-        key=lambda x: x.get('created_at', ''),
-        reverse=True
-    )[:5]
+    recent_notifications = await target_db.notifications.find(
+        {"tenant_id": tenant_id},
+        {"_id": 0}
+    ).sort("created_at", -1).limit(5).to_list(5)
     
     return {
-        "total_unread": unread_count,
-        "sticky_alerts": sticky_count,
+        "total_unread": counters["unread"],
+        "sticky_alerts": counters["sticky"],
         "by_type": {
-            "unpaid_invoices": unpaid_invoices,
-            "low_stock": low_stock_alerts,
-            "payment_received": payment_received,
-            "sale_cancelled": sale_cancelled
+            "unpaid_invoices": by_type.get(NotificationType.UNPAID_INVOICE.value, 0),
+            "low_stock": by_type.get(NotificationType.LOW_STOCK.value, 0),
+            "payment_received": by_type.get(NotificationType.PAYMENT_RECEIVED.value, 0),
+            "sale_cancelled": by_type.get(NotificationType.SALE_CANCELLED.value, 0)
         },
         "recent": recent_notifications
     }
@@ -5656,7 +5634,7 @@ async def create_due_request(
     notif_doc = notification.model_dump()
     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
     notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-    await target_db.notifications.insert_one(notif_doc)
+    await insert_notifications(target_db, [notif_doc])
     
     # Broadcast via WebSocket to tenant admins only
     asyncio.create_task(broadcast_notification(
@@ -5838,6 +5816,7 @@ async def approve_due_request(
     
     created_sale_id = result.sale_id
     invoice_no = result.invoice_no
+    report_cache.invalidate_tenant(current_user["tenant_id"])
     
     logger.info(f"✅ Created sale {invoice_no} from due request {due_request.get('request_number')}")
     
@@ -5875,12 +5854,13 @@ async def approve_due_request(
     notif_doc = notification.model_dump()
     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
     notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-    await target_db.notifications.insert_one(notif_doc)
+    await insert_notifications(target_db, [notif_doc])
     
     # Mark the original due request notification as read
-    await target_db.notifications.update_many(
-        {"reference_id": request_id, "type": NotificationType.DUE_REQUEST.value},
-        {"$set": {"is_read": True, "is_sticky": False}}
+    await mark_notifications_read(
+        target_db,
+        {"tenant_id": current_user["tenant_id"], "reference_id": request_id, "type": NotificationType.DUE_REQUEST.value},
+        extra_set={"is_sticky": False}
     )
     
     # Broadcast via WebSocket to the staff who requested
@@ -5966,12 +5946,13 @@ async def reject_due_request(
     notif_doc = notification.model_dump()
     notif_doc['created_at'] = notif_doc['created_at'].isoformat()
     notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-    await target_db.notifications.insert_one(notif_doc)
+    await insert_notifications(target_db, [notif_doc])
     
     # Mark the original due request notification as read
-    await target_db.notifications.update_many(
-        {"reference_id": request_id, "type": NotificationType.DUE_REQUEST.value},
-        {"$set": {"is_read": True, "is_sticky": False}}
+    await mark_notifications_read(
+        target_db,
+        {"tenant_id": current_user["tenant_id"], "reference_id": request_id, "type": NotificationType.DUE_REQUEST.value},
+        extra_set={"is_sticky": False}
     )
     
     # Broadcast via WebSocket to the staff who requested
@@ -6207,10 +6188,74 @@ async def get_customers(
     
     return customers
 
-# ========== EXPENSE ROUTES ==========
-@api_router.post("/expenses", response_model=Expense)
-async def create_expense(
-    expense_data: ExpenseCreate,
+@api_router.get("/customers/{customer_id}/statement")
+async def get_customer_statement(
+    customer_id: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    format: str = "json",
+    current_user: dict = Depends(get_current_user)
+):
+    """Customer statement of invoices and payments with running balance (json or streamed csv)"""
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    if format not in ("json", "csv"):
+        raise HTTPException(status_code=400, detail="format must be 'json' or 'csv'")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for customer statement: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    customer = await target_db.customers.find_one(
+        {"id": customer_id, "tenant_id": current_user["tenant_id"]},
+        {"_id": 0, "id": 1, "name": 1, "phone": 1}
+    )
+    if not customer:
+        raise HTTPException(status_code=404, detail="Customer not found")
+    
+    entries = iter_customer_statement(
+        target_db,
+        current_user["tenant_id"],
+        customer_id,
+        start_date=start_date,
+        end_date=end_date
+    )
+    
+    if format == "csv":
+        columns = ["date", "type", "reference", "sale_id", "debit", "credit", "balance"]
+        
+        async def stream_csv():
+            yield ",".join(columns) + "\n"
+            async for entry in entries:
+                yield ",".join(
+                    '"' + str(entry.get(c) if entry.get(c) is not None else "").replace('"', '""') + '"'
+                    for c in columns
+                ) + "\n"
+        
+        return StreamingResponse(
+            stream_csv(),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="statement-{customer_id}.csv"'}
+        )
+    
+    statement = [entry async for entry in entries]
+    return {
+        "customer": customer,
+        "start_date": start_date,
+        "end_date": end_date,
+        "entries": statement,
+        "closing_balance": statement[-1]["balance"] if statement else 0
+    }
+
+# ========== EXPENSE ROUTES ==========
+@api_router.post("/expenses", response_model=Expense)
+async def create_expense(
+    expense_data: ExpenseCreate,
     current_user: dict = Depends(get_current_user)
 ):
     if not current_user.get("tenant_id"):
@@ -6235,6 +6280,7 @@ async def create_expense(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.expenses.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"])
     return expense
 
 @api_router.get("/expenses", response_model=List[Expense])
@@ -6407,7 +6453,8 @@ async def create_purchase(
                     "created_at": datetime.now(timezone.utc).isoformat(),
                     "updated_at": datetime.now(timezone.utc).isoformat()
                 }
-                await target_db.products.insert_one(new_product)
+                async with quota_reservation(current_user["tenant_id"], MAX_PRODUCTS, target_db=target_db):
+                    await target_db.products.insert_one(new_product)
                 
                 # Update item with the new product_id
                 item["product_id"] = new_product["id"]
@@ -6431,6 +6478,7 @@ async def create_purchase(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.purchases.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"])
     
     # Update existing products with warranty terms from this purchase
     if include_warranty_terms and warranty_terms:
@@ -6753,8 +6801,20 @@ async def apply_purchase_to_stock(
                         "created_at": datetime.now(timezone.utc).isoformat(),
                         "updated_at": datetime.now(timezone.utc).isoformat()
                     }
-                    await target_db.products.insert_one(new_product)
+                    async with quota_reservation(current_user["tenant_id"], MAX_PRODUCTS, target_db=target_db):
+                        await target_db.products.insert_one(new_product)
                     product_id = new_product["id"]
+                    await record_stock_movements(target_db, [{
+                        "tenant_id": current_user["tenant_id"],
+                        "product_id": product_id,
+                        "branch_id": None,
+                        "delta": quantity,
+                        "reason": StockMovementReason.PURCHASE,
+                        "reference_type": "purchase",
+                        "reference_id": purchase_id,
+                        "actor_id": current_user.get("id"),
+                        "unit_cost": float(item.get("price", 0))
+                    }])
                     
                     # Update the purchase item with the new product_id using array index
                     await target_db.purchases.update_one(
@@ -6779,15 +6839,20 @@ async def apply_purchase_to_stock(
                 continue
             
             # Update product stock for existing products (including products found by name)
-            result = await target_db.products.update_one(
-                {"id": product_id, "tenant_id": current_user["tenant_id"]},
-                {
-                    "$inc": {"stock": quantity},
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
+            result = await apply_stock_movement(
+                target_db,
+                tenant_id=current_user["tenant_id"],
+                product_id=product_id,
+                branch_id=None,
+                delta=quantity,
+                reason=StockMovementReason.PURCHASE,
+                reference_type="purchase",
+                reference_id=purchase_id,
+                actor_id=current_user.get("id"),
+                unit_cost=float(item.get("price", 0))
             )
             
-            if result.modified_count > 0:
+            if result is not None:
                 items_updated.append({
                     "product_id": product_id,
                     "quantity_added": quantity
@@ -6806,6 +6871,7 @@ async def apply_purchase_to_stock(
                 }
             }
         )
+        report_cache.invalidate_tenant(current_user["tenant_id"])
         
         message_parts = []
         if products_created:
@@ -6976,6 +7042,7 @@ async def get_supplier_warranty(
 # ========== REPORTS ==========
 @api_router.get("/reports/profit-loss")
 async def get_profit_loss_report(
+    branch_id: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     if not current_user.get("tenant_id"):
@@ -6991,37 +7058,31 @@ async def get_profit_loss_report(
             raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
     
     tenant_id = current_user["tenant_id"]
+    # Branch users only see their own branch
+    branch_id = apply_branch_filter(current_user, explicit_branch_id=branch_id).get("branch_id")
     
-    # Get sales
-    sales = await target_db.sales.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(10000)
-    total_revenue = sum(sale.get("total", 0) for sale in sales)
-    
-    # Get expenses
-    expenses = await target_db.expenses.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(10000)
-    total_expenses = sum(expense.get("amount", 0) for expense in expenses)
+    async def compute_report():
+        return await get_profit_loss_totals(target_db=target_db, tenant_id=tenant_id, branch_id=branch_id)
     
-    # Get purchases
-    purchases = await target_db.purchases.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(10000)
-    total_purchases = sum(purchase.get("total_amount", 0) for purchase in purchases)
-    
-    profit = total_revenue - total_expenses - total_purchases
-    
-    return {
-        "revenue": total_revenue,
-        "expenses": total_expenses,
-        "purchases": total_purchases,
-        "profit": profit,
-        "profit_margin": (profit / total_revenue * 100) if total_revenue > 0 else 0
-    }
+    return await report_cache.get_or_compute(tenant_id, "profit_loss", {"branch_id": branch_id}, compute_report)
 
 @api_router.get("/reports/top-products")
 async def get_top_products(
     current_user: dict = Depends(get_current_user),
-    limit: int = 10
+    limit: int = 10,
+    start_date: str = None,
+    end_date: str = None,
+    branch_id: str = None,
+    category: str = None,
+    sort_by: str = "revenue"
 ):
+    """Get top-selling products aggregated in MongoDB with date, branch and category filters"""
     if not current_user.get("tenant_id"):
         raise HTTPException(status_code=400, detail="Tenant ID required")
     
+    if sort_by not in TOP_PRODUCTS_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Invalid sort_by. Use one of: qty, revenue, margin")
+    
     # Resolve tenant-specific database
     target_db = db
     if current_user.get("tenant_slug"):
@@ -7031,46 +7092,31 @@ async def get_top_products(
             logger.error(f"❌ Failed to resolve tenant DB for top-products report: {resolve_error}")
             raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
     
-    # Get all sales and aggregate by product
-    sales = await target_db.sales.find({"tenant_id": current_user["tenant_id"]}, {"_id": 0}).to_list(10000)
+    query = {"tenant_id": current_user["tenant_id"]}
+    if branch_id:
+        query = apply_branch_filter(current_user, query, explicit_branch_id=branch_id)
     
-    product_sales = {}
-    for sale in sales:
-        for item in sale.get("items", []):
-            product_id = item.get("product_id")
-            if product_id not in product_sales:
-                product_sales[product_id] = {
-                    "quantity": 0,
-                    "revenue": 0
-                }
-            product_sales[product_id]["quantity"] += item.get("quantity", 0)
-            product_sales[product_id]["revenue"] += item.get("price", 0) * item.get("quantity", 0)
-    
-    # Sort by revenue
-    top_products = sorted(
-        product_sales.items(),
-        key=lambda x: x[1]["revenue"],
-        reverse=True
-    )[:limit]
-    
-    # Enrich with product details
-    enriched_products = []
-    for pid, data in top_products:
-        product = await target_db.products.find_one(
-            {"id": pid, "tenant_id": current_user["tenant_id"]},
-            {"_id": 0}
+    date_filter = build_created_at_filter(start_date, end_date)
+    if date_filter:
+        query["created_at"] = date_filter
+    
+    limit = max(1, min(limit, 500))
+    
+    async def compute_report():
+        return await get_top_products_report(
+            target_db=target_db,
+            sales_query=query,
+            limit=limit,
+            sort_by=sort_by,
+            category=category
         )
-        enriched_data = {
-            "product_id": pid,
-            "quantity": data["quantity"],
-            "revenue": data["revenue"]
-        }
-        if product:
-            enriched_data["product_name"] = product.get("name")
-            enriched_data["product_sku"] = product.get("sku")
-        enriched_products.append(enriched_data)
     
-    return enriched_products
+    return await report_cache.get_or_compute(
+        current_user["tenant_id"],
+        "top_products",
+        {"query": query, "limit": limit, "sort_by": sort_by, "category": category},
+        compute_report
+    )
 
 @api_router.get("/reports/branch-sales")
 async def get_branch_sales_report(
@@ -7094,83 +7140,272 @@ async def get_branch_sales_report(
     user_role = current_user.get("role", "")
     user_branch_id = current_user.get("branch_id")
     
-    query = {"tenant_id": tenant_id}
-    
-    if start_date or end_date:
-        date_filter = {}
-        if start_date:
-            date_filter["$gte"] = start_date + "T00:00:00"
-        if end_date:
-            date_filter["$lte"] = end_date + "T23:59:59"
-        if date_filter:
-            query["created_at"] = date_filter
-    
-    if user_role == "staff" and user_branch_id:
-        query["branch_id"] = user_branch_id
+    for date_value in (start_date, end_date):
+        if date_value:
+            try:
+                datetime.strptime(date_value, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
     
-    sales = await target_db.sales.find(query, {"_id": 0}).to_list(50000)
+    branch_filter = user_branch_id if user_role == "staff" and user_branch_id else None
     
-    branches = await target_db.branches.find(
-        {"tenant_id": tenant_id},
-        {"_id": 0, "id": 1, "name": 1, "branch_code": 1}
-    ).to_list(100)
-    branch_map = {b["id"]: b for b in branches}
-    
-    branch_stats = {}
-    for sale in sales:
-        branch_id = sale.get("branch_id") or "unassigned"
+    async def compute_report():
+        branch_totals = await get_branch_sales_totals(
+            target_db=target_db,
+            tenant_id=tenant_id,
+            branch_id=branch_filter,
+            start_date=start_date,
+            end_date=end_date
+        )
         
-        if branch_id not in branch_stats:
+        branches = await target_db.branches.find(
+            {"tenant_id": tenant_id},
+            {"_id": 0, "id": 1, "name": 1, "branch_code": 1}
+        ).to_list(100)
+        branch_map = {b["id"]: b for b in branches}
+        
+        branch_stats = {}
+        for branch_id, totals in branch_totals.items():
             branch_info = branch_map.get(branch_id, {})
             branch_stats[branch_id] = {
                 "branch_id": branch_id,
                 "branch_name": branch_info.get("name", "Unassigned" if branch_id == "unassigned" else "Unknown Branch"),
                 "branch_code": branch_info.get("branch_code", ""),
-                "total_sales": 0,
-                "sales_count": 0,
-                "subtotal": 0,
-                "discount": 0,
-                "tax": 0,
-                "items_sold": 0,
-                "payments_received": 0
+                **totals
             }
         
-        stats = branch_stats[branch_id]
-        stats["sales_count"] += 1
-        stats["total_sales"] += sale.get("total", 0)
-        stats["subtotal"] += sale.get("subtotal", 0)
-        stats["discount"] += sale.get("discount", 0)
-        stats["tax"] += sale.get("tax", 0)
-        stats["payments_received"] += sale.get("amount_paid", sale.get("total", 0))
-        
-        for item in sale.get("items", []):
-            stats["items_sold"] += item.get("quantity", 0)
-    
-    branch_list = sorted(
-        branch_stats.values(),
-        key=lambda x: x["total_sales"],
-        reverse=True
-    )
-    
-    overall = {
-        "total_sales": sum(b["total_sales"] for b in branch_list),
-        "sales_count": sum(b["sales_count"] for b in branch_list),
-        "subtotal": sum(b["subtotal"] for b in branch_list),
-        "discount": sum(b["discount"] for b in branch_list),
-        "tax": sum(b["tax"] for b in branch_list),
-        "items_sold": sum(b["items_sold"] for b in branch_list),
-        "payments_received": sum(b["payments_received"] for b in branch_list),
-        "branch_count": len(branch_list)
-    }
-    
-    return {
-        "branches": branch_list,
-        "overall": overall,
-        "filters": {
-            "start_date": start_date,
-            "end_date": end_date
+        branch_list = sorted(
+            branch_stats.values(),
+            key=lambda x: x["total_sales"],
+            reverse=True
+        )
+        
+        overall = {
+            "total_sales": sum(b["total_sales"] for b in branch_list),
+            "sales_count": sum(b["sales_count"] for b in branch_list),
+            "subtotal": sum(b["subtotal"] for b in branch_list),
+            "discount": sum(b["discount"] for b in branch_list),
+            "tax": sum(b["tax"] for b in branch_list),
+            "items_sold": sum(b["items_sold"] for b in branch_list),
+            "payments_received": sum(b["payments_received"] for b in branch_list),
+            "branch_count": len(branch_list)
         }
-    }
+        
+        return {
+            "branches": branch_list,
+            "overall": overall,
+            "filters": {
+                "start_date": start_date,
+                "end_date": end_date
+            }
+        }
+    
+    return await report_cache.get_or_compute(
+        tenant_id,
+        "branch_sales",
+        {"branch_id": branch_filter, "start_date": start_date, "end_date": end_date},
+        compute_report
+    )
+
+@api_router.get("/reports/stock-valuation")
+async def get_stock_valuation_report(
+    branch_id: Optional[str] = None,
+    category: Optional[str] = None,
+    method: ValuationMethod = ValuationMethod.WEIGHTED_AVERAGE,
+    current_user: dict = Depends(get_current_user)
+):
+    """Stock value by branch and category (weighted average or FIFO), from precomputed totals"""
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for stock valuation report: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    branch_query = apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    valuation = await get_stock_valuation(
+        target_db,
+        current_user["tenant_id"],
+        method=method,
+        branch_id=branch_query.get("branch_id"),
+        category=category
+    )
+    
+    branches = await target_db.branches.find(
+        {"tenant_id": current_user["tenant_id"]},
+        {"_id": 0, "id": 1, "name": 1}
+    ).to_list(100)
+    branch_names = {b["id"]: b.get("name") for b in branches}
+    for row in valuation["rows"]:
+        row["branch_name"] = branch_names.get(row["branch_id"], "Main Stock" if row["branch_id"] is None else "Unknown Branch")
+    
+    return valuation
+
+@api_router.post("/reports/stock-valuation/rebuild")
+async def rebuild_stock_valuation_report(
+    current_user: dict = Depends(get_current_user)
+):
+    """Re-seed valuation from current stock levels at known costs"""
+    if current_user.get("role") not in [UserRole.SUPER_ADMIN.value, UserRole.TENANT_ADMIN.value, UserRole.HEAD_OFFICE.value]:
+        raise HTTPException(status_code=403, detail="Only administrators can rebuild stock valuation")
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for stock valuation rebuild: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    positions = await rebuild_stock_valuation(target_db, current_user["tenant_id"])
+    branch_ids = await target_db.branches.distinct("id", {"tenant_id": current_user["tenant_id"]})
+    for branch_id in branch_ids:
+        await rebuild_branch_counters(target_db, current_user["tenant_id"], branch_id)
+    return {"message": "Stock valuation rebuilt", "positions": positions}
+
+# ========== REPORT JOBS ==========
+@api_router.post("/reports/jobs")
+async def create_report_job(
+    job_request: ReportJobCreate,
+    current_user: dict = Depends(get_current_user)
+):
+    """Queue a long-running report or export; poll the job and download the file when completed"""
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for report job: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    for date_value in (job_request.start_date, job_request.end_date):
+        if date_value:
+            try:
+                datetime.strptime(date_value, "%Y-%m-%d")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Dates must be in YYYY-MM-DD format")
+    
+    if job_request.sort_by not in TOP_PRODUCTS_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail="Invalid sort_by. Use one of: qty, revenue, margin")
+    
+    if job_request.report_type == ReportJobType.SALE_LINES and current_user.get("role") not in [
+        UserRole.SUPER_ADMIN.value, UserRole.TENANT_ADMIN.value, UserRole.HEAD_OFFICE.value
+    ]:
+        raise HTTPException(status_code=403, detail="Only administrators can export sales data")
+    
+    if job_request.format == ReportJobFormat.PARQUET:
+        if job_request.report_type not in PARQUET_REPORT_TYPES:
+            raise HTTPException(status_code=400, detail="Parquet is only available for sale_lines exports")
+        if not pyarrow_available():
+            raise HTTPException(status_code=503, detail="Parquet export is not available on this server")
+    
+    # Branch users can only export their own branch
+    branch_query = apply_branch_filter(current_user, explicit_branch_id=job_request.branch_id)
+    job_request.branch_id = branch_query.get("branch_id")
+    
+    try:
+        job = await report_job_queue.enqueue(
+            target_db,
+            current_user["tenant_id"],
+            current_user.get("id"),
+            job_request
+        )
+    except ReportJobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    
+    return job
+
+@api_router.get("/reports/jobs")
+async def get_report_jobs(
+    current_user: dict = Depends(get_current_user),
+    limit: int = 50
+):
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for report jobs: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    limit = max(1, min(limit, 200))
+    jobs = await target_db.report_jobs.find(
+        {"tenant_id": current_user["tenant_id"]},
+        {"_id": 0}
+    ).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    return jobs
+
+@api_router.get("/reports/jobs/{job_id}")
+async def get_report_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for report job: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    job = await target_db.report_jobs.find_one(
+        {"id": job_id, "tenant_id": current_user["tenant_id"]},
+        {"_id": 0}
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    
+    return job
+
+@api_router.get("/reports/jobs/{job_id}/download")
+async def download_report_job(
+    job_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for report download: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    job = await target_db.report_jobs.find_one(
+        {"id": job_id, "tenant_id": current_user["tenant_id"]},
+        {"_id": 0}
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if job.get("status") == ReportJobStatus.EXPIRED.value:
+        raise HTTPException(status_code=410, detail="Report file has expired; please run the report again")
+    if job.get("status") != ReportJobStatus.COMPLETED.value:
+        raise HTTPException(status_code=409, detail=f"Report job is {job.get('status')}")
+    
+    file_path = job_file_path(job["tenant_id"], job["id"], job["format"])
+    if not file_path.exists():
+        raise HTTPException(status_code=410, detail="Report file is no longer available")
+    
+    media_type = MEDIA_TYPES.get(job["format"], "application/octet-stream")
+    return FileResponse(file_path, media_type=media_type, filename=job.get("file_name") or file_path.name)
 
 # ========== DOCTOR ROUTES (Clinic) ==========
 @api_router.post("/doctors", response_model=Doctor)
@@ -7712,29 +7947,18 @@ async def approve_return(
     )
     
     if sale:
-        # Restore stock based on branch_id
-        if sale.get('branch_id'):
-            # Restore to branch-specific stock
-            await target_db.product_branches.update_one(
-                {
-                    "product_id": return_req['product_id'],
-                    "branch_id": sale['branch_id'],
-                    "tenant_id": current_user["tenant_id"]
-                },
-                {
-                    "$inc": {"stock": return_req['quantity']},
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
-            )
-        else:
-            # Restore to global stock
-            await target_db.products.update_one(
-                {"id": return_req['product_id'], "tenant_id": current_user["tenant_id"]},
-                {
-                    "$inc": {"stock": return_req['quantity']},
-                    "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-                }
-            )
+        # Restore stock based on branch_id (branch stock_quantity or global stock)
+        await apply_stock_movement(
+            target_db,
+            tenant_id=current_user["tenant_id"],
+            product_id=return_req['product_id'],
+            branch_id=sale.get('branch_id'),
+            delta=return_req['quantity'],
+            reason=StockMovementReason.RETURN,
+            reference_type="return",
+            reference_id=return_id,
+            actor_id=current_user.get("id")
+        )
         
         # Update sale total and payment status if needed
         refund_amount = return_req.get('refund_amount', 0)
@@ -7763,6 +7987,13 @@ async def approve_return(
                     }
                 }
             )
+            await adjust_sales_daily_rollup(
+                target_db,
+                sale,
+                total_delta=new_total - sale['total'],
+                payments_delta=new_amount_paid - sale.get('amount_paid', 0)
+            )
+            report_cache.invalidate_tenant(current_user["tenant_id"])
             
             # Update or delete customer due if exists
             if sale.get('customer_name'):
@@ -8326,7 +8557,8 @@ async def create_branch(
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
     
-    await target_db.branches.insert_one(doc)
+    async with quota_reservation(current_user["tenant_id"], MAX_BRANCHES, target_db=target_db):
+        await target_db.branches.insert_one(doc)
     return branch
 
 @api_router.get("/branches", response_model=List[Branch])
@@ -8436,6 +8668,7 @@ async def delete_branch(
     result = await target_db.branches.delete_one({"id": branch_id, "tenant_id": current_user["tenant_id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Branch not found")
+    await release_quota(current_user["tenant_id"], MAX_BRANCHES)
     
     # Also delete associated product-branch records
     await target_db.product_branches.delete_many({"branch_id": branch_id, "tenant_id": current_user["tenant_id"]})
@@ -8479,8 +8712,24 @@ async def assign_product_to_branch(
     doc = product_branch.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     doc['updated_at'] = doc['updated_at'].isoformat()
+    doc['is_low_stock'] = is_low_stock(product_branch.stock_quantity, product_branch.reorder_level)
     
     await target_db.product_branches.insert_one(doc)
+    await inc_branch_counters(
+        target_db, current_user["tenant_id"], product_branch.branch_id,
+        skus=1, units=product_branch.stock_quantity, low_stock=int(doc['is_low_stock'])
+    )
+    if product_branch.stock_quantity:
+        await record_stock_movements(target_db, [{
+            "tenant_id": current_user["tenant_id"],
+            "product_id": product_branch.product_id,
+            "branch_id": product_branch.branch_id,
+            "delta": product_branch.stock_quantity,
+            "reason": StockMovementReason.ASSIGNMENT,
+            "reference_type": "product_branch",
+            "reference_id": product_branch.id,
+            "actor_id": current_user.get("id")
+        }])
     
     # Create notifications for users in this branch about new stock
     product = await target_db.products.find_one(
@@ -8516,7 +8765,7 @@ async def assign_product_to_branch(
             notif_doc = notification.model_dump()
             notif_doc['created_at'] = notif_doc['created_at'].isoformat()
             notif_doc['updated_at'] = notif_doc['updated_at'].isoformat()
-            await target_db.notifications.insert_one(notif_doc)
+            await insert_notifications(target_db, [notif_doc])
     
     return product_branch
 
@@ -8587,11 +8836,31 @@ async def update_product_branch(
         if assignment["branch_id"] != current_user.get("branch_id"):
             raise HTTPException(status_code=403, detail="Can only update own branch")
     
-    await target_db.product_branches.update_one(
+    previous = await target_db.product_branches.find_one_and_update(
         {"id": assignment_id, "tenant_id": current_user["tenant_id"]},
-        {"$set": {**update_data, "updated_at": datetime.now(timezone.utc).isoformat()}}
+        {"$set": {**update_data, "updated_at": datetime.now(timezone.utc).isoformat()}},
+        projection={"_id": 0, "stock_quantity": 1},
+        return_document=ReturnDocument.BEFORE
     )
     
+    if previous and "stock_quantity" in update_data:
+        stock_delta = (update_data["stock_quantity"] or 0) - (previous.get("stock_quantity") or 0)
+        await inc_branch_counters(target_db, current_user["tenant_id"], assignment["branch_id"], units=stock_delta)
+        if stock_delta:
+            await record_stock_movements(target_db, [{
+                "tenant_id": current_user["tenant_id"],
+                "product_id": assignment["product_id"],
+                "branch_id": assignment["branch_id"],
+                "delta": stock_delta,
+                "reason": StockMovementReason.ADJUSTMENT,
+                "reference_type": "product_branch",
+                "reference_id": assignment_id,
+                "actor_id": current_user.get("id")
+            }])
+    
+    if previous and ("stock_quantity" in update_data or "reorder_level" in update_data):
+        await refresh_low_stock_flag(target_db, current_user["tenant_id"], assignment["product_id"], assignment["branch_id"])
+    
     return {"message": "Product-branch assignment updated"}
 
 @api_router.delete("/product-branches/{assignment_id}")
@@ -8611,14 +8880,32 @@ async def delete_product_branch(
             logger.error(f"❌ Failed to resolve tenant DB for product-branch deletion: {resolve_error}")
             raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
     
-    result = await target_db.product_branches.delete_one({
-        "id": assignment_id,
-        "tenant_id": current_user["tenant_id"]
-    })
+    deleted = await target_db.product_branches.find_one_and_delete(
+        {"id": assignment_id, "tenant_id": current_user["tenant_id"]},
+        projection={"_id": 0, "product_id": 1, "branch_id": 1, "stock_quantity": 1, "reorder_level": 1, "is_low_stock": 1}
+    )
     
-    if result.deleted_count == 0:
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Assignment not found")
     
+    was_low = deleted.get("is_low_stock", is_low_stock(deleted.get("stock_quantity"), deleted.get("reorder_level")))
+    await inc_branch_counters(
+        target_db, current_user["tenant_id"], deleted["branch_id"],
+        skus=-1, units=-(deleted.get("stock_quantity") or 0), low_stock=-int(bool(was_low))
+    )
+    
+    if deleted.get("stock_quantity"):
+        await record_stock_movements(target_db, [{
+            "tenant_id": current_user["tenant_id"],
+            "product_id": deleted["product_id"],
+            "branch_id": deleted["branch_id"],
+            "delta": -deleted["stock_quantity"],
+            "reason": StockMovementReason.ASSIGNMENT_REMOVED,
+            "reference_type": "product_branch",
+            "reference_id": assignment_id,
+            "actor_id": current_user.get("id")
+        }])
+    
     return {"message": "Product-branch assignment deleted"}
 
 # ========== STOCK TRANSFER ROUTES ==========
@@ -8678,22 +8965,36 @@ async def create_stock_transfer(
     
     await target_db.stock_transfers.insert_one(doc)
     
+    # Stock arrives at the destination at the source branch's average cost
+    transfer_unit_cost = await get_average_unit_cost(
+        target_db, current_user["tenant_id"], transfer_data.product_id, transfer_data.from_branch_id
+    )
+    
     # Update source branch stock (deduct)
-    await target_db.product_branches.update_one(
-        {"id": source_assignment["id"], "tenant_id": current_user["tenant_id"]},
-        {
-            "$inc": {"stock_quantity": -transfer_data.quantity},
-            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-        }
+    await apply_stock_movement(
+        target_db,
+        tenant_id=current_user["tenant_id"],
+        product_id=transfer_data.product_id,
+        branch_id=transfer_data.from_branch_id,
+        delta=-transfer_data.quantity,
+        reason=StockMovementReason.TRANSFER_OUT,
+        reference_type="stock_transfer",
+        reference_id=stock_transfer.id,
+        actor_id=current_user["id"]
     )
     
     # Update destination branch stock (add)
-    await target_db.product_branches.update_one(
-        {"id": dest_assignment["id"], "tenant_id": current_user["tenant_id"]},
-        {
-            "$inc": {"stock_quantity": transfer_data.quantity},
-            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
-        }
+    await apply_stock_movement(
+        target_db,
+        tenant_id=current_user["tenant_id"],
+        product_id=transfer_data.product_id,
+        branch_id=transfer_data.to_branch_id,
+        delta=transfer_data.quantity,
+        reason=StockMovementReason.TRANSFER_IN,
+        reference_type="stock_transfer",
+        reference_id=stock_transfer.id,
+        actor_id=current_user["id"],
+        unit_cost=transfer_unit_cost
     )
     
     return stock_transfer
@@ -8739,6 +9040,126 @@ async def get_stock_transfers(
     
     return transfers
 
+# ========== STOCK LEDGER ROUTES ==========
+@api_router.get("/stock/movements")
+async def get_stock_movements(
+    product_id: Optional[str] = None,
+    branch_id: Optional[str] = None,
+    reason: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    limit: int = 100,
+    skip: int = 0,
+    current_user: dict = Depends(get_current_user)
+):
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for stock movements: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    await ensure_stock_ledger_indexes(target_db)
+    query = apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    if product_id:
+        query["product_id"] = product_id
+    if reason:
+        query["reason"] = reason
+    date_filter = build_created_at_filter(start_date, end_date)
+    if date_filter:
+        query["created_at"] = date_filter
+    
+    limit = max(1, min(limit, 500))
+    movements = await target_db.stock_movements.find(query, {"_id": 0}).sort(
+        "created_at", -1
+    ).skip(max(skip, 0)).limit(limit).to_list(limit)
+    
+    return {"movements": movements, "limit": limit, "skip": skip}
+
+@api_router.get("/stock/movements/summary")
+async def get_stock_movements_summary(
+    branch_id: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for stock movement summary: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    branch_query = apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    date_filter = build_created_at_filter(start_date, end_date) or {}
+    
+    return await get_stock_movement_summary(
+        target_db,
+        current_user["tenant_id"],
+        branch_id=branch_query.get("branch_id"),
+        start=date_filter.get("$gte"),
+        end=date_filter.get("$lte")
+    )
+
+@api_router.get("/stock/levels")
+async def get_stock_levels(
+    at: str,
+    branch_id: Optional[str] = None,
+    product_id: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Stock levels at a point in time (ISO datetime, or YYYY-MM-DD for end of day).
+    Omit branch_id for product-level stock.
+    """
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for stock levels: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    try:
+        at_time = datetime.fromisoformat(at)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid 'at' timestamp. Use ISO format or YYYY-MM-DD")
+    if len(at) == 10:
+        at_time = at_time.replace(hour=23, minute=59, second=59)
+    if at_time.tzinfo is None:
+        at_time = at_time.replace(tzinfo=timezone.utc)
+    
+    branch_query = apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    effective_branch_id = branch_query.get("branch_id")
+    
+    levels = await get_stock_levels_at(
+        target_db,
+        current_user["tenant_id"],
+        effective_branch_id,
+        at_time.astimezone(timezone.utc).isoformat(),
+        product_id=product_id
+    )
+    
+    return {
+        "branch_id": effective_branch_id,
+        "at": at_time.isoformat(),
+        "levels": [{"product_id": pid, "quantity": qty} for pid, qty in levels.items()]
+    }
+
 # ========== BRANCH-SPECIFIC DASHBOARD STATS ==========
 @api_router.get("/branches/{branch_id}/stats")
 async def get_branch_stats(
@@ -8771,33 +9192,69 @@ async def get_branch_stats(
         if branch_id != current_user.get("branch_id"):
             raise HTTPException(status_code=403, detail="Access denied")
     
-    # Get total products in branch
-    products_count = await target_db.product_branches.count_documents({
-        "branch_id": branch_id,
-        "tenant_id": current_user["tenant_id"]
-    })
-    
-    # Get total stock value
-    product_branches = await target_db.product_branches.find({
-        "branch_id": branch_id,
-        "tenant_id": current_user["tenant_id"]
-    }, {"_id": 0}).to_list(10000)
-    
-    total_stock = sum(pb.get("stock", 0) for pb in product_branches)
-    total_value = sum(pb.get("stock", 0) * pb.get("purchase_price", 0) for pb in product_branches)
-    
-    # Get low stock items (below reorder level)
-    low_stock_count = len([pb for pb in product_branches if pb.get("stock", 0) <= pb.get("reorder_level", 5)])
+    # Counters are maintained on every stock mutation
+    counters = await get_branch_counters(target_db, current_user["tenant_id"], branch_id)
     
     return {
         "branch_id": branch_id,
         "branch_name": branch.get("name"),
-        "total_products": products_count,
-        "total_stock": total_stock,
-        "total_value": total_value,
-        "low_stock_items": low_stock_count
+        "total_products": counters.get("sku_count", 0),
+        "total_stock": counters.get("units", 0),
+        "total_value": round(counters.get("value", 0), 2),
+        "low_stock_items": counters.get("low_stock_count", 0)
     }
 
+@api_router.get("/branches/{branch_id}/low-stock")
+async def get_branch_low_stock(
+    branch_id: str,
+    limit: int = 100,
+    skip: int = 0,
+    current_user: dict = Depends(get_current_user)
+):
+    """Products at or below their reorder level in a branch, lowest stock first"""
+    if not current_user.get("tenant_id"):
+        raise HTTPException(status_code=400, detail="Tenant ID required")
+    
+    # Resolve tenant-specific database
+    target_db = db
+    if current_user.get("tenant_slug"):
+        try:
+            target_db = await resolve_tenant_db(current_user["tenant_slug"])
+        except Exception as resolve_error:
+            logger.error(f"❌ Failed to resolve tenant DB for branch low stock: {resolve_error}")
+            raise HTTPException(status_code=500, detail="Failed to resolve tenant database")
+    
+    apply_branch_filter(current_user, explicit_branch_id=branch_id)
+    await ensure_branch_counter_indexes(target_db)
+    # Make sure flags exist for assignments created before they were tracked
+    await get_branch_counters(target_db, current_user["tenant_id"], branch_id)
+    
+    limit = max(1, min(limit, 500))
+    assignments = await target_db.product_branches.find(
+        {"tenant_id": current_user["tenant_id"], "branch_id": branch_id, "is_low_stock": True},
+        {"_id": 0}
+    ).sort("stock_quantity", 1).skip(max(skip, 0)).limit(limit).to_list(limit)
+    
+    product_ids = [a["product_id"] for a in assignments]
+    products = await target_db.products.find(
+        {"id": {"$in": product_ids}, "tenant_id": current_user["tenant_id"]},
+        {"_id": 0, "id": 1, "name": 1, "sku": 1, "category": 1}
+    ).to_list(len(product_ids))
+    product_map = {p["id"]: p for p in products}
+    
+    return [
+        {
+            "product_id": a["product_id"],
+            "product_name": product_map.get(a["product_id"], {}).get("name"),
+            "sku": product_map.get(a["product_id"], {}).get("sku"),
+            "category": product_map.get(a["product_id"], {}).get("category"),
+            "stock_quantity": a.get("stock_quantity", 0),
+            "reorder_level": a.get("reorder_level"),
+            "assignment_id": a.get("id")
+        }
+        for a in assignments
+    ]
+
 # ========== COMPUTER COMPONENTS ROUTES ==========
 @api_router.post("/components", response_model=Component)
 async def create_component(
@@ -9079,6 +9536,33 @@ async def add_part_to_job(
     if not job_card:
         raise HTTPException(status_code=404, detail="Job card not found")
     
+    # Parts drawn from inventory are deducted from stock before the part is recorded
+    if part_data.get("product_id"):
+        raw_quantity = part_data.get("quantity")
+        try:
+            quantity = float(1 if raw_quantity is None else raw_quantity)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Part quantity must be a number")
+        if not quantity > 0 or quantity == float("inf"):
+            raise HTTPException(status_code=400, detail="Part quantity must be greater than zero")
+        part_data["quantity"] = int(quantity) if quantity.is_integer() else quantity
+        
+        branch_id = part_data.get("branch_id") or job_card.get("branch_id")
+        updated = await apply_stock_movement(
+            target_db,
+            tenant_id=current_user["tenant_id"],
+            product_id=part_data["product_id"],
+            branch_id=branch_id,
+            delta=-part_data["quantity"],
+            reason=StockMovementReason.JOB_PART,
+            reference_type="job_card",
+            reference_id=job_id,
+            actor_id=current_user.get("id")
+        )
+        if updated is None:
+            detail = "Product not assigned to branch" if branch_id else "Product not found"
+            raise HTTPException(status_code=400, detail=detail)
+    
     parts_used = job_card.get("parts_used", [])
     parts_used.append(part_data)
     
@@ -9226,6 +9710,7 @@ async def create_shipment(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.cnf_shipments.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return shipment
 
 @api_router.get("/cnf/shipments", response_model=List[Shipment])
@@ -9286,6 +9771,7 @@ async def update_shipment(
         {"$set": update_data}
     )
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Shipment updated successfully"}
 
 @api_router.patch("/cnf/shipments/{shipment_id}/status")
@@ -9314,6 +9800,7 @@ async def update_shipment_status(
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Shipment not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Shipment status updated"}
 
 @api_router.delete("/cnf/shipments/{shipment_id}")
@@ -9338,6 +9825,7 @@ async def delete_shipment(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Shipment not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Shipment deleted successfully"}
 
 # ========== CNF JOB FILE ROUTES ==========
@@ -9369,6 +9857,7 @@ async def create_job_file(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.cnf_job_files.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return job
 
 @api_router.get("/cnf/jobs", response_model=List[JobFile])
@@ -9429,6 +9918,7 @@ async def update_job_file(
         {"$set": update_data}
     )
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Job file updated successfully"}
 
 @api_router.patch("/cnf/jobs/{job_id}/status")
@@ -9457,6 +9947,7 @@ async def update_job_status(
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Job file not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Job status updated"}
 
 @api_router.delete("/cnf/jobs/{job_id}")
@@ -9481,6 +9972,7 @@ async def delete_job_file(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Job file not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Job file deleted successfully"}
 
 # ========== CNF BILLING ROUTES ==========
@@ -9529,6 +10021,7 @@ async def create_billing(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.cnf_billing.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return billing
 
 @api_router.get("/cnf/billing", response_model=List[CNFBilling])
@@ -9590,6 +10083,7 @@ async def update_payment_status(
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Billing record not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Payment status updated"}
 
 # ========== CNF DOCUMENT ROUTES ==========
@@ -9748,6 +10242,7 @@ async def create_transport(
     doc['updated_at'] = doc['updated_at'].isoformat()
     
     await target_db.cnf_transport.insert_one(doc)
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return transport
 
 @api_router.get("/cnf/transport", response_model=List[Transport])
@@ -9815,6 +10310,7 @@ async def update_transport(
         {"$set": update_data}
     )
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Transport updated successfully"}
 
 @api_router.patch("/cnf/transport/{transport_id}/status")
@@ -9849,6 +10345,7 @@ async def update_transport_status(
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Transport not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Transport status updated"}
 
 @api_router.delete("/cnf/transport/{transport_id}")
@@ -9873,6 +10370,7 @@ async def delete_transport(
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Transport not found")
     
+    report_cache.invalidate_tenant(current_user["tenant_id"], ("cnf_summary",))
     return {"message": "Transport deleted successfully"}
 
 # ========== CNF REPORTS ROUTE ==========
@@ -9892,43 +10390,46 @@ async def get_cnf_reports_summary(current_user: dict = Depends(get_current_user)
     
     tenant_id = current_user["tenant_id"]
     
-    # Get counts
-    total_shipments = await target_db.cnf_shipments.count_documents({"tenant_id": tenant_id})
-    active_shipments = await target_db.cnf_shipments.count_documents({
-        "tenant_id": tenant_id,
-        "status": {"$nin": ["delivered"]}
-    })
-    total_jobs = await target_db.cnf_job_files.count_documents({"tenant_id": tenant_id})
-    active_jobs = await target_db.cnf_job_files.count_documents({
-        "tenant_id": tenant_id,
-        "status": {"$nin": ["completed", "cancelled"]}
-    })
-    
-    # Get billing summary
-    billings = await target_db.cnf_billing.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(10000)
-    total_revenue = sum(b.get("total_amount", 0) for b in billings)
-    pending_payments = sum(
-        b.get("total_amount", 0) for b in billings 
-        if b.get("payment_status") == "pending"
-    )
-    
-    # Get transport summary
-    total_transports = await target_db.cnf_transport.count_documents({"tenant_id": tenant_id})
-    active_transports = await target_db.cnf_transport.count_documents({
-        "tenant_id": tenant_id,
-        "status": {"$nin": ["delivered", "cancelled"]}
-    })
+    async def compute_report():
+        # Get counts
+        total_shipments = await target_db.cnf_shipments.count_documents({"tenant_id": tenant_id})
+        active_shipments = await target_db.cnf_shipments.count_documents({
+            "tenant_id": tenant_id,
+            "status": {"$nin": ["delivered"]}
+        })
+        total_jobs = await target_db.cnf_job_files.count_documents({"tenant_id": tenant_id})
+        active_jobs = await target_db.cnf_job_files.count_documents({
+            "tenant_id": tenant_id,
+            "status": {"$nin": ["completed", "cancelled"]}
+        })
+        
+        # Get billing summary
+        billings = await target_db.cnf_billing.find({"tenant_id": tenant_id}, {"_id": 0}).to_list(10000)
+        total_revenue = sum(b.get("total_amount", 0) for b in billings)
+        pending_payments = sum(
+            b.get("total_amount", 0) for b in billings 
+            if b.get("payment_status") == "pending"
+        )
+        
+        # Get transport summary
+        total_transports = await target_db.cnf_transport.count_documents({"tenant_id": tenant_id})
+        active_transports = await target_db.cnf_transport.count_documents({
+            "tenant_id": tenant_id,
+            "status": {"$nin": ["delivered", "cancelled"]}
+        })
+        
+        return {
+            "total_shipments": total_shipments,
+            "active_shipments": active_shipments,
+            "total_jobs": total_jobs,
+            "active_jobs": active_jobs,
+            "total_revenue": total_revenue,
+            "pending_payments": pending_payments,
+            "total_transports": total_transports,
+            "active_transports": active_transports
+        }
     
-    return {
-        "total_shipments": total_shipments,
-        "active_shipments": active_shipments,
-        "total_jobs": total_jobs,
-        "active_jobs": active_jobs,
-        "total_revenue": total_revenue,
-        "pending_payments": pending_payments,
-        "total_transports": total_transports,
-        "active_transports": active_transports
-    }
+    return await report_cache.get_or_compute(tenant_id, "cnf_summary", None, compute_report)
 
 app.include_router(api_router)
 
@@ -9970,18 +10471,20 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
         tenant_id = payload.get("tenant_id", "")
         user_id = payload.get("user_id", "")
         user_role = payload.get("role", "")
+        user_branch_id = payload.get("branch_id")
         
         if not tenant_id or not user_id:
             await websocket.close(code=4001)
             return
         
-        await ws_manager.connect(websocket, tenant_id, user_id, user_role)
+        connection = await ws_manager.connect(websocket, tenant_id, user_id, user_role, user_branch_id)
         
         try:
             while True:
                 data = await websocket.receive_text()
                 if data == "ping":
-                    await websocket.send_text("pong")
+                    # Replies share the connection's send queue so writes never interleave
+                    connection.send("pong")
         except WebSocketDisconnect:
             ws_manager.disconnect(websocket, tenant_id, user_id)
     except jwt.ExpiredSignatureError:
@@ -10006,12 +10509,12 @@ async def broadcast_notification(tenant_id: str, user_id: str = None, notificati
         "data": data or {},
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
-    if user_id:
-        await ws_manager.send_to_user(tenant_id, user_id, message)
-    elif admins_only:
-        await ws_manager.send_to_tenant_admins(tenant_id, message)
-    else:
-        await ws_manager.send_to_tenant_admins(tenant_id, message)
+    await broadcast_bus.publish({
+        "tenant_id": tenant_id,
+        "user_id": user_id,
+        "admins_only": admins_only or not user_id,
+        "message": message
+    })
 
 # Mount uploads directory for settings images
 uploads_path = Path(__file__).parent / "static" / "uploads"
@@ -0,0 +1,370 @@
+"""
+Append-only stock movement ledger.
+Every stock change is applied through this module so that product stock
+(`products.stock`) and branch stock (`product_branches.stock_quantity`) are
+updated consistently and each change is recorded in `stock_movements`.
+Per-branch snapshots in `stock_snapshots` let point-in-time queries read the
+nearest snapshot plus a short ledger tail instead of replaying every movement.
+"""
+
+from datetime import datetime, timezone, timedelta
+from enum import Enum
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+import logging
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+
+from db_connection import indexes_ensured, mark_indexes_ensured
+from branch_stock_counters import apply_branch_stock_delta
+from inventory_valuation import apply_valuation_movement
+
+logger = logging.getLogger(__name__)
+
+# Take a new snapshot for a branch after this many movements
+SNAPSHOT_EVERY_MOVEMENTS = 500
+# Periodic snapshots are dated this far back. A movement's created_at is stamped
+# before it is inserted, so a tail ending at the current time could miss
+# movements still being written, and their delta would be lost for good.
+SNAPSHOT_LAG_SECONDS = 60
+
+
+class StockMovementReason(str, Enum):
+    OPENING = "opening"
+    SALE = "sale"
+    SALE_CANCELLED = "sale_cancelled"
+    RETURN = "return"
+    PURCHASE = "purchase"
+    TRANSFER_OUT = "transfer_out"
+    TRANSFER_IN = "transfer_in"
+    JOB_PART = "job_part"
+    ASSIGNMENT = "assignment"
+    ASSIGNMENT_REMOVED = "assignment_removed"
+    ADJUSTMENT = "adjustment"
+
+
+async def ensure_stock_ledger_indexes(target_db) -> None:
+    if indexes_ensured(target_db, "stock_ledger"):
+        return
+    try:
+        await target_db.stock_movements.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("created_at", ASCENDING)],
+            name="tenant_branch_created_at"
+        )
+        await target_db.stock_movements.create_index(
+            [("tenant_id", ASCENDING), ("product_id", ASCENDING), ("created_at", DESCENDING)],
+            name="tenant_product_created_at"
+        )
+        await target_db.stock_snapshots.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING), ("taken_at", DESCENDING)],
+            name="tenant_branch_taken_at"
+        )
+        await target_db.stock_ledger_state.create_index(
+            [("tenant_id", ASCENDING), ("branch_id", ASCENDING)],
+            unique=True,
+            name="tenant_branch"
+        )
+        mark_indexes_ensured(target_db, "stock_ledger")
+    except Exception as e:
+        logger.warning(f"Failed to ensure stock ledger indexes on {target_db.name}: {e}")
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+async def _read_live_levels(target_db, tenant_id: str, branch_id: Optional[str]) -> Dict[str, float]:
+    if branch_id:
+        cursor = target_db.product_branches.find(
+            {"tenant_id": tenant_id, "branch_id": branch_id},
+            {"_id": 0, "product_id": 1, "stock_quantity": 1, "stock": 1}
+        )
+        return {
+            doc["product_id"]: doc.get("stock_quantity", doc.get("stock", 0)) or 0
+            async for doc in cursor
+        }
+    cursor = target_db.products.find({"tenant_id": tenant_id}, {"_id": 0, "id": 1, "stock": 1})
+    return {doc["id"]: doc.get("stock", 0) or 0 async for doc in cursor}
+
+
+async def _take_opening_snapshot(target_db, tenant_id: str, branch_id: Optional[str]) -> None:
+    """
+    Record a branch's live stock as its opening snapshot so the ledger tail starts
+    from real balances. The live levels already include the movements that created
+    the branch's ledger state, which all predate taken_at.
+    """
+    taken_at = _now_iso()
+    levels = await _read_live_levels(target_db, tenant_id, branch_id)
+    await target_db.stock_snapshots.insert_one({
+        "id": str(uuid4()),
+        "tenant_id": tenant_id,
+        "branch_id": branch_id,
+        "taken_at": taken_at,
+        "reason": StockMovementReason.OPENING.value,
+        "levels": levels
+    })
+
+
+async def record_stock_movements(target_db, movements: List[Dict[str, Any]]) -> None:
+    """
+    Append movements to the ledger (the stock fields must already be updated).
+
+    Each movement needs tenant_id, product_id, branch_id (None for product-level
+    stock), delta and reason; reference_type, reference_id, actor_id and
+    unit_cost (for inbound stock at a known cost) are optional.
+    """
+    if not movements:
+        return
+    await ensure_stock_ledger_indexes(target_db)
+
+    now = _now_iso()
+    docs = []
+    per_branch: Dict[tuple, int] = {}
+    for movement in movements:
+        reason = movement["reason"]
+        docs.append({
+            "id": str(uuid4()),
+            "tenant_id": movement["tenant_id"],
+            "product_id": movement["product_id"],
+            "branch_id": movement.get("branch_id"),
+            "delta": movement["delta"],
+            "reason": reason.value if isinstance(reason, Enum) else reason,
+            "reference_type": movement.get("reference_type"),
+            "reference_id": movement.get("reference_id"),
+            "actor_id": movement.get("actor_id"),
+            "unit_cost": movement.get("unit_cost"),
+            "created_at": movement.get("created_at") or now
+        })
+        key = (movement["tenant_id"], movement.get("branch_id"))
+        per_branch[key] = per_branch.get(key, 0) + 1
+
+    await target_db.stock_movements.insert_many(docs, ordered=False)
+
+    for doc in docs:
+        try:
+            await apply_valuation_movement(target_db, doc)
+        except Exception as e:
+            logger.warning(f"Valuation update failed for product {doc['product_id']}: {e}")
+
+    for (tenant_id, branch_id), count in per_branch.items():
+        # One round trip counts the movements, creates the branch's state on its first
+        # movement and tells whether a snapshot is due
+        state = await target_db.stock_ledger_state.find_one_and_update(
+            {"tenant_id": tenant_id, "branch_id": branch_id},
+            {"$inc": {"movements_since_snapshot": count}, "$setOnInsert": {"created_at": now}},
+            projection={"_id": 0, "movements_since_snapshot": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        if state is None:
+            await _take_opening_snapshot(target_db, tenant_id, branch_id)
+        elif state.get("movements_since_snapshot", 0) + count >= SNAPSHOT_EVERY_MOVEMENTS:
+            await maybe_take_snapshot(target_db, tenant_id, branch_id)
+
+
+async def apply_stock_movement(
+    target_db,
+    *,
+    tenant_id: str,
+    product_id: str,
+    branch_id: Optional[str],
+    delta: float,
+    reason: StockMovementReason,
+    reference_type: Optional[str] = None,
+    reference_id: Optional[str] = None,
+    actor_id: Optional[str] = None,
+    unit_cost: Optional[float] = None
+):
+    """
+    Apply a stock delta and append it to the ledger.
+
+    Branch stock lives in product_branches.stock_quantity; product-level stock
+    (no branch) lives in products.stock.
+
+    Returns:
+        The updated stock document (product_branches row or product), or None
+        if the product is not assigned to the branch / does not exist
+    """
+    await ensure_stock_ledger_indexes(target_db)
+
+    created_at = _now_iso()
+    if branch_id:
+        updated = await apply_branch_stock_delta(target_db, tenant_id, product_id, branch_id, delta)
+    else:
+        updated = await target_db.products.find_one_and_update(
+            {"id": product_id, "tenant_id": tenant_id},
+            {"$inc": {"stock": delta}, "$set": {"updated_at": created_at}},
+            projection={"_id": 0, "id": 1, "name": 1, "stock": 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    if updated is not None:
+        await record_stock_movements(target_db, [{
+            "tenant_id": tenant_id,
+            "product_id": product_id,
+            "branch_id": branch_id,
+            "delta": delta,
+            "reason": reason,
+            "reference_type": reference_type,
+            "reference_id": reference_id,
+            "actor_id": actor_id,
+            "unit_cost": unit_cost,
+            "created_at": created_at
+        }])
+    return updated
+
+
+async def _sum_movements(
+    target_db,
+    tenant_id: str,
+    branch_id: Optional[str],
+    after: Optional[str],
+    until: Optional[str],
+    product_id: Optional[str] = None
+) -> Dict[str, float]:
+    created_filter: Dict[str, str] = {}
+    if after:
+        created_filter["$gt"] = after
+    if until:
+        created_filter["$lte"] = until
+    match: Dict[str, Any] = {"tenant_id": tenant_id, "branch_id": branch_id}
+    if created_filter:
+        match["created_at"] = created_filter
+    if product_id:
+        match["product_id"] = product_id
+
+    rows = await target_db.stock_movements.aggregate([
+        {"$match": match},
+        {"$group": {"_id": "$product_id", "delta": {"$sum": "$delta"}}}
+    ]).to_list(None)
+    return {row["_id"]: row["delta"] for row in rows}
+
+
+async def maybe_take_snapshot(target_db, tenant_id: str, branch_id: Optional[str], force: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Snapshot a branch's levels once SNAPSHOT_EVERY_MOVEMENTS movements have accumulated.
+    The counter is reset atomically, so only one caller takes each snapshot. The
+    snapshot is dated SNAPSHOT_LAG_SECONDS back and built from the previous one
+    plus the ledger tail up to that time; a branch without snapshots gets an
+    opening snapshot instead.
+    """
+    claim_filter: Dict[str, Any] = {"tenant_id": tenant_id, "branch_id": branch_id}
+    if not force:
+        claim_filter["movements_since_snapshot"] = {"$gte": SNAPSHOT_EVERY_MOVEMENTS}
+    claimed = await target_db.stock_ledger_state.update_one(
+        claim_filter,
+        {"$set": {"movements_since_snapshot": 0, "last_snapshot_at": _now_iso()}}
+    )
+    if not claimed.modified_count and not force:
+        return None
+
+    taken_at = (datetime.now(timezone.utc) - timedelta(seconds=SNAPSHOT_LAG_SECONDS)).isoformat()
+    previous = await target_db.stock_snapshots.find_one(
+        {"tenant_id": tenant_id, "branch_id": branch_id},
+        {"_id": 0},
+        sort=[("taken_at", -1)]
+    )
+    if previous is None:
+        await _take_opening_snapshot(target_db, tenant_id, branch_id)
+        return None
+    if previous["taken_at"] >= taken_at:
+        # The latest snapshot is still inside the lag window
+        return None
+    levels = dict(previous.get("levels", {}))
+    tail = await _sum_movements(target_db, tenant_id, branch_id, previous["taken_at"], taken_at)
+    for pid, delta in tail.items():
+        levels[pid] = levels.get(pid, 0) + delta
+
+    snapshot = {
+        "id": str(uuid4()),
+        "tenant_id": tenant_id,
+        "branch_id": branch_id,
+        "taken_at": taken_at,
+        "reason": "periodic",
+        "levels": levels
+    }
+    await target_db.stock_snapshots.insert_one(dict(snapshot))
+    logger.info(f"Stock snapshot taken for tenant {tenant_id} branch {branch_id or 'global'}")
+    return snapshot
+
+
+async def get_stock_levels_at(
+    target_db,
+    tenant_id: str,
+    branch_id: Optional[str],
+    at: str,
+    product_id: Optional[str] = None
+) -> Dict[str, float]:
+    """
+    Stock levels for a branch (or product-level stock when branch_id is None) at an ISO time.
+
+    Uses the nearest snapshot at or before `at` plus the ledger tail after it. If the
+    time predates every snapshot, the earliest later snapshot is walked back instead.
+    """
+    await ensure_stock_ledger_indexes(target_db)
+
+    before = await target_db.stock_snapshots.find_one(
+        {"tenant_id": tenant_id, "branch_id": branch_id, "taken_at": {"$lte": at}},
+        {"_id": 0},
+        sort=[("taken_at", -1)]
+    )
+    if before:
+        levels = dict(before.get("levels", {}))
+        deltas = await _sum_movements(target_db, tenant_id, branch_id, before["taken_at"], at, product_id)
+        sign = 1
+    else:
+        after = await target_db.stock_snapshots.find_one(
+            {"tenant_id": tenant_id, "branch_id": branch_id, "taken_at": {"$gt": at}},
+            {"_id": 0},
+            sort=[("taken_at", 1)]
+        )
+        if not after:
+            return await _read_live_levels(target_db, tenant_id, branch_id)
+        levels = dict(after.get("levels", {}))
+        deltas = await _sum_movements(target_db, tenant_id, branch_id, at, after["taken_at"], product_id)
+        sign = -1
+
+    for pid, delta in deltas.items():
+        levels[pid] = levels.get(pid, 0) + sign * delta
+
+    if product_id:
+        return {product_id: levels.get(product_id, 0)}
+    return levels
+
+
+async def get_stock_movement_summary(
+    target_db,
+    tenant_id: str,
+    branch_id: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Movements in a window grouped by product and reason (inbound, outbound and net)."""
+    match: Dict[str, Any] = {"tenant_id": tenant_id}
+    if branch_id is not None:
+        match["branch_id"] = branch_id
+    created_filter: Dict[str, str] = {}
+    if start:
+        created_filter["$gte"] = start
+    if end:
+        created_filter["$lte"] = end
+    if created_filter:
+        match["created_at"] = created_filter
+
+    return await target_db.stock_movements.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"product_id": "$product_id", "reason": "$reason"},
+            "quantity": {"$sum": "$delta"},
+            "movements": {"$sum": 1}
+        }},
+        {"$group": {
+            "_id": "$_id.product_id",
+            "inbound": {"$sum": {"$cond": [{"$gt": ["$quantity", 0]}, "$quantity", 0]}},
+            "outbound": {"$sum": {"$cond": [{"$lt": ["$quantity", 0]}, "$quantity", 0]}},
+            "net": {"$sum": "$quantity"},
+            "by_reason": {"$push": {"reason": "$_id.reason", "quantity": "$quantity", "movements": "$movements"}}
+        }},
+        {"$project": {"_id": 0, "product_id": "$_id", "inbound": 1, "outbound": 1, "net": 1, "by_reason": 1}},
+        {"$sort": {"product_id": 1}}
+    ], allowDiskUse=True).to_list(None)
@@ -2,14 +2,23 @@
 Subscription State Machine Manager
 Handles all state transitions for billing subscriptions
 """
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 from motor.motor_asyncio import AsyncIOMotorClient
 from billing_models import SubscriptionStatus
 from audit_logger import log_action
+import logging
 import os
+import uuid
+
+logger = logging.getLogger(__name__)
 
 mongo_url = os.environ.get('MONGO_URL') or os.environ.get('Mongo_URL')
 
+DEFAULT_GRACE_DAYS = 3
+EVENT_BATCH_SIZE = 1000
+
+_sweep_indexes_ensured = False
+
 class SubscriptionStateManager:
     """Manages subscription lifecycle state transitions"""
     
@@ -89,12 +98,79 @@ class SubscriptionStateManager:
         finally:
             admin_client.close()
     
+    @staticmethod
+    async def ensure_sweep_indexes(admin_db):
+        """Indexes for the expiry sweep; created once per process."""
+        global _sweep_indexes_ensured
+        if _sweep_indexes_ensured:
+            return
+        try:
+            await admin_db.subscriptions.create_index([("status", 1), ("expires_on", 1)], name="status_expires_on")
+            await admin_db.subscriptions.create_index([("status", 1), ("trial_ends_at", 1)], name="status_trial_ends_at")
+            await admin_db.subscriptions.create_index([("status", 1), ("grace_expires_at", 1)], name="status_grace_expires_at")
+            await admin_db.subscriptions.create_index("last_sweep_id", name="last_sweep_id", sparse=True)
+            _sweep_indexes_ensured = True
+        except Exception as e:
+            logger.warning(f"Failed to ensure subscription sweep indexes: {e}")
+    
+    @staticmethod
+    async def _sweep_transition(admin_db, sweep_id: str, now: datetime, old_status: SubscriptionStatus, new_status: SubscriptionStatus, expiry_field: str, extra_set, reason_fn) -> int:
+        """
+        Move every subscription in old_status whose expiry_field has passed to new_status
+        with one update_many, then write their billing events in bulk.
+        
+        The update tags the moved documents with the sweep id and old status, so the
+        events are written for exactly the subscriptions this transition moved (the
+        trial and grace passes both end in suspended).
+        """
+        sweep_tag = f"{sweep_id}:{old_status.value}"
+        result = await admin_db.subscriptions.update_many(
+            {"status": old_status.value, expiry_field: {"$lt": now}},
+            [{"$set": {
+                "status": new_status.value,
+                "updated_at": now,
+                "last_sweep_id": sweep_tag,
+                **extra_set
+            }}]
+        )
+        if not result.modified_count:
+            return 0
+        
+        events = []
+        cursor = admin_db.subscriptions.find(
+            {"last_sweep_id": sweep_tag, "status": new_status.value},
+            {"_id": 0, "subscription_id": 1, "tenant_id": 1, "grace_period_days": 1}
+        ).batch_size(EVENT_BATCH_SIZE)
+        async for sub in cursor:
+            events.append({
+                "event_id": f"evt_{sub['subscription_id']}_{int(now.timestamp())}_{old_status.value}",
+                "subscription_id": sub["subscription_id"],
+                "tenant_id": sub["tenant_id"],
+                "event_type": "status_changed",
+                "old_status": old_status.value,
+                "new_status": new_status.value,
+                "triggered_by": "system_scheduler",
+                "reason": reason_fn(sub),
+                "metadata": {"sweep_id": sweep_id},
+                "created_at": now
+            })
+            if len(events) >= EVENT_BATCH_SIZE:
+                await admin_db.billing_events.insert_many(events, ordered=False)
+                events = []
+        if events:
+            await admin_db.billing_events.insert_many(events, ordered=False)
+        return result.modified_count
+    
     @staticmethod
     async def check_expired_subscriptions():
         """
         Check all subscriptions for expiration and apply state transitions
         Called by background scheduler
         
+        Each transition (trial -> suspended, active -> grace, grace -> suspended)
+        is a single set-based update_many on its expiry field, so a run costs a
+        few index scans rather than several round trips per subscription.
+        
         Returns:
             dict: Summary of actions taken
         """
@@ -102,6 +178,7 @@ class SubscriptionStateManager:
         admin_db = admin_client["admin_hub"]
         
         now = datetime.now(timezone.utc)
+        sweep_id = f"sweep_{int(now.timestamp())}_{uuid.uuid4().hex[:8]}"
         actions_taken = {
             "trial_expired": 0,
             "moved_to_grace": 0,
@@ -110,63 +187,34 @@ class SubscriptionStateManager:
         }
         
         try:
-            # Find all active or trial subscriptions
-            subscriptions = await admin_db.subscriptions.find({
-                "status": {"$in": [SubscriptionStatus.TRIAL.value, SubscriptionStatus.ACTIVE.value, SubscriptionStatus.GRACE.value]}
-            }).to_list(1000)
-            
-            for sub in subscriptions:
-                sub_id = sub["subscription_id"]
-                status = sub["status"]
-                
-                # Check trial expiration
-                if status == SubscriptionStatus.TRIAL.value and sub.get("trial_ends_at"):
-                    if now > sub["trial_ends_at"]:
-                        # Trial expired - move to suspended (no payment)
-                        await SubscriptionStateManager.transition_state(
-                            sub_id,
-                            SubscriptionStatus.SUSPENDED,
-                            "Trial period expired",
-                            "system_scheduler"
-                        )
-                        actions_taken["trial_expired"] += 1
-                
-                # Check active subscription expiration
-                elif status == SubscriptionStatus.ACTIVE.value and sub.get("expires_on"):
-                    if now > sub["expires_on"]:
-                        # Active expired - move to grace period
-                        grace_days = sub.get("grace_period_days", 3)
-                        grace_expires_at = now + timedelta(days=grace_days)
-                        
-                        # Use state machine for transition
-                        await SubscriptionStateManager.transition_state(
-                            sub_id,
-                            SubscriptionStatus.GRACE,
-                            f"Subscription expired, entering {grace_days}-day grace period",
-                            "system_scheduler"
-                        )
-                        
-                        # Update grace expiration metadata
-                        await admin_db.subscriptions.update_one(
-                            {"subscription_id": sub_id},
-                            {"$set": {
-                                "grace_expires_at": grace_expires_at,
-                                "updated_at": now
-                            }}
-                        )
-                        actions_taken["moved_to_grace"] += 1
-                
-                # Check grace period expiration
-                elif status == SubscriptionStatus.GRACE.value and sub.get("grace_expires_at"):
-                    if now > sub["grace_expires_at"]:
-                        # Grace expired - suspend
-                        await SubscriptionStateManager.transition_state(
-                            sub_id,
-                            SubscriptionStatus.SUSPENDED,
-                            "Grace period expired without payment",
-                            "system_scheduler"
-                        )
-                        actions_taken["suspended"] += 1
+            await SubscriptionStateManager.ensure_sweep_indexes(admin_db)
+            
+            # Trial expired - move to suspended (no payment)
+            actions_taken["trial_expired"] = await SubscriptionStateManager._sweep_transition(
+                admin_db, sweep_id, now,
+                SubscriptionStatus.TRIAL, SubscriptionStatus.SUSPENDED, "trial_ends_at",
+                {},
+                lambda sub: "Trial period expired"
+            )
+            
+            # Grace expired - suspend (before moving new subscriptions into grace)
+            actions_taken["suspended"] = await SubscriptionStateManager._sweep_transition(
+                admin_db, sweep_id, now,
+                SubscriptionStatus.GRACE, SubscriptionStatus.SUSPENDED, "grace_expires_at",
+                {},
+                lambda sub: "Grace period expired without payment"
+            )
+            
+            # Active expired - move to grace period of each subscription's grace_period_days
+            actions_taken["moved_to_grace"] = await SubscriptionStateManager._sweep_transition(
+                admin_db, sweep_id, now,
+                SubscriptionStatus.ACTIVE, SubscriptionStatus.GRACE, "expires_on",
+                {"grace_expires_at": {"$add": [
+                    now,
+                    {"$multiply": [{"$ifNull": ["$grace_period_days", DEFAULT_GRACE_DAYS]}, 24 * 60 * 60 * 1000]}
+                ]}},
+                lambda sub: f"Subscription expired, entering {sub.get('grace_period_days', DEFAULT_GRACE_DAYS)}-day grace period"
+            )
             
             return actions_taken
             
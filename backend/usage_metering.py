@@ -0,0 +1,293 @@
+"""
+Tenant usage metering.
+Write paths keep live per-tenant counters in admin_hub.tenant_usage (products,
+users, branches and orders per month) with a single $inc each. A daily job
+writes one UsageSnapshot per tenant from those counters with bulk inserts, and
+fleet usage is served from the latest snapshots instead of counting across
+every tenant database. A weekly reconcile recounts each tenant to correct
+drift; tenants without counters yet are recounted before each snapshot.
+Counters that have been set from a real count are flagged under `seeded`, so
+plan quotas can seed a counter the first time they enforce it.
+"""
+
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional, Union
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+USAGE_COLLECTION = "tenant_usage"
+SNAPSHOT_COLLECTION = "usage_snapshots"
+SNAPSHOT_BATCH_SIZE = 1000
+
+PRODUCTS = "products_count"
+USERS = "users_count"
+BRANCHES = "branches_count"
+ORDERS_BY_MONTH = "orders_by_month"
+SEEDED = "seeded"
+
+_indexes_ensured = False
+
+
+def _admin_db():
+    from db_connection import get_admin_db
+    return get_admin_db()
+
+
+def usage_month(when: Union[str, datetime, None] = None) -> str:
+    """YYYY-MM for a datetime or ISO string (now when omitted)."""
+    if isinstance(when, str):
+        return when[:7]
+    return (when or datetime.now(timezone.utc)).strftime("%Y-%m")
+
+
+def usage_indexes_ready() -> bool:
+    return _indexes_ensured
+
+
+async def _drop_duplicate_counters(admin_db) -> int:
+    """
+    Remove every counter document of tenants that have more than one (left by
+    concurrent upserts before the unique index existed). They are recounted on
+    the next quota check or snapshot.
+    """
+    duplicates = await admin_db[USAGE_COLLECTION].aggregate([
+        {"$group": {"_id": "$tenant_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+    if not duplicates:
+        return 0
+    result = await admin_db[USAGE_COLLECTION].delete_many({"tenant_id": {"$in": [d["_id"] for d in duplicates]}})
+    logger.warning(f"Dropped {result.deleted_count} duplicate usage counters for {len(duplicates)} tenants")
+    return result.deleted_count
+
+
+async def ensure_usage_indexes():
+    """Create the usage indexes (at startup and before use); returns whether they exist."""
+    global _indexes_ensured
+    if _indexes_ensured:
+        return True
+    admin_db = _admin_db()
+    try:
+        try:
+            await admin_db[USAGE_COLLECTION].create_index("tenant_id", unique=True, name="tenant_id_unique")
+        except OperationFailure as e:
+            if e.code != 11000:
+                raise
+            await _drop_duplicate_counters(admin_db)
+            await admin_db[USAGE_COLLECTION].create_index("tenant_id", unique=True, name="tenant_id_unique")
+        await admin_db[SNAPSHOT_COLLECTION].create_index(
+            [("tenant_id", ASCENDING), ("snapshot_date", ASCENDING)], unique=True, name="tenant_snapshot_date"
+        )
+        await admin_db[SNAPSHOT_COLLECTION].create_index("snapshot_date", name="snapshot_date")
+        _indexes_ensured = True
+    except Exception as e:
+        logger.warning(f"Failed to ensure usage indexes: {e}")
+    return _indexes_ensured
+
+
+async def record_usage(tenant_id: Optional[str], metric: str, delta: int = 1) -> None:
+    """Adjust a live usage counter; metering never fails the write that triggered it."""
+    if not tenant_id or not delta:
+        return
+    try:
+        await _admin_db()[USAGE_COLLECTION].update_one(
+            {"tenant_id": tenant_id},
+            {"$inc": {metric: delta}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Failed to record {metric} usage for tenant {tenant_id}: {e}")
+
+
+async def record_order(tenant_id: Optional[str], created_at: Union[str, datetime, None] = None, delta: int = 1) -> None:
+    """Count an order (or, with delta=-1, a cancelled one) in the month it was created."""
+    await record_usage(tenant_id, f"{ORDERS_BY_MONTH}.{usage_month(created_at)}", delta)
+
+
+async def get_tenant_usage(tenant_id: str) -> Dict[str, Any]:
+    usage = await _admin_db()[USAGE_COLLECTION].find_one({"tenant_id": tenant_id}, {"_id": 0}) or {"tenant_id": tenant_id}
+    usage["orders_this_month"] = usage.get(ORDERS_BY_MONTH, {}).get(usage_month(), 0)
+    return usage
+
+
+async def count_usage(target_db, users_db, tenant_id: str, metric: str) -> int:
+    """
+    Count one metric from the tenant's collections. `metric` is a counter field:
+    products_count, users_count, branches_count or orders_by_month.<YYYY-MM>.
+    """
+    if metric == USERS:
+        return await users_db.users.count_documents({"tenant_id": tenant_id})
+    if metric == PRODUCTS:
+        return await target_db.products.count_documents({"tenant_id": tenant_id})
+    if metric == BRANCHES:
+        return await target_db.branches.count_documents({"tenant_id": tenant_id})
+    if metric.startswith(f"{ORDERS_BY_MONTH}."):
+        month_start = datetime.strptime(metric.split(".", 1)[1], "%Y-%m").replace(tzinfo=timezone.utc)
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        return await target_db.sales.count_documents({
+            "tenant_id": tenant_id,
+            "created_at": {"$gte": month_start.isoformat(), "$lt": next_month.isoformat()},
+            "status": {"$ne": "cancelled"}
+        })
+    raise ValueError(f"Unknown usage metric {metric}")
+
+
+async def reconcile_tenant_usage(target_db, users_db, tenant_id: str) -> Dict[str, Any]:
+    """Recount a tenant's usage from its collections and overwrite the live counters."""
+    now = datetime.now(timezone.utc)
+    orders_field = f"{ORDERS_BY_MONTH}.{usage_month(now)}"
+    counts = {
+        metric: await count_usage(target_db, users_db, tenant_id, metric)
+        for metric in (PRODUCTS, BRANCHES, USERS, orders_field)
+    }
+    await _admin_db()[USAGE_COLLECTION].update_one(
+        {"tenant_id": tenant_id},
+        # orders_field is a dotted path, so earlier months' counters are left in place
+        {"$set": {
+            **counts,
+            **{f"{SEEDED}.{metric}": True for metric in counts},
+            "reconciled_at": now,
+            "updated_at": now
+        }},
+        upsert=True
+    )
+    return counts
+
+
+async def reconcile_all_tenant_usage(only_missing: bool = False) -> int:
+    """Scheduled job: recount usage for every tenant (or only tenants never recounted)."""
+    from db_connection import get_default_db
+    from job_coordination import run_for_tenants
+
+    await ensure_usage_indexes()
+    users_db = get_default_db()
+    # Counters created by writes or quota reservations before a recount start from zero
+    metered = set(await _admin_db()[USAGE_COLLECTION].distinct(
+        "tenant_id", {"reconciled_at": {"$exists": True}}
+    )) if only_missing else set()
+
+    async def reconcile_tenant(tenant, target_db) -> int:
+        # Registry entries may not carry tenant_id; fall back to the ids present in the database
+        tenant_ids = [tenant['tenant_id']] if tenant.get('tenant_id') else await target_db.products.distinct("tenant_id")
+        reconciled = 0
+        for tenant_id in tenant_ids:
+            if tenant_id in metered:
+                continue
+            await reconcile_tenant_usage(target_db, users_db, tenant_id)
+            reconciled += 1
+        return reconciled
+
+    results, _ = await run_for_tenants("Usage reconciliation", reconcile_tenant)
+    return sum(results.values())
+
+
+async def _storage_by_tenant() -> Dict[str, Dict[str, Any]]:
+    """Data size of each tenant's database (one dbStats per distinct database)."""
+    from db_connection import iter_active_tenants, tenant_db_for
+
+    by_database: Dict[tuple, List[Dict[str, Any]]] = {}
+    async for tenant in iter_active_tenants():
+        if tenant.get("tenant_id"):
+            by_database.setdefault((tenant.get("db_uri"), tenant.get("db_name")), []).append(tenant)
+
+    storage: Dict[str, Dict[str, Any]] = {}
+    for members in by_database.values():
+        try:
+            stats = await tenant_db_for(members[0]).command("dbStats")
+        except Exception as e:
+            logger.warning(f"Failed to read storage for {members[0].get('slug')}: {e}")
+            continue
+        for tenant in members:
+            storage[tenant["tenant_id"]] = {
+                "storage_used_gb": round(stats.get("dataSize", 0) / 1024 ** 3, 3),
+                # Tenants sharing a database each report the whole database
+                "storage_shared_by": len(members)
+            }
+    return storage
+
+
+async def write_daily_snapshots(now: Optional[datetime] = None) -> int:
+    """
+    Scheduled job: write today's UsageSnapshot for every metered tenant.
+    Re-running on the same day leaves existing snapshots in place.
+
+    Returns:
+        Number of snapshots inserted
+    """
+    await ensure_usage_indexes()
+    admin_db = _admin_db()
+    now = now or datetime.now(timezone.utc)
+    snapshot_date = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    month = usage_month(now)
+
+    usage_docs = await admin_db[USAGE_COLLECTION].find({}, {"_id": 0}).to_list(None)
+    tenant_ids = [usage["tenant_id"] for usage in usage_docs]
+    subscriptions = await admin_db.subscriptions.find(
+        {"tenant_id": {"$in": tenant_ids}}, {"_id": 0, "tenant_id": 1, "subscription_id": 1}
+    ).to_list(None)
+    subscription_ids = {sub["tenant_id"]: sub["subscription_id"] for sub in subscriptions}
+    storage = await _storage_by_tenant()
+
+    snapshots = []
+    for usage in usage_docs:
+        tenant_id = usage["tenant_id"]
+        snapshots.append({
+            "snapshot_id": f"snap_{tenant_id}_{snapshot_date.strftime('%Y%m%d')}",
+            "tenant_id": tenant_id,
+            "subscription_id": subscription_ids.get(tenant_id),
+            "snapshot_date": snapshot_date,
+            "usage_metrics": {
+                PRODUCTS: usage.get(PRODUCTS, 0),
+                USERS: usage.get(USERS, 0),
+                BRANCHES: usage.get(BRANCHES, 0),
+                "orders_this_month": usage.get(ORDERS_BY_MONTH, {}).get(month, 0),
+                **storage.get(tenant_id, {})
+            },
+            "created_at": now
+        })
+
+    inserted = 0
+    for start in range(0, len(snapshots), SNAPSHOT_BATCH_SIZE):
+        try:
+            result = await admin_db[SNAPSHOT_COLLECTION].insert_many(
+                snapshots[start:start + SNAPSHOT_BATCH_SIZE], ordered=False
+            )
+            inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            inserted += e.details.get("nInserted", 0)
+    return inserted
+
+
+async def get_fleet_usage(snapshot_date: Optional[datetime] = None) -> Dict[str, Any]:
+    """Every tenant's usage from the snapshots of one day (the latest by default), with fleet totals."""
+    admin_db = _admin_db()
+    if snapshot_date is None:
+        latest = await admin_db[SNAPSHOT_COLLECTION].find_one(
+            {}, {"_id": 0, "snapshot_date": 1}, sort=[("snapshot_date", DESCENDING)]
+        )
+        if not latest:
+            return {"snapshot_date": None, "tenants": [], "totals": {}}
+        snapshot_date = latest["snapshot_date"]
+
+    snapshots = await admin_db[SNAPSHOT_COLLECTION].find(
+        {"snapshot_date": {"$gte": snapshot_date, "$lt": snapshot_date + timedelta(days=1)}},
+        {"_id": 0}
+    ).to_list(None)
+
+    totals: Dict[str, float] = {}
+    for snapshot in snapshots:
+        for metric, value in snapshot.get("usage_metrics", {}).items():
+            if metric in (PRODUCTS, USERS, BRANCHES, "orders_this_month"):
+                totals[metric] = totals.get(metric, 0) + value
+    return {
+        "snapshot_date": snapshot_date,
+        "tenant_count": len(snapshots),
+        "tenants": snapshots,
+        "totals": totals
+    }
@@ -16,6 +16,7 @@ from warranty_utils import (
 )
 from tenant_dependency import TenantContext, get_tenant_context, get_current_user_from_token
 from db_connection import resolve_tenant_db, get_admin_db
+from report_cache import report_cache
 
 MONGO_URL = os.environ.get('MONGO_URL')
 client = AsyncIOMotorClient(MONGO_URL)
@@ -52,6 +53,8 @@ async def create_warranty_event(
     event_dict['updated_at'] = event_dict['updated_at'].isoformat()
     
     await tenant_db.warranty_events.insert_one(event_dict)
+    # Every warranty write logs an event, so this keeps the cached dashboard stats current
+    report_cache.invalidate_tenant(tenant_id, ("warranty_stats",))
     return event
 
 async def update_warranty_status(
@@ -717,44 +720,47 @@ async def get_warranty_stats(
     tenant_db = tenant_ctx.db
     tenant_id = tenant_ctx.user.get("tenant_id")
     
-    pipeline = [
-        {"$match": {"tenant_id": tenant_id}},
-        {"$group": {
-            "_id": "$current_status",
-            "count": {"$sum": 1}
-        }}
-    ]
-    
-    status_counts = await tenant_db.warranty_records.aggregate(pipeline).to_list(100)
-    
-    stats = {
-        "total_warranties": 0,
-        "active": 0,
-        "claimed": 0,
-        "under_inspection": 0,
-        "replacement_pending": 0,
-        "replaced": 0,
-        "refunded": 0,
-        "declined": 0,
-        "closed": 0
-    }
-    
-    for item in status_counts:
-        status = item['_id']
-        count = item['count']
-        stats['total_warranties'] += count
-        if status in stats:
-            stats[status] = count
-    
-    recent_claims = await tenant_db.warranty_events.count_documents({
-        "tenant_id": tenant_id,
-        "event_type": "claim_registered",
-        "created_at": {"$gte": (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()}
-    })
-    
-    stats['new_claims_last_7_days'] = recent_claims
+    async def compute_stats():
+        pipeline = [
+            {"$match": {"tenant_id": tenant_id}},
+            {"$group": {
+                "_id": "$current_status",
+                "count": {"$sum": 1}
+            }}
+        ]
+        
+        status_counts = await tenant_db.warranty_records.aggregate(pipeline).to_list(100)
+        
+        stats = {
+            "total_warranties": 0,
+            "active": 0,
+            "claimed": 0,
+            "under_inspection": 0,
+            "replacement_pending": 0,
+            "replaced": 0,
+            "refunded": 0,
+            "declined": 0,
+            "closed": 0
+        }
+        
+        for item in status_counts:
+            status = item['_id']
+            count = item['count']
+            stats['total_warranties'] += count
+            if status in stats:
+                stats[status] = count
+        
+        recent_claims = await tenant_db.warranty_events.count_documents({
+            "tenant_id": tenant_id,
+            "event_type": "claim_registered",
+            "created_at": {"$gte": (datetime.now(timezone.utc) - timedelta(days=7)).isoformat()}
+        })
+        
+        stats['new_claims_last_7_days'] = recent_claims
+        
+        return stats
     
-    return stats
+    return await report_cache.get_or_compute(tenant_id, "warranty_stats", None, compute_stats)
 
 @warranty_router.post("/warranty/{warranty_id}/link-supplier")
 async def link_supplier_warranty(
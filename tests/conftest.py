@@ -0,0 +1,36 @@
+"""
+Shared fixtures for the backend unit tests.
+Backend modules are imported from backend/ directly. Tests that need MongoDB
+use the `mongo_db` fixture, which connects to TEST_MONGO_URL and is skipped
+when it is not set.
+"""
+
+import os
+import sys
+from uuid import uuid4
+
+import pytest
+import pytest_asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+TEST_MONGO_URL = os.environ.get("TEST_MONGO_URL")
+
+
+@pytest_asyncio.fixture
+async def mongo_client():
+    if not TEST_MONGO_URL:
+        pytest.skip("TEST_MONGO_URL is not set")
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(TEST_MONGO_URL, serverSelectionTimeoutMS=2000)
+    yield client
+    client.close()
+
+
+@pytest_asyncio.fixture
+async def mongo_db(mongo_client):
+    """A throwaway database, dropped after the test."""
+    name = f"erp_test_{uuid4().hex[:8]}"
+    yield mongo_client[name]
+    await mongo_client.drop_database(name)
@@ -0,0 +1,52 @@
+import pytest
+import pytest_asyncio
+
+import notification_service
+from notification_models import AnnouncementDeliveryStatus
+from notification_service import NotificationService
+
+
+class _Cache:
+    def __init__(self):
+        self.bumps = 0
+
+    async def bump_version(self):
+        self.bumps += 1
+
+
+@pytest_asyncio.fixture
+async def admin(mongo_db, monkeypatch):
+    monkeypatch.setattr(notification_service, "admin_db", mongo_db)
+    monkeypatch.setattr(notification_service, "announcement_cache", _Cache())
+    await mongo_db.tenant_registry.insert_many([
+        {"tenant_id": f"t{i}", "slug": f"t{i}", "status": "active"} for i in range(3)
+    ])
+    await mongo_db.announcements.insert_one({
+        "announcement_id": "a1",
+        "audience_type": "all_tenants",
+        "is_active": True,
+        "delivery_status": AnnouncementDeliveryStatus.DELIVERING.value,
+        "delivery_owner": "worker-b"
+    })
+    return mongo_db
+
+
+@pytest.mark.asyncio
+async def test_owner_delivers_and_completes(admin):
+    assert await NotificationService.deliver_announcement("a1", owner="worker-b") == 3
+
+    announcement = await admin.announcements.find_one({"announcement_id": "a1"})
+    assert announcement["delivery_status"] == AnnouncementDeliveryStatus.COMPLETED.value
+    assert announcement["delivered_count"] == 3
+    assert "delivery_owner" not in announcement
+
+
+@pytest.mark.asyncio
+async def test_worker_whose_lease_was_taken_over_stops_without_writing(admin):
+    assert await NotificationService.deliver_announcement("a1", owner="worker-a") == 0
+
+    assert await admin.notification_receipts.count_documents({}) == 0
+    assert notification_service.announcement_cache.bumps == 0
+    announcement = await admin.announcements.find_one({"announcement_id": "a1"})
+    assert announcement["delivery_owner"] == "worker-b"
+    assert announcement["delivery_status"] == AnnouncementDeliveryStatus.DELIVERING.value
@@ -0,0 +1,43 @@
+import pytest
+
+from branch_stock_counters import get_branch_counters, inc_branch_counters, rebuild_branch_counters
+
+TENANT = "tenant-1"
+BRANCH = "branch-1"
+
+
+async def _seed_branch(db):
+    await db.products.insert_many([
+        {"id": "p1", "tenant_id": TENANT, "unit_cost": 2.0, "category": "Cables"},
+        {"id": "p2", "tenant_id": TENANT, "cost": 10.0},
+    ])
+    await db.product_branches.insert_many([
+        {"product_id": "p1", "branch_id": BRANCH, "tenant_id": TENANT, "stock_quantity": 50, "reorder_level": 5},
+        {"product_id": "p2", "branch_id": BRANCH, "tenant_id": TENANT, "stock_quantity": 3, "purchase_price": 12.0},
+    ])
+
+
+@pytest.mark.asyncio
+async def test_rebuild_values_unvalued_assignments_at_cost(mongo_db):
+    await _seed_branch(mongo_db)
+
+    counters = await get_branch_counters(mongo_db, TENANT, BRANCH)
+
+    assert counters["sku_count"] == 2
+    assert counters["units"] == 53
+    assert counters["low_stock_count"] == 1
+    assert counters["value"] == pytest.approx(50 * 2.0 + 3 * 12.0)
+    assert await mongo_db.stock_valuations.count_documents({"branch_id": BRANCH}) == 2
+
+
+@pytest.mark.asyncio
+async def test_rebuild_is_stable_and_keeps_later_increments(mongo_db):
+    await _seed_branch(mongo_db)
+    first = await rebuild_branch_counters(mongo_db, TENANT, BRANCH)
+    second = await rebuild_branch_counters(mongo_db, TENANT, BRANCH)
+    assert second["value"] == pytest.approx(first["value"])
+
+    await inc_branch_counters(mongo_db, TENANT, BRANCH, units=-1)
+    stored = await mongo_db.branch_stock_counters.find_one({"tenant_id": TENANT, "branch_id": BRANCH})
+    assert stored["units"] == 52
+    assert stored["version"] >= 3
@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import pytest
+
+import broadcast_bus
+from broadcast_bus import InProcessBroadcastBus, MongoBroadcastBus, create_broadcast_bus
+from connection_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        self.sent.append(json.loads(text))
+
+
+async def _settle():
+    for _ in range(50):
+        await asyncio.sleep(0)
+
+
+def test_memory_bus_is_selected_by_setting(monkeypatch):
+    monkeypatch.setattr(broadcast_bus, "BROADCAST_BUS", "memory")
+    assert isinstance(create_broadcast_bus(), InProcessBroadcastBus)
+
+
+@pytest.mark.asyncio
+async def test_in_process_bus_delivers_to_local_sockets():
+    manager = ConnectionManager()
+    admin, cashier = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(admin, "t1", "a1", "tenant_admin")
+    await manager.connect(cashier, "t1", "u1", "cashier")
+    bus = InProcessBroadcastBus()
+    await bus.start(manager.deliver)
+
+    await bus.publish({"tenant_id": "t1", "user_id": "u1", "message": {"type": "due_request"}})
+    await bus.publish({"tenant_id": "t1", "message": {"type": "due_approved"}})
+    await _settle()
+
+    assert cashier.sent == [{"type": "due_request"}]
+    assert admin.sent == [{"type": "due_approved"}]
+    await bus.stop()
+
+
+@pytest.mark.asyncio
+async def test_mongo_bus_relays_between_workers(mongo_db):
+    received = {"first": [], "second": []}
+
+    def deliver_to(name):
+        async def deliver(envelope):
+            received[name].append(envelope["message"])
+        return deliver
+
+    first, second = MongoBroadcastBus(lambda: mongo_db), MongoBroadcastBus(lambda: mongo_db)
+    await first.start(deliver_to("first"))
+    await second.start(deliver_to("second"))
+    try:
+        await first.publish({"tenant_id": "t1", "message": {"type": "ping"}})
+        for _ in range(50):
+            if received["second"]:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        await first.stop()
+        await second.stop()
+
+    assert received["first"] == [{"type": "ping"}]
+    assert received["second"] == [{"type": "ping"}]
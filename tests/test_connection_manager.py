@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+
+import connection_manager
+from connection_manager import Connection, ConnectionManager
+
+
+class FakeWebSocket:
+    """Records sent text; sends block until `release` is set."""
+
+    def __init__(self, blocked: bool = False, fail: bool = False):
+        self.sent = []
+        self.closed_with = None
+        self.fail = fail
+        self.release = asyncio.Event()
+        if not blocked:
+            self.release.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        await self.release.wait()
+        if self.fail:
+            raise ConnectionError("socket gone")
+        self.sent.append(text)
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+async def _settle():
+    # Each send goes through wait_for, which takes a few loop iterations
+    for _ in range(50):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_coalesced_messages_replace_the_queued_one():
+    websocket = FakeWebSocket(blocked=True)
+    connection = Connection(websocket, "t1", "u1", "cashier", None, lambda _: None)
+
+    connection.send("first")
+    await _settle()  # the drain task takes "first" and blocks sending it
+    connection.send("counters-1", "notification_counters")
+    connection.send("other")
+    connection.send("counters-2", "notification_counters")
+
+    websocket.release.set()
+    await _settle()
+    assert websocket.sent == ["first", "counters-2", "other"]
+    connection.close()
+
+
+@pytest.mark.asyncio
+async def test_full_queue_drops_oldest(monkeypatch):
+    monkeypatch.setattr(connection_manager, "SEND_QUEUE_SIZE", 3)
+    websocket = FakeWebSocket(blocked=True)
+    connection = Connection(websocket, "t1", "u1", "cashier", None, lambda _: None)
+
+    connection.send("in-flight")
+    await _settle()
+    for index in range(5):
+        connection.send(f"m{index}")
+
+    assert connection.dropped == 2
+    websocket.release.set()
+    await _settle()
+    assert websocket.sent == ["in-flight", "m2", "m3", "m4"]
+    connection.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_send_closes_only_that_connection():
+    manager = ConnectionManager()
+    broken, healthy = FakeWebSocket(fail=True), FakeWebSocket()
+    await manager.connect(broken, "t1", "u1", "tenant_admin")
+    await manager.connect(healthy, "t1", "u2", "tenant_admin")
+
+    assert await manager.send_to_tenant_admins("t1", {"type": "ping"}) == 2
+    await _settle()
+
+    assert broken.closed_with == 4000
+    assert [json.loads(text) for text in healthy.sent] == [{"type": "ping"}]
+    assert await manager.send_to_tenant_admins("t1", {"type": "ping"}) == 1
+
+
+@pytest.mark.asyncio
+async def test_notifications_reach_only_their_audience():
+    manager = ConnectionManager()
+    admin, branch_user, other_branch = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    await manager.connect(admin, "t1", "a1", "tenant_admin")
+    await manager.connect(branch_user, "t1", "u1", "cashier", "b1")
+    await manager.connect(other_branch, "t1", "u2", "cashier", "b2")
+
+    await manager.deliver({
+        "kind": "notification",
+        "tenant_id": "t1",
+        "audience": {"user_id": None, "branch_id": "b1"},
+        "message": {"type": "notification"}
+    })
+    await _settle()
+
+    assert len(admin.sent) == 1
+    assert len(branch_user.sent) == 1
+    assert other_branch.sent == []
@@ -0,0 +1,111 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from dues_service import get_dues_aging, iter_customer_statement
+
+TENANT = "tenant-1"
+AS_OF = datetime(2026, 6, 30, tzinfo=timezone.utc)
+
+
+def _age(days: int) -> str:
+    return (AS_OF - timedelta(days=days)).isoformat()
+
+
+@pytest_asyncio.fixture
+async def dues(mongo_db):
+    await mongo_db.sales.insert_one({"id": "s4", "tenant_id": TENANT, "branch_id": "b1", "customer_id": "c2"})
+    await mongo_db.customer_dues.insert_many([
+        {"id": "d1", "tenant_id": TENANT, "customer_id": "c1", "customer_name": "Ann", "branch_id": "b1",
+         "sale_id": "s1", "due_amount": 10, "transaction_date": _age(30)},
+        {"id": "d2", "tenant_id": TENANT, "customer_id": "c1", "customer_name": "Ann", "branch_id": "b1",
+         "sale_id": "s2", "due_amount": 20, "transaction_date": _age(31)},
+        # Seeded dues may store the date as a BSON date
+        {"id": "d3", "tenant_id": TENANT, "customer_id": "c2", "customer_name": "Bob", "branch_id": "b2",
+         "sale_id": "s3", "due_amount": 40, "transaction_date": AS_OF - timedelta(days=75)},
+        # Written before dues carried a branch; it is taken from the sale
+        {"id": "d4", "tenant_id": TENANT, "customer_name": "Bob", "sale_id": "s4", "due_amount": 5, "transaction_date": _age(200)},
+        {"id": "paid", "tenant_id": TENANT, "customer_id": "c1", "customer_name": "Ann", "branch_id": "b1",
+         "sale_id": "s5", "due_amount": 0, "transaction_date": _age(5)},
+    ])
+    return mongo_db
+
+
+@pytest.mark.asyncio
+async def test_aging_buckets_by_customer(dues):
+    aging = await get_dues_aging(dues, TENANT, group_by="customer", as_of=AS_OF)
+
+    rows = {row["customer_key"]: row for row in aging["rows"]}
+    assert [row["customer_key"] for row in aging["rows"]] == ["c2", "c1"]
+    assert (rows["c1"]["0_30"], rows["c1"]["31_60"], rows["c1"]["open_invoices"]) == (10, 20, 2)
+    assert (rows["c2"]["61_90"], rows["c2"]["90_plus"], rows["c2"]["total_due"]) == (40, 5, 45)
+    assert aging["totals"] == {"total_due": 75, "open_invoices": 4, "0_30": 10, "31_60": 20, "61_90": 40, "90_plus": 5}
+    assert aging["total_groups"] == 2
+
+
+@pytest.mark.asyncio
+async def test_aging_pages_groups_and_filters_by_branch(dues):
+    page = await get_dues_aging(dues, TENANT, group_by="customer", as_of=AS_OF, skip=1, limit=1)
+    assert [row["customer_key"] for row in page["rows"]] == ["c1"]
+    assert page["total_groups"] == 2
+
+    by_branch = await get_dues_aging(dues, TENANT, group_by="branch", as_of=AS_OF)
+    assert [(row["branch_key"], row["total_due"]) for row in by_branch["rows"]] == [("b2", 40), ("b1", 35)]
+
+    b1 = await get_dues_aging(dues, TENANT, group_by="branch", branch_id="b1", as_of=AS_OF)
+    assert [row["branch_key"] for row in b1["rows"]] == ["b1"]
+    assert b1["totals"]["90_plus"] == 5
+
+
+@pytest_asyncio.fixture
+async def statement(mongo_db):
+    await mongo_db.sales.insert_many([
+        {"id": "s1", "tenant_id": TENANT, "customer_id": "c1", "invoice_no": "INV-1", "total": 100,
+         "created_at": "2026-03-01T10:00:00+00:00"},
+        {"id": "s2", "tenant_id": TENANT, "customer_id": "c1", "invoice_no": "INV-2", "total": 50,
+         "created_at": "2026-04-01T10:00:00+00:00"},
+        {"id": "s3", "tenant_id": TENANT, "customer_id": "c1", "invoice_no": "INV-3", "total": 70,
+         "status": "cancelled", "created_at": "2026-03-15T10:00:00+00:00"},
+        {"id": "s4", "tenant_id": TENANT, "customer_id": "c2", "invoice_no": "INV-4", "total": 30,
+         "created_at": "2026-03-02T10:00:00+00:00"},
+    ])
+    await mongo_db.payments.insert_many([
+        {"id": "p1", "tenant_id": TENANT, "sale_id": "s1", "amount": 60, "method": "cash",
+         "received_at": "2026-03-05T09:00:00+00:00"},
+        {"id": "p2", "tenant_id": TENANT, "sale_id": "s2", "amount": 50, "method": "card",
+         "created_at": "2026-04-02T09:00:00+00:00"},
+        # Same sale id in another tenant
+        {"id": "p3", "tenant_id": "tenant-2", "sale_id": "s1", "amount": 100, "created_at": "2026-03-06T09:00:00+00:00"},
+    ])
+    return mongo_db
+
+
+async def _statement(target_db, **kwargs):
+    return [
+        (entry["type"], entry["reference"], entry["balance"])
+        async for entry in iter_customer_statement(target_db, TENANT, "c1", **kwargs)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_statement_runs_a_balance_over_invoices_and_payments(statement):
+    assert await _statement(statement) == [
+        ("invoice", "INV-1", 100),
+        ("payment", "cash", 40),
+        ("invoice", "INV-2", 90),
+        ("payment", "card", 40),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_statement_folds_earlier_entries_into_an_opening_balance(statement):
+    assert await _statement(statement, start_date="2026-03-10") == [
+        ("opening_balance", None, 40),
+        ("invoice", "INV-2", 90),
+        ("payment", "card", 40),
+    ]
+    assert await _statement(statement, end_date="2026-03-31") == [
+        ("invoice", "INV-1", 100),
+        ("payment", "cash", 40),
+    ]
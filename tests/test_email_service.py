@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+import pytest
+
+import email_service
+from email_service import SMTPSessionPool, TokenBucket
+
+
+class FakeSMTP:
+    opened = 0
+
+    def __init__(self, config):
+        FakeSMTP.opened += 1
+        self.config = config
+        self.is_connected = True
+        self.sent = []
+
+    async def send_message(self, message):
+        self.sent.append(message)
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    FakeSMTP.opened = 0
+
+    async def _open(pool):
+        return FakeSMTP(pool.smtp_config)
+
+    monkeypatch.setattr(SMTPSessionPool, "_open", _open)
+    return FakeSMTP
+
+
+@pytest.mark.asyncio
+async def test_pool_reuses_sessions_and_reconnects_after_the_session_cap(fake_smtp, monkeypatch):
+    monkeypatch.setattr(email_service, "SMTP_MESSAGES_PER_SESSION", 3)
+    pool = SMTPSessionPool({"host": "smtp.test"}, size=1)
+
+    for index in range(5):
+        await pool.send(f"message {index}")
+
+    assert fake_smtp.opened == 2
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_configure_reconnects_with_new_settings(fake_smtp):
+    pool = SMTPSessionPool({"host": "old.test"}, size=1)
+    await pool.send("first")
+    pool.configure({"host": "new.test"})
+    await pool.send("second")
+
+    assert fake_smtp.opened == 2
+    slot = await pool._idle.get()
+    assert slot[0].config == {"host": "new.test"}
+    pool._idle.put_nowait(slot)
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_paces_beyond_its_burst():
+    bucket = TokenBucket(rate=50, capacity=5)
+    started = time.monotonic()
+    for _ in range(10):
+        await bucket.acquire()
+    # 5 tokens are available at once, the other 5 arrive at 50 per second
+    assert time.monotonic() - started >= 0.09
+
+
+class SMTPSink:
+    """Minimal local SMTP server that keeps every message it receives."""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 sink ready\r\n")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode().strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                writer.write(b"250 sink\r\n")
+            elif command == "DATA":
+                writer.write(b"354 end with .\r\n")
+                await writer.drain()
+                data = []
+                while (row := await reader.readline()) not in (b".\r\n", b""):
+                    data.append(row)
+                self.messages.append(b"".join(data).decode())
+                writer.write(b"250 queued\r\n")
+            elif command == "QUIT":
+                writer.write(b"221 bye\r\n")
+                await writer.drain()
+                break
+            else:
+                writer.write(b"250 ok\r\n")
+            await writer.drain()
+        writer.close()
+
+
+@pytest.mark.asyncio
+async def test_pool_delivers_to_a_local_smtp_sink_over_one_session():
+    sink = SMTPSink()
+    port = await sink.start()
+    config = {"host": "127.0.0.1", "port": port, "use_tls": False, "from_email": "erp@test.local"}
+    pool = SMTPSessionPool(config, size=1)
+    try:
+        for index in range(3):
+            await pool.send(email_service.build_message(config, f"user{index}@test.local", f"Hello {index}", "<p>Hi</p>"))
+    finally:
+        await pool.close()
+        await sink.stop()
+
+    assert len(sink.messages) == 3
+    assert sink.connections == 1
+    assert "Subject: Hello 2" in sink.messages[2]
@@ -0,0 +1,82 @@
+import pytest
+
+from inventory_valuation import _apply_delta, ensure_valuation_indexes, get_stock_valuation, rebuild_stock_valuation
+
+TENANT = "tenant-1"
+
+
+def _position(quantity=0.0, unit_cost=10.0):
+    value = quantity * unit_cost
+    return {
+        "quantity": quantity,
+        "avg_value": value,
+        "fifo_value": value,
+        "layers": [{"quantity": quantity, "unit_cost": unit_cost}] if quantity > 0 else [],
+        "fallback_cost": unit_cost
+    }
+
+
+def test_weighted_average_and_fifo_diverge_on_outflow():
+    position = _apply_delta(_position(10, 10.0), 10, 20.0)
+    assert position["avg_value"] == 300
+
+    position = _apply_delta(position, -5, None)
+    # Average cost 15 per unit; FIFO takes the oldest layer at 10
+    assert position["avg_value"] == 225
+    assert position["fifo_value"] == 250
+    assert position["layers"] == [{"quantity": 5, "unit_cost": 10.0}, {"quantity": 10, "unit_cost": 20.0}]
+
+
+def test_negative_stock_is_carried_at_the_last_unit_cost():
+    position = _apply_delta(_position(2, 10.0), -5, None)
+    assert position["quantity"] == -3
+    assert position["avg_value"] == position["fifo_value"] == -30
+    assert position["fallback_cost"] == 10.0
+
+
+def test_receipt_into_negative_stock_is_not_averaged_up():
+    position = _apply_delta(_position(2, 10.0), -5, None)
+    position = _apply_delta(position, 10, 12.0)
+
+    assert position["quantity"] == 7
+    assert position["avg_value"] / position["quantity"] == 12.0
+    assert position["fifo_value"] == 84
+    assert position["layers"] == [{"quantity": 7, "unit_cost": 12.0}]
+
+
+def test_receipt_that_leaves_stock_negative_keeps_it_at_the_receipt_cost():
+    position = _apply_delta(_position(0, 10.0), -5, None)
+    position = _apply_delta(position, 2, 12.0)
+
+    assert position["quantity"] == -3
+    assert position["avg_value"] == -36
+    assert position["layers"] == []
+
+
+@pytest.mark.asyncio
+async def test_rebuild_replaces_live_positions_and_drops_stale_ones(mongo_db):
+    await mongo_db.products.insert_one({"id": "p1", "tenant_id": TENANT, "stock": 4, "unit_cost": 5, "category": "Cables"})
+    await mongo_db.product_branches.insert_one(
+        {"product_id": "p1", "branch_id": "b1", "tenant_id": TENANT, "stock_quantity": 3, "purchase_price": 6}
+    )
+    # A position written concurrently by a movement, and one for a product that is gone
+    await mongo_db.stock_valuations.insert_many([
+        {"tenant_id": TENANT, "product_id": "p1", "branch_id": "b1", "category": "Cables",
+         "quantity": 1, "avg_value": 6, "fifo_value": 6, "layers": [], "fallback_cost": 6},
+        {"tenant_id": TENANT, "product_id": "gone", "branch_id": None, "category": "Cables",
+         "quantity": 9, "avg_value": 90, "fifo_value": 90, "layers": [], "fallback_cost": 10,
+         "updated_at": "2020-01-01T00:00:00+00:00"}
+    ])
+    await ensure_valuation_indexes(mongo_db)
+
+    assert await rebuild_stock_valuation(mongo_db, TENANT) == 2
+
+    positions = {
+        (doc["product_id"], doc["branch_id"]): doc
+        async for doc in mongo_db.stock_valuations.find({"tenant_id": TENANT}, {"_id": 0})
+    }
+    assert set(positions) == {("p1", None), ("p1", "b1")}
+    assert positions[("p1", "b1")]["avg_value"] == 18
+    valuation = await get_stock_valuation(mongo_db, TENANT)
+    assert valuation["total_quantity"] == 7
+    assert valuation["total_value"] == 38
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+import db_connection
+from job_coordination import run_for_tenants
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    tenants = []
+
+    async def iter_active_tenants(batch_size: int = 1000):
+        for tenant in tenants:
+            yield tenant
+
+    monkeypatch.setattr(db_connection, "iter_active_tenants", iter_active_tenants)
+    monkeypatch.setattr(db_connection, "tenant_db_for", lambda tenant: tenant.get("db_name"))
+    return tenants
+
+
+@pytest.mark.asyncio
+async def test_runs_every_tenant_beyond_a_thousand(registry):
+    registry.extend({"slug": f"t{i}", "db_uri": "mongodb://x", "db_name": f"db{i}"} for i in range(1500))
+
+    async def work(tenant, target_db):
+        await asyncio.sleep(0)
+        return target_db
+
+    results, failed = await run_for_tenants("test", work, concurrency=20)
+    assert len(results) == 1500
+    assert failed == []
+
+
+@pytest.mark.asyncio
+async def test_unique_databases_skips_slugless_entries_before_deduplicating(registry):
+    registry.extend([
+        {"db_uri": "mongodb://x", "db_name": "shared"},
+        {"slug": "a", "db_uri": "mongodb://x", "db_name": "shared"},
+        {"slug": "b", "db_uri": "mongodb://x", "db_name": "shared"},
+        {"slug": "c", "db_uri": "mongodb://x", "db_name": "own"},
+    ])
+
+    async def work(tenant, target_db):
+        return target_db
+
+    results, _ = await run_for_tenants("test", work, unique_databases=True)
+    assert results == {"a": "shared", "c": "own"}
+
+
+@pytest.mark.asyncio
+async def test_failures_and_timeouts_do_not_stop_other_tenants(registry):
+    registry.extend([{"slug": slug, "db_uri": "mongodb://x", "db_name": slug} for slug in ("ok", "boom", "slow")])
+
+    async def work(tenant, target_db):
+        if target_db == "boom":
+            raise RuntimeError("boom")
+        if target_db == "slow":
+            await asyncio.sleep(1)
+        return "done"
+
+    results, failed = await run_for_tenants("test", work, timeout=0.05)
+    assert results == {"ok": "done"}
+    assert sorted(failed) == ["boom", "slow"]
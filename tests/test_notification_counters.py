@@ -0,0 +1,94 @@
+import pytest
+
+import notification_counters
+from notification_counters import (
+    ALL_SCOPE, delete_notifications, insert_notifications,
+    mark_notifications_read, reconcile_notification_counters
+)
+
+TENANT = "tenant-1"
+
+
+def _notification(notification_id, **fields):
+    return {"id": notification_id, "tenant_id": TENANT, "type": "low_stock", "is_read": False, **fields}
+
+
+async def _counter(target_db, scope):
+    doc = await target_db.notification_counters.find_one({"tenant_id": TENANT, "scope": scope})
+    return (doc or {}).get("unread", 0)
+
+
+@pytest.mark.asyncio
+async def test_reconcile_rebuilds_counts_and_drops_stale_scopes(mongo_db):
+    await mongo_db.notifications.insert_many([
+        {"tenant_id": TENANT, "user_id": "u1", "type": "low_stock", "is_read": False},
+        {"tenant_id": TENANT, "user_id": "u1", "type": "low_stock", "is_read": True},
+        {"tenant_id": TENANT, "branch_id": "b1", "type": "sale", "is_sticky": True},
+        {"tenant_id": TENANT, "type": "announcement"},
+        {"tenant_id": "other", "user_id": "u9", "type": "sale"},
+    ])
+    await mongo_db.notification_counters.insert_many([
+        {"tenant_id": TENANT, "scope": "user:u1", "unread": 40},
+        {"tenant_id": TENANT, "scope": "user:gone", "unread": 3},
+        {"tenant_id": "other", "scope": "user:u9", "unread": 1},
+    ])
+
+    all_scope = await reconcile_notification_counters(mongo_db, TENANT)
+
+    assert all_scope["unread"] == 3
+    assert all_scope["sticky"] == 1
+    assert all_scope["by_type"] == {"low_stock": 1, "sale": 1, "announcement": 1}
+
+    docs = {
+        doc["scope"]: doc
+        async for doc in mongo_db.notification_counters.find({"tenant_id": TENANT}, {"_id": 0})
+    }
+    assert set(docs) == {ALL_SCOPE, "user:u1", "branch:b1", "tenant"}
+    assert docs["user:u1"]["unread"] == 1
+    assert docs[ALL_SCOPE]["initialized"] is True
+    assert await mongo_db.notification_counters.count_documents({"tenant_id": "other"}) == 1
+
+
+@pytest.mark.asyncio
+async def test_insert_counts_unread_notifications_per_scope(mongo_db):
+    await insert_notifications(mongo_db, [
+        _notification("n1", user_id="u1"),
+        _notification("n2", branch_id="b1", is_sticky=True, type="sale"),
+        _notification("n3", is_read=True),
+    ])
+
+    assert await _counter(mongo_db, "user:u1") == 1
+    assert await _counter(mongo_db, "branch:b1") == 1
+    assert await _counter(mongo_db, "tenant") == 0
+    all_scope = await mongo_db.notification_counters.find_one({"tenant_id": TENANT, "scope": ALL_SCOPE})
+    assert all_scope["unread"] == 2
+    assert all_scope["sticky"] == 1
+    assert all_scope["by_type"] == {"low_stock": 1, "sale": 1}
+
+
+@pytest.mark.asyncio
+async def test_mark_all_read_in_batches_uncounts_each_notification_once(mongo_db, monkeypatch):
+    monkeypatch.setattr(notification_counters, "NOTIFICATION_BATCH_SIZE", 3)
+    await insert_notifications(mongo_db, [_notification(f"n{i}", user_id="u1") for i in range(7)])
+    # Read concurrently by another request, which already uncounted it
+    await mark_notifications_read(mongo_db, {"tenant_id": TENANT, "id": "n4"})
+
+    assert await mark_notifications_read(mongo_db, {"tenant_id": TENANT, "user_id": "u1"}) == 6
+    assert await mark_notifications_read(mongo_db, {"tenant_id": TENANT, "user_id": "u1"}) == 0
+    assert await _counter(mongo_db, "user:u1") == 0
+    assert await _counter(mongo_db, ALL_SCOPE) == 0
+    assert await mongo_db.notifications.count_documents({"is_read": True, "expires_at": {"$exists": True}}) == 7
+
+
+@pytest.mark.asyncio
+async def test_delete_uncounts_only_the_unread_notifications_it_removed(mongo_db):
+    await insert_notifications(mongo_db, [
+        _notification("n1", sale_id="s1"),
+        _notification("n2", sale_id="s1", is_read=True),
+        _notification("n3", sale_id="s2"),
+    ])
+
+    assert await delete_notifications(mongo_db, {"tenant_id": TENANT, "sale_id": "s1"}) == 2
+    assert await _counter(mongo_db, "tenant") == 1
+    assert await _counter(mongo_db, ALL_SCOPE) == 1
+    assert await mongo_db.notifications.distinct("id") == ["n3"]
@@ -0,0 +1,79 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import notification_feed
+from notification_feed import get_notification_feed
+
+TENANT = "tenant-1"
+ADMIN = {"id": "u-admin", "tenant_id": TENANT, "role": "tenant_admin"}
+STAFF = {"id": "u1", "tenant_id": TENANT, "role": "staff", "branch_id": "b1"}
+
+
+@pytest.fixture(autouse=True)
+def no_receipt_indexes(monkeypatch):
+    # Receipts live in the shared admin database, which the feed tests do not touch
+    monkeypatch.setattr(notification_feed, "_receipt_indexes_ready", True)
+
+
+class _Announcements:
+    def __init__(self, entries):
+        self.entries = entries
+
+    async def tenant_announcements(self, tenant_id):
+        return self.entries
+
+
+async def _pages(target_db, user, limit, include_announcements=False, **kwargs):
+    pages, cursor = [], None
+    while True:
+        page = await get_notification_feed(
+            target_db, user, limit=limit, cursor=cursor, include_announcements=include_announcements, **kwargs
+        )
+        pages.append([item["id"] for item in page["notifications"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.asyncio
+async def test_pages_through_more_than_a_page_of_notifications_sharing_a_timestamp(mongo_db):
+    created_at = datetime(2026, 3, 1, 9, 0, tzinfo=timezone.utc).isoformat()
+    await mongo_db.notifications.insert_many([
+        {"id": f"n{i:02d}", "tenant_id": TENANT, "message": "batch", "created_at": created_at, "is_read": False}
+        for i in range(8)
+    ])
+
+    pages = await _pages(mongo_db, ADMIN, limit=3)
+
+    assert pages == [["n07", "n06", "n05"], ["n04", "n03", "n02"], ["n01", "n00"]]
+
+
+@pytest.mark.asyncio
+async def test_merges_scopes_and_announcements_newest_first(mongo_db, monkeypatch):
+    base = datetime(2026, 3, 1, 9, 0, tzinfo=timezone.utc)
+
+    def at(minutes):
+        return base + timedelta(minutes=minutes)
+
+    await mongo_db.notifications.insert_many([
+        {"id": "n-own1", "tenant_id": TENANT, "user_id": "u1", "created_at": at(10).isoformat()},
+        {"id": "n-wide1", "tenant_id": TENANT, "created_at": at(8).isoformat()},
+        {"id": "n-b1", "tenant_id": TENANT, "branch_id": "b1", "is_read": False, "created_at": at(6).isoformat()},
+        {"id": "n-own2", "tenant_id": TENANT, "user_id": "u1", "branch_id": "b1", "created_at": at(3).isoformat()},
+        # Not visible to u1
+        {"id": "n-other", "tenant_id": TENANT, "user_id": "u2", "created_at": at(9).isoformat()},
+        {"id": "n-b2", "tenant_id": TENANT, "branch_id": "b2", "created_at": at(7).isoformat()},
+    ])
+    monkeypatch.setattr(notification_feed, "announcement_cache", _Announcements([
+        ({"announcement_id": "a1", "message": "tie"}, (at(8), False, False)),
+        ({"announcement_id": "a2", "message": "old"}, (at(4), True, False)),
+    ]))
+
+    pages = await _pages(mongo_db, STAFF, limit=2, include_announcements=True)
+
+    # Equal timestamps are ordered by id, across streams and page boundaries
+    assert pages == [["n-own1", "n-wide1"], ["a1", "n-b1"], ["a2", "n-own2"]]
+
+    unread = await get_notification_feed(mongo_db, STAFF, limit=10, unread_only=True)
+    assert [item["id"] for item in unread["notifications"]] == ["a1", "n-b1"]
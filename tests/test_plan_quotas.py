@@ -0,0 +1,88 @@
+import pytest
+
+import db_connection
+import plan_quotas
+import usage_metering
+from plan_quotas import MAX_PRODUCTS, MAX_USERS, QuotaExceeded, quota_reservation, release_quota, reserve_quota
+from usage_metering import ORDERS_BY_MONTH, PRODUCTS, USAGE_COLLECTION, reconcile_tenant_usage, usage_month
+
+TENANT = "tenant-1"
+
+
+@pytest.fixture
+def quotas(mongo_db, monkeypatch):
+    limits = {}
+
+    async def get_tenant_quotas(tenant_id):
+        return limits
+
+    monkeypatch.setattr(plan_quotas, "_admin_db", lambda: mongo_db)
+    monkeypatch.setattr(usage_metering, "_admin_db", lambda: mongo_db)
+    monkeypatch.setattr(usage_metering, "_indexes_ensured", False)
+    monkeypatch.setattr(db_connection, "get_default_db", lambda: mongo_db)
+    monkeypatch.setattr(plan_quotas, "get_tenant_quotas", get_tenant_quotas)
+    return limits
+
+
+async def _counter(db, field):
+    return (await db[USAGE_COLLECTION].find_one({"tenant_id": TENANT}) or {}).get(field)
+
+
+@pytest.mark.asyncio
+async def test_first_reservation_seeds_from_the_real_count(mongo_db, quotas):
+    quotas[MAX_PRODUCTS] = 3
+    await mongo_db.products.insert_many([{"id": f"p{i}", "tenant_id": TENANT} for i in range(3)])
+
+    with pytest.raises(QuotaExceeded):
+        await reserve_quota(TENANT, MAX_PRODUCTS, target_db=mongo_db)
+    assert await _counter(mongo_db, PRODUCTS) == 3
+
+
+@pytest.mark.asyncio
+async def test_reserve_up_to_the_limit_and_release(mongo_db, quotas):
+    quotas[MAX_PRODUCTS] = 2
+
+    await reserve_quota(TENANT, MAX_PRODUCTS, target_db=mongo_db)
+    await reserve_quota(TENANT, MAX_PRODUCTS, target_db=mongo_db)
+    with pytest.raises(QuotaExceeded):
+        await reserve_quota(TENANT, MAX_PRODUCTS, target_db=mongo_db)
+    assert await _counter(mongo_db, PRODUCTS) == 2
+
+    await release_quota(TENANT, MAX_PRODUCTS)
+    await reserve_quota(TENANT, MAX_PRODUCTS, target_db=mongo_db)
+    assert await _counter(mongo_db, PRODUCTS) == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_create_gives_the_unit_back(mongo_db, quotas):
+    quotas[MAX_USERS] = 1
+    with pytest.raises(RuntimeError):
+        async with quota_reservation(TENANT, MAX_USERS):
+            raise RuntimeError("insert failed")
+    async with quota_reservation(TENANT, MAX_USERS):
+        pass
+    with pytest.raises(QuotaExceeded):
+        await reserve_quota(TENANT, MAX_USERS)
+
+
+@pytest.mark.asyncio
+async def test_duplicate_counters_are_dropped_so_the_unique_index_can_be_built(mongo_db, quotas):
+    await mongo_db[USAGE_COLLECTION].insert_many([
+        {"tenant_id": TENANT, PRODUCTS: 1},
+        {"tenant_id": TENANT, PRODUCTS: 1},
+        {"tenant_id": "other", PRODUCTS: 4},
+    ])
+
+    assert await usage_metering.ensure_usage_indexes() is True
+    assert await mongo_db[USAGE_COLLECTION].count_documents({"tenant_id": TENANT}) == 0
+    assert await mongo_db[USAGE_COLLECTION].count_documents({"tenant_id": "other"}) == 1
+
+
+@pytest.mark.asyncio
+async def test_reconcile_keeps_earlier_months_of_orders(mongo_db, quotas):
+    await mongo_db[USAGE_COLLECTION].insert_one({"tenant_id": TENANT, ORDERS_BY_MONTH: {"2020-01": 42}})
+    await mongo_db.sales.insert_one({"id": "s1", "tenant_id": TENANT, "created_at": usage_month() + "-01T00:00:00+00:00"})
+
+    await reconcile_tenant_usage(mongo_db, mongo_db, TENANT)
+
+    assert await _counter(mongo_db, ORDERS_BY_MONTH) == {"2020-01": 42, usage_month(): 1}
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from report_cache import INVALIDATE_KIND, ReportCache
+
+
+class RecordingBus:
+    def __init__(self):
+        self.envelopes = []
+
+    async def publish(self, envelope):
+        self.envelopes.append(envelope)
+
+
+async def _compute_value(value):
+    return value
+
+
+@pytest.mark.asyncio
+async def test_invalidation_is_relayed_and_applied_by_other_workers():
+    bus = RecordingBus()
+    writer, reader = ReportCache(), ReportCache()
+    writer.configure_bus(bus)
+
+    assert await reader.get_or_compute("t1", "profit_loss", None, lambda: _compute_value(1)) == 1
+    writer.invalidate_tenant("t1")
+    await asyncio.sleep(0)
+
+    assert len(bus.envelopes) == 1
+    envelope = bus.envelopes[0]
+    assert envelope["kind"] == INVALIDATE_KIND
+    assert envelope["tenant_id"] == "t1"
+
+    reader.apply_invalidation(envelope)
+    assert await reader.get_or_compute("t1", "profit_loss", None, lambda: _compute_value(2)) == 2
+
+
+@pytest.mark.asyncio
+async def test_own_relayed_invalidation_is_ignored():
+    bus = RecordingBus()
+    cache = ReportCache()
+    cache.configure_bus(bus)
+    cache.invalidate_tenant("t1", ("profit_loss",))
+    await asyncio.sleep(0)
+
+    await cache.get_or_compute("t1", "profit_loss", None, lambda: _compute_value(1))
+    cache.apply_invalidation(bus.envelopes[0])
+    assert await cache.get_or_compute("t1", "profit_loss", None, lambda: _compute_value(2)) == 1
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone, timedelta
+
+import csv
+
+import pytest
+
+import report_jobs
+from report_jobs import ReportJobStatus, _write_report_file, expire_report_files, fail_stale_jobs, job_file_path
+
+
+def _iso(delta_seconds: int) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=delta_seconds)).isoformat()
+
+
+@pytest.mark.asyncio
+async def test_fail_stale_jobs_only_fails_expired_leases(mongo_db):
+    await mongo_db.report_jobs.insert_many([
+        {"id": "expired", "status": ReportJobStatus.RUNNING.value, "lease_expires_at": _iso(-10), "updated_at": _iso(-600)},
+        {"id": "live", "status": ReportJobStatus.QUEUED.value, "lease_expires_at": _iso(200), "updated_at": _iso(-600)},
+        {"id": "legacy", "status": ReportJobStatus.QUEUED.value, "updated_at": _iso(-3600)},
+        {"id": "done", "status": ReportJobStatus.COMPLETED.value, "lease_expires_at": _iso(-10), "updated_at": _iso(-600)},
+    ])
+
+    assert await fail_stale_jobs(mongo_db) == 2
+
+    statuses = {job["id"]: job["status"] async for job in mongo_db.report_jobs.find({}, {"_id": 0})}
+    assert statuses == {
+        "expired": ReportJobStatus.FAILED.value,
+        "live": ReportJobStatus.QUEUED.value,
+        "legacy": ReportJobStatus.FAILED.value,
+        "done": ReportJobStatus.COMPLETED.value,
+    }
+
+
+@pytest.mark.asyncio
+async def test_sale_lines_job_streams_one_row_per_line(mongo_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_jobs, "REPORT_EXPORT_DIR", tmp_path)
+    await mongo_db.sales.insert_many([
+        {"id": "s1", "tenant_id": "t1", "branch_id": "b1", "created_at": "2026-03-01T10:00:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 2, "price": 5.0}, {"product_id": "p2", "quantity": 1, "price": 3.0}]},
+        {"id": "s2", "tenant_id": "t1", "branch_id": "b2", "created_at": "2026-03-01T11:00:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 1, "price": 5.0}]},
+    ])
+    job = {"id": "job-1", "tenant_id": "t1", "report_type": "sale_lines", "format": "csv", "params": {"branch_id": "b1"}}
+
+    assert await _write_report_file(mongo_db, job) == 2
+
+    with open(tmp_path / "t1" / "job-1.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["sale_id"], row["line_number"], row["line_total"]) for row in rows] == [("s1", "1", "10.0"), ("s1", "2", "3.0")]
+
+
+@pytest.mark.asyncio
+async def test_customer_dues_and_profit_loss_jobs_keep_to_the_branch(mongo_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_jobs, "REPORT_EXPORT_DIR", tmp_path)
+    await mongo_db.sales.insert_many([
+        {"id": "s1", "tenant_id": "t1", "branch_id": "b1", "total": 100.0, "created_at": "2026-03-01T10:00:00+00:00"},
+        {"id": "s2", "tenant_id": "t1", "branch_id": "b2", "total": 40.0, "created_at": "2026-03-01T11:00:00+00:00"},
+    ])
+    # d2 predates stored branches and takes its branch from the sale
+    await mongo_db.customer_dues.insert_many([
+        {"id": "d1", "tenant_id": "t1", "sale_id": "s1", "branch_id": "b1", "customer_name": "Ann", "due_amount": 30.0},
+        {"id": "d2", "tenant_id": "t1", "sale_id": "s2", "customer_name": "Bob", "due_amount": 15.0},
+    ])
+    await mongo_db.expenses.insert_one({"id": "e1", "tenant_id": "t1", "amount": 25.0, "date": "2026-03-01"})
+
+    dues_job = {"id": "dues", "tenant_id": "t1", "report_type": "customer_dues", "format": "csv", "params": {"branch_id": "b2"}}
+    assert await _write_report_file(mongo_db, dues_job) == 1
+    with open(tmp_path / "t1" / "dues.csv", newline="") as f:
+        assert [row["customer_name"] for row in csv.DictReader(f)] == ["Bob"]
+
+    pl_job = {"id": "pl", "tenant_id": "t1", "report_type": "profit_loss", "format": "csv", "params": {"branch_id": "b1"}}
+    await _write_report_file(mongo_db, pl_job)
+    with open(tmp_path / "t1" / "pl.csv", newline="") as f:
+        totals = {row["metric"]: float(row["value"]) for row in csv.DictReader(f)}
+    assert totals["revenue"] == 100.0
+    assert totals["expenses"] == 0
+
+
+@pytest.mark.asyncio
+async def test_expire_report_files_deletes_files_past_their_expiry(mongo_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_jobs, "REPORT_EXPORT_DIR", tmp_path)
+    jobs = [
+        {"id": "old", "tenant_id": "t1", "format": "csv", "status": ReportJobStatus.COMPLETED.value, "expires_at": _iso(-10)},
+        {"id": "fresh", "tenant_id": "t1", "format": "csv", "status": ReportJobStatus.COMPLETED.value, "expires_at": _iso(3600)},
+        {"id": "legacy", "tenant_id": "t1", "format": "csv", "status": ReportJobStatus.COMPLETED.value, "finished_at": _iso(-7 * 86400)},
+        {"id": "partial", "tenant_id": "t1", "format": "csv", "status": ReportJobStatus.FAILED.value, "expires_at": _iso(-10)},
+    ]
+    await mongo_db.report_jobs.insert_many([dict(job) for job in jobs])
+    for job in jobs:
+        path = job_file_path(job["tenant_id"], job["id"], job["format"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("metric,value\n")
+
+    assert await expire_report_files(mongo_db) == 3
+    assert await expire_report_files(mongo_db) == 0
+
+    assert [p.stem for p in (tmp_path / "t1").iterdir()] == ["fresh"]
+    statuses = {job["id"]: job["status"] async for job in mongo_db.report_jobs.find({}, {"_id": 0})}
+    assert statuses == {
+        "old": ReportJobStatus.EXPIRED.value,
+        "fresh": ReportJobStatus.COMPLETED.value,
+        "legacy": ReportJobStatus.EXPIRED.value,
+        "partial": ReportJobStatus.FAILED.value,
+    }
@@ -0,0 +1,131 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from report_service import (
+    build_created_at_filter, get_branch_sales_totals, get_top_products_report, refresh_sales_daily_rollups
+)
+
+TENANT = "tenant-1"
+
+
+@pytest_asyncio.fixture
+async def sales(mongo_db):
+    await mongo_db.products.insert_many([
+        {"id": "p1", "tenant_id": TENANT, "name": "Cable", "sku": "C-1", "category": "Cables", "unit_cost": 2},
+        {"id": "p2", "tenant_id": TENANT, "name": "Router", "sku": "R-1", "category": "Network", "unit_cost": 9},
+        # Same product id in another tenant must not be joined
+        {"id": "p1", "tenant_id": "tenant-2", "name": "Other", "sku": "O-1", "category": "Other", "unit_cost": 100},
+    ])
+    await mongo_db.sales.insert_many([
+        {"id": "s0", "tenant_id": TENANT, "created_at": "2026-02-28T23:59:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 50, "price": 5}]},
+        {"id": "s1", "tenant_id": TENANT, "created_at": "2026-03-01T00:00:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 3, "price": 5}, {"product_id": "p2", "quantity": 3, "price": 10, "unit_cost": 9}]},
+        {"id": "s2", "tenant_id": TENANT, "created_at": "2026-03-02T18:30:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 1, "price": 5, "unit_cost": 4}]},
+        {"id": "s3", "tenant_id": TENANT, "created_at": "2026-03-03T00:00:00+00:00",
+         "items": [{"product_id": "p2", "quantity": 50, "price": 10}]},
+        {"id": "s4", "tenant_id": "tenant-2", "created_at": "2026-03-01T12:00:00+00:00",
+         "items": [{"product_id": "p1", "quantity": 7, "price": 5}]},
+    ])
+    return mongo_db
+
+
+async def _top_products(target_db, **kwargs):
+    sales_query = {"tenant_id": TENANT, "created_at": build_created_at_filter("2026-03-01", "2026-03-02")}
+    return await get_top_products_report(target_db=target_db, sales_query=sales_query, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_groups_line_items_by_product_within_the_date_range(sales):
+    rows = {row["product_id"]: row for row in await _top_products(sales)}
+
+    assert set(rows) == {"p1", "p2"}
+    # Lines without a unit cost fall back to the product's cost
+    assert (rows["p1"]["quantity"], rows["p1"]["revenue"], rows["p1"]["cost"], rows["p1"]["margin"]) == (4, 20, 10, 10)
+    assert (rows["p2"]["quantity"], rows["p2"]["revenue"], rows["p2"]["cost"], rows["p2"]["margin"]) == (3, 30, 27, 3)
+    assert rows["p1"]["product_name"] == "Cable"
+    assert rows["p1"]["margin_percent"] == 50
+
+
+@pytest.mark.asyncio
+async def test_sort_orders(sales):
+    assert [row["product_id"] for row in await _top_products(sales, sort_by="revenue")] == ["p2", "p1"]
+    assert [row["product_id"] for row in await _top_products(sales, sort_by="qty")] == ["p1", "p2"]
+    assert [row["product_id"] for row in await _top_products(sales, sort_by="margin")] == ["p1", "p2"]
+
+
+@pytest.mark.asyncio
+async def test_margin_sort_is_applied_before_the_limit(sales):
+    rows = await _top_products(sales, sort_by="margin", limit=1)
+
+    assert [row["product_id"] for row in rows] == ["p1"]
+
+
+@pytest.mark.asyncio
+async def test_category_restricts_products(sales):
+    rows = await _top_products(sales, category="Cables")
+
+    assert [row["product_id"] for row in rows] == ["p1"]
+    assert await _top_products(sales, category="Missing") == []
+
+
+def _days_ago(days: int) -> datetime:
+    return datetime.now(timezone.utc).replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=days)
+
+
+def _day(days: int) -> str:
+    return _days_ago(days).strftime("%Y-%m-%d")
+
+
+async def _rollups(target_db):
+    return {
+        (row["branch_id"], row["day"]): row
+        async for row in target_db.sales_daily_rollups.find({"tenant_id": TENANT}, {"_id": 0})
+    }
+
+
+@pytest.mark.asyncio
+async def test_refresh_rolls_up_closed_days_by_branch(mongo_db):
+    await mongo_db.sales.insert_many([
+        {"id": "s1", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(2).isoformat(), "total": 10, "items": [{"quantity": 2}]},
+        # created_at stored as a BSON date is rolled up too
+        {"id": "s2", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(2), "total": 5, "items": [{"quantity": 1}]},
+        {"id": "s3", "tenant_id": TENANT, "created_at": _days_ago(1).isoformat(), "total": 7, "amount_paid": 3, "items": []},
+        {"id": "today", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(0).isoformat(), "total": 100, "items": []},
+    ])
+
+    assert await refresh_sales_daily_rollups(mongo_db, TENANT) == _day(1)
+
+    rollups = await _rollups(mongo_db)
+    assert set(rollups) == {("b1", _day(2)), ("unassigned", _day(1))}
+    assert (rollups[("b1", _day(2))]["total_sales"], rollups[("b1", _day(2))]["sales_count"]) == (15, 2)
+    assert rollups[("b1", _day(2))]["items_sold"] == 3
+    assert rollups[("unassigned", _day(1))]["payments_received"] == 3
+
+    # Today is still open and comes from the sales themselves
+    totals = await get_branch_sales_totals(target_db=mongo_db, tenant_id=TENANT)
+    assert totals["b1"]["total_sales"] == 115
+    assert totals["unassigned"]["total_sales"] == 7
+
+
+@pytest.mark.asyncio
+async def test_refresh_only_aggregates_days_after_the_watermark(mongo_db):
+    await mongo_db.report_rollup_state.insert_one({"tenant_id": TENANT, "name": "sales_daily", "through_day": _day(3)})
+    await mongo_db.sales.insert_many([
+        {"id": "new", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(2).isoformat(), "total": 10, "items": []},
+        # Backdated to a day the watermark has already closed: never rolled up
+        {"id": "backdated", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(4).isoformat(), "total": 99, "items": []},
+    ])
+
+    assert await refresh_sales_daily_rollups(mongo_db, TENANT) == _day(1)
+    assert set(await _rollups(mongo_db)) == {("b1", _day(2))}
+
+    # A second refresh on the same day does not aggregate again
+    await mongo_db.sales.insert_one(
+        {"id": "late", "tenant_id": TENANT, "branch_id": "b1", "created_at": _days_ago(2).isoformat(), "total": 1, "items": []}
+    )
+    assert await refresh_sales_daily_rollups(mongo_db, TENANT) == _day(1)
+    assert (await _rollups(mongo_db))[("b1", _day(2))]["total_sales"] == 10
@@ -0,0 +1,47 @@
+import pytest
+
+from sales_export import write_sale_lines_parquet
+
+TENANT = "tenant-1"
+
+
+@pytest.mark.asyncio
+async def test_parquet_round_trips_schema_and_row_count(mongo_db, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from sales_export import sale_line_schema
+
+    await mongo_db.products.insert_one({"id": "p1", "tenant_id": TENANT, "name": "Cable", "sku": "C-1", "category": "Cables"})
+    await mongo_db.sales.insert_many([
+        {
+            "id": "s1", "tenant_id": TENANT, "branch_id": "b1", "created_at": "2026-03-01T10:00:00+00:00",
+            "items": [{"product_id": "p1", "quantity": 2, "price": 5.0}, {"product_id": "p1", "quantity": 1, "price": 5.0}],
+            "total": 15.0
+        },
+        {
+            "id": "s2", "tenant_id": TENANT, "branch_id": "b2", "created_at": "2026-03-02T10:00:00+00:00",
+            "items": [{"product_id": "p1", "quantity": 4, "price": 5.0}],
+            "total": 20.0
+        },
+    ])
+    path = tmp_path / "sale_lines.parquet"
+
+    assert await write_sale_lines_parquet(mongo_db, TENANT, path) == 3
+
+    table = pq.read_table(path)
+    assert table.schema.equals(sale_line_schema())
+    assert table.num_rows == 3
+    assert table.column("product_sku").to_pylist() == ["C-1", "C-1", "C-1"]
+    assert table.column("line_total").to_pylist() == [10.0, 5.0, 20.0]
+
+
+@pytest.mark.asyncio
+async def test_parquet_export_of_an_empty_branch_is_still_readable(mongo_db, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from sales_export import sale_line_schema
+
+    path = tmp_path / "sale_lines.parquet"
+
+    assert await write_sale_lines_parquet(mongo_db, TENANT, path, branch_id="none") == 0
+    table = pq.read_table(path)
+    assert table.num_rows == 0
+    assert table.schema.equals(sale_line_schema())
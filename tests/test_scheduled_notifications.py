@@ -0,0 +1,55 @@
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import pytest_asyncio
+
+from notification_counters import ALL_SCOPE
+from scheduled_notifications import UNPAID_INVOICE, ensure_scheduled_notification_indexes, notify_daily_due_reminders
+
+TENANT = "tenant-1"
+
+
+@pytest_asyncio.fixture
+async def dues(mongo_db):
+    await ensure_scheduled_notification_indexes(mongo_db)
+    await mongo_db.customer_dues.insert_many([
+        {"id": "d1", "tenant_id": TENANT, "sale_id": "s1", "customer_name": "Ann", "due_amount": 10, "sale_number": "SALE-1"},
+        {"id": "d2", "tenant_id": TENANT, "sale_id": "s2", "customer_name": "Bob", "due_amount": 25, "sale_number": "SALE-2"},
+        {"id": "paid", "tenant_id": TENANT, "sale_id": "s3", "customer_name": "Cy", "due_amount": 0, "sale_number": "SALE-3"},
+    ])
+    return mongo_db
+
+
+async def _reminders(target_db):
+    return sorted(await target_db.notifications.distinct("reference_id", {"tenant_id": TENANT, "type": UNPAID_INVOICE}))
+
+
+@pytest.mark.asyncio
+async def test_one_reminder_per_open_due_per_day(dues):
+    assert await notify_daily_due_reminders(dues, TENANT) == {"scanned": 2, "created": 2}
+    assert await notify_daily_due_reminders(dues, TENANT) == {"scanned": 2, "created": 0}
+
+    assert await _reminders(dues) == ["d1", "d2"]
+    assert await dues.notifications.count_documents({"tenant_id": TENANT}) == 2
+    counter = await dues.notification_counters.find_one({"tenant_id": TENANT, "scope": ALL_SCOPE})
+    assert counter["unread"] == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_runs_are_deduplicated_by_the_daily_key(dues):
+    results = await asyncio.gather(*(notify_daily_due_reminders(dues, TENANT) for _ in range(3)))
+
+    assert sum(result["created"] for result in results) == 2
+    assert await dues.notifications.count_documents({"tenant_id": TENANT}) == 2
+    counter = await dues.notification_counters.find_one({"tenant_id": TENANT, "scope": ALL_SCOPE})
+    assert counter["unread"] == 2
+
+
+@pytest.mark.asyncio
+async def test_reminders_repeat_on_the_next_day(dues):
+    await notify_daily_due_reminders(dues, TENANT)
+
+    tomorrow = datetime.now(timezone.utc) + timedelta(days=1)
+    assert (await notify_daily_due_reminders(dues, TENANT, now=tomorrow))["created"] == 2
+    assert await dues.notifications.count_documents({"tenant_id": TENANT}) == 4
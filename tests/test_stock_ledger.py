@@ -0,0 +1,99 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+from stock_ledger import (
+    SNAPSHOT_EVERY_MOVEMENTS, StockMovementReason, apply_stock_movement, get_stock_levels_at,
+    maybe_take_snapshot, record_stock_movements
+)
+
+TENANT = "tenant-1"
+BRANCH = "branch-1"
+
+
+def _iso(delta_seconds: float = 0) -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=delta_seconds)).isoformat()
+
+
+@pytest.mark.asyncio
+async def test_first_recorded_movement_takes_opening_snapshot(mongo_db):
+    # create_product style: stock is written first, then the movement is recorded
+    await mongo_db.products.insert_one({"id": "p1", "tenant_id": TENANT, "stock": 5})
+    await record_stock_movements(mongo_db, [{
+        "tenant_id": TENANT, "product_id": "p1", "branch_id": None,
+        "delta": 5, "reason": StockMovementReason.OPENING
+    }])
+
+    snapshots = await mongo_db.stock_snapshots.find({"tenant_id": TENANT}, {"_id": 0}).to_list(None)
+    assert len(snapshots) == 1
+    assert snapshots[0]["reason"] == StockMovementReason.OPENING.value
+    assert snapshots[0]["levels"] == {"p1": 5}
+
+
+@pytest.mark.asyncio
+async def test_levels_at_walk_the_ledger_from_the_opening_snapshot(mongo_db):
+    await mongo_db.product_branches.insert_one(
+        {"product_id": "p1", "branch_id": BRANCH, "tenant_id": TENANT, "stock_quantity": 10}
+    )
+    before_sale = _iso(-1)
+
+    await apply_stock_movement(
+        mongo_db, tenant_id=TENANT, product_id="p1", branch_id=BRANCH,
+        delta=-3, reason=StockMovementReason.SALE
+    )
+    after_first = _iso()
+    await apply_stock_movement(
+        mongo_db, tenant_id=TENANT, product_id="p1", branch_id=BRANCH,
+        delta=-2, reason=StockMovementReason.SALE
+    )
+
+    assert await mongo_db.stock_snapshots.count_documents({"branch_id": BRANCH}) == 1
+    assert await get_stock_levels_at(mongo_db, TENANT, BRANCH, before_sale) == {"p1": 10}
+    assert await get_stock_levels_at(mongo_db, TENANT, BRANCH, after_first) == {"p1": 7}
+    assert await get_stock_levels_at(mongo_db, TENANT, BRANCH, _iso(1), product_id="p1") == {"p1": 5}
+
+
+@pytest.mark.asyncio
+async def test_periodic_snapshot_once_threshold_is_reached(mongo_db):
+    await mongo_db.products.insert_one({"id": "p1", "tenant_id": TENANT, "stock": 0})
+    await record_stock_movements(mongo_db, [
+        {"tenant_id": TENANT, "product_id": "p1", "branch_id": None, "delta": 1, "reason": StockMovementReason.PURCHASE}
+    ])
+    # Periodic snapshots are dated back by the lag, so the opening one must be older
+    await mongo_db.stock_snapshots.update_many({"tenant_id": TENANT}, {"$set": {"taken_at": _iso(-3600)}})
+    await record_stock_movements(mongo_db, [
+        {"tenant_id": TENANT, "product_id": "p1", "branch_id": None, "delta": 1, "reason": StockMovementReason.PURCHASE}
+        for _ in range(SNAPSHOT_EVERY_MOVEMENTS)
+    ])
+
+    reasons = await mongo_db.stock_snapshots.distinct("reason", {"tenant_id": TENANT})
+    assert sorted(reasons) == ["opening", "periodic"]
+    state = await mongo_db.stock_ledger_state.find_one({"tenant_id": TENANT, "branch_id": None})
+    assert state["movements_since_snapshot"] == 0
+
+
+@pytest.mark.asyncio
+async def test_snapshot_keeps_movement_stamped_before_it_but_inserted_after(mongo_db):
+    await mongo_db.stock_snapshots.insert_one({
+        "id": "s0", "tenant_id": TENANT, "branch_id": None,
+        "taken_at": _iso(-3600), "reason": "opening", "levels": {"p1": 10}
+    })
+    await mongo_db.stock_ledger_state.insert_one(
+        {"tenant_id": TENANT, "branch_id": None, "movements_since_snapshot": 0}
+    )
+    await record_stock_movements(mongo_db, [{
+        "tenant_id": TENANT, "product_id": "p1", "branch_id": None,
+        "delta": -1, "reason": StockMovementReason.SALE, "created_at": _iso(-1800)
+    }])
+
+    # A writer stamps its movement, the snapshot runs, then the movement is inserted
+    stamped_at = _iso()
+    snapshot = await maybe_take_snapshot(mongo_db, TENANT, None, force=True)
+    await record_stock_movements(mongo_db, [{
+        "tenant_id": TENANT, "product_id": "p1", "branch_id": None,
+        "delta": -2, "reason": StockMovementReason.SALE, "created_at": stamped_at
+    }])
+
+    assert snapshot["levels"] == {"p1": 9}
+    assert snapshot["taken_at"] < stamped_at
+    assert await get_stock_levels_at(mongo_db, TENANT, None, _iso(1)) == {"p1": 7}
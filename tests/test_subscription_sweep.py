@@ -0,0 +1,57 @@
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import subscription_state_manager
+from subscription_state_manager import SubscriptionStateManager
+
+
+class _ClientFor:
+    """Stands in for AsyncIOMotorClient so the sweep runs against the test database."""
+
+    def __init__(self, database):
+        self._database = database
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getitem__(self, name):
+        return self._database
+
+    def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_sweep_writes_one_event_per_transition(mongo_db, monkeypatch):
+    monkeypatch.setattr(subscription_state_manager, "_sweep_indexes_ensured", False)
+    monkeypatch.setattr(subscription_state_manager, "AsyncIOMotorClient", _ClientFor(mongo_db))
+    past = datetime.now(timezone.utc) - timedelta(days=1)
+    future = datetime.now(timezone.utc) + timedelta(days=10)
+    await mongo_db.subscriptions.insert_many([
+        {"subscription_id": "trial", "tenant_id": "t1", "status": "trial", "trial_ends_at": past},
+        {"subscription_id": "grace", "tenant_id": "t2", "status": "grace", "grace_expires_at": past},
+        {"subscription_id": "active", "tenant_id": "t3", "status": "active", "expires_on": past, "grace_period_days": 7},
+        {"subscription_id": "current", "tenant_id": "t4", "status": "active", "expires_on": future},
+    ])
+
+    actions = await SubscriptionStateManager.check_expired_subscriptions()
+
+    assert actions["trial_expired"] == 1
+    assert actions["suspended"] == 1
+    assert actions["moved_to_grace"] == 1
+
+    events = await mongo_db.billing_events.find({}, {"_id": 0}).to_list(None)
+    transitions = sorted((e["subscription_id"], e["old_status"], e["new_status"]) for e in events)
+    assert transitions == [
+        ("active", "active", "grace"),
+        ("grace", "grace", "suspended"),
+        ("trial", "trial", "suspended"),
+    ]
+    assert len({e["event_id"] for e in events}) == 3
+    assert len({e["metadata"]["sweep_id"] for e in events}) == 1
+
+    moved = await mongo_db.subscriptions.find_one({"subscription_id": "active"})
+    grace_days = (moved["grace_expires_at"].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).days
+    assert grace_days in (6, 7)
+    assert (await mongo_db.subscriptions.find_one({"subscription_id": "current"}))["status"] == "active"